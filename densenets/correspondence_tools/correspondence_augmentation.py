@@ -9,6 +9,11 @@ for image data.
 - For operations on a list of pixel indices, we need a matching
 implementation.
 
+The images can be PIL images, numpy arrays or torch tensors of shape [H, W]
+or [H, W, C], and are returned as the same type. On numpy arrays the flips
+are views and nothing is copied until the image is converted to a tensor,
+see densenets.transforms.ToNormalizedTensor.
+
 """
 
 import random
@@ -25,7 +30,7 @@ def random_image_and_indices_mutation(images, uv_pixel_positions):
 
     :param images: a list of images (for example the rgb, depth, and mask) for which the
                         **same** mutation will be applied
-    :type  images: list of PIL.image.image
+    :type  images: list of PIL.image.image, numpy.ndarray or torch.Tensor
 
     :param uv_pixel_positions: pixel locations (u, v) in the image.
         See doc/coordinate_conventions.md for definition of (u, v)
@@ -40,7 +45,7 @@ def random_image_and_indices_mutation(images, uv_pixel_positions):
               and return the mutated_uv_pixel_positions with same type
 
     :return mutated_image_list, mutated_uv_pixel_positions
-        :rtype: list of PIL.image.image, tuple of torch Tensors
+        :rtype: list of the type of images, tuple of torch Tensors
 
     """
 
@@ -62,6 +67,35 @@ def random_image_and_indices_mutation(images, uv_pixel_positions):
         return mutated_images, mutated_uv_pixel_positions
 
 
+def random_image_indices_and_mask_index_mutation(
+    images, uv_pixel_positions, mask_index
+):
+    """
+    Same as random_image_and_indices_mutation(), additionally applying the
+    mutation to the MaskIndex of the images so that it doesn't have to be
+    recomputed from the mutated mask.
+
+    :param mask_index: index of the mask of images
+    :type  mask_index: MaskIndex
+
+    :return mutated_image_list, mutated_uv_pixel_positions, mutated_mask_index
+        :rtype: list of the type of images, tuple of torch Tensors, MaskIndex
+    """
+    if random.random() < 0.5:
+        return images, uv_pixel_positions, mask_index
+
+    else:
+        mutated_images, mutated_uv_pixel_positions = flip_vertical(
+            images, uv_pixel_positions
+        )
+        mutated_images, mutated_uv_pixel_positions = flip_horizontal(
+            mutated_images, mutated_uv_pixel_positions
+        )
+
+        # flip vertical followed by flip horizontal
+        return mutated_images, mutated_uv_pixel_positions, mask_index.rotate_180()
+
+
 def flip_vertical(images, uv_pixel_positions):
     """
     Fip the images and the pixel positions vertically (flip up/down)
@@ -69,9 +103,10 @@ def flip_vertical(images, uv_pixel_positions):
     See random_image_and_indices_mutation() for documentation of args and return types.
 
     """
-    mutated_images = [ImageOps.flip(image) for image in images]
+    mutated_images = [_flip_image(image, 0) for image in images]
     v_pixel_positions = uv_pixel_positions[1]
-    mutated_v_pixel_positions = (images[0].height - 1) - v_pixel_positions
+    image_height = _image_height_and_width(images[0])[0]
+    mutated_v_pixel_positions = (image_height - 1) - v_pixel_positions
     mutated_uv_pixel_positions = (uv_pixel_positions[0], mutated_v_pixel_positions)
     return mutated_images, mutated_uv_pixel_positions
 
@@ -84,55 +119,83 @@ def flip_horizontal(images, uv_pixel_positions):
 
     """
 
-    mutated_images = [ImageOps.mirror(image) for image in images]
+    mutated_images = [_flip_image(image, 1) for image in images]
     u_pixel_positions = uv_pixel_positions[0]
-    mutated_u_pixel_positions = (images[0].width - 1) - u_pixel_positions
+    image_width = _image_height_and_width(images[0])[1]
+    mutated_u_pixel_positions = (image_width - 1) - u_pixel_positions
     mutated_uv_pixel_positions = (mutated_u_pixel_positions, uv_pixel_positions[1])
     return mutated_images, mutated_uv_pixel_positions
 
 
-def random_domain_randomize_background(image_rgb, image_mask):
+def _flip_image(image, axis):
+    """
+    Flips an image up/down (axis 0) or left/right (axis 1). Numpy arrays are
+    flipped as views, torch tensors are copied since torch has no negative
+    strides.
+    :rtype: same as image
+    """
+    if isinstance(image, Image.Image):
+        if axis == 0:
+            return ImageOps.flip(image)
+        return ImageOps.mirror(image)
+    if torch.is_tensor(image):
+        return torch.flip(image, [axis])
+    return np.flip(image, axis)
+
+
+def _image_height_and_width(image):
+    if isinstance(image, Image.Image):
+        return image.height, image.width
+    return image.shape[0], image.shape[1]
+
+
+def random_domain_randomize_background(image_rgb, image_mask, background_bank=None):
     """
     Ranomly call domain_randomize_background
     """
     if random.random() < 0.5:
         return image_rgb
     else:
-        return domain_randomize_background(image_rgb, image_mask)
+        return domain_randomize_background(image_rgb, image_mask, background_bank)
 
 
-def domain_randomize_background(image_rgb, image_mask):
+def domain_randomize_background(image_rgb, image_mask, background_bank=None):
     """
     This function applies domain randomization to the non-masked part of the image.
 
     :param image_rgb: rgb image for which the non-masked parts of the image will
                         be domain randomized
-    :type  image_rgb: PIL.image.image
+    :type  image_rgb: PIL.image.image or numpy.ndarray
 
     :param image_mask: mask of part of image to be left alone, all else will be domain randomized
-    :type image_mask: PIL.image.image
+    :type image_mask: PIL.image.image or numpy.ndarray
 
-    :return domain_randomized_image_rgb:
-    :rtype: PIL.image.image
+    :param background_bank: if given the background is sampled from it, otherwise
+                        a new one is made with get_random_image
+    :type background_bank: densenets.dataset.background_bank.BackgroundBank
+
+    :return domain_randomized_image_rgb: a new image, image_rgb is not modified
+        and may be read-only
+    :rtype: same as image_rgb
     """
-    # First, mask the rgb image
     image_rgb_numpy = np.asarray(image_rgb)
     image_mask_numpy = np.asarray(image_mask)
-    three_channel_mask = np.zeros_like(image_rgb_numpy)
-    three_channel_mask[:, :, 0] = three_channel_mask[:, :, 1] = three_channel_mask[
-        :, :, 2
-    ] = image_mask
-    image_rgb_numpy = image_rgb_numpy * three_channel_mask
 
-    # Next, domain randomize all non-masked parts of image
-    three_channel_mask_complement = (
-        np.ones_like(three_channel_mask) - three_channel_mask
+    # keep the masked part of the image, domain randomize the rest. A
+    # contiguous uint8 mask of all three channels makes this two plain
+    # multiply-adds, np.where with a broadcast bool mask is several times slower
+    three_channel_mask = np.repeat(
+        (image_mask_numpy != 0).view(np.uint8)[:, :, None], 3, axis=2
     )
-    random_rgb_image = get_random_image(image_rgb_numpy.shape)
-    random_rgb_background = three_channel_mask_complement * random_rgb_image
-
-    domain_randomized_image_rgb = image_rgb_numpy + random_rgb_background
-    return Image.fromarray(domain_randomized_image_rgb)
+    if background_bank is None:
+        random_rgb_image = get_random_image(image_rgb_numpy.shape)
+    else:
+        random_rgb_image = background_bank.sample(image_rgb_numpy.shape)
+    domain_randomized_image_rgb = image_rgb_numpy * three_channel_mask
+    domain_randomized_image_rgb += (1 - three_channel_mask) * random_rgb_image
+    if isinstance(image_rgb, Image.Image):
+        return Image.fromarray(domain_randomized_image_rgb)
+    return domain_randomized_image_rgb
 
 
 def get_random_image(shape):
@@ -250,9 +313,9 @@ def merge_images_with_occlusions(
     - both of these sets of matches must be pruned for any occlusions that occur.
 
     :param image_a, image_b: the two images to merge
-    :type image_a, image_b: each a PIL.image.image
+    :type image_a, image_b: each a PIL.image.image or numpy.ndarray
     :param mask_a, mask_b: the masks for these images
-    :type mask_a, mask_b: each a PIL.image.image
+    :type mask_a, mask_b: each a PIL.image.image or numpy.ndarray
     :param matches_a, matches_b:
     :type matches_a, mathces_b: each a tuple of torch Tensors, each of length n, i.e:
 
@@ -263,7 +326,7 @@ def merge_images_with_occlusions(
         Note: only support torch.LongTensors
 
     :return: merged image, merged_mask, pruned_matches_a, pruned_associated_matches_a, pruned_matches_b, pruned_associated_matches_b
-    :rtype: PIL.image.image, numpy array, rest are same types as matches_a and matches_b
+    :rtype: type of image_a, numpy array, rest are same types as matches_a and matches_b
 
     """
 
@@ -333,8 +396,10 @@ def merge_images_with_occlusions(
     merged_masked_numpy = merged_masked_numpy.clip(
         0, 1
     )  # in future, could preserve identities of masks
+    if isinstance(image_a, Image.Image):
+        merged_image_numpy = Image.fromarray(merged_image_numpy)
     return (
-        Image.fromarray(merged_image_numpy),
+        merged_image_numpy,
         merged_masked_numpy,
         matches_a,
         associated_matches_a,
@@ -343,6 +408,106 @@ def merge_images_with_occlusions(
     )
 
 
+def composite_images_with_occlusions(images, masks):
+    """
+    Layers any number of images in a random order, each one pasted over the
+    ones below it where its mask is set. The bottom image is kept whole, its
+    background included. This generalizes merge_images_with_occlusions to more
+    than two images.
+
+    The owner map records which image each pixel of the composite comes
+    from. The composite is gathered from the stacked images through it in a
+    single pass, so each additional image costs one boolean assignment of its
+    mask and a copy into the stack.
+
+    :param images: the images to layer, all of the same size
+    :type images: list of numpy.ndarray [H, W, 3] uint8 or PIL.image.image
+    :param masks: the mask of each image
+    :type masks: list of numpy.ndarray [H, W] or PIL.image.image
+
+    :return: composite, owner, merged_mask. owner holds the index into images
+             of the image seen at each pixel, merged_mask is the union of the masks
+    :rtype: numpy.ndarray [H, W, 3] uint8, numpy.ndarray [H, W] int64,
+            numpy.ndarray [H, W] uint8
+    """
+    images = [np.asarray(image) for image in images]
+    masks = [np.asarray(mask) for mask in masks]
+    image_height, image_width = images[0].shape[0:2]
+    for image, mask in zip(images, masks):
+        if (image.shape[0:2] != (image_height, image_width)) or (
+            mask.shape != (image_height, image_width)
+        ):
+            raise ValueError(
+                "all images and masks have to be %dx%d to be composited"
+                % (image_width, image_height)
+            )
+
+    order = list(range(len(images)))
+    random.shuffle(order)
+    owner = np.full((image_height, image_width), order[0], dtype=np.int64)
+    for index in order[1:]:
+        owner[masks[index] != 0] = index
+
+    num_pixels = image_height * image_width
+    composite = np.take(
+        np.stack(images).reshape(-1, 3),
+        owner.ravel() * num_pixels + np.arange(num_pixels),
+        axis=0,
+    ).reshape(image_height, image_width, 3)
+
+    # every pixel not owned by the bottom image is on the mask of its owner
+    merged_mask = (owner != order[0]) | (masks[order[0]] != 0)
+    return composite, owner, merged_mask.astype(np.uint8)
+
+
+def prune_occluded_matches(owners, matches):
+    """
+    Drops the matches of each image that are occluded in any of the
+    composites, i.e. where the owner map doesn't hold the index of the image
+    the match comes from. The matches of all images are checked at once, with
+    one gather per owner map.
+
+    :param owners: the owner maps of the composites, see
+                   composite_images_with_occlusions
+    :type owners: list of numpy.ndarray [H, W]
+    :param matches: for each image, in the order of the images of the
+                    composites, one (u_pixel_positions, v_pixel_positions) per
+                    owner map, or None if the image has no matches. Note: only
+                    support torch.LongTensors
+    :type matches: list of tuples
+
+    :return: kept_matches, num_kept. kept_matches holds one (u, v) per owner
+             map, with the remaining matches of all the images concatenated in
+             order, or is None if none remain. num_kept is the number of
+             matches kept of each image.
+    :rtype: tuple of tuples of torch.LongTensor, list of ints
+    """
+    num_images = len(matches)
+    present = [(index, x) for index, x in enumerate(matches) if x is not None]
+    if len(present) == 0:
+        return None, [0] * num_images
+
+    owner_ids = torch.cat(
+        [
+            torch.full((len(x[0][0]),), index, dtype=torch.long)
+            for index, x in present
+        ]
+    )
+    keep = torch.ones(len(owner_ids), dtype=torch.bool)
+    concatenated = []
+    for i, owner in enumerate(owners):
+        u = torch.cat([x[i][0] for _, x in present])
+        v = torch.cat([x[i][1] for _, x in present])
+        keep &= torch.from_numpy(owner)[v, u] == owner_ids
+        concatenated.append((u, v))
+
+    num_kept = torch.bincount(owner_ids[keep], minlength=num_images).tolist()
+    if not keep.any():
+        return None, num_kept
+    kept_matches = tuple((u[keep], v[keep]) for u, v in concatenated)
+    return kept_matches, num_kept
+
+
 def prune_matches_if_occluded(foreground_mask_numpy, background_matches_pair):
     """
     Checks if any of the matches have been occluded.
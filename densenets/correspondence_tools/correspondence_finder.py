@@ -5,35 +5,73 @@ import warnings
 import numpy as numpy
 import numpy as np
 import torch
+from densenets.correspondence_tools.non_match_sampler import NonMatchSampler
+from densenets.correspondence_tools.projection_context import (
+    get_default_K_matrix,
+    get_projection_context,
+)
 from densenets.dense_correspondence_manipulation.utils import constants, utils
-from numpy.linalg import inv
 
 # turns out to be faster to do this match generation on the CPU
 # for the general size of params we expect
 # also this will help by not taking up GPU memory,
 # allowing batch sizes to stay large
-dtype_float = torch.FloatTensor
-dtype_long = torch.LongTensor
+DEFAULT_DEVICE = torch.device('cpu')
+DEFAULT_DTYPE = torch.float32
 
+# occlusion margin, in meters
+OCCLUSION_MARGIN = 0.003
 
-def pytorch_rand_select_pixel(width, height, num_samples=1):
-    two_rand_numbers = torch.rand(2, num_samples)
+# OcclusionMode.BILINEAR widens the margin by the change in depth of the
+# surface of image b over this many pixels, up to MAX_OCCLUSION_MARGIN meters
+OCCLUSION_SLOPE_PIXELS = 1.0
+MAX_OCCLUSION_MARGIN = 0.02
+
+
+class OcclusionMode:
+    """
+    How the depth of image b is looked up to test whether a pixel of image a
+    projected into image b is occluded there
+    """
+
+    # depth of the pixel the projection falls in, fixed margin
+    NEAREST = "nearest"
+    # depth bilinearly interpolated at the sub-pixel projection, the margin
+    # grows with the slope of the surface, see OCCLUSION_SLOPE_PIXELS
+    BILINEAR = "bilinear"
+
+
+def resolve_device(device=None):
+    """
+    The functions of this module take the device to run on as an argument
+    rather than through module state, so they can be called from several
+    threads and for several devices at once.
+
+    :param device: a torch.device, a device string like 'cuda:0', the legacy
+        'CPU' and 'GPU' strings, or None for DEFAULT_DEVICE
+    :type device: torch.device or str
+    :return:
+    :rtype: torch.device
+    """
+    if device is None:
+        return DEFAULT_DEVICE
+    if isinstance(device, torch.device):
+        return device
+    if device == 'CPU':
+        return torch.device('cpu')
+    if device == 'GPU':
+        return torch.device('cuda')
+    return torch.device(device)
+
+
+def pytorch_rand_select_pixel(width, height, num_samples=1, device=None):
+    two_rand_numbers = torch.rand(2, num_samples, device=resolve_device(device))
     two_rand_numbers[0, :] = two_rand_numbers[0, :] * width
     two_rand_numbers[1, :] = two_rand_numbers[1, :] * height
-    two_rand_ints = torch.floor(two_rand_numbers).type(dtype_long)
+    two_rand_ints = torch.floor(two_rand_numbers).long()
     return (two_rand_ints[0], two_rand_ints[1])
 
 
-def get_default_K_matrix():
-    K = numpy.zeros((3, 3))
-    K[0, 0] = 533.6422696034836  # focal x
-    K[1, 1] = 534.7824445233571  # focal y
-    K[0, 2] = 319.4091030774892  # principal point x
-    K[1, 2] = 236.4374299691866  # principal point y
-    K[2, 2] = 1.0
-    return K
-
-
 def get_body_to_rdf():
     body_to_rdf = numpy.zeros((3, 3))
     body_to_rdf[0, 1] = -1.0
@@ -54,12 +92,26 @@ def invert_transform(transform4):
 
 
 def apply_transform_torch(vec3, transform4):
-    ones_row = torch.ones_like(vec3[0, :]).type(dtype_float).unsqueeze(0)
+    ones_row = torch.ones_like(vec3[0, :]).unsqueeze(0)
     vec4 = torch.cat((vec3, ones_row), 0)
     vec4 = transform4.mm(vec4)
     return vec4[0:3]
 
 
+def _to_torch(array, device, dtype=None):
+    """
+    :param array: numpy array, e.g. a depth image or a pose. It may be a
+        read-only view, e.g. of the frame bank or of a memory-mapped store
+    :type array: numpy.ndarray
+    :param dtype: defaults to the dtype of array
+    :type dtype: torch.dtype
+    :return: a copy of array on device, as dtype, it never shares memory with
+        array
+    :rtype: torch.Tensor
+    """
+    return torch.tensor(np.asarray(array), device=device, dtype=dtype)
+
+
 def random_sample_from_masked_image(img_mask, num_samples):
     """
     Samples num_samples (row, column) convention pixel locations from the masked image
@@ -85,13 +137,16 @@ def random_sample_from_masked_image(img_mask, num_samples):
     return sampled_idx_list
 
 
-def random_sample_from_masked_image_torch(img_mask, num_samples):
+def random_sample_from_masked_image_torch(img_mask, num_samples, device=None):
     """
 
     :param img_mask: Numpy array [H,W] or torch.Tensor with shape [H,W]
     :type img_mask:
     :param num_samples: an integer
     :type num_samples:
+    :param device: device of the returned pixels, see resolve_device(). Defaults
+        to the device of img_mask if it is a torch.Tensor
+    :type device: torch.device or str
     :return: tuple of torch.LongTensor in (u,v) format. Each torch.LongTensor has shape
     [num_samples]
     :rtype:
@@ -100,17 +155,21 @@ def random_sample_from_masked_image_torch(img_mask, num_samples):
     image_height, image_width = img_mask.shape
 
     if isinstance(img_mask, np.ndarray):
-        img_mask_torch = torch.from_numpy(img_mask).float()
+        img_mask_torch = _to_torch(img_mask, resolve_device(device))
+    elif device is not None:
+        img_mask_torch = img_mask.to(resolve_device(device))
     else:
         img_mask_torch = img_mask
 
     # This code would randomly subsample from the mask
-    mask = img_mask_torch.view(image_width * image_height, 1).squeeze(1)
+    mask = img_mask_torch.reshape(-1)
     mask_indices_flat = torch.nonzero(mask)
     if len(mask_indices_flat) == 0:
         return (None, None)
 
-    rand_numbers = torch.rand(num_samples) * len(mask_indices_flat)
+    rand_numbers = torch.rand(num_samples, device=mask.device) * len(
+        mask_indices_flat
+    )
     rand_indices = torch.floor(rand_numbers).long()
     uv_vec_flattened = torch.index_select(mask_indices_flat, 0, rand_indices).squeeze(1)
     uv_vec = utils.flattened_pixel_locations_to_u_v(uv_vec_flattened, image_width)
@@ -135,10 +194,7 @@ def pinhole_projection_image_to_world(uv, z, K):
 
     warnings.warn("Potentially incorrect implementation", category=DeprecationWarning)
 
-    u_v_1 = np.array([uv[0], uv[1], 1])
-    K_inv = inv(K)
-    pos = z * K_inv.dot(u_v_1)
-    return pos
+    return get_projection_context(K).image_to_camera(uv, z)
 
 
 def pinhole_projection_image_to_camera_coordinates(uv, z, K):
@@ -156,11 +212,7 @@ def pinhole_projection_image_to_camera_coordinates(uv, z, K):
     :rtype: numpy.array size (3,)
     """
 
-    u_v_1 = np.array([uv[0], uv[1], 1])
-    K_inv = inv(K)
-
-    pos = z * K_inv.dot(u_v_1)
-    return pos
+    return get_projection_context(K).image_to_camera(uv, z)
 
 
 def pinhole_projection_image_to_camera_coordinates_vectorized(uv, z, K):
@@ -188,7 +240,7 @@ def pinhole_projection_image_to_camera_coordinates_vectorized(uv, z, K):
     uv_homog[1, :] = uv[1]
     uv_homog[2, :] = np.ones(N)
 
-    K_inv = inv(K)
+    K_inv = get_projection_context(K).K_inv
     pos = z * K_inv.dot(uv_homog)  # 3 x N
 
     return np.transpose(pos)
@@ -211,10 +263,7 @@ def pinhole_projection_image_to_world_coordinates(uv, z, K, camera_to_world):
     :rtype: numpy.array size (3,)
     """
 
-    pos_in_camera_frame = pinhole_projection_image_to_camera_coordinates(uv, z, K)
-    pos_in_camera_frame_homog = np.append(pos_in_camera_frame, 1)
-    pos_in_world_homog = camera_to_world.dot(pos_in_camera_frame_homog)
-    return pos_in_world_homog[:3]
+    return get_projection_context(K).image_to_world(uv, z, camera_to_world)
 
 
 def pinhole_projection_world_to_image(world_pos, K, camera_to_world=None):
@@ -264,12 +313,20 @@ def where(cond, x_1, x_2):
     :return:
     :rtype:
     """
-    cond = cond.type(dtype_float)
+    cond = cond.to(x_1.dtype)
     return (cond * x_1) + ((1 - cond) * x_2)
 
 
 def create_non_correspondences(
-    uv_b_matches, img_b_shape, num_non_matches_per_match=100, img_b_mask=None
+    uv_b_matches,
+    img_b_shape,
+    num_non_matches_per_match=100,
+    img_b_mask=None,
+    img_b_mask_index=None,
+    img_b_mask_index_inverse=False,
+    device=None,
+    dtype=DEFAULT_DTYPE,
+    min_distance=1,
 ):
     """
     Takes in pixel matches (uv_b_matches) that correspond to matches in another image, and generates non-matches by just sampling in image space.
@@ -295,147 +352,142 @@ def create_non_correspondences(
         - masked image, we will select from the non-zero entries
         - shape is H x W
 
+    (optional)
+    :param img_b_mask_index: MaskIndex, precomputed index of the mask for image b.
+        Used instead of img_b_mask, the non-matches are sampled from it directly
+
+    (optional)
+    :param img_b_mask_index_inverse: bool, sample from the pixels outside of
+        img_b_mask_index instead
+
+    (optional)
+    :param device: torch.device the non-matches are created on, see
+        resolve_device(). Defaults to the device of uv_b_matches
+
+    (optional)
+    :param dtype: floating point dtype of the non-matches
+
+    (optional)
+    :param min_distance: int, every non-match is at least this many pixels
+        away from its match in u or in v, see NonMatchSampler
+
     :return: tuple of torch.FloatTensors, i.e. (torch.FloatTensor, torch.FloatTensor).
         - The first element of the tuple is all "u" pixel positions, and the right element of the tuple is all "v" positions
         - Each torch.FloatTensor is of shape torch.Shape([num_matches, non_matches_per_match])
         - This shape makes it so that each row of the non-matches corresponds to the row for the match in uv_a
     """
-    image_width = img_b_shape[1]
-    image_height = img_b_shape[0]
-
     if uv_b_matches is None:
         return None
 
-    num_matches = len(uv_b_matches[0])
-
-    def get_random_uv_b_non_matches():
-        return pytorch_rand_select_pixel(
-            width=image_width,
-            height=image_height,
-            num_samples=num_matches * num_non_matches_per_match,
-        )
-
-    if img_b_mask is not None:
-        img_b_mask_flat = img_b_mask.view(-1, 1).squeeze(1)
-        mask_b_indices_flat = torch.nonzero(img_b_mask_flat)
-        if len(mask_b_indices_flat) == 0:
-            print("warning, empty mask b")
-            uv_b_non_matches = get_random_uv_b_non_matches()
+    if img_b_mask_index is not None:
+        if img_b_mask_index_inverse:
+            pixels = img_b_mask_index.outside
         else:
-            num_samples = num_matches * num_non_matches_per_match
-            rand_numbers_b = torch.rand(num_samples) * len(mask_b_indices_flat)
-            rand_indices_b = torch.floor(rand_numbers_b).long()
-            randomized_mask_b_indices_flat = torch.index_select(
-                mask_b_indices_flat, 0, rand_indices_b
-            ).squeeze(1)
-            uv_b_non_matches = (
-                randomized_mask_b_indices_flat % image_width,
-                randomized_mask_b_indices_flat / image_width,
-            )
+            pixels = img_b_mask_index.inside
+    elif img_b_mask is not None:
+        if torch.is_tensor(img_b_mask):
+            img_b_mask = img_b_mask.cpu().numpy()
+        pixels = np.flatnonzero(img_b_mask)
     else:
-        uv_b_non_matches = get_random_uv_b_non_matches()
-
-    # for each in uv_a, we want non-matches
-    # first just randomly sample "non_matches"
-    # we will later move random samples that were too close to being matches
-    uv_b_non_matches = (
-        uv_b_non_matches[0].reshape(num_matches, num_non_matches_per_match),
-        uv_b_non_matches[1].reshape(num_matches, num_non_matches_per_match),
-    )
+        pixels = None
 
-    # uv_b_matches can now be used to make sure no "non_matches" are too close
-    # to preserve tensor size, rather than pruning, we can perturb these in pixel space
-    copied_uv_b_matches_0 = torch.t(
-        uv_b_matches[0].repeat(num_non_matches_per_match, 1)
+    sampler = _make_non_match_sampler(uv_b_matches, img_b_shape, min_distance)
+    return _sample_non_correspondences(
+        sampler, num_non_matches_per_match, pixels, device, dtype, uv_b_matches
     )
-    copied_uv_b_matches_1 = torch.t(
-        uv_b_matches[1].repeat(num_non_matches_per_match, 1)
-    )
-
-    diffs_0 = copied_uv_b_matches_0 - uv_b_non_matches[0].type(dtype_float)
-    diffs_1 = copied_uv_b_matches_1 - uv_b_non_matches[1].type(dtype_float)
 
-    diffs_0_flattened = diffs_0.reshape(-1, 1)
-    diffs_1_flattened = diffs_1.reshape(-1, 1)
 
-    diffs_0_flattened = torch.abs(diffs_0_flattened).squeeze(1)
-    diffs_1_flattened = torch.abs(diffs_1_flattened).squeeze(1)
-
-    need_to_be_perturbed = torch.zeros_like(diffs_0_flattened)
-    ones = torch.zeros_like(diffs_0_flattened)
-    num_pixels_too_close = 1.0
-    threshold = torch.ones_like(diffs_0_flattened) * num_pixels_too_close
-
-    # determine which pixels are too close to being matches
-    need_to_be_perturbed = where(
-        diffs_0_flattened < threshold, ones, need_to_be_perturbed
-    )
-    need_to_be_perturbed = where(
-        diffs_1_flattened < threshold, ones, need_to_be_perturbed
-    )
-
-    minimal_perturb = num_pixels_too_close / 2
-    minimal_perturb_vector = (torch.rand(len(need_to_be_perturbed)) * 2).floor() * (
-        minimal_perturb * 2
-    ) - minimal_perturb
-    std_dev = 10
-    random_vector = (
-        torch.randn(len(need_to_be_perturbed)) * std_dev + minimal_perturb_vector
-    )
-    perturb_vector = need_to_be_perturbed * random_vector
+def create_masked_and_background_non_correspondences(
+    uv_b_matches,
+    img_b_shape,
+    img_b_mask_index,
+    num_masked_non_matches_per_match,
+    num_background_non_matches_per_match,
+    background_outside_of_mask=True,
+    device=None,
+    dtype=DEFAULT_DTYPE,
+    min_distance=1,
+):
+    """
+    Same as calling create_non_correspondences() twice, once for the non-matches
+    inside of the mask of image b and once for the background non-matches, but
+    the geometry of the matches is only worked out once.
+
+    :param img_b_mask_index: MaskIndex of the mask of image b
+    :type img_b_mask_index: MaskIndex
+    :param background_outside_of_mask: draw the background non-matches from the
+        pixels outside of the mask, otherwise from the whole image
+    :type background_outside_of_mask: bool
+    :return: masked non-matches, background non-matches, each as returned by
+        create_non_correspondences()
+    :rtype: tuple, tuple
+    """
+    if uv_b_matches is None:
+        return None, None
 
-    uv_b_non_matches_0_flat = (
-        uv_b_non_matches[0].reshape(-1, 1).type(dtype_float).squeeze(1)
+    if background_outside_of_mask:
+        background_pixels = img_b_mask_index.outside
+    else:
+        background_pixels = None
+
+    sampler = _make_non_match_sampler(uv_b_matches, img_b_shape, min_distance)
+    masked_non_matches = _sample_non_correspondences(
+        sampler,
+        num_masked_non_matches_per_match,
+        img_b_mask_index.inside,
+        device,
+        dtype,
+        uv_b_matches,
     )
-    uv_b_non_matches_1_flat = (
-        uv_b_non_matches[1].reshape(-1, 1).type(dtype_float).squeeze(1)
+    background_non_matches = _sample_non_correspondences(
+        sampler,
+        num_background_non_matches_per_match,
+        background_pixels,
+        device,
+        dtype,
+        uv_b_matches,
     )
+    return masked_non_matches, background_non_matches
 
-    uv_b_non_matches_0_flat = uv_b_non_matches_0_flat + perturb_vector
-    uv_b_non_matches_1_flat = uv_b_non_matches_1_flat + perturb_vector
-
-    # now just need to wrap around any that went out of bounds
 
-    # handle wrapping in width
-    lower_bound = 0.0
-    upper_bound = image_width * 1.0 - 1
-    lower_bound_vec = torch.ones_like(uv_b_non_matches_0_flat) * lower_bound
-    upper_bound_vec = torch.ones_like(uv_b_non_matches_0_flat) * upper_bound
-
-    uv_b_non_matches_0_flat = where(
-        uv_b_non_matches_0_flat > upper_bound_vec,
-        uv_b_non_matches_0_flat - upper_bound_vec,
-        uv_b_non_matches_0_flat,
-    )
-
-    uv_b_non_matches_0_flat = where(
-        uv_b_non_matches_0_flat < lower_bound_vec,
-        uv_b_non_matches_0_flat + upper_bound_vec,
-        uv_b_non_matches_0_flat,
+def _make_non_match_sampler(uv_b_matches, img_b_shape, min_distance):
+    """
+    :return: sampler for the non-matches of the rounded down uv_b_matches
+    :rtype: NonMatchSampler
+    """
+    image_height, image_width = img_b_shape[0:2]
+    u_b = uv_b_matches[0].detach().cpu().numpy().astype(np.int64)
+    v_b = uv_b_matches[1].detach().cpu().numpy().astype(np.int64)
+    return NonMatchSampler(
+        v_b * image_width + u_b, image_height, image_width, min_distance
     )
 
-    # handle wrapping in height
-    lower_bound = 0.0
-    upper_bound = image_height * 1.0 - 1
-    lower_bound_vec = torch.ones_like(uv_b_non_matches_1_flat) * lower_bound
-    upper_bound_vec = torch.ones_like(uv_b_non_matches_1_flat) * upper_bound
 
-    uv_b_non_matches_1_flat = where(
-        uv_b_non_matches_1_flat > upper_bound_vec,
-        uv_b_non_matches_1_flat - upper_bound_vec,
-        uv_b_non_matches_1_flat,
-    )
+def _sample_non_correspondences(
+    sampler, num_non_matches_per_match, pixels, device, dtype, uv_b_matches
+):
+    """
+    Draws the non-matches from pixels, or from the whole image if pixels is
+    None or empty
+    :return: (u,v) tuple of [num_matches, num_non_matches_per_match] tensors
+    :rtype: tuple
+    """
+    if device is None:
+        device = uv_b_matches[0].device
+    else:
+        device = resolve_device(device)
 
-    uv_b_non_matches_1_flat = where(
-        uv_b_non_matches_1_flat < lower_bound_vec,
-        uv_b_non_matches_1_flat + upper_bound_vec,
-        uv_b_non_matches_1_flat,
-    )
+    flat_b = sampler.sample(num_non_matches_per_match, pixels=pixels)
+    if flat_b is None:
+        print("warning, empty mask b")
+        flat_b = sampler.sample(num_non_matches_per_match)
 
-    return (
-        uv_b_non_matches_0_flat.view(num_matches, num_non_matches_per_match),
-        uv_b_non_matches_1_flat.view(num_matches, num_non_matches_per_match),
-    )
+    # written straight into the output tensors
+    u_b = torch.empty(flat_b.shape, dtype=dtype)
+    v_b = torch.empty(flat_b.shape, dtype=dtype)
+    np.remainder(flat_b, sampler.image_width, out=u_b.numpy(), casting='unsafe')
+    np.floor_divide(flat_b, sampler.image_width, out=v_b.numpy(), casting='unsafe')
+    return (u_b.to(device), v_b.to(device))
 
 
 # Optionally, uv_a specifies the pixels in img_a for which to find matches
@@ -450,6 +502,10 @@ def batch_find_pixel_correspondences(
     device='CPU',
     img_a_mask=None,
     K=None,
+    img_a_mask_index=None,
+    dtype=DEFAULT_DTYPE,
+    occlusion_mode=OcclusionMode.NEAREST,
+    return_stats=False,
 ):
     """
     Computes pixel correspondences in batch
@@ -474,8 +530,8 @@ def batch_find_pixel_correspondences(
                             will either be occluded or outside of field-of-view.
     :type  num_attempts: int
     --
-    :param device:      either 'CPU' or 'CPU'
-    :type  device:      string
+    :param device:      device to compute on, see resolve_device()
+    :type  device:      torch.device or string
     --
     :param img_a_mask:  optional arg, an image where each nonzero pixel will be used as a mask
     :type  img_a_mask:  ndarray, of shape (H, W)
@@ -483,235 +539,714 @@ def batch_find_pixel_correspondences(
     :param K:           optional arg, an image where each nonzero pixel will be used as a mask
     :type  K:           ndarray, of shape (H, W)
     --
+    :param img_a_mask_index: optional arg, precomputed index of img_a_mask. Used
+                        instead of img_a_mask, the pixels are sampled from it directly
+    :type  img_a_mask_index: MaskIndex
+    --
+    :param dtype:       floating point dtype of the computation
+    :type  dtype:       torch.dtype
+    --
+    :param occlusion_mode: how the occlusion test looks up the depth of image b
+    :type  occlusion_mode: OcclusionMode
+    --
+    :param return_stats: also return how many attempts failed each test, see
+                        match_stats()
+    :type  return_stats: bool
+    --
     :return:            "Tuple of tuples", i.e. pixel position tuples for image a and image b (uv_a, uv_b).
-                        Each of these is a tuple of pixel positions
+                        Each of these is a tuple of pixel positions. (uv_a, uv_b, stats)
+                        if return_stats is set.
     :rtype:             Each of uv_a is a tuple of torch.FloatTensors
     """
     assert img_a_depth.shape == img_b_depth.shape
     image_width = img_a_depth.shape[1]
     image_height = img_b_depth.shape[0]
-
-    global dtype_float
-    global dtype_long
-    if device == 'CPU':
-        dtype_float = torch.FloatTensor
-        dtype_long = torch.LongTensor
-    if device == 'GPU':
-        dtype_float = torch.cuda.FloatTensor
-        dtype_long = torch.cuda.LongTensor
+    device = resolve_device(device)
 
     if uv_a is None:
         uv_a = pytorch_rand_select_pixel(
-            width=image_width, height=image_height, num_samples=num_attempts
+            width=image_width,
+            height=image_height,
+            num_samples=num_attempts,
+            device=device,
         )
     else:
         uv_a = (
-            torch.LongTensor([uv_a[0]]).type(dtype_long),
-            torch.LongTensor([uv_a[1]]).type(dtype_long),
+            torch.tensor([uv_a[0]], dtype=torch.long, device=device).view(-1),
+            torch.tensor([uv_a[1]], dtype=torch.long, device=device).view(-1),
         )
         num_attempts = 1
 
-    if img_a_mask is None:
+    if img_a_mask_index is not None:
+        uv_a_vec = img_a_mask_index.sample_uv(num_attempts)
+        if uv_a_vec[0] is None:
+            return _no_correspondences(return_stats)
+        uv_a_vec = (uv_a_vec[0].to(device), uv_a_vec[1].to(device))
+    elif img_a_mask is None:
         uv_a_vec = (
-            torch.ones(num_attempts).type(dtype_long) * uv_a[0],
-            torch.ones(num_attempts).type(dtype_long) * uv_a[1],
+            torch.ones(num_attempts, dtype=torch.long, device=device) * uv_a[0],
+            torch.ones(num_attempts, dtype=torch.long, device=device) * uv_a[1],
         )
-        uv_a_vec_flattened = uv_a_vec[1] * image_width + uv_a_vec[0]
     else:
-        img_a_mask = torch.from_numpy(img_a_mask).type(dtype_float)
+        img_a_mask = _to_torch(img_a_mask, device, dtype)
 
         # Option A: This next line samples from img mask
         uv_a_vec = random_sample_from_masked_image_torch(
             img_a_mask, num_samples=num_attempts
         )
         if uv_a_vec[0] is None:
-            return (None, None)
+            return _no_correspondences(return_stats)
 
         # Option B: These 4 lines grab ALL from img mask
         # mask_a = img_a_mask.squeeze(0)
         # mask_a = mask_a/torch.max(mask_a)
-        # nonzero = (torch.nonzero(mask_a)).type(dtype_long)
+        # nonzero = (torch.nonzero(mask_a)).long()
         # uv_a_vec = (nonzero[:,1], nonzero[:,0])
 
-        # Always use this line
-        # print("-"*10)
-        # print(image_width)
-        # print(image_height)
-        # print(max(uv_a_vec[0]))
-        # print(max(uv_a_vec[1]))
-        uv_a_vec_flattened = (uv_a_vec[1] * image_width + uv_a_vec[0]).type(dtype_long)
+    return compute_correspondences_for_pixels(
+        img_a_depth,
+        img_a_pose,
+        img_b_depth,
+        img_b_pose,
+        uv_a_vec,
+        K=K,
+        device=device,
+        dtype=dtype,
+        occlusion_mode=occlusion_mode,
+        return_stats=return_stats,
+    )
+
 
+def _no_correspondences(return_stats):
+    """
+    :return: the result of batch_find_pixel_correspondences when image a has
+             no pixels to sample from
+    """
+    if return_stats:
+        return (None, None, match_stats(0, 0, 0, 0))
+    return (None, None)
+
+
+def match_stats(num_attempts, num_has_depth, num_in_view, num_matches):
+    """
+    Counts of a correspondence search, returned by the correspondence finding
+    functions when called with return_stats=True. match_yield, the fraction of
+    attempted pixels that became matches, tells how many attempts are needed
+    for a number of matches.
+    :param num_has_depth: attempts with a depth return in image a
+    :param num_in_view: of those, the ones that land inside of image b
+    :param num_matches: of those, the ones that aren't occluded in image b
+    :return: num_attempts, num_no_depth, num_out_of_view, num_occluded,
+             num_matches, match_yield
+    :rtype: dict
+    """
+    num_attempts = int(num_attempts)
+    num_matches = int(num_matches)
+    return {
+        "num_attempts": num_attempts,
+        "num_no_depth": num_attempts - int(num_has_depth),
+        "num_out_of_view": int(num_has_depth) - int(num_in_view),
+        "num_occluded": int(num_in_view) - num_matches,
+        "num_matches": num_matches,
+        "match_yield": num_matches / float(num_attempts) if num_attempts > 0 else 0.0,
+    }
+
+
+def compute_correspondences_for_pixels(
+    img_a_depth,
+    img_a_pose,
+    img_b_depth,
+    img_b_pose,
+    uv_a_vec,
+    K=None,
+    device=None,
+    dtype=DEFAULT_DTYPE,
+    occlusion_mode=OcclusionMode.NEAREST,
+    return_stats=False,
+):
+    """
+    Finds the pixels of image b corresponding to the given pixels of image a,
+    pruning those without depth, outside of image b or occluded in image b.
+    This is the part of batch_find_pixel_correspondences that runs after the
+    pixels of image a have been chosen.
+
+    :param img_a_depth: depth image for image a
+    :type  img_a_depth: numpy 2d array (H x W) encoded as a uint16
+    :param img_a_pose:  pose for image a, in right-down-forward optical frame
+    :type  img_a_pose:  numpy 2d array, 4 x 4 (homogeneous transform)
+    :param img_b_depth: depth image for image b
+    :type  img_b_depth: numpy 2d array (H x W) encoded as a uint16
+    :param img_b_pose:  pose for image b, in right-down-forward optical frame
+    :type  img_b_pose:  numpy 2d array, 4 x 4 (homogeneous transform)
+    :param uv_a_vec:    pixels of image a, tuple of (u,v) torch.LongTensors
+    :type  uv_a_vec:    tuple
+    :param K:           optional 3 x 3 camera intrinsics matrix
+    :type  K:           numpy.ndarray
+    :param device:      device to compute on, see resolve_device(). Defaults
+                        to the device of uv_a_vec
+    :type  device:      torch.device or string
+    :param dtype:       floating point dtype of the computation
+    :type  dtype:       torch.dtype
+    :param occlusion_mode: how the occlusion test looks up the depth of image b
+    :type  occlusion_mode: OcclusionMode
+    :param return_stats: also return the match_stats() of the search
+    :type  return_stats: bool
+    :return:            (uv_a_vec, uv_b_vec) of the surviving pixels, see
+                        batch_find_pixel_correspondences
+    :rtype:             tuple of tuples of torch.Tensors
+    """
     if K is None:
         K = get_default_K_matrix()
 
-    K_inv = inv(K)
-    body_to_rdf = get_body_to_rdf()
-    rdf_to_body = inv(body_to_rdf)
+    if device is None:
+        device = uv_a_vec[0].device
+    else:
+        device = resolve_device(device)
+
+    return _project_and_prune(
+        img_a_depth,
+        img_a_pose,
+        img_b_depth,
+        img_b_pose,
+        uv_a_vec,
+        K,
+        K,
+        device=device,
+        dtype=dtype,
+        occlusion_mode=occlusion_mode,
+        return_stats=return_stats,
+    )
+
+
+def _project_and_prune(
+    img_a_depth,
+    img_a_pose,
+    img_b_depth,
+    img_b_pose,
+    uv_a_vec,
+    K_a,
+    K_b,
+    device=DEFAULT_DEVICE,
+    dtype=DEFAULT_DTYPE,
+    occlusion_mode=OcclusionMode.NEAREST,
+    return_stats=False,
+):
+    """
+    Projects the pixels uv_a_vec of image a into image b and keeps those that
+    have a depth return in image a, land inside of image b and aren't occluded
+    in image b.
+
+    Every attempted pixel is carried through the whole projection and the
+    three tests are combined into a single validity mask, so the surviving
+    pixels are compacted only once at the end.
+
+    :return: (uv_a_vec, uv_b_vec), and the match_stats() if return_stats is
+             set, see batch_find_pixel_correspondences
+    :rtype: tuple of tuples of torch.Tensors
+    """
+    u_a_vec = uv_a_vec[0].to(device=device, dtype=torch.long)
+    v_a_vec = uv_a_vec[1].to(device=device, dtype=torch.long)
+    u2_vec, v2_vec, has_depth, in_view, valid = _reproject(
+        img_a_depth,
+        img_a_pose,
+        img_b_depth,
+        img_b_pose,
+        (u_a_vec, v_a_vec),
+        K_a,
+        K_b,
+        device=device,
+        dtype=dtype,
+        occlusion_mode=occlusion_mode,
+    )
+
+    keep = torch.nonzero(valid).squeeze(1)
+    uv_a_vec = (
+        torch.index_select(u_a_vec, 0, keep),
+        torch.index_select(v_a_vec, 0, keep),
+    )
+    uv_b_vec = (
+        torch.index_select(u2_vec, 0, keep),
+        torch.index_select(v2_vec, 0, keep),
+    )
+    if return_stats:
+        stats = match_stats(
+            len(valid),
+            has_depth.sum(),
+            (has_depth & in_view).sum(),
+            len(keep),
+        )
+        return (uv_a_vec, uv_b_vec, stats)
+    return (uv_a_vec, uv_b_vec)
 
-    img_a_depth_torch = torch.from_numpy(img_a_depth).type(dtype_float)
-    img_a_depth_torch = torch.squeeze(img_a_depth_torch, 0)
-    img_a_depth_torch = img_a_depth_torch.view(-1, 1)
 
-    # print("A" + "-"*50)
-    # print(max(uv_a_vec_flattened))
-    # print(img_a_depth_torch.shape)
-    # print("A" + "-"*50)
+def _reproject(
+    img_a_depth,
+    img_a_pose,
+    img_b_depth,
+    img_b_pose,
+    uv_a_vec,
+    K_a,
+    K_b,
+    dense=False,
+    device=DEFAULT_DEVICE,
+    dtype=DEFAULT_DTYPE,
+    occlusion_mode=OcclusionMode.NEAREST,
+):
+    """
+    Projects the pixels uv_a_vec of image a into image b and runs the three
+    pruning tests on every one of them. Set dense if uv_a_vec is every pixel
+    of image a in flattened order, they are then back-projected with the ray
+    grid of image a. uv_a_vec has to be on device.
+    :return: u2_vec, v2_vec: the pixel positions in image b
+             has_depth: the pixel has a depth return in image a
+             in_view: it lands inside of image b
+             valid: it passes all three tests, i.e. it also isn't occluded
+             in image b
+    :rtype: torch.FloatTensors, torch.BoolTensors
+    """
+    image_a_height, image_a_width = img_a_depth.shape[0:2]
+    image_b_height, image_b_width = img_b_depth.shape[0:2]
+    context_a = get_projection_context(K_a, image_a_height, image_a_width)
+    context_b = get_projection_context(K_b, image_b_height, image_b_width)
+    u_a_vec, v_a_vec = uv_a_vec
+
+    u2_vec, v2_vec, has_depth, in_view, valid = _reproject_pairs(
+        _to_torch(img_a_depth, device, dtype).view(-1),
+        _to_torch(img_b_depth, device, dtype).view(-1),
+        _to_torch(img_a_pose, device, dtype).unsqueeze(0),
+        _to_torch(invert_transform(img_b_pose), device, dtype).unsqueeze(0),
+        u_a_vec.unsqueeze(0),
+        v_a_vec.unsqueeze(0),
+        context_a,
+        context_b,
+        dense=dense,
+        occlusion_mode=occlusion_mode,
+    )
+    return u2_vec[0], v2_vec[0], has_depth[0], in_view[0], valid[0]
+
+
+def _reproject_pairs(
+    depths_a_torch,
+    depths_b_torch,
+    a_to_world,
+    world_to_b,
+    u_a_vec,
+    v_a_vec,
+    context_a,
+    context_b,
+    offset_a=0,
+    offset_b=0,
+    dense=False,
+    occlusion_mode=OcclusionMode.NEAREST,
+):
+    """
+    The reprojection and pruning of _reproject() for P pairs of images at
+    once, each with A pixels of image a. _reproject() is the case P = 1,
+    batch_find_pixel_correspondences_for_pairs() runs all of its pairs
+    through it.
+    :param depths_a_torch, depths_b_torch: flattened depth images, each may
+        hold several images back to back
+    :type depths_a_torch, depths_b_torch: torch.Tensor
+    :param a_to_world: camera_to_world poses of image a
+    :type a_to_world: torch.Tensor with shape [P, 4, 4]
+    :param world_to_b: inverse camera_to_world poses of image b
+    :type world_to_b: torch.Tensor with shape [P, 4, 4]
+    :param u_a_vec, v_a_vec: pixels of image a
+    :type u_a_vec, v_a_vec: torch.LongTensor with shape [P, A]
+    :param context_a, context_b: projection contexts of images a and b, with
+        the image sizes
+    :type context_a, context_b: ProjectionContext
+    :param offset_a, offset_b: index of pixel 0 of image a, image b, of each
+        pair in depths_a_torch, depths_b_torch
+    :type offset_a, offset_b: int or torch.LongTensor with shape [P, 1]
+    :param dense: u_a_vec, v_a_vec are every pixel of image a in flattened
+        order, they are then back-projected with the ray grid of image a
+    :type dense: bool
+    :return: u2_vec, v2_vec, has_depth, in_view, valid, see _reproject(),
+             each with shape [P, A]
+    :rtype: torch.FloatTensors, torch.BoolTensors
+    """
+    image_b_height = context_b.image_height
+    image_b_width = context_b.image_width
+    uv_a_vec_flattened = (v_a_vec * context_a.image_width + u_a_vec).long()
 
     depth_vec = (
-        torch.index_select(img_a_depth_torch, 0, uv_a_vec_flattened)
+        _gather(depths_a_torch, offset_a + uv_a_vec_flattened)
         * 1.0
         / constants.DEPTH_IM_SCALE
     )
-    depth_vec = depth_vec.squeeze(1)
 
-    # Prune based on
     # Case 1: depth is zero (for this data, this means no-return)
-    nonzero_indices = torch.nonzero(depth_vec)
-    if nonzero_indices.dim() == 0:
-        return (None, None)
-    nonzero_indices = nonzero_indices.squeeze(1)
-    depth_vec = torch.index_select(depth_vec, 0, nonzero_indices)
+    has_depth = depth_vec != 0
 
-    # prune u_vec and v_vec, then multiply by already pruned depth_vec
-    u_a_pruned = torch.index_select(uv_a_vec[0], 0, nonzero_indices)
-    u_vec = u_a_pruned.type(dtype_float) * depth_vec
+    # [P, 3, A] points, transformed by the per pair [P, 4, 4] poses
+    if dense:
+        point_camera_frame_rdf_vec = context_a.back_project_image(
+            depth_vec.unsqueeze(1)
+        )
+    else:
+        point_camera_frame_rdf_vec = context_a.back_project(
+            u_a_vec, v_a_vec, depth_vec, dim=1
+        )
+    ones_row = torch.ones_like(depth_vec).unsqueeze(1)
+
+    point_world_frame_rdf_vec = torch.matmul(
+        a_to_world, torch.cat((point_camera_frame_rdf_vec, ones_row), 1)
+    )[:, 0:3]
+    point_camera_2_frame_rdf_vec = torch.matmul(
+        world_to_b, torch.cat((point_world_frame_rdf_vec, ones_row), 1)
+    )[:, 0:3]
+
+    vec2_vec = torch.matmul(
+        _to_torch(context_b.K, depth_vec.device, depth_vec.dtype),
+        point_camera_2_frame_rdf_vec,
+    )
 
-    v_a_pruned = torch.index_select(uv_a_vec[1], 0, nonzero_indices)
-    v_vec = v_a_pruned.type(dtype_float) * depth_vec
+    u2_vec = vec2_vec[:, 0] / vec2_vec[:, 2]
+    v2_vec = vec2_vec[:, 1] / vec2_vec[:, 2]
+    z2_vec = vec2_vec[:, 2]
 
-    z_vec = depth_vec
+    # Case 2: the pixels projected into image b are outside FOV, the upper
+    # bounds need to be epsilon less than the image size. Pixels landing
+    # exactly on u2 = 0 or v2 = 0 are dropped too.
+    epsilon = 1e-3
+    in_view = (u2_vec > 0) & (u2_vec <= image_b_width * 1.0 - epsilon)
+    in_view &= (v2_vec > 0) & (v2_vec <= image_b_height * 1.0 - epsilon)
+
+    # Case 3: the pixels in image b are occluded, OR there is no depth return
+    # in image b so we aren't sure
+    valid = _visible_in_image_b(
+        depths_b_torch,
+        u2_vec,
+        v2_vec,
+        z2_vec,
+        has_depth & in_view,
+        image_b_height,
+        image_b_width,
+        occlusion_mode,
+        offset=offset_b,
+    )
 
-    full_vec = torch.stack((u_vec, v_vec, z_vec))
+    return u2_vec, v2_vec, has_depth, in_view, valid
 
-    K_inv_torch = torch.from_numpy(K_inv).type(dtype_float)
-    point_camera_frame_rdf_vec = K_inv_torch.mm(full_vec)
 
-    point_world_frame_rdf_vec = apply_transform_torch(
-        point_camera_frame_rdf_vec, torch.from_numpy(img_a_pose).type(dtype_float)
+def _visible_in_image_b(
+    img_b_depth_torch,
+    u2_vec,
+    v2_vec,
+    z2_vec,
+    valid,
+    image_height,
+    image_width,
+    occlusion_mode,
+    offset=0,
+):
+    """
+    The occlusion test: keeps the pixels of valid that have a depth return in
+    image b at their projection (u2, v2), no closer than z2 minus the occlusion
+    margin. The lookup is done for every pixel, those that aren't valid are
+    pointed at pixel 0 of image b.
+    :param img_b_depth_torch: flattened depth image b, or several images
+    :type img_b_depth_torch: torch.Tensor
+    :param valid: the pixels that passed the other tests
+    :type valid: torch.BoolTensor, same shape as u2_vec
+    :param offset: index of pixel 0 of image b in img_b_depth_torch, may be a
+        tensor broadcasting against u2_vec
+    :type offset: int or torch.LongTensor
+    :return: valid and visible in image b
+    :rtype: torch.BoolTensor
+    """
+    if occlusion_mode == OcclusionMode.NEAREST:
+        uv_b_vec_flattened = (
+            v2_vec.long() * image_width + u2_vec.long()
+        )  # simply round to int -- good enough
+        uv_b_vec_flattened = torch.where(
+            valid, uv_b_vec_flattened, torch.zeros_like(uv_b_vec_flattened)
+        )
+        depth2_vec = (
+            _gather(img_b_depth_torch, offset + uv_b_vec_flattened)
+            * 1.0
+            / constants.DEPTH_IM_SCALE
+        )
+        return valid & (depth2_vec > 0) & (depth2_vec >= z2_vec - OCCLUSION_MARGIN)
+
+    if occlusion_mode != OcclusionMode.BILINEAR:
+        raise ValueError("unknown occlusion_mode %s" % (occlusion_mode,))
+
+    # pixel n holds the depth along the ray through the coordinate n, see
+    # ProjectionContext.pixel_rays(), while NEAREST looks up floor(u2), up to a
+    # pixel away. The 2 x 2 pixels around (u2, v2) are (x0, y0) to
+    # (x0 + 1, y0 + 1), clamped to the image.
+    zeros = torch.zeros_like(u2_vec)
+    x = torch.where(valid, u2_vec, zeros).clamp(0, image_width - 1)
+    y = torch.where(valid, v2_vec, zeros).clamp(0, image_height - 1)
+    x0 = x.floor().clamp(max=max(image_width - 2, 0))
+    y0 = y.floor().clamp(max=max(image_height - 2, 0))
+    fx = x - x0
+    fy = y - y0
+    flat00 = offset + y0.long() * image_width + x0.long()
+    step_u = 1 if image_width > 1 else 0
+    step_v = image_width if image_height > 1 else 0
+
+    # [4, ...] depths and weights of the pixels (x0, y0), (x0 + 1, y0),
+    # (x0, y0 + 1) and (x0 + 1, y0 + 1)
+    depths = (
+        torch.stack(
+            [
+                _gather(img_b_depth_torch, flat00 + step)
+                for step in (0, step_u, step_v, step_u + step_v)
+            ]
+        )
+        * 1.0
+        / constants.DEPTH_IM_SCALE
     )
-    point_camera_2_frame_rdf_vec = apply_transform_torch(
-        point_world_frame_rdf_vec,
-        torch.from_numpy(invert_transform(img_b_pose)).type(dtype_float),
+    weights = torch.stack(
+        ((1 - fx) * (1 - fy), fx * (1 - fy), (1 - fx) * fy, fx * fy)
     )
 
-    K_torch = torch.from_numpy(K).type(dtype_float)
-    vec2_vec = K_torch.mm(point_camera_2_frame_rdf_vec)
+    # pixels without a depth return are left out of the interpolation
+    has_depth2 = depths > 0
+    weights = weights * has_depth2
+    weight_sum = weights.sum(0)
+    depth2_vec = (weights * depths).sum(0) / weight_sum.clamp(min=1e-12)
+
+    # the depth change over one pixel along u and along v, where all four
+    # pixels have a depth return
+    d00, d10, d01, d11 = depths
+    slope_u = (d10 - d00) * (1 - fy) + (d11 - d01) * fy
+    slope_v = (d01 - d00) * (1 - fx) + (d11 - d10) * fx
+    slope = torch.where(
+        has_depth2.all(0), slope_u.abs() + slope_v.abs(), torch.zeros_like(slope_u)
+    )
+    occlusion_margin = (OCCLUSION_MARGIN + OCCLUSION_SLOPE_PIXELS * slope).clamp(
+        max=MAX_OCCLUSION_MARGIN
+    )
 
-    u2_vec = vec2_vec[0] / vec2_vec[2]
-    v2_vec = vec2_vec[1] / vec2_vec[2]
+    return valid & (weight_sum > 0) & (depth2_vec >= z2_vec - occlusion_margin)
 
-    maybe_z2_vec = point_camera_2_frame_rdf_vec[2]
 
-    z2_vec = vec2_vec[2]
+def _gather(values, index):
+    """
+    :return: values[index] for a flat values and any shape of index
+    :rtype: torch.Tensor
+    """
+    return torch.index_select(values, 0, index.reshape(-1)).view(index.shape)
 
-    # Prune based on
-    # Case 2: the pixels projected into image b are outside FOV
-    # u2_vec bounds should be: 0, image_width
-    # v2_vec bounds should be: 0, image_height
 
-    # do u2-based pruning
-    u2_vec_lower_bound = 0.0
-    epsilon = 1e-3
-    u2_vec_upper_bound = (
-        image_width * 1.0 - epsilon
-    )  # careful, needs to be epsilon less!!
-    lower_bound_vec = torch.ones_like(u2_vec) * u2_vec_lower_bound
-    upper_bound_vec = torch.ones_like(u2_vec) * u2_vec_upper_bound
-    zeros_vec = torch.zeros_like(u2_vec)
-
-    u2_vec = where(u2_vec < lower_bound_vec, zeros_vec, u2_vec)
-    u2_vec = where(u2_vec > upper_bound_vec, zeros_vec, u2_vec)
-    in_bound_indices = torch.nonzero(u2_vec)
-    if in_bound_indices.dim() == 0:
-        return (None, None)
-    in_bound_indices = in_bound_indices.squeeze(1)
-
-    # apply pruning
-    u2_vec = torch.index_select(u2_vec, 0, in_bound_indices)
-    v2_vec = torch.index_select(v2_vec, 0, in_bound_indices)
-    z2_vec = torch.index_select(z2_vec, 0, in_bound_indices)
-    u_a_pruned = torch.index_select(
-        u_a_pruned, 0, in_bound_indices
-    )  # also prune from first list
-    v_a_pruned = torch.index_select(
-        v_a_pruned, 0, in_bound_indices
-    )  # also prune from first list
-
-    # do v2-based pruning
-    v2_vec_lower_bound = 0.0
-    v2_vec_upper_bound = image_height * 1.0 - epsilon
-    lower_bound_vec = torch.ones_like(v2_vec) * v2_vec_lower_bound
-    upper_bound_vec = torch.ones_like(v2_vec) * v2_vec_upper_bound
-    zeros_vec = torch.zeros_like(v2_vec)
-
-    v2_vec = where(v2_vec < lower_bound_vec, zeros_vec, v2_vec)
-    v2_vec = where(v2_vec > upper_bound_vec, zeros_vec, v2_vec)
-    in_bound_indices = torch.nonzero(v2_vec)
-    if in_bound_indices.dim() == 0:
-        return (None, None)
-    in_bound_indices = in_bound_indices.squeeze(1)
-
-    # apply pruning
-    u2_vec = torch.index_select(u2_vec, 0, in_bound_indices)
-    v2_vec = torch.index_select(v2_vec, 0, in_bound_indices)
-    z2_vec = torch.index_select(z2_vec, 0, in_bound_indices)
-    u_a_pruned = torch.index_select(
-        u_a_pruned, 0, in_bound_indices
-    )  # also prune from first list
-    v_a_pruned = torch.index_select(
-        v_a_pruned, 0, in_bound_indices
-    )  # also prune from first list
-
-    # Prune based on
-    # Case 3: the pixels in image b are occluded, OR there is no depth return in image b so we aren't sure
-
-    img_b_depth_torch = torch.from_numpy(img_b_depth).type(dtype_float)
-    img_b_depth_torch = torch.squeeze(img_b_depth_torch, 0)
-    img_b_depth_torch = img_b_depth_torch.view(-1, 1)
-
-    uv_b_vec_flattened = v2_vec.type(dtype_long) * image_width + u2_vec.type(
-        dtype_long
-    )  # simply round to int -- good enough
-    # occlusion check for smooth surfaces
-
-    # print("B" + "-"*50)
-    # print(max(uv_b_vec_flattened) if len(uv_b_vec_flattened)!=0 else -1)
-    # print(img_b_depth_torch.shape)
-    # print("B" + "-"*50)
-
-    depth2_vec = (
-        torch.index_select(img_b_depth_torch, 0, uv_b_vec_flattened) * 1.0 / 1000
+class FlowStatus:
+    """
+    Per pixel result of compute_flow_field()
+    """
+
+    VALID = 0
+    NO_DEPTH = 1  # no depth return in image a
+    OUT_OF_VIEW = 2  # projects outside of image b
+    OCCLUDED = 3  # occluded in image b, or no depth return there
+
+
+def compute_flow_field(
+    img_a_depth,
+    img_a_pose,
+    img_b_depth,
+    img_b_pose,
+    K=None,
+    device=None,
+    dtype=DEFAULT_DTYPE,
+    occlusion_mode=OcclusionMode.NEAREST,
+):
+    """
+    Computes where every pixel of image a lands in image b, with the same
+    reprojection and pruning as batch_find_pixel_correspondences. The pixels
+    for which status is FlowStatus.VALID are exactly those that
+    batch_find_pixel_correspondences would return as matches.
+
+    :param img_a_depth: depth image for image a
+    :type  img_a_depth: numpy 2d array (H x W) encoded as a uint16
+    :param img_a_pose:  pose for image a, in right-down-forward optical frame
+    :type  img_a_pose:  numpy 2d array, 4 x 4 (homogeneous transform)
+    :param img_b_depth: depth image for image b
+    :type  img_b_depth: numpy 2d array (H x W) encoded as a uint16
+    :param img_b_pose:  pose for image b, in right-down-forward optical frame
+    :type  img_b_pose:  numpy 2d array, 4 x 4 (homogeneous transform)
+    :param K:           optional 3 x 3 camera intrinsics matrix
+    :type  K:           numpy.ndarray
+    :param device:      device to compute on, see resolve_device()
+    :type  device:      torch.device or string
+    :param dtype:       floating point dtype of the computation
+    :type  dtype:       torch.dtype
+    :param occlusion_mode: how the occlusion test looks up the depth of image b
+    :type  occlusion_mode: OcclusionMode
+    :return:            uv_b: [2, H, W] (u, v) position in image b of every
+                        pixel of image a, NaN where it has no depth.
+                        status: [H, W] FlowStatus of every pixel of image a
+    :rtype:             torch.FloatTensor, torch.ByteTensor
+    """
+    if K is None:
+        K = get_default_K_matrix()
+
+    device = resolve_device(device)
+    image_height, image_width = img_a_depth.shape
+    flat = torch.arange(image_height * image_width, device=device)
+    uv_a_vec = (flat % image_width, flat // image_width)
+    u2_vec, v2_vec, has_depth, in_view, valid = _reproject(
+        img_a_depth,
+        img_a_pose,
+        img_b_depth,
+        img_b_pose,
+        uv_a_vec,
+        K,
+        K,
+        dense=True,
+        device=device,
+        dtype=dtype,
+        occlusion_mode=occlusion_mode,
     )
-    depth2_vec = depth2_vec.squeeze(1)
-
-    # occlusion margin, in meters
-    occlusion_margin = 0.003
-    z2_vec = z2_vec - occlusion_margin
-    zeros_vec = torch.zeros_like(depth2_vec)
-
-    depth2_vec = where(
-        depth2_vec < zeros_vec, zeros_vec, depth2_vec
-    )  # to be careful, prune any negative depths
-    depth2_vec = where(depth2_vec < z2_vec, zeros_vec, depth2_vec)  # prune occlusions
-    non_occluded_indices = torch.nonzero(depth2_vec)
-    if non_occluded_indices.dim() == 0:
-        return (None, None)
-    non_occluded_indices = non_occluded_indices.squeeze(1)
-    depth2_vec = torch.index_select(depth2_vec, 0, non_occluded_indices)
-
-    # apply pruning
-    u2_vec = torch.index_select(u2_vec, 0, non_occluded_indices)
-    v2_vec = torch.index_select(v2_vec, 0, non_occluded_indices)
-    u_a_pruned = torch.index_select(
-        u_a_pruned, 0, non_occluded_indices
-    )  # also prune from first list
-    v_a_pruned = torch.index_select(
-        v_a_pruned, 0, non_occluded_indices
-    )  # also prune from first list
-
-    uv_b_vec = (u2_vec, v2_vec)
-    uv_a_vec = (u_a_pruned, v_a_pruned)
-    return (uv_a_vec, uv_b_vec)
+
+    status = torch.full_like(flat, FlowStatus.OCCLUDED, dtype=torch.uint8)
+    status[valid] = FlowStatus.VALID
+    status[~in_view] = FlowStatus.OUT_OF_VIEW
+    status[~has_depth] = FlowStatus.NO_DEPTH
+
+    uv_b = torch.stack((u2_vec, v2_vec))
+    uv_b[:, ~has_depth] = float('nan')
+    return (
+        uv_b.view(2, image_height, image_width),
+        status.view(image_height, image_width),
+    )
+
+
+def batch_find_pixel_correspondences_for_pairs(
+    depths,
+    poses,
+    pairs,
+    masks=None,
+    num_attempts=None,
+    K=None,
+    device=None,
+    dtype=DEFAULT_DTYPE,
+    occlusion_mode=OcclusionMode.NEAREST,
+):
+    """
+    Computes pixel correspondences for many pairs of images of the same size
+    at once. The pixels of image a are projected into image b and pruned
+    exactly like in batch_find_pixel_correspondences, but the images, poses
+    and K are converted to torch once and all pairs go through a single
+    vectorized pass.
+
+    B = number of images, P = number of pairs
+
+    :param depths: depth images
+    :type  depths: numpy array (B x H x W) encoded as a uint16
+    :param poses:  camera_to_world poses, in right-down-forward optical frame
+    :type  poses:  numpy array (B x 4 x 4)
+    :param pairs:  (a, b) indices into depths and poses of each pair
+    :type  pairs:  array-like, P x 2
+    :param masks:  optional masks, only the nonzero pixels of image a are used
+    :type  masks:  numpy array (B x H x W)
+    :param num_attempts: number of pixels of image a sampled with replacement
+                         for each pair. If None every pixel of image a (every
+                         nonzero pixel of its mask) is tried.
+    :type  num_attempts: int
+    :param K:      optional 3 x 3 camera intrinsics matrix, shared by all images
+    :type  K:      numpy.ndarray
+    :param device: device to compute on, see resolve_device()
+    :type  device: torch.device or string
+    :param dtype:  floating point dtype of the computation
+    :type  dtype:  torch.dtype
+    :param occlusion_mode: how the occlusion test looks up the depth of image b
+    :type  occlusion_mode: OcclusionMode
+    :return:       uv_a_vec, uv_b_vec, offsets. uv_a_vec and uv_b_vec are
+                   (u,v) tuples holding the matches of all pairs back to back,
+                   those of pair i being entries offsets[i]:offsets[i+1]
+    :rtype:        tuple of torch.LongTensors, tuple of torch.FloatTensors,
+                   torch.LongTensor of shape [P + 1]
+    """
+    depths = np.asarray(depths)
+    num_images, image_height, image_width = depths.shape
+    num_pixels = image_height * image_width
+    pairs = torch.from_numpy(np.asarray(pairs, dtype=np.int64).reshape(-1, 2))
+    frames_a = pairs[:, 0]
+    frames_b = pairs[:, 1]
+    num_pairs = len(pairs)
+
+    device = resolve_device(device)
+    context = get_projection_context(K, image_height, image_width)
+
+    # pixels of image a to try for each pair, [P, A] flattened indices. When
+    # pairs have different numbers of candidates the rows are padded and
+    # attempted marks the real entries.
+    if masks is not None:
+        masks = np.asarray(masks).reshape(num_images, num_pixels)
+        inside = [np.flatnonzero(mask) for mask in masks]
+        counts = torch.LongTensor([len(x) for x in inside])
+        starts = torch.zeros(num_images, dtype=torch.long)
+        starts[1:] = torch.cumsum(counts, 0)[:-1]
+        # trailing 0 so that the padding of pairs with an empty mask can point
+        # past the last mask
+        inside = torch.from_numpy(np.concatenate(inside + [np.zeros(1, np.int64)]))
+        pair_counts = counts[frames_a]
+
+        if num_attempts is None:
+            num_attempts = int(pair_counts.max()) if num_pairs > 0 else 0
+            rows = torch.arange(num_attempts).unsqueeze(0).expand(num_pairs, -1)
+            attempted = rows < pair_counts.unsqueeze(1)
+        else:
+            rand_numbers = torch.rand(num_pairs, num_attempts)
+            rows = torch.floor(rand_numbers * pair_counts.unsqueeze(1)).long()
+            attempted = (pair_counts > 0).unsqueeze(1).expand(-1, num_attempts)
+        rows = torch.where(attempted, rows, torch.zeros_like(rows))
+        flat_a = inside[starts[frames_a].unsqueeze(1) + rows]
+    else:
+        if num_attempts is None:
+            num_attempts = num_pixels
+            flat_a = torch.arange(num_pixels).unsqueeze(0).expand(num_pairs, -1)
+        else:
+            two_rand_numbers = torch.rand(2, num_pairs, num_attempts)
+            u = torch.floor(two_rand_numbers[0] * image_width).long()
+            v = torch.floor(two_rand_numbers[1] * image_height).long()
+            flat_a = v * image_width + u
+        attempted = torch.ones(num_pairs, num_attempts, dtype=torch.bool)
+
+    flat_a = flat_a.to(device)
+    attempted = attempted.to(device)
+    frames_a = frames_a.to(device)
+    frames_b = frames_b.to(device)
+    u_a_vec = flat_a % image_width
+    v_a_vec = flat_a // image_width
+
+    depths_torch = _to_torch(depths, device, dtype).view(-1)
+    poses_torch = _to_torch(poses, device, dtype)
+    inverse_poses_torch = _to_torch(
+        np.stack([invert_transform(pose) for pose in poses]), device, dtype
+    )
+    u2_vec, v2_vec, _, _, valid = _reproject_pairs(
+        depths_torch,
+        depths_torch,
+        poses_torch[frames_a],
+        inverse_poses_torch[frames_b],
+        u_a_vec,
+        v_a_vec,
+        context,
+        context,
+        offset_a=frames_a.unsqueeze(1) * num_pixels,
+        offset_b=frames_b.unsqueeze(1) * num_pixels,
+        occlusion_mode=occlusion_mode,
+    )
+    valid &= attempted
+
+    offsets = torch.zeros(num_pairs + 1, dtype=torch.long, device=device)
+    offsets[1:] = torch.cumsum(valid.sum(1), 0)
+
+    keep = torch.nonzero(valid.view(-1)).squeeze(1)
+    uv_a_vec = (
+        torch.index_select(u_a_vec.reshape(-1), 0, keep),
+        torch.index_select(v_a_vec.reshape(-1), 0, keep),
+    )
+    uv_b_vec = (
+        torch.index_select(u2_vec.reshape(-1), 0, keep),
+        torch.index_select(v2_vec.reshape(-1), 0, keep),
+    )
+    return uv_a_vec, uv_b_vec, offsets
 
 
 def batch_find_pixel_correspondences_different_size(
@@ -725,6 +1260,8 @@ def batch_find_pixel_correspondences_different_size(
     img_a_mask=None,
     K_a=None,
     K_b=None,
+    dtype=DEFAULT_DTYPE,
+    occlusion_mode=OcclusionMode.NEAREST,
 ):
     """
     Computes pixel correspondences in batch
@@ -749,8 +1286,8 @@ def batch_find_pixel_correspondences_different_size(
                             will either be occluded or outside of field-of-view.
     :type  num_attempts: int
     --
-    :param device:      either 'CPU' or 'CPU'
-    :type  device:      string
+    :param device:      device to compute on, see resolve_device()
+    :type  device:      torch.device or string
     --
     :param img_a_mask:  optional arg, an image where each nonzero pixel will be used as a mask
     :type  img_a_mask:  ndarray, of shape (H, W)
@@ -758,43 +1295,41 @@ def batch_find_pixel_correspondences_different_size(
     :param K:           optional arg, an image where each nonzero pixel will be used as a mask
     :type  K:           ndarray, of shape (H, W)
     --
+    :param dtype:       floating point dtype of the computation
+    :type  dtype:       torch.dtype
+    --
+    :param occlusion_mode: how the occlusion test looks up the depth of image b
+    :type  occlusion_mode: OcclusionMode
+    --
     :return:            "Tuple of tuples", i.e. pixel position tuples for image a and image b (uv_a, uv_b).
                         Each of these is a tuple of pixel positions
     :rtype:             Each of uv_a is a tuple of torch.FloatTensors
     """
     image_a_width = img_a_depth.shape[1]
     image_a_height = img_a_depth.shape[0]
-    image_b_width = img_b_depth.shape[1]
-    image_b_height = img_b_depth.shape[0]
-
-    global dtype_float
-    global dtype_long
-    if device == 'CPU':
-        dtype_float = torch.FloatTensor
-        dtype_long = torch.LongTensor
-    if device == 'GPU':
-        dtype_float = torch.cuda.FloatTensor
-        dtype_long = torch.cuda.LongTensor
+    device = resolve_device(device)
 
     if uv_a is None:
         uv_a = pytorch_rand_select_pixel(
-            width=image_a_width, height=image_a_height, num_samples=num_attempts
+            width=image_a_width,
+            height=image_a_height,
+            num_samples=num_attempts,
+            device=device,
         )
     else:
         uv_a = (
-            torch.LongTensor([uv_a[0]]).type(dtype_long),
-            torch.LongTensor([uv_a[1]]).type(dtype_long),
+            torch.tensor([uv_a[0]], dtype=torch.long, device=device).view(-1),
+            torch.tensor([uv_a[1]], dtype=torch.long, device=device).view(-1),
         )
         num_attempts = 1
 
     if img_a_mask is None:
         uv_a_vec = (
-            torch.ones(num_attempts).type(dtype_long) * uv_a[0],
-            torch.ones(num_attempts).type(dtype_long) * uv_a[1],
+            torch.ones(num_attempts, dtype=torch.long, device=device) * uv_a[0],
+            torch.ones(num_attempts, dtype=torch.long, device=device) * uv_a[1],
         )
-        uv_a_vec_flattened = uv_a_vec[1] * image_a_width + uv_a_vec[0]
     else:
-        img_a_mask = torch.from_numpy(img_a_mask).type(dtype_float)
+        img_a_mask = _to_torch(img_a_mask, device, dtype)
 
         # Option A: This next line samples from img mask
         uv_a_vec = random_sample_from_masked_image_torch(
@@ -806,185 +1341,24 @@ def batch_find_pixel_correspondences_different_size(
         # Option B: These 4 lines grab ALL from img mask
         # mask_a = img_a_mask.squeeze(0)
         # mask_a = mask_a/torch.max(mask_a)
-        # nonzero = (torch.nonzero(mask_a)).type(dtype_long)
+        # nonzero = (torch.nonzero(mask_a)).long()
         # uv_a_vec = (nonzero[:,1], nonzero[:,0])
 
-        # Always use this line
-        # print("-"*10)
-        # print(image_width)
-        # print(image_height)
-        # print(max(uv_a_vec[0]))
-        # print(max(uv_a_vec[1]))
-        uv_a_vec_flattened = (uv_a_vec[1] * image_a_width + uv_a_vec[0]).type(
-            dtype_long
-        )
-
     if K_a is None:
         K_a = get_default_K_matrix()
 
     if K_b is None:
         K_b = get_default_K_matrix()
 
-    K_a_inv = inv(K_a)
-    img_a_depth_torch = torch.from_numpy(img_a_depth).type(dtype_float)
-    img_a_depth_torch = torch.squeeze(img_a_depth_torch, 0)
-    img_a_depth_torch = img_a_depth_torch.view(-1, 1)
-
-    # print("A" + "-"*50)
-    # print(max(uv_a_vec_flattened))
-    # print(img_a_depth_torch.shape)
-    # print("A" + "-"*50)
-
-    depth_vec = (
-        torch.index_select(img_a_depth_torch, 0, uv_a_vec_flattened)
-        * 1.0
-        / constants.DEPTH_IM_SCALE
+    return _project_and_prune(
+        img_a_depth,
+        img_a_pose,
+        img_b_depth,
+        img_b_pose,
+        uv_a_vec,
+        K_a,
+        K_b,
+        device=device,
+        dtype=dtype,
+        occlusion_mode=occlusion_mode,
     )
-    depth_vec = depth_vec.squeeze(1)
-
-    # Prune based on
-    # Case 1: depth is zero (for this data, this means no-return)
-    nonzero_indices = torch.nonzero(depth_vec)
-    if nonzero_indices.dim() == 0:
-        return (None, None)
-    nonzero_indices = nonzero_indices.squeeze(1)
-    depth_vec = torch.index_select(depth_vec, 0, nonzero_indices)
-
-    # prune u_vec and v_vec, then multiply by already pruned depth_vec
-    u_a_pruned = torch.index_select(uv_a_vec[0], 0, nonzero_indices)
-    u_vec = u_a_pruned.type(dtype_float) * depth_vec
-
-    v_a_pruned = torch.index_select(uv_a_vec[1], 0, nonzero_indices)
-    v_vec = v_a_pruned.type(dtype_float) * depth_vec
-
-    z_vec = depth_vec
-
-    full_vec = torch.stack((u_vec, v_vec, z_vec))
-
-    K_a_inv_torch = torch.from_numpy(K_a_inv).type(dtype_float)
-    point_camera_frame_rdf_vec = K_a_inv_torch.mm(full_vec)
-
-    point_world_frame_rdf_vec = apply_transform_torch(
-        point_camera_frame_rdf_vec, torch.from_numpy(img_a_pose).type(dtype_float)
-    )
-    point_camera_2_frame_rdf_vec = apply_transform_torch(
-        point_world_frame_rdf_vec,
-        torch.from_numpy(invert_transform(img_b_pose)).type(dtype_float),
-    )
-
-    K_b_torch = torch.from_numpy(K_b).type(dtype_float)
-    vec2_vec = K_b_torch.mm(point_camera_2_frame_rdf_vec)
-
-    u2_vec = vec2_vec[0] / vec2_vec[2]
-    v2_vec = vec2_vec[1] / vec2_vec[2]
-
-    z2_vec = vec2_vec[2]
-
-    # Prune based on
-    # Case 2: the pixels projected into image b are outside FOV
-    # u2_vec bounds should be: 0, image_width
-    # v2_vec bounds should be: 0, image_height
-
-    # do u2-based pruning
-    u2_vec_lower_bound = 0.0
-    epsilon = 1e-3
-    u2_vec_upper_bound = (
-        image_b_width * 1.0 - epsilon
-    )  # careful, needs to be epsilon less!!
-    lower_bound_vec = torch.ones_like(u2_vec) * u2_vec_lower_bound
-    upper_bound_vec = torch.ones_like(u2_vec) * u2_vec_upper_bound
-    zeros_vec = torch.zeros_like(u2_vec)
-
-    u2_vec = where(u2_vec < lower_bound_vec, zeros_vec, u2_vec)
-    u2_vec = where(u2_vec > upper_bound_vec, zeros_vec, u2_vec)
-    in_bound_indices = torch.nonzero(u2_vec)
-    if in_bound_indices.dim() == 0:
-        return (None, None)
-    in_bound_indices = in_bound_indices.squeeze(1)
-
-    # apply pruning
-    u2_vec = torch.index_select(u2_vec, 0, in_bound_indices)
-    v2_vec = torch.index_select(v2_vec, 0, in_bound_indices)
-    z2_vec = torch.index_select(z2_vec, 0, in_bound_indices)
-    u_a_pruned = torch.index_select(
-        u_a_pruned, 0, in_bound_indices
-    )  # also prune from first list
-    v_a_pruned = torch.index_select(
-        v_a_pruned, 0, in_bound_indices
-    )  # also prune from first list
-
-    # do v2-based pruning
-    v2_vec_lower_bound = 0.0
-    v2_vec_upper_bound = image_b_height * 1.0 - epsilon
-    lower_bound_vec = torch.ones_like(v2_vec) * v2_vec_lower_bound
-    upper_bound_vec = torch.ones_like(v2_vec) * v2_vec_upper_bound
-    zeros_vec = torch.zeros_like(v2_vec)
-
-    v2_vec = where(v2_vec < lower_bound_vec, zeros_vec, v2_vec)
-    v2_vec = where(v2_vec > upper_bound_vec, zeros_vec, v2_vec)
-    in_bound_indices = torch.nonzero(v2_vec)
-    if in_bound_indices.dim() == 0:
-        return (None, None)
-    in_bound_indices = in_bound_indices.squeeze(1)
-
-    # apply pruning
-    u2_vec = torch.index_select(u2_vec, 0, in_bound_indices)
-    v2_vec = torch.index_select(v2_vec, 0, in_bound_indices)
-    z2_vec = torch.index_select(z2_vec, 0, in_bound_indices)
-    u_a_pruned = torch.index_select(
-        u_a_pruned, 0, in_bound_indices
-    )  # also prune from first list
-    v_a_pruned = torch.index_select(
-        v_a_pruned, 0, in_bound_indices
-    )  # also prune from first list
-
-    # Prune based on
-    # Case 3: the pixels in image b are occluded, OR there is no depth return in image b so we aren't sure
-
-    img_b_depth_torch = torch.from_numpy(img_b_depth).type(dtype_float)
-    img_b_depth_torch = torch.squeeze(img_b_depth_torch, 0)
-    img_b_depth_torch = img_b_depth_torch.view(-1, 1)
-
-    uv_b_vec_flattened = v2_vec.type(dtype_long) * image_b_width + u2_vec.type(
-        dtype_long
-    )  # simply round to int -- good enough
-    # occlusion check for smooth surfaces
-
-    # print("B" + "-"*50)
-    # print(max(uv_b_vec_flattened) if len(uv_b_vec_flattened)!=0 else -1)
-    # print(img_b_depth_torch.shape)
-    # print("B" + "-"*50)
-
-    depth2_vec = (
-        torch.index_select(img_b_depth_torch, 0, uv_b_vec_flattened) * 1.0 / 1000
-    )
-    depth2_vec = depth2_vec.squeeze(1)
-
-    # occlusion margin, in meters
-    occlusion_margin = 0.003
-    z2_vec = z2_vec - occlusion_margin
-    zeros_vec = torch.zeros_like(depth2_vec)
-
-    depth2_vec = where(
-        depth2_vec < zeros_vec, zeros_vec, depth2_vec
-    )  # to be careful, prune any negative depths
-    depth2_vec = where(depth2_vec < z2_vec, zeros_vec, depth2_vec)  # prune occlusions
-    non_occluded_indices = torch.nonzero(depth2_vec)
-    if non_occluded_indices.dim() == 0:
-        return (None, None)
-    non_occluded_indices = non_occluded_indices.squeeze(1)
-    depth2_vec = torch.index_select(depth2_vec, 0, non_occluded_indices)
-
-    # apply pruning
-    u2_vec = torch.index_select(u2_vec, 0, non_occluded_indices)
-    v2_vec = torch.index_select(v2_vec, 0, non_occluded_indices)
-    u_a_pruned = torch.index_select(
-        u_a_pruned, 0, non_occluded_indices
-    )  # also prune from first list
-    v_a_pruned = torch.index_select(
-        v_a_pruned, 0, non_occluded_indices
-    )  # also prune from first list
-
-    uv_b_vec = (u2_vec, v2_vec)
-    uv_a_vec = (u_a_pruned, v_a_pruned)
-    return (uv_a_vec, uv_b_vec)
@@ -0,0 +1,270 @@
+"""
+NumPy implementation of the correspondence sampling of correspondence_finder,
+selected with correspondence_backend: numpy in training.yaml.
+
+At the sizes used at train time the torch version is dominated by per-op
+dispatch and by torch's intra-op threads competing with the DataLoader
+workers. This version runs the same tests on NumPy arrays in the calling
+thread. The whole a -> b reprojection is folded into a single 3 x 4 matrix per
+pair. The random draws come from np.random rather than torch, so results match
+the torch version in distribution only.
+
+The functions take and return the same arguments and torch tensors as their
+correspondence_finder counterparts, see those for the details. The
+non-correspondences are sampled with NumPy by both backends, this module
+uses the correspondence_finder functions for them.
+"""
+
+import numpy as np
+import torch
+from densenets.correspondence_tools.correspondence_finder import (
+    MAX_OCCLUSION_MARGIN,
+    OCCLUSION_MARGIN,
+    OCCLUSION_SLOPE_PIXELS,
+    OcclusionMode,
+    create_masked_and_background_non_correspondences,
+    create_non_correspondences,
+    invert_transform,
+    match_stats,
+)
+from densenets.correspondence_tools.projection_context import get_projection_context
+from densenets.dense_correspondence_manipulation.utils import constants
+
+
+def batch_find_pixel_correspondences(
+    img_a_depth,
+    img_a_pose,
+    img_b_depth,
+    img_b_pose,
+    uv_a=None,
+    num_attempts=20,
+    device=None,
+    img_a_mask=None,
+    K=None,
+    img_a_mask_index=None,
+    dtype=None,
+    occlusion_mode=OcclusionMode.NEAREST,
+    return_stats=False,
+):
+    """
+    See correspondence_finder.batch_find_pixel_correspondences. device and
+    dtype are accepted for compatibility and ignored, the results are CPU
+    tensors.
+    :return: (uv_a, uv_b), tuples of (u,v) torch.LongTensors and
+             torch.FloatTensors, or (None, None) if the mask of image a is
+             empty. The match_stats() come third if return_stats is set.
+    :rtype: tuple
+    """
+    assert img_a_depth.shape == img_b_depth.shape
+    image_height, image_width = img_a_depth.shape[0:2]
+
+    if uv_a is not None:
+        u_a = np.array([uv_a[0]], dtype=np.int64).reshape(-1)
+        v_a = np.array([uv_a[1]], dtype=np.int64).reshape(-1)
+        flat_a = v_a * image_width + u_a
+    elif img_a_mask_index is not None:
+        flat_a = _sample_from_pixels(img_a_mask_index.inside, num_attempts)
+    elif img_a_mask is not None:
+        flat_a = _sample_from_pixels(
+            np.flatnonzero(np.asarray(img_a_mask)), num_attempts
+        )
+    else:
+        flat_a = _sample_uniform(image_width, image_height, num_attempts)
+
+    if flat_a is None:
+        if return_stats:
+            return (None, None, match_stats(0, 0, 0, 0))
+        return (None, None)
+
+    return _find_correspondences(
+        img_a_depth,
+        img_a_pose,
+        img_b_depth,
+        img_b_pose,
+        flat_a,
+        K,
+        occlusion_mode,
+        return_stats,
+    )
+
+
+def compute_correspondences_for_pixels(
+    img_a_depth,
+    img_a_pose,
+    img_b_depth,
+    img_b_pose,
+    uv_a_vec,
+    K=None,
+    occlusion_mode=OcclusionMode.NEAREST,
+    return_stats=False,
+    **kwargs
+):
+    """
+    See correspondence_finder.compute_correspondences_for_pixels
+    :param uv_a_vec: pixels of image a, (u,v) torch.LongTensors or arrays
+    :type uv_a_vec: tuple
+    """
+    image_width = img_a_depth.shape[1]
+    u_a = np.asarray(uv_a_vec[0], dtype=np.int64)
+    v_a = np.asarray(uv_a_vec[1], dtype=np.int64)
+    return _find_correspondences(
+        img_a_depth,
+        img_a_pose,
+        img_b_depth,
+        img_b_pose,
+        v_a * image_width + u_a,
+        K,
+        occlusion_mode,
+        return_stats,
+    )
+
+
+def _find_correspondences(
+    img_a_depth,
+    img_a_pose,
+    img_b_depth,
+    img_b_pose,
+    flat_a,
+    K,
+    occlusion_mode=OcclusionMode.NEAREST,
+    return_stats=False,
+):
+    """
+    Runs the three pruning tests of correspondence_finder._reproject on the
+    flattened pixels flat_a of image a and returns the survivors
+    :rtype: tuple of tuples of torch.Tensors
+    """
+    num_attempts = len(flat_a)
+    image_height, image_width = img_b_depth.shape[0:2]
+    context = get_projection_context(K)
+
+    # pixel a -> pixel b, as a single 3 x 4 matrix applied to depth * (u, v, 1)
+    a_to_b = invert_transform(img_b_pose).dot(img_a_pose)[0:3]
+    projection = context.K.dot(a_to_b)
+    projection[:, 0:3] = projection[:, 0:3].dot(context.K_inv)
+    projection = projection.astype(np.float32)
+
+    # Case 1: depth is zero (for this data, this means no-return)
+    depth_vec = img_a_depth.reshape(-1)[flat_a].astype(np.float32) / np.float32(
+        constants.DEPTH_IM_SCALE
+    )
+    keep = np.flatnonzero(depth_vec)
+    flat_a = flat_a[keep]
+    depth_vec = depth_vec[keep]
+
+    u_a = flat_a % image_width
+    v_a = flat_a // image_width
+    uv1 = np.empty((3, len(flat_a)), dtype=np.float32)
+    uv1[0] = u_a
+    uv1[1] = v_a
+    uv1[2] = 1.0
+    vec2_vec = projection[:, 0:3].dot(uv1)
+    vec2_vec *= depth_vec
+    vec2_vec += projection[:, 3:4]
+
+    z2_vec = vec2_vec[2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u2_vec = vec2_vec[0] / z2_vec
+        v2_vec = vec2_vec[1] / z2_vec
+
+    # Case 2: the pixels projected into image b are outside FOV
+    epsilon = 1e-3
+    in_view = (u2_vec > 0) & (u2_vec <= image_width * 1.0 - epsilon)
+    in_view &= (v2_vec > 0) & (v2_vec <= image_height * 1.0 - epsilon)
+    keep = np.flatnonzero(in_view)
+
+    # Case 3: the pixels in image b are occluded, OR there is no depth return
+    # in image b so we aren't sure
+    u2_vec = u2_vec[keep]
+    v2_vec = v2_vec[keep]
+    visible = _visible_in_image_b(
+        img_b_depth, u2_vec, v2_vec, z2_vec[keep], occlusion_mode
+    )
+    num_in_view = len(keep)
+    keep = keep[visible]
+
+    uv_a_vec = (torch.from_numpy(u_a[keep]), torch.from_numpy(v_a[keep]))
+    uv_b_vec = (
+        torch.from_numpy(np.ascontiguousarray(u2_vec[visible])),
+        torch.from_numpy(np.ascontiguousarray(v2_vec[visible])),
+    )
+    if return_stats:
+        stats = match_stats(num_attempts, len(flat_a), num_in_view, len(keep))
+        return (uv_a_vec, uv_b_vec, stats)
+    return (uv_a_vec, uv_b_vec)
+
+
+def _visible_in_image_b(img_b_depth, u2_vec, v2_vec, z2_vec, occlusion_mode):
+    """
+    The occlusion test of correspondence_finder._visible_in_image_b, for
+    pixels that are all inside of image b
+    :return: the pixels that are visible in image b
+    :rtype: numpy.ndarray (bool)
+    """
+    image_height, image_width = img_b_depth.shape[0:2]
+    img_b_depth = img_b_depth.reshape(-1)
+
+    if occlusion_mode == OcclusionMode.NEAREST:
+        flat_b = v2_vec.astype(np.int64) * image_width + u2_vec.astype(np.int64)
+        depth2_vec = img_b_depth[flat_b].astype(np.float32) / np.float32(
+            constants.DEPTH_IM_SCALE
+        )
+        return (depth2_vec > 0) & (depth2_vec >= z2_vec - OCCLUSION_MARGIN)
+
+    if occlusion_mode != OcclusionMode.BILINEAR:
+        raise ValueError("unknown occlusion_mode %s" % (occlusion_mode,))
+
+    # the 2 x 2 pixels around (u2, v2)
+    x = np.clip(u2_vec, 0, image_width - 1)
+    y = np.clip(v2_vec, 0, image_height - 1)
+    x0 = np.minimum(np.floor(x), max(image_width - 2, 0))
+    y0 = np.minimum(np.floor(y), max(image_height - 2, 0))
+    fx = x - x0
+    fy = y - y0
+    flat00 = y0.astype(np.int64) * image_width + x0.astype(np.int64)
+    step_u = 1 if image_width > 1 else 0
+    step_v = image_width if image_height > 1 else 0
+    steps = np.array([0, step_u, step_v, step_u + step_v])
+    depths = img_b_depth[flat00 + steps[:, None]].astype(np.float32) / np.float32(
+        constants.DEPTH_IM_SCALE
+    )
+    weights = np.stack(((1 - fx) * (1 - fy), fx * (1 - fy), (1 - fx) * fy, fx * fy))
+
+    has_depth2 = depths > 0
+    weights *= has_depth2
+    weight_sum = weights.sum(0)
+    depth2_vec = (weights * depths).sum(0) / np.maximum(weight_sum, np.float32(1e-12))
+
+    d00, d10, d01, d11 = depths
+    slope_u = (d10 - d00) * (1 - fy) + (d11 - d01) * fy
+    slope_v = (d01 - d00) * (1 - fx) + (d11 - d10) * fx
+    slope = np.where(has_depth2.all(0), np.abs(slope_u) + np.abs(slope_v), 0)
+    occlusion_margin = np.minimum(
+        OCCLUSION_MARGIN + OCCLUSION_SLOPE_PIXELS * slope, MAX_OCCLUSION_MARGIN
+    )
+
+    return (weight_sum > 0) & (depth2_vec >= z2_vec - occlusion_margin)
+
+
+def _sample_from_pixels(pixels, num_samples):
+    """
+    :param pixels: flattened pixel indices
+    :type pixels: numpy.ndarray
+    :return: num_samples of them drawn uniformly with replacement, None if
+             pixels is empty
+    :rtype: numpy.ndarray (int64)
+    """
+    if len(pixels) == 0:
+        return None
+    rows = np.random.randint(0, len(pixels), size=num_samples)
+    return pixels[rows].astype(np.int64)
+
+
+def _sample_uniform(image_width, image_height, num_samples):
+    """
+    :return: num_samples flattened pixel indices drawn uniformly from the image
+    :rtype: numpy.ndarray (int64)
+    """
+    return np.random.randint(0, image_width * image_height, size=num_samples).astype(
+        np.int64
+    )
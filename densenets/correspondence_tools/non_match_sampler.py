@@ -0,0 +1,127 @@
+"""
+Draws the non-matches of a set of matches in image b, see
+correspondence_finder.create_non_correspondences.
+
+Every non-match is drawn uniformly from a sorted list of flattened pixels,
+a MaskIndex's inside or outside pixels or the whole image, leaving out the
+pixels closer than min_distance to its match. The excluded square around a
+match covers one contiguous run of the sorted list per image row. A uniform
+index into the remaining pixels is mapped to a pixel by shifting it past
+those runs, so no sample is ever rejected or perturbed.
+"""
+
+import numpy as np
+
+
+class NonMatchSampler(object):
+    """
+    Samples the non-matches of a fixed set of matches from any number of
+    pixel lists. The excluded squares are computed once, in the constructor.
+    """
+
+    def __init__(self, flat_matches, image_height, image_width, min_distance=1):
+        """
+        :param flat_matches: flattened pixel n = u + W * v of each match in
+            image b
+        :type flat_matches: numpy.ndarray, shape [M]
+        :param min_distance: non-matches are at least this many pixels away
+            from their match in u or in v, i.e. max(|du|, |dv|) >= min_distance.
+            0 allows the match itself.
+        :type min_distance: int
+        """
+        flat_matches = np.asarray(flat_matches, dtype=np.int64)
+        self.num_matches = len(flat_matches)
+        self.image_height = int(image_height)
+        self.image_width = int(image_width)
+        self.min_distance = int(min_distance)
+
+        # the excluded square around each match, as one [start, stop) range of
+        # flattened pixels per image row, [M, 2 * min_distance - 1]
+        self._start = None
+        self._stop = None
+        self._outside_image = None
+        if self.min_distance > 0 and self.num_matches > 0:
+            radius = self.min_distance - 1
+            v = flat_matches // image_width
+            u = flat_matches - v * image_width
+            v_rows = v[:, None] + np.arange(-radius, radius + 1)
+            u_start = np.maximum(u - radius, 0)[:, None]
+            u_stop = np.minimum(u + radius + 1, image_width)[:, None]
+            self._start = v_rows * image_width + u_start
+            self._stop = v_rows * image_width + u_stop
+            self._outside_image = (v_rows < 0) | (v_rows >= image_height)
+
+    def sample(self, num_non_matches_per_match, pixels=None):
+        """
+        Draws the non-matches of every match uniformly from the pixels that
+        are at least min_distance away from it. If the excluded square covers
+        all of pixels the non-matches of that match are drawn from all of them.
+        :param num_non_matches_per_match:
+        :type num_non_matches_per_match: int
+        :param pixels: sorted flattened pixels to draw from, None for the
+            whole image
+        :type pixels: numpy.ndarray
+        :return: flattened non-matches, row i holding those of match i, None if
+            pixels is empty
+        :rtype: numpy.ndarray (int64), shape [M, num_non_matches_per_match]
+        """
+        if pixels is None:
+            num_pixels = self.image_height * self.image_width
+        else:
+            num_pixels = len(pixels)
+        if num_pixels == 0:
+            return None
+
+        shape = (self.num_matches, num_non_matches_per_match)
+        if self._start is None:
+            rows = np.random.randint(0, num_pixels, size=shape)
+            return self._rows_to_pixels(rows, pixels)
+
+        # the excluded ranges as rows of the pixel list
+        if pixels is None:
+            start = self._start
+            lengths = self._stop - self._start
+        else:
+            start = np.searchsorted(pixels, self._start)
+            lengths = np.searchsorted(pixels, self._stop) - start
+        lengths[self._outside_image] = 0
+
+        num_allowed = num_pixels - lengths.sum(axis=1)
+        covered = num_allowed <= 0
+        if covered.any():
+            lengths[covered] = 0
+            num_allowed[covered] = num_pixels
+
+        rows = np.random.randint(0, num_allowed[:, None], size=shape)
+        for j in range(lengths.shape[1]):
+            np.add(
+                rows,
+                lengths[:, j : j + 1],
+                out=rows,
+                where=rows >= start[:, j : j + 1],
+            )
+
+        return self._rows_to_pixels(rows, pixels)
+
+    @staticmethod
+    def _rows_to_pixels(rows, pixels):
+        if pixels is None:
+            return rows
+        return pixels[rows].astype(np.int64, copy=False)
+
+
+def sample_non_matches(
+    flat_matches,
+    num_non_matches_per_match,
+    image_height,
+    image_width,
+    pixels=None,
+    min_distance=1,
+):
+    """
+    Shorthand for NonMatchSampler(...).sample(...) with a single pixel list
+    :return: see NonMatchSampler.sample()
+    :rtype: numpy.ndarray (int64), shape [M, num_non_matches_per_match]
+    """
+    sampler = NonMatchSampler(flat_matches, image_height, image_width, min_distance)
+    return sampler.sample(num_non_matches_per_match, pixels=pixels)
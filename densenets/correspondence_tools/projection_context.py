@@ -0,0 +1,190 @@
+"""
+Camera intrinsics in the forms needed to project pixels to 3D and back,
+computed once per intrinsics matrix and image size rather than on every call.
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from numpy.linalg import inv
+
+# number of (K, image size) combinations kept by get_projection_context()
+PROJECTION_CONTEXT_CACHE_SIZE = 16
+
+_projection_contexts = OrderedDict()
+_projection_contexts_lock = threading.Lock()
+
+
+def get_default_K_matrix():
+    K = np.zeros((3, 3))
+    K[0, 0] = 533.6422696034836  # focal x
+    K[1, 1] = 534.7824445233571  # focal y
+    K[0, 2] = 319.4091030774892  # principal point x
+    K[1, 2] = 236.4374299691866  # principal point y
+    K[2, 2] = 1.0
+    return K
+
+
+class ProjectionContext(object):
+    """
+    Holds K and K_inv, as float64 numpy arrays and as float32 torch tensors,
+    and the unit ray grid of an image: the [3, H*W] tensor of
+    K_inv * (u, v, 1) for every pixel n = u + W * v. Back-projecting a whole
+    depth image is then a single multiply of the grid by the depths.
+
+    Sampled pixels are back-projected with pixel_rays(), which evaluates
+    the same float32 expression as the grid for just those pixels: gathering
+    scattered pixels from the grid is slower than recomputing their rays.
+
+    Use get_projection_context() to share contexts rather than building them.
+    Contexts are safe to use from several threads, the ray grid is kept once
+    per device.
+    """
+
+    def __init__(self, K, image_height=None, image_width=None):
+        """
+        :param K: 3 x 3 pinhole camera intrinsics matrix, last row [0, 0, 1]
+        :type K: numpy.ndarray
+        :param image_height, image_width: size of the images, only needed for
+            the ray grid
+        :type image_height, image_width: int
+        """
+        self.K = np.array(K, dtype=np.float64)
+        if not np.array_equal(self.K[2], [0.0, 0.0, 1.0]):
+            raise ValueError(
+                "K must be a pinhole intrinsics matrix with last row [0, 0, 1], "
+                "got %s" % (self.K,)
+            )
+        self.K_inv = inv(self.K)
+        self.K_torch = torch.from_numpy(self.K).float()
+        self.K_inv_torch = torch.from_numpy(self.K_inv).float()
+        self.image_height = image_height
+        self.image_width = image_width
+        self._ray_grids = dict()
+        self._lock = threading.Lock()
+
+    def pixel_rays(self, u_vec, v_vec, dtype=torch.float32):
+        """
+        :param u_vec, v_vec: pixel coordinates, of any shape
+        :type u_vec, v_vec: torch.Tensor
+        :param dtype: floating point dtype of the rays
+        :type dtype: torch.dtype
+        :return: x and y of K_inv * (u, v, 1), the z of every ray is 1
+        :rtype: torch.Tensor, torch.Tensor
+        """
+        K_inv = self.K_inv
+        u_vec = u_vec.to(dtype)
+        v_vec = v_vec.to(dtype)
+        ray_x = torch.add(float(K_inv[0, 2]), u_vec, alpha=float(K_inv[0, 0]))
+        if K_inv[0, 1] != 0:
+            ray_x.add_(v_vec, alpha=float(K_inv[0, 1]))
+        ray_y = torch.add(float(K_inv[1, 2]), v_vec, alpha=float(K_inv[1, 1]))
+        return ray_x, ray_y
+
+    @property
+    def ray_grid(self):
+        """
+        :return: K_inv * (u, v, 1) of every pixel, on the CPU
+        :rtype: torch.FloatTensor with shape [3, H*W]
+        """
+        return self.get_ray_grid(torch.device('cpu'), torch.float32)
+
+    def get_ray_grid(self, device, dtype=torch.float32):
+        """
+        :return: K_inv * (u, v, 1) of every pixel, built on first use for
+                 each device and dtype
+        :rtype: torch.Tensor with shape [3, H*W]
+        """
+        key = (device, dtype)
+        with self._lock:
+            ray_grid = self._ray_grids.get(key)
+            if ray_grid is None:
+                if self.image_height is None or self.image_width is None:
+                    raise ValueError("the ray grid needs the image size")
+                flat = torch.arange(self.image_height * self.image_width, device=device)
+                ray_x, ray_y = self.pixel_rays(
+                    flat % self.image_width, flat // self.image_width, dtype=dtype
+                )
+                ray_grid = torch.stack((ray_x, ray_y, torch.ones_like(ray_x)))
+                self._ray_grids[key] = ray_grid
+        return ray_grid
+
+    def back_project(self, u_vec, v_vec, depth_vec, dim=0):
+        """
+        :param u_vec, v_vec: pixel coordinates
+        :type u_vec, v_vec: torch.LongTensor
+        :param depth_vec: depth of each pixel, in meters, same shape
+        :type depth_vec: torch.FloatTensor
+        :param dim: dimension along which x, y, z are stacked
+        :type dim: int
+        :return: the points in camera frame, e.g. [3, N] for [N] pixels, with
+                 the device and dtype of depth_vec
+        :rtype: torch.FloatTensor
+        """
+        ray_x, ray_y = self.pixel_rays(u_vec, v_vec, dtype=depth_vec.dtype)
+        return torch.stack(
+            (ray_x.mul_(depth_vec), ray_y.mul_(depth_vec), depth_vec), dim
+        )
+
+    def back_project_image(self, depth_vec):
+        """
+        Same as back_project() for every pixel of the image, in order
+        :param depth_vec: flattened depth image, in meters
+        :type depth_vec: torch.FloatTensor with shape [H*W]
+        :return: the points in camera frame
+        :rtype: torch.FloatTensor with shape [3, H*W]
+        """
+        return self.get_ray_grid(depth_vec.device, depth_vec.dtype) * depth_vec
+
+    def image_to_camera(self, uv, z):
+        """
+        Takes a (u,v) pixel location to its 3D location in camera frame
+        :param uv: pixel location in image
+        :type uv:
+        :param z: depth, in camera frame
+        :type z: float
+        :return: (x,y,z) in camera frame
+        :rtype: numpy.array size (3,)
+        """
+        return z * self.K_inv.dot(np.array([uv[0], uv[1], 1]))
+
+    def image_to_world(self, uv, z, camera_to_world):
+        """
+        Same as image_to_camera() but in world frame
+        :param camera_to_world: 4 x 4 homogeneous transform
+        :type camera_to_world: numpy array
+        :return: (x,y,z) in world frame
+        :rtype: numpy.array size (3,)
+        """
+        pos_in_camera_frame = self.image_to_camera(uv, z)
+        return np.dot(camera_to_world, np.append(pos_in_camera_frame, 1))[:3]
+
+
+def get_projection_context(K=None, image_height=None, image_width=None):
+    """
+    Returns the shared ProjectionContext for these intrinsics and image size,
+    keeping the last PROJECTION_CONTEXT_CACHE_SIZE of them
+    :param K: 3 x 3 camera intrinsics matrix, defaults to get_default_K_matrix()
+    :type K: numpy.ndarray
+    :param image_height, image_width:
+    :type image_height, image_width: int
+    :return:
+    :rtype: ProjectionContext
+    """
+    if K is None:
+        K = get_default_K_matrix()
+    K = np.asarray(K, dtype=np.float64)
+
+    key = (K.tobytes(), image_height, image_width)
+    with _projection_contexts_lock:
+        context = _projection_contexts.get(key)
+        if context is None:
+            context = ProjectionContext(K, image_height, image_width)
+            _projection_contexts[key] = context
+            if len(_projection_contexts) > PROJECTION_CONTEXT_CACHE_SIZE:
+                _projection_contexts.popitem(last=False)
+        else:
+            _projection_contexts.move_to_end(key)
+    return context
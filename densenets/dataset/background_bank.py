@@ -0,0 +1,176 @@
+import atexit
+import os
+import time
+from multiprocessing import shared_memory
+
+import densenets.correspondence_tools.correspondence_augmentation as correspondence_augmentation
+import numpy as np
+from densenets.dataset.frame_bank import get_resident_memory_bytes
+from PIL import Image, ImageOps
+
+# the backgrounds are this much larger than the images in each direction, so
+# that random crops of them differ
+CROP_MARGIN = 0.25
+
+# largest change of the brightness of a channel by the random tint
+MAX_TINT = 0.2
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+
+
+class BackgroundBank(object):
+    """
+    Backgrounds for domain randomization held in a shared memory array of
+    shape [N, H, W, 3] uint8, either synthesized once with
+    correspondence_augmentation.get_random_image or loaded from image files.
+
+    sample() returns a random crop of a random background, randomly flipped
+    and tinted, which costs a single pass over the image rather than the
+    synthesis of a new one. The DataLoader workers inherit the array through
+    fork, like the FrameBank.
+    """
+
+    def __init__(self, num_backgrounds, image_height, image_width):
+        """
+        :param num_backgrounds: number of backgrounds in the bank
+        :type num_backgrounds: int
+        :param image_height, image_width: largest size of the images that
+            sample() is called for. The backgrounds are CROP_MARGIN larger.
+        :type image_height, image_width: int
+        """
+        if num_backgrounds <= 0:
+            raise ValueError("the background bank needs at least one background")
+
+        self._image_shape = (image_height, image_width)
+        background_height = int(round(image_height * (1 + CROP_MARGIN)))
+        background_width = int(round(image_width * (1 + CROP_MARGIN)))
+        shape = (num_backgrounds, background_height, background_width, 3)
+
+        self._shared_memory = shared_memory.SharedMemory(
+            create=True, size=int(np.prod(shape))
+        )
+        self._backgrounds = np.ndarray(
+            shape, dtype=np.uint8, buffer=self._shared_memory.buf
+        )
+        self._owner_pid = os.getpid()
+        self.load_time = None
+        atexit.register(self.close)
+
+    @staticmethod
+    def synthesize(num_backgrounds, image_height, image_width):
+        """
+        Fills a bank with the random solid, gradient and noise images of
+        correspondence_augmentation.get_random_image
+        :rtype: BackgroundBank
+        """
+        start_time = time.time()
+        bank = BackgroundBank(num_backgrounds, image_height, image_width)
+        for background in bank._backgrounds:
+            background[:] = correspondence_augmentation.get_random_image(
+                background.shape
+            )
+        bank.load_time = time.time() - start_time
+        return bank
+
+    @staticmethod
+    def from_directory(directory, image_height, image_width, num_backgrounds=0):
+        """
+        Fills a bank with the images in a directory, e.g. a texture dataset,
+        each scaled and center cropped to the size of the backgrounds
+        :param num_backgrounds: use the first num_backgrounds images in sorted
+            order, all of them if 0
+        :type num_backgrounds: int
+        :rtype: BackgroundBank
+        """
+        start_time = time.time()
+        filenames = sorted(
+            os.path.join(directory, x)
+            for x in os.listdir(directory)
+            if x.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        if num_backgrounds > 0:
+            filenames = filenames[0:num_backgrounds]
+        if len(filenames) == 0:
+            raise ValueError("no background images found in %s" % (directory))
+
+        bank = BackgroundBank(len(filenames), image_height, image_width)
+        background_size = (bank._backgrounds.shape[2], bank._backgrounds.shape[1])
+        for background, filename in zip(bank._backgrounds, filenames):
+            image = Image.open(filename).convert('RGB')
+            background[:] = np.asarray(
+                ImageOps.fit(image, background_size, Image.BILINEAR)
+            )
+        bank.load_time = time.time() - start_time
+        return bank
+
+    def close(self):
+        """
+        Releases the shared memory. Only unlinks it in the process that created
+        the bank.
+        """
+        if self._shared_memory is None:
+            return
+        self._backgrounds = None
+        self._shared_memory.close()
+        if os.getpid() == self._owner_pid:
+            self._shared_memory.unlink()
+        self._shared_memory = None
+
+    @property
+    def num_backgrounds(self):
+        return self._backgrounds.shape[0]
+
+    @property
+    def nbytes(self):
+        return self._backgrounds.nbytes
+
+    def sample(self, shape):
+        """
+        A random crop of a random background, flipped up/down and left/right
+        with probability 0.5 each and with every channel scaled by a random
+        factor within 1 +- MAX_TINT. Uses the global numpy random state, like
+        get_random_image.
+        :param shape: (H, W, 3), at most the image size the bank was made for
+        :type shape: tuple of ints
+        :return: a new image, the bank is not modified
+        :rtype: numpy.ndarray [H, W, 3] uint8
+        """
+        image_height, image_width = shape[0], shape[1]
+        if (image_height > self._image_shape[0]) or (
+            image_width > self._image_shape[1]
+        ):
+            raise ValueError(
+                "the background bank was made for images of at most %s, got %s"
+                % (self._image_shape, (image_height, image_width))
+            )
+
+        background = self._backgrounds[np.random.randint(self.num_backgrounds)]
+        top = np.random.randint(background.shape[0] - image_height + 1)
+        left = np.random.randint(background.shape[1] - image_width + 1)
+        crop = background[top : top + image_height, left : left + image_width]
+        if np.random.uniform() < 0.5:
+            crop = crop[::-1]
+        if np.random.uniform() < 0.5:
+            crop = crop[:, ::-1]
+
+        # the tint is applied through a lookup table per channel, which also
+        # copies the crop out of the bank
+        gains = np.random.uniform(1 - MAX_TINT, 1 + MAX_TINT, 3)
+        lookup = np.clip(np.arange(256)[:, None] * gains, 0, 255).astype(np.uint8)
+        image = np.empty((image_height, image_width, 3), dtype=np.uint8)
+        for channel in range(3):
+            np.take(lookup[:, channel], crop[:, :, channel], out=image[:, :, channel])
+        return image
+
+    def get_stats(self):
+        """
+        :return: number of backgrounds, size of the bank, the time it took to
+                 fill it and the resident memory of this process
+        :rtype: dict
+        """
+        stats = dict()
+        stats['num_backgrounds'] = self.num_backgrounds
+        stats['bank_bytes'] = self.nbytes
+        stats['load_time'] = self.load_time
+        stats['resident_memory_bytes'] = get_resident_memory_bytes()
+        return stats
@@ -0,0 +1,136 @@
+import torch
+from densenets.dataset.dense_correspondence_dataset_masked import (
+    PIXEL_INDEX_DTYPE,
+    DenseCorrespondenceDataset,
+)
+
+# positions of the match and non-match index lists in the tuple returned by
+# SpartanDataset.__getitem__: matches_a, matches_b, masked_non_matches_a,
+# masked_non_matches_b, background_non_matches_a, background_non_matches_b,
+# blind_non_matches_a, blind_non_matches_b
+INDEX_FIELDS = range(3, 11)
+
+
+def pack_indices(index_tensors):
+    """
+    Concatenates variable length index lists into a single tensor plus
+    offsets, the indices of sample i being values[offsets[i]:offsets[i+1]].
+    Placeholders made by DenseCorrespondenceDataset.empty_tensor() are packed
+    as empty lists.
+    :param index_tensors: one 1-D tensor of pixel indices per sample
+    :type index_tensors: list
+    :return: values, see PIXEL_INDEX_DTYPE, and offsets with shape [N + 1]
+    :rtype: torch.IntTensor, torch.LongTensor
+    """
+    non_empty = [
+        tensor.to(PIXEL_INDEX_DTYPE)
+        for tensor in index_tensors
+        if not DenseCorrespondenceDataset.is_empty(tensor)
+    ]
+    lengths = [
+        0 if DenseCorrespondenceDataset.is_empty(tensor) else len(tensor)
+        for tensor in index_tensors
+    ]
+
+    offsets = torch.zeros(len(index_tensors) + 1, dtype=torch.long)
+    offsets[1:] = torch.cumsum(torch.LongTensor(lengths), 0)
+    if len(non_empty) > 0:
+        values = torch.cat(non_empty)
+    else:
+        values = torch.zeros(0, dtype=PIXEL_INDEX_DTYPE)
+    return values, offsets
+
+
+def unpack_indices(values, offsets, i):
+    """
+    Returns the indices of sample i, or DenseCorrespondenceDataset.empty_tensor()
+    if it has none, so that the result can be handed to the loss functions as is
+    :param values, offsets: see pack_indices()
+    :param i: sample in the batch
+    :type i: int
+    :return:
+    :rtype: torch.IntTensor
+    """
+    start = int(offsets[i])
+    end = int(offsets[i + 1])
+    if start == end:
+        return DenseCorrespondenceDataset.empty_tensor().to(values.device)
+    return values[start:end]
+
+
+def collate_metadata(metadata_list):
+    """
+    Turns a list of metadata dicts into a dict of lists, None where a sample
+    doesn't have a key (e.g. empty samples)
+    """
+    keys = []
+    for metadata in metadata_list:
+        for key in metadata:
+            if key not in keys:
+                keys.append(key)
+
+    return dict(
+        (key, [metadata.get(key) for metadata in metadata_list]) for key in keys
+    )
+
+
+def collate_matches(batch):
+    """
+    collate_fn for a DataLoader over a SpartanDataset, allowing batch sizes
+    above 1 even though every sample has a different number of matches and
+    non-matches.
+
+    Returns the same 12 fields as SpartanDataset.__getitem__, batched:
+
+    - match_type: torch.LongTensor with shape [N], -1 for empty samples
+    - image_a_rgb, image_b_rgb: stacked into [N, 3, H, W]
+    - each of the 8 index lists: a (values, offsets) tuple, see pack_indices()
+    - metadata: dict of lists, see collate_metadata()
+
+    :param batch: list of samples returned by SpartanDataset.__getitem__
+    :type batch: list of tuples
+    :return:
+    :rtype: tuple
+    """
+    match_type = torch.LongTensor([int(sample[0]) for sample in batch])
+    image_a_rgb = torch.stack([sample[1] for sample in batch])
+    image_b_rgb = torch.stack([sample[2] for sample in batch])
+
+    collated = [match_type, image_a_rgb, image_b_rgb]
+    for field in INDEX_FIELDS:
+        collated.append(pack_indices([sample[field] for sample in batch]))
+    collated.append(collate_metadata([sample[11] for sample in batch]))
+    return tuple(collated)
+
+
+def get_tensor_nbytes(data):
+    """
+    :return: bytes of all tensors in data, which may be nested in tuples,
+             lists and dicts
+    :rtype: int
+    """
+    if torch.is_tensor(data):
+        return data.element_size() * data.numel()
+    if isinstance(data, dict):
+        data = list(data.values())
+    if isinstance(data, (tuple, list)):
+        return sum(get_tensor_nbytes(x) for x in data)
+    return 0
+
+
+def get_payload_nbytes(data):
+    """
+    Size of the tensors of a sample of SpartanDataset.__getitem__ or of a batch
+    of collate_matches(). A DataLoader worker moves these tensors into shared
+    memory to hand them to the training process, so this is the per sample or
+    per batch payload of the workers.
+    :param data: a sample or a batch
+    :type data: tuple
+    :return: bytes of the images, of the 8 index lists and of all tensors
+    :rtype: dict
+    """
+    payload = dict()
+    payload['images'] = get_tensor_nbytes(data[1:3])
+    payload['indices'] = get_tensor_nbytes([data[field] for field in INDEX_FIELDS])
+    payload['total'] = get_tensor_nbytes(data)
+    return payload
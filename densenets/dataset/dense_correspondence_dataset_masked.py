@@ -7,6 +7,7 @@ import random
 
 import densenets.correspondence_tools.correspondence_augmentation as correspondence_augmentation
 import densenets.correspondence_tools.correspondence_finder as correspondence_finder
+import densenets.correspondence_tools.correspondence_finder_numpy as correspondence_finder_numpy
 import densenets.dense_correspondence_manipulation.utils.utils as utils
 import numpy as np
 import torch
@@ -25,6 +26,10 @@ from PIL import Image
 # For more info see:
 # http://pytorch.org/docs/master/data.html#torch.utils.data.Dataset
 
+# dtype of the flattened pixel indices v * W + u of the samples. int32 holds
+# images of up to 2^31 pixels at half the bytes that the DataLoader workers send
+PIXEL_INDEX_DTYPE = torch.int32
+
 
 class ComposeJoint(object):
     def __init__(self, transforms):
@@ -62,11 +67,25 @@ class ImageType:
     MASK = 2
 
 
+class StorageBackend:
+    PNG = "png"  # decode the individual png files
+    PACKED = "packed"  # memory-mapped shard written by pack_frame_store.py
+
+
+class CorrespondenceBackend:
+    TORCH = "torch"  # correspondence_finder
+    NUMPY = "numpy"  # correspondence_finder_numpy, no torch ops in the workers
+
+
 class DenseCorrespondenceDataset(data.Dataset):
     def __init__(self, debug=False):
 
         self.debug = debug
         self.mode = "train"
+        self._storage_backend = StorageBackend.PNG
+        self._correspondence_backend = CorrespondenceBackend.TORCH
+        self.non_match_min_distance = 1
+        self.occlusion_mode = correspondence_finder.OcclusionMode.NEAREST
         self.both_to_tensor = ComposeJoint(
             [[transforms.ToTensor(), transforms.ToTensor()]]
         )
@@ -74,6 +93,17 @@ class DenseCorrespondenceDataset(data.Dataset):
     def __len__(self):
         return self.num_images_total
 
+    @property
+    def _correspondence_finder(self):
+        """
+        The module of the correspondence backend. It is looked up rather than
+        stored, so that the dataset pickles into spawn and forkserver
+        DataLoader workers
+        """
+        if self._correspondence_backend == CorrespondenceBackend.NUMPY:
+            return correspondence_finder_numpy
+        return correspondence_finder
+
     def __getitem__(self, index):
         """
         The method through which the dataset is accessed for training.
@@ -125,7 +155,7 @@ class DenseCorrespondenceDataset(data.Dataset):
 
         # image b
         image_b_idx = self.get_img_idx_with_different_pose(
-            scene_name, image_a_pose, num_attempts=50
+            scene_name, image_a_pose, num_attempts=50, img_a_idx=image_a_idx
         )
         metadata['image_b_idx'] = image_b_idx
         if image_b_idx is None:
@@ -145,13 +175,14 @@ class DenseCorrespondenceDataset(data.Dataset):
         image_b_depth_numpy = np.asarray(image_b_depth)
 
         # find correspondences
-        uv_a, uv_b = correspondence_finder.batch_find_pixel_correspondences(
+        uv_a, uv_b = self._correspondence_finder.batch_find_pixel_correspondences(
             image_a_depth_numpy,
             image_a_pose,
             image_b_depth_numpy,
             image_b_pose,
             num_attempts=self.num_matching_attempts,
             img_a_mask=np.asarray(image_a_mask),
+            occlusion_mode=self.occlusion_mode,
         )
 
         if uv_a is None:
@@ -235,11 +266,12 @@ class DenseCorrespondenceDataset(data.Dataset):
         image_width = image_b_shape[1]
         image_height = image_b_shape[1]
 
-        uv_b_non_matches = correspondence_finder.create_non_correspondences(
+        uv_b_non_matches = self._correspondence_finder.create_non_correspondences(
             uv_b,
             image_b_shape,
             num_non_matches_per_match=self.num_non_matches_per_match,
             img_b_mask=image_b_mask,
+            min_distance=self.non_match_min_distance,
         )
 
         if self.debug:
@@ -351,9 +383,9 @@ class DenseCorrespondenceDataset(data.Dataset):
         """
         Makes a placeholder tensor
         :return:
-        :rtype:
+        :rtype: torch.IntTensor
         """
-        return torch.LongTensor([-1])
+        return torch.tensor([-1], dtype=PIXEL_INDEX_DTYPE)
 
     @staticmethod
     def is_empty(tensor):
@@ -385,6 +417,20 @@ class DenseCorrespondenceDataset(data.Dataset):
 
         return rgb, depth, mask, pose
 
+    def get_rgbd_mask_pose_arrays(self, scene_name, img_idx):
+        """
+        Same as get_rgbd_mask_pose but returns numpy arrays instead of PIL images.
+        The arrays may be read-only views, copy them before modifying in place.
+        :param scene_name:
+        :type scene_name: str
+        :param img_idx:
+        :type img_idx: int
+        :return: rgb, depth, mask, pose
+        :rtype: [H,W,3] uint8, [H,W] uint16, [H,W] uint8, a 4x4 numpy array
+        """
+        rgb, depth, mask, pose = self.get_rgbd_mask_pose(scene_name, img_idx)
+        return np.asarray(rgb), np.asarray(depth), np.asarray(mask), pose
+
     def get_random_rgbd_mask_pose(self):
         """
         Simple wrapper method for `get_rgbd_mask_pose`.
@@ -397,11 +443,22 @@ class DenseCorrespondenceDataset(data.Dataset):
         return self.get_rgbd_mask_pose(scene_name, img_idx)
 
     def get_img_idx_with_different_pose(
-        self, scene_name, pose_a, threshold=0.2, angle_threshold=20, num_attempts=10
+        self,
+        scene_name,
+        pose_a,
+        threshold=0.2,
+        angle_threshold=20,
+        num_attempts=10,
+        img_a_idx=None,
     ):
         """
         Try to get an image with a different pose to the one passed in. If one can't be found
-        then return None
+        then return None.
+
+        If img_a_idx is passed and the dataset has a pair index for the scene
+        (see get_pair_index) the partner is drawn directly from the precomputed
+        list of valid partners, so this only returns None if no such image exists.
+        Otherwise falls back to rejection sampling with num_attempts draws.
         :param scene_name:
         :type scene_name:
         :param pose_a:
@@ -410,10 +467,24 @@ class DenseCorrespondenceDataset(data.Dataset):
         :type threshold:
         :param num_attempts:
         :type num_attempts:
+        :param img_a_idx: the image index of pose_a
+        :type img_a_idx: int
         :return: an index with a different-enough pose
         :rtype: int or None
         """
 
+        if img_a_idx is not None:
+            pair_index = self.get_pair_index(
+                scene_name, threshold=threshold, angle_threshold=angle_threshold
+            )
+            if pair_index is not None:
+                image_idxs = self.get_pose_store(scene_name).image_idxs
+                row_a = self.get_pose_store(scene_name).get_row(img_a_idx)
+                row_b = pair_index.sample_partner(row_a)
+                if row_b is None:
+                    return None
+                return int(image_idxs[row_b])
+
         counter = 0
         while counter < num_attempts:
             img_idx = self.get_random_image_index(scene_name)
@@ -427,6 +498,17 @@ class DenseCorrespondenceDataset(data.Dataset):
 
         return None
 
+    def get_pair_index(self, scene_name, threshold=0.2, angle_threshold=20):
+        """
+        Returns the PairIndex of valid image pairs for this scene and thresholds,
+        or None if the dataset doesn't support it
+        :param scene_name:
+        :type scene_name:
+        :return:
+        :rtype: densenets.dataset.pair_index.PairIndex or None
+        """
+        return None
+
     def rgb_image_to_tensor(self, img):
         """
         Transforms a PIL.Image to a torch.FloatTensor.
@@ -523,6 +605,14 @@ class DenseCorrespondenceDataset(data.Dataset):
         """
         raise NotImplementedError("subclass must implement this method")
 
+    def get_pose_store(self, scene_name):
+        """
+        :param scene_name: str
+        :return: the compiled poses of the scene
+        :rtype: densenets.dataset.pose_store.PoseStore
+        """
+        raise NotImplementedError("subclass must implement this method")
+
     def get_pose_from_scene_name_and_idx(self, scene_name, idx):
         """
 
@@ -703,12 +793,43 @@ class DenseCorrespondenceDataset(data.Dataset):
             * self.num_non_matches_per_match
         )
 
+        self.non_match_min_distance = int(
+            training_config['training'].get("non_match_min_distance", 1)
+        )
+
         self.cross_scene_num_samples = training_config['training'][
             "cross_scene_num_samples"
         ]
 
         self._use_image_b_mask_inv = training_config["training"]["use_image_b_mask_inv"]
 
+        self._storage_backend = training_config["training"].get(
+            "storage_backend", StorageBackend.PNG
+        )
+        if self._storage_backend not in (StorageBackend.PNG, StorageBackend.PACKED):
+            raise ValueError("unsupported storage_backend %s" % (self._storage_backend))
+
+        self._correspondence_backend = training_config["training"].get(
+            "correspondence_backend", CorrespondenceBackend.TORCH
+        )
+        if self._correspondence_backend not in (
+            CorrespondenceBackend.TORCH,
+            CorrespondenceBackend.NUMPY,
+        ):
+            raise ValueError(
+                "unsupported correspondence_backend %s"
+                % (self._correspondence_backend)
+            )
+
+        self.occlusion_mode = training_config["training"].get(
+            "occlusion_mode", correspondence_finder.OcclusionMode.NEAREST
+        )
+        if self.occlusion_mode not in (
+            correspondence_finder.OcclusionMode.NEAREST,
+            correspondence_finder.OcclusionMode.BILINEAR,
+        ):
+            raise ValueError("unsupported occlusion_mode %s" % (self.occlusion_mode))
+
         from densenets.dataset.spartan_dataset_masked import SpartanDatasetDataType
 
         self._data_load_types = []
@@ -0,0 +1,146 @@
+import os
+
+import densenets.correspondence_tools.correspondence_finder as correspondence_finder
+import numpy as np
+from densenets.correspondence_tools.correspondence_finder import FlowStatus
+from densenets.dataset.scene_structure import SceneStructure
+
+FLOW_FIELD_VERSION = 1
+
+
+class FlowField(object):
+    """
+    Dense a->b correspondences of a frame pair:
+
+    - uv_b: [2, H, W] float32, (u, v) position in image b of every pixel of
+      image a, NaN where image a has no depth
+    - status: [H, W] uint8, the FlowStatus of every pixel of image a
+
+    Looking up the match of a pixel is a single array read, the pixels with
+    status FlowStatus.VALID are those batch_find_pixel_correspondences
+    would match.
+    """
+
+    def __init__(self, uv_b, status):
+        self._uv_b = uv_b
+        self._status = status
+
+    @staticmethod
+    def from_frames(depth_a, pose_a, depth_b, pose_b, K=None):
+        """
+        :param depth_a, depth_b: [H, W] uint16 depth images
+        :type depth_a, depth_b: numpy.ndarray
+        :param pose_a, pose_b: 4 x 4 camera_to_world
+        :type pose_a, pose_b: numpy.ndarray
+        :param K: optional 3 x 3 camera intrinsics matrix
+        :type K: numpy.ndarray
+        :return:
+        :rtype: FlowField
+        """
+        uv_b, status = correspondence_finder.compute_flow_field(
+            np.asarray(depth_a), pose_a, np.asarray(depth_b), pose_b, K=K
+        )
+        return FlowField(uv_b.cpu().numpy(), status.cpu().numpy())
+
+    @staticmethod
+    def load(filename):
+        """
+        :param filename: flow field npz file, see SceneStructure.flow_field_filename
+        :type filename: str
+        :return:
+        :rtype: FlowField
+        """
+        with np.load(filename) as data:
+            version = int(data['version'])
+            if version != FLOW_FIELD_VERSION:
+                raise ValueError(
+                    "flow field %s has version %d, expected %d. Rerun "
+                    "compute_flow_fields.py" % (filename, version, FLOW_FIELD_VERSION)
+                )
+            return FlowField(data['uv_b'], data['status'])
+
+    def save(self, filename):
+        """
+        Writes the flow field as a compressed npz file, through a temporary
+        file so readers never see a partial one
+        :param filename: see SceneStructure.flow_field_filename
+        :type filename: str
+        :return:
+        :rtype:
+        """
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+
+        tmp_filename = filename + '.tmp.npz'
+        np.savez_compressed(
+            tmp_filename,
+            version=np.int32(FLOW_FIELD_VERSION),
+            uv_b=self._uv_b,
+            status=self._status,
+        )
+        os.replace(tmp_filename, filename)
+
+    @property
+    def uv_b(self):
+        return self._uv_b
+
+    @property
+    def status(self):
+        return self._status
+
+    @property
+    def image_height(self):
+        return self._status.shape[0]
+
+    @property
+    def image_width(self):
+        return self._status.shape[1]
+
+    @property
+    def valid_mask(self):
+        """
+        :return: [H, W] bool, the pixels of image a that have a match
+        :rtype: numpy.ndarray
+        """
+        return self._status == FlowStatus.VALID
+
+    def lookup(self, u_a, v_a):
+        """
+        :param u_a, v_a: pixels of image a
+        :type u_a, v_a: int or array-like of ints
+        :return: their (u, v) position in image b and their FlowStatus
+        :rtype: numpy.ndarray, numpy.ndarray, numpy.ndarray
+        """
+        return (
+            self._uv_b[0, v_a, u_a],
+            self._uv_b[1, v_a, u_a],
+            self._status[v_a, u_a],
+        )
+
+    def get_matches(self):
+        """
+        :return: flattened pixel indices of the matches in image a and image b,
+                 rounded like the matches returned at train time
+        :rtype: np.array (int64), np.array (int64)
+        """
+        flat_a = np.flatnonzero(self.valid_mask)
+        u_b = self._uv_b[0].reshape(-1)[flat_a].astype(np.int64)
+        v_b = self._uv_b[1].reshape(-1)[flat_a].astype(np.int64)
+        return flat_a, v_b * self.image_width + u_b
+
+
+def load_scene_flow_field(processed_dir, img_a_idx, img_b_idx):
+    """
+    :param processed_dir: the processed folder of the scene
+    :type processed_dir: str
+    :return:
+    :rtype: FlowField
+    """
+    filename = SceneStructure(processed_dir).flow_field_filename(img_a_idx, img_b_idx)
+    if not os.path.isfile(filename):
+        raise ValueError(
+            "no flow field at %s, run "
+            "dense_correspondence_manipulation/scripts/compute_flow_fields.py"
+            % (filename)
+        )
+    return FlowField.load(filename)
@@ -0,0 +1,212 @@
+import atexit
+import multiprocessing
+import os
+import resource
+from multiprocessing import shared_memory
+
+import numpy as np
+from densenets.dataset.mask_index import MaskIndex
+from PIL import Image
+
+# arrays of the bank being filled, inherited by the forked decoding workers
+_fill_arrays = None
+
+
+def _decode_into_bank(task):
+    row, rgb_filename, depth_filename, mask_filename = task
+    rgb, depth, mask = _fill_arrays
+    rgb[row] = np.asarray(Image.open(rgb_filename).convert('RGB'))
+    depth[row] = np.asarray(Image.open(depth_filename))
+    mask[row] = np.asarray(Image.open(mask_filename))
+
+
+def get_resident_memory_bytes():
+    """
+    Resident set size of the current process, falls back to the peak RSS if
+    /proc isn't available
+    :return:
+    :rtype: int
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class FrameBank(object):
+    """
+    Every frame of a set of scenes decoded once into three shared memory
+    arrays:
+
+    - rgb: [N, H, W, 3] uint8
+    - depth: [N, H, W] uint16
+    - mask: [N, H, W] uint8
+
+    The DataLoader workers inherit the arrays through fork and are handed
+    read-only views, so there is no file I/O and no decoding during training.
+    """
+
+    def __init__(self, frames, image_height, image_width):
+        """
+        :param frames: list of (scene_name, img_idx), one per row of the bank
+        :type frames: list
+        :param image_height, image_width: all frames must have this size
+        :type image_height, image_width: int
+        """
+        if len(frames) == 0:
+            raise ValueError("no frames to preload")
+
+        self._image_shape = (image_height, image_width)
+        self._row_from_frame = dict()
+        for row, (scene_name, img_idx) in enumerate(frames):
+            self._row_from_frame[(scene_name, int(img_idx))] = row
+
+        num_frames = len(frames)
+        self._shapes = dict()
+        self._shapes['rgb'] = (num_frames, image_height, image_width, 3)
+        self._shapes['depth'] = (num_frames, image_height, image_width)
+        self._shapes['mask'] = (num_frames, image_height, image_width)
+        self._dtypes = {'rgb': np.uint8, 'depth': np.uint16, 'mask': np.uint8}
+
+        self._shared_memory = dict()
+        self._arrays = dict()
+        for key in ['rgb', 'depth', 'mask']:
+            nbytes = int(np.prod(self._shapes[key])) * np.dtype(self._dtypes[key]).itemsize
+            self._shared_memory[key] = shared_memory.SharedMemory(
+                create=True, size=nbytes
+            )
+            self._arrays[key] = np.ndarray(
+                self._shapes[key],
+                dtype=self._dtypes[key],
+                buffer=self._shared_memory[key].buf,
+            )
+
+        self._mask_indices = None
+        self._owner_pid = os.getpid()
+        self.load_time = None
+        atexit.register(self.close)
+
+    def close(self):
+        """
+        Releases the shared memory. Only unlinks it in the process that created
+        the bank.
+        """
+        if len(self._shared_memory) == 0:
+            return
+        self._arrays = dict()
+        self._mask_indices = None
+        for shm in self._shared_memory.values():
+            shm.close()
+            if os.getpid() == self._owner_pid:
+                shm.unlink()
+        self._shared_memory = dict()
+
+    @property
+    def num_frames(self):
+        return len(self._row_from_frame)
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self._arrays.values())
+
+    def has_frame(self, scene_name, img_idx):
+        return (scene_name, int(img_idx)) in self._row_from_frame
+
+    def set_frame(self, row, rgb, depth, mask):
+        self._arrays['rgb'][row] = rgb
+        self._arrays['depth'][row] = depth
+        self._arrays['mask'][row] = mask
+
+    def get_frame(self, scene_name, img_idx):
+        """
+        Returns read-only views of the rgb, depth and mask of a frame
+        :param scene_name:
+        :type scene_name: str
+        :param img_idx:
+        :type img_idx: int
+        :return: rgb, depth, mask
+        :rtype: np.ndarray, np.ndarray, np.ndarray
+        """
+        row = self._row_from_frame[(scene_name, int(img_idx))]
+        views = []
+        for key in ['rgb', 'depth', 'mask']:
+            view = self._arrays[key][row]
+            view.flags.writeable = False
+            views.append(view)
+        return tuple(views)
+
+    def build_mask_indices(self):
+        """
+        Computes the MaskIndex of every frame once the bank is filled. Call it
+        before the DataLoader starts its workers so that they inherit them.
+        """
+        self._mask_indices = [
+            MaskIndex.from_mask(mask) for mask in self._arrays['mask']
+        ]
+
+    def get_mask_index(self, scene_name, img_idx):
+        """
+        :return: the MaskIndex of a frame, None if build_mask_indices() wasn't
+                 called
+        :rtype: MaskIndex
+        """
+        if self._mask_indices is None:
+            return None
+        row = self._row_from_frame[(scene_name, int(img_idx))]
+        return self._mask_indices[row]
+
+    def decode_png_files(self, filenames, num_workers=None):
+        """
+        Decodes the png files of every row with a pool of forked workers, each
+        writing straight into the shared arrays
+        :param filenames: list of (rgb_filename, depth_filename, mask_filename),
+                          one per row
+        :type filenames: list
+        :param num_workers: size of the pool, defaults to the number of cpus
+        :type num_workers: int
+        :return:
+        :rtype:
+        """
+        global _fill_arrays
+
+        tasks = [
+            (row, rgb_filename, depth_filename, mask_filename)
+            for row, (rgb_filename, depth_filename, mask_filename) in enumerate(
+                filenames
+            )
+        ]
+
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+
+        _fill_arrays = (self._arrays['rgb'], self._arrays['depth'], self._arrays['mask'])
+        try:
+            if num_workers > 1:
+                pool = multiprocessing.get_context('fork').Pool(num_workers)
+                try:
+                    pool.map(_decode_into_bank, tasks, chunksize=16)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for task in tasks:
+                    _decode_into_bank(task)
+        finally:
+            _fill_arrays = None
+
+    def get_stats(self):
+        """
+        :return: number of frames, size of the bank, load time and the resident
+                 memory of this process
+        :rtype: dict
+        """
+        stats = dict()
+        stats['num_frames'] = self.num_frames
+        stats['bank_bytes'] = self.nbytes
+        stats['load_time'] = self.load_time
+        stats['resident_memory_bytes'] = get_resident_memory_bytes()
+        return stats
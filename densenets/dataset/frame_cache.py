@@ -0,0 +1,226 @@
+import atexit
+import logging
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# layout of the counters array
+_HITS = 0
+_MISSES = 1
+_EVICTIONS = 2
+_INSERTS = 3
+_CLOCK = 4
+_NUM_COUNTERS = 5
+
+
+def frame_nbytes(image_height, image_width):
+    """
+    Number of bytes needed to hold a decoded rgb (uint8), depth (uint16) and
+    mask (uint8) frame
+    """
+    num_pixels = image_height * image_width
+    return num_pixels * 3 + num_pixels * 2 + num_pixels
+
+
+class SharedFrameCache(object):
+    """
+    LRU cache of decoded rgb, depth and mask arrays, shared between the
+    DataLoader workers.
+
+    The cache is a fixed number of equally sized slots in a shared memory
+    arena, plus small shared bookkeeping arrays (slot keys, last-use clock,
+    hit/miss/eviction counters). Every access takes a single process-shared
+    lock; frames are copied in and out under it so a slot can never be evicted
+    while it is being read.
+
+    Create it in the main process before the DataLoader starts its workers.
+    The workers inherit the arena and the lock, so they have to be forked (the
+    default DataLoader start method on Linux).
+    """
+
+    def __init__(self, size_bytes, image_height, image_width, scene_names):
+        """
+        :param size_bytes: size of the arena, determines the number of slots
+        :type size_bytes: int
+        :param image_height, image_width: largest frame size that will be cached
+        :type image_height, image_width: int
+        :param scene_names: every scene that may be cached
+        :type scene_names: list of str
+        """
+        self._slot_nbytes = frame_nbytes(image_height, image_width)
+        self._num_slots = int(size_bytes // self._slot_nbytes)
+        if self._num_slots < 1:
+            raise ValueError(
+                "frame cache of %d bytes can't hold a single %dx%d frame"
+                % (size_bytes, image_width, image_height)
+            )
+
+        self._scene_ids = dict(
+            (scene_name, i) for i, scene_name in enumerate(sorted(scene_names))
+        )
+        self._lock = multiprocessing.Lock()
+
+        self._arena = shared_memory.SharedMemory(
+            create=True, size=self._num_slots * self._slot_nbytes
+        )
+        self._meta = shared_memory.SharedMemory(
+            create=True, size=self._meta_nbytes(self._num_slots)
+        )
+        self._owner_pid = os.getpid()
+        self._attach_arrays()
+        self._keys[:] = -1
+        self._last_used[:] = 0
+        self._shapes[:] = 0
+        self._counters[:] = 0
+        atexit.register(self.close)
+
+        logging.info(
+            "frame cache: %d slots of %.2f MB"
+            % (self._num_slots, self._slot_nbytes / 1e6)
+        )
+
+    @staticmethod
+    def _meta_nbytes(num_slots):
+        # keys, last_used (int64) + shapes (2 x int64) + counters
+        return (num_slots * 4 + _NUM_COUNTERS) * 8
+
+    def _attach_arrays(self):
+        meta = np.ndarray(
+            self._meta_nbytes(self._num_slots) // 8, dtype=np.int64, buffer=self._meta.buf
+        )
+        n = self._num_slots
+        self._keys = meta[0:n]
+        self._last_used = meta[n : 2 * n]
+        self._shapes = meta[2 * n : 4 * n].reshape(n, 2)
+        self._counters = meta[4 * n : 4 * n + _NUM_COUNTERS]
+        self._slots = np.ndarray(
+            (n, self._slot_nbytes), dtype=np.uint8, buffer=self._arena.buf
+        )
+
+    def close(self):
+        """
+        Releases the shared memory. Only unlinks it in the process that created
+        the cache.
+        """
+        if self._arena is None:
+            return
+        self._keys = self._last_used = self._shapes = None
+        self._counters = self._slots = None
+        self._arena.close()
+        self._meta.close()
+        if os.getpid() == self._owner_pid:
+            self._arena.unlink()
+            self._meta.unlink()
+        self._arena = self._meta = None
+
+    def _key(self, scene_name, img_idx):
+        return (self._scene_ids[scene_name] << 32) | int(img_idx)
+
+    def _slot_views(self, slot, image_height, image_width):
+        num_pixels = image_height * image_width
+        data = self._slots[slot]
+        rgb = data[0 : 3 * num_pixels].reshape(image_height, image_width, 3)
+        depth = (
+            data[3 * num_pixels : 5 * num_pixels]
+            .view(np.uint16)
+            .reshape(image_height, image_width)
+        )
+        mask = data[5 * num_pixels : 6 * num_pixels].reshape(
+            image_height, image_width
+        )
+        return rgb, depth, mask
+
+    def get(self, scene_name, img_idx):
+        """
+        Returns copies of the cached rgb, depth and mask arrays, or None on a
+        miss
+        :param scene_name:
+        :type scene_name: str
+        :param img_idx:
+        :type img_idx: int
+        :return: rgb, depth, mask or None
+        :rtype: np.ndarray, np.ndarray, np.ndarray
+        """
+        key = self._key(scene_name, img_idx)
+        with self._lock:
+            slots = np.flatnonzero(self._keys == key)
+            if len(slots) == 0:
+                self._counters[_MISSES] += 1
+                return None
+
+            slot = slots[0]
+            self._counters[_HITS] += 1
+            self._counters[_CLOCK] += 1
+            self._last_used[slot] = self._counters[_CLOCK]
+            image_height, image_width = self._shapes[slot]
+            return tuple(
+                np.array(view)
+                for view in self._slot_views(slot, image_height, image_width)
+            )
+
+    def put(self, scene_name, img_idx, rgb, depth, mask):
+        """
+        Inserts a frame, evicting the least recently used one if the cache is
+        full
+        :param rgb: [H, W, 3] uint8
+        :param depth: [H, W] uint16
+        :param mask: [H, W] uint8
+        :return:
+        :rtype:
+        """
+        image_height, image_width = depth.shape
+        if frame_nbytes(image_height, image_width) > self._slot_nbytes:
+            raise ValueError(
+                "frame of size %dx%d is larger than the cache slots"
+                % (image_width, image_height)
+            )
+
+        key = self._key(scene_name, img_idx)
+        with self._lock:
+            self._counters[_CLOCK] += 1
+            slots = np.flatnonzero(self._keys == key)
+            if len(slots) > 0:
+                # another worker inserted it in the meantime
+                self._last_used[slots[0]] = self._counters[_CLOCK]
+                return
+
+            empty_slots = np.flatnonzero(self._keys == -1)
+            if len(empty_slots) > 0:
+                slot = empty_slots[0]
+            else:
+                slot = np.argmin(self._last_used)
+                self._counters[_EVICTIONS] += 1
+
+            rgb_slot, depth_slot, mask_slot = self._slot_views(
+                slot, image_height, image_width
+            )
+            rgb_slot[:] = rgb
+            depth_slot[:] = depth
+            mask_slot[:] = mask
+            self._shapes[slot] = (image_height, image_width)
+            self._keys[slot] = key
+            self._last_used[slot] = self._counters[_CLOCK]
+            self._counters[_INSERTS] += 1
+
+    def get_stats(self):
+        """
+        Returns the hit, miss and eviction counters, aggregated over every
+        process using the cache
+        :return:
+        :rtype: dict
+        """
+        with self._lock:
+            hits = int(self._counters[_HITS])
+            misses = int(self._counters[_MISSES])
+            stats = dict()
+            stats['hits'] = hits
+            stats['misses'] = misses
+            stats['evictions'] = int(self._counters[_EVICTIONS])
+            stats['inserts'] = int(self._counters[_INSERTS])
+            stats['num_slots'] = self._num_slots
+            stats['num_cached_frames'] = int(np.count_nonzero(self._keys != -1))
+            stats['size_bytes'] = self._num_slots * self._slot_nbytes
+        stats['hit_rate'] = hits / float(max(hits + misses, 1))
+        return stats
@@ -0,0 +1,419 @@
+import logging
+import os
+
+import densenets.dense_correspondence_manipulation.utils.utils as utils
+import numpy as np
+from densenets.dataset.mask_index import MaskIndex
+from densenets.dataset.scene_structure import SceneStructure
+from PIL import Image
+
+# Each block in the shard starts on a page boundary so that the views handed
+# out by FrameStore never straddle a page they don't need.
+SHARD_ALIGNMENT = 4096
+FRAME_STORE_VERSION = 1
+
+
+class MaskEncoding:
+    UINT8 = 'uint8'
+    PACKBITS = 'packbits'
+
+
+def _align(offset, alignment=SHARD_ALIGNMENT):
+    return int((offset + alignment - 1) // alignment * alignment)
+
+
+def _image_filenames(scene_structure, img_idx):
+    """
+    Returns the rgb, depth and mask png filenames for a frame, following the
+    same layout as SpartanDataset.get_image_filename
+    :param scene_structure:
+    :type scene_structure: SceneStructure
+    :param img_idx:
+    :type img_idx: int
+    :return: rgb_filename, depth_filename, mask_filename
+    :rtype: str, str, str
+    """
+    prefix = utils.getPaddedString(img_idx, width=6)
+    rgb_filename = os.path.join(scene_structure.images_dir, prefix + '_rgb.png')
+    depth_filename = os.path.join(
+        scene_structure.rendered_images_dir, prefix + '_depth.png'
+    )
+    mask_filename = os.path.join(scene_structure.image_masks_dir, prefix + '_mask.png')
+    return rgb_filename, depth_filename, mask_filename
+
+
+def pack_scene(processed_dir, img_idxs=None, mask_encoding=MaskEncoding.UINT8):
+    """
+    Decodes every rgb, depth and mask png of a scene once and writes them into a
+    single contiguous shard, together with a yaml index describing its layout.
+
+    The shard holds three blocks, each starting on a page boundary:
+
+    - rgb: uint8 with shape [N, H, W, 3]
+    - depth: uint16 with shape [N, H, W]
+    - mask: uint8 with shape [N, H, W], or if mask_encoding is 'packbits'
+            uint8 with shape [N, ceil(H*W/8)]
+
+    Row i of each block corresponds to index['image_idxs'][i].
+
+    The MaskIndex of every mask is written to a second file, see
+    write_mask_index().
+
+    :param processed_dir: the processed folder of the scene
+    :type processed_dir: str
+    :param img_idxs: image indices to pack, defaults to the keys of pose_data.yaml
+    :type img_idxs: list of int
+    :param mask_encoding: one of MaskEncoding
+    :type mask_encoding: str
+    :return: the index that was written
+    :rtype: dict
+    """
+    if mask_encoding not in (MaskEncoding.UINT8, MaskEncoding.PACKBITS):
+        raise ValueError("unsupported mask_encoding %s" % (mask_encoding))
+
+    ss = SceneStructure(processed_dir)
+    if img_idxs is None:
+        img_idxs = utils.getDictFromYamlFilename(ss.camera_pose_file).keys()
+    img_idxs = sorted(int(idx) for idx in img_idxs)
+    if len(img_idxs) == 0:
+        raise ValueError("no frames to pack in %s" % (processed_dir))
+
+    rgb_filename, _, _ = _image_filenames(ss, img_idxs[0])
+    width, height = Image.open(rgb_filename).size
+    num_frames = len(img_idxs)
+    num_pixels = height * width
+
+    blocks = dict()
+    blocks['rgb'] = {'dtype': 'uint8', 'shape': [num_frames, height, width, 3]}
+    blocks['depth'] = {'dtype': 'uint16', 'shape': [num_frames, height, width]}
+    if mask_encoding == MaskEncoding.UINT8:
+        blocks['mask'] = {'dtype': 'uint8', 'shape': [num_frames, height, width]}
+    else:
+        blocks['mask'] = {
+            'dtype': 'uint8',
+            'shape': [num_frames, int(np.ceil(num_pixels / 8.0))],
+        }
+
+    offset = 0
+    for key in ['rgb', 'depth', 'mask']:
+        block = blocks[key]
+        offset = _align(offset)
+        block['offset'] = offset
+        offset += int(np.prod(block['shape'])) * np.dtype(block['dtype']).itemsize
+    shard_size = _align(offset)
+
+    if not os.path.isdir(ss.frame_store_dir):
+        os.makedirs(ss.frame_store_dir)
+
+    tmp_shard_file = ss.frame_store_shard_file + '.tmp'
+    shard = np.memmap(tmp_shard_file, dtype=np.uint8, mode='w+', shape=(shard_size,))
+    views = dict()
+    for key, block in blocks.items():
+        views[key] = np.ndarray(
+            block['shape'], dtype=block['dtype'], buffer=shard, offset=block['offset']
+        )
+
+    for row, img_idx in enumerate(img_idxs):
+        rgb_filename, depth_filename, mask_filename = _image_filenames(ss, img_idx)
+        views['rgb'][row] = np.asarray(Image.open(rgb_filename).convert('RGB'))
+        views['depth'][row] = np.asarray(Image.open(depth_filename))
+        mask = np.asarray(Image.open(mask_filename))
+        if mask_encoding == MaskEncoding.UINT8:
+            views['mask'][row] = mask
+        else:
+            views['mask'][row] = np.packbits(mask.reshape(-1) != 0)
+
+    shard.flush()
+
+    masks = views['mask']
+    if mask_encoding == MaskEncoding.PACKBITS:
+        masks = (
+            np.unpackbits(mask, count=num_pixels).reshape(height, width)
+            for mask in masks
+        )
+    mask_index_blocks = write_mask_index(ss.frame_store_mask_index_file, masks)
+
+    del masks
+    del views
+    del shard
+    os.replace(tmp_shard_file, ss.frame_store_shard_file)
+
+    index = dict()
+    index['version'] = FRAME_STORE_VERSION
+    index['image_height'] = height
+    index['image_width'] = width
+    index['mask_encoding'] = mask_encoding
+    index['image_idxs'] = img_idxs
+    index['shard_size'] = shard_size
+    index['blocks'] = blocks
+    index['mask_index_blocks'] = mask_index_blocks
+    utils.saveToYaml(index, ss.frame_store_index_file, flush=True)
+
+    logging.info(
+        "packed %d frames of %s into %s (%.1f MB)"
+        % (num_frames, processed_dir, ss.frame_store_shard_file, shard_size / 1e6)
+    )
+    return index
+
+
+def write_mask_index(filename, masks):
+    """
+    Writes the MaskIndex of every mask into a single file holding three
+    blocks, each starting on a page boundary:
+
+    - inside: int32, the concatenated MaskIndex.inside of every mask
+    - offsets: int64 with shape [N + 1], the inside pixels of row i are
+               inside[offsets[i]:offsets[i+1]]
+    - bbox: int32 with shape [N, 4], (u_min, v_min, u_max, v_max), -1 for
+            empty masks
+
+    MaskIndex.outside isn't stored, it is computed from inside when needed.
+    :param filename:
+    :type filename: str
+    :param masks: the [H, W] masks, one per row
+    :type masks: iterable of numpy.ndarray
+    :return: description of the blocks
+    :rtype: dict
+    """
+    mask_indices = [MaskIndex.from_mask(mask) for mask in masks]
+    num_frames = len(mask_indices)
+
+    offsets = np.zeros(num_frames + 1, dtype=np.int64)
+    np.cumsum([m.num_inside for m in mask_indices], out=offsets[1:])
+
+    blocks = dict()
+    blocks['inside'] = {'dtype': 'int32', 'shape': [int(offsets[-1])]}
+    blocks['offsets'] = {'dtype': 'int64', 'shape': [num_frames + 1]}
+    blocks['bbox'] = {'dtype': 'int32', 'shape': [num_frames, 4]}
+
+    offset = 0
+    for key in ['inside', 'offsets', 'bbox']:
+        block = blocks[key]
+        offset = _align(offset)
+        block['offset'] = offset
+        offset += int(np.prod(block['shape'])) * np.dtype(block['dtype']).itemsize
+    file_size = max(_align(offset), 1)
+
+    tmp_filename = filename + '.tmp'
+    data = np.memmap(tmp_filename, dtype=np.uint8, mode='w+', shape=(file_size,))
+    views = dict()
+    for key, block in blocks.items():
+        views[key] = np.ndarray(
+            block['shape'], dtype=block['dtype'], buffer=data, offset=block['offset']
+        )
+
+    views['offsets'][:] = offsets
+    for row, mask_index in enumerate(mask_indices):
+        views['inside'][offsets[row] : offsets[row + 1]] = mask_index.inside
+        if mask_index.bbox is None:
+            views['bbox'][row] = -1
+        else:
+            views['bbox'][row] = mask_index.bbox
+
+    data.flush()
+    del views
+    del data
+    os.replace(tmp_filename, filename)
+    blocks['file_size'] = file_size
+    return blocks
+
+
+class FrameStore(object):
+    """
+    Read-only access to a shard written by pack_scene().
+
+    The shard is memory-mapped lazily on first access, so a FrameStore can be
+    created in the main process and pickled into DataLoader workers, each of
+    which then maps the file on its own.
+    """
+
+    def __init__(self, processed_dir):
+        self._scene_structure = SceneStructure(processed_dir)
+        self._index = utils.getDictFromYamlFilename(
+            self._scene_structure.frame_store_index_file
+        )
+        if self._index['version'] != FRAME_STORE_VERSION:
+            raise ValueError(
+                "frame store %s has version %s, expected %d"
+                % (processed_dir, self._index['version'], FRAME_STORE_VERSION)
+            )
+
+        self._row_from_img_idx = dict()
+        for row, img_idx in enumerate(self._index['image_idxs']):
+            self._row_from_img_idx[int(img_idx)] = row
+
+        self._mmap = None
+        self._blocks = None
+        self._mask_index_mmap = None
+        self._mask_index_blocks = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_mmap'] = None
+        state['_blocks'] = None
+        state['_mask_index_mmap'] = None
+        state['_mask_index_blocks'] = None
+        return state
+
+    @staticmethod
+    def exists(processed_dir):
+        """
+        Returns True if a packed frame store has been written for this scene
+        :param processed_dir:
+        :type processed_dir: str
+        :return:
+        :rtype: bool
+        """
+        ss = SceneStructure(processed_dir)
+        return os.path.isfile(ss.frame_store_index_file) and os.path.isfile(
+            ss.frame_store_shard_file
+        )
+
+    def _open(self):
+        self._mmap = np.memmap(
+            self._scene_structure.frame_store_shard_file, dtype=np.uint8, mode='r'
+        )
+        if self._mmap.size != self._index['shard_size']:
+            raise ValueError(
+                "shard %s has size %d, index expects %d"
+                % (
+                    self._scene_structure.frame_store_shard_file,
+                    self._mmap.size,
+                    self._index['shard_size'],
+                )
+            )
+
+        self._blocks = dict()
+        for key, block in self._index['blocks'].items():
+            self._blocks[key] = np.ndarray(
+                block['shape'],
+                dtype=block['dtype'],
+                buffer=self._mmap,
+                offset=block['offset'],
+            )
+
+    def _open_mask_index(self):
+        blocks = self._index['mask_index_blocks']
+        self._mask_index_mmap = np.memmap(
+            self._scene_structure.frame_store_mask_index_file, dtype=np.uint8, mode='r'
+        )
+        if self._mask_index_mmap.size != blocks['file_size']:
+            raise ValueError(
+                "mask index %s has size %d, index expects %d"
+                % (
+                    self._scene_structure.frame_store_mask_index_file,
+                    self._mask_index_mmap.size,
+                    blocks['file_size'],
+                )
+            )
+
+        self._mask_index_blocks = dict()
+        # stores packed before outside was dropped still have an outside block
+        for key in ['inside', 'offsets', 'bbox']:
+            block = blocks[key]
+            self._mask_index_blocks[key] = np.ndarray(
+                block['shape'],
+                dtype=block['dtype'],
+                buffer=self._mask_index_mmap,
+                offset=block['offset'],
+            )
+
+    @property
+    def image_idxs(self):
+        return list(self._index['image_idxs'])
+
+    @property
+    def image_shape(self):
+        return self._index['image_height'], self._index['image_width']
+
+    @property
+    def mask_encoding(self):
+        return self._index['mask_encoding']
+
+    def has_image(self, img_idx):
+        return int(img_idx) in self._row_from_img_idx
+
+    def get_row(self, img_idx):
+        """
+        Returns the row of the shard that holds img_idx
+        :param img_idx:
+        :type img_idx: int
+        :return:
+        :rtype: int
+        """
+        try:
+            return self._row_from_img_idx[int(img_idx)]
+        except KeyError:
+            raise ValueError(
+                "image %s is not in frame store %s"
+                % (img_idx, self._scene_structure.frame_store_shard_file)
+            )
+
+    def get_rgb(self, img_idx):
+        """
+        :return: read-only view with shape [H, W, 3], dtype uint8
+        :rtype: numpy.ndarray
+        """
+        if self._blocks is None:
+            self._open()
+        return self._blocks['rgb'][self.get_row(img_idx)]
+
+    def get_depth(self, img_idx):
+        """
+        :return: read-only view with shape [H, W], dtype uint16
+        :rtype: numpy.ndarray
+        """
+        if self._blocks is None:
+            self._open()
+        return self._blocks['depth'][self.get_row(img_idx)]
+
+    def get_mask(self, img_idx):
+        """
+        Zero-copy view for uint8 masks. Bit-packed masks are unpacked into a new
+        array.
+        :return: array with shape [H, W], dtype uint8
+        :rtype: numpy.ndarray
+        """
+        if self._blocks is None:
+            self._open()
+        mask = self._blocks['mask'][self.get_row(img_idx)]
+        if self.mask_encoding == MaskEncoding.UINT8:
+            return mask
+
+        height, width = self.image_shape
+        return np.unpackbits(mask, count=height * width).reshape(height, width)
+
+    @property
+    def has_mask_index(self):
+        """
+        Stores packed before mask indices were added don't have them
+        :return:
+        :rtype: bool
+        """
+        return 'mask_index_blocks' in self._index
+
+    def get_mask_index(self, img_idx):
+        """
+        :return: the MaskIndex of the mask of img_idx, backed by the memory map
+        :rtype: MaskIndex
+        """
+        if self._mask_index_blocks is None:
+            self._open_mask_index()
+        row = self.get_row(img_idx)
+        offsets = self._mask_index_blocks['offsets']
+        inside = self._mask_index_blocks['inside'][offsets[row] : offsets[row + 1]]
+        height, width = self.image_shape
+        bbox = self._mask_index_blocks['bbox'][row]
+        if bbox[0] < 0:
+            bbox = None
+        return MaskIndex(inside, height, width, bbox=bbox)
+
+    def get_frame(self, img_idx):
+        """
+        Returns rgb, depth and mask arrays for img_idx
+        :param img_idx:
+        :type img_idx: int
+        :return: rgb, depth, mask
+        :rtype: numpy.ndarray, numpy.ndarray, numpy.ndarray
+        """
+        return self.get_rgb(img_idx), self.get_depth(img_idx), self.get_mask(img_idx)
@@ -0,0 +1,205 @@
+import numpy as np
+import torch
+
+
+class MaskIndex(object):
+    """
+    Sparse form of a binary [H, W] mask, so that pixels can be sampled from
+    the mask or from its inverse without scanning the whole image:
+
+    - inside: sorted np.array of the flattened indices n = u + W * v of the
+      nonzero mask pixels, dtype=np.int32
+    - outside: the same for the zero pixels of the mask, computed from inside
+      on first use if it isn't given and kept, the transforms carry it over
+      once it is computed
+    - bbox: (u_min, v_min, u_max, v_max) of the nonzero pixels, None if the
+      mask is empty
+    """
+
+    def __init__(self, inside, image_height, image_width, bbox=None, outside=None):
+        self._inside = inside
+        self._outside = outside
+        self.image_height = int(image_height)
+        self.image_width = int(image_width)
+        if bbox is None and len(inside) > 0:
+            u = inside % self.image_width
+            v = inside // self.image_width
+            bbox = (int(u.min()), int(v[0]), int(u.max()), int(v[-1]))
+        self._bbox = None if bbox is None else tuple(int(x) for x in bbox)
+
+    @staticmethod
+    def from_mask(mask):
+        """
+        :param mask: [H, W] array, nonzero pixels are inside the mask
+        :type mask: numpy.ndarray
+        :return:
+        :rtype: MaskIndex
+        """
+        mask = np.asarray(mask)
+        image_height, image_width = mask.shape
+        inside = np.flatnonzero(mask).astype(np.int32)
+        return MaskIndex(inside, image_height, image_width)
+
+    @property
+    def inside(self):
+        return self._inside
+
+    @property
+    def bbox(self):
+        return self._bbox
+
+    @property
+    def num_pixels(self):
+        return self.image_height * self.image_width
+
+    @property
+    def num_inside(self):
+        return len(self._inside)
+
+    @property
+    def num_outside(self):
+        return self.num_pixels - len(self._inside)
+
+    def contains(self, flat):
+        """
+        :param flat: flattened pixel indices
+        :type flat: np.array
+        :return: whether each pixel is inside of the mask
+        :rtype: np.array of bool
+        """
+        if len(self._inside) == 0:
+            return np.zeros(len(flat), dtype=bool)
+        rows = np.searchsorted(self._inside, flat)
+        rows = np.minimum(rows, len(self._inside) - 1)
+        return self._inside[rows] == flat
+
+    def to_mask(self):
+        """
+        :return: the [H, W] uint8 mask
+        :rtype: numpy.ndarray
+        """
+        mask = np.zeros(self.num_pixels, dtype=np.uint8)
+        mask[self._inside] = 1
+        return mask.reshape(self.image_height, self.image_width)
+
+    @property
+    def outside(self):
+        if self._outside is None:
+            mask = np.ones(self.num_pixels, dtype=bool)
+            mask[self._inside] = False
+            self._outside = np.flatnonzero(mask).astype(np.int32)
+        return self._outside
+
+    def sample(self, num_samples, inverse=False):
+        """
+        Samples pixels uniformly, with replacement, from the mask or from its
+        inverse
+        :param num_samples:
+        :type num_samples: int
+        :param inverse: sample from the pixels outside of the mask
+        :type inverse: bool
+        :return: flattened pixel indices, None if there is nothing to sample from
+        :rtype: torch.LongTensor
+        """
+        count = self.num_outside if inverse else self.num_inside
+        if count == 0:
+            return None
+
+        pixels = self.outside if inverse else self._inside
+        rand_numbers = torch.rand(num_samples) * count
+        rand_indices = torch.floor(rand_numbers).long()
+        return torch.from_numpy(np.take(pixels, rand_indices.numpy())).long()
+
+    def sample_uv(self, num_samples, inverse=False):
+        """
+        Same as sample() but in (u,v) format
+        :return: tuple of torch.LongTensor, (None, None) if there is nothing
+                 to sample from
+        :rtype:
+        """
+        flat = self.sample(num_samples, inverse=inverse)
+        if flat is None:
+            return (None, None)
+        return (flat % self.image_width, flat // self.image_width)
+
+    def _flip_pixels(self, flat, flip_u, flip_v):
+        """
+        :param flat: sorted flattened pixel indices
+        :type flat: np.array
+        :return: the sorted flattened indices of the pixels mirrored
+                 left/right if flip_u and up/down if flip_v, None for None
+        :rtype: np.array
+        """
+        if flat is None:
+            return None
+        u = flat % self.image_width
+        v = flat // self.image_width
+        if flip_u:
+            u = self.image_width - 1 - u
+        if flip_v:
+            v = self.image_height - 1 - v
+        return np.sort(v * self.image_width + u).astype(np.int32)
+
+    def flip_vertical(self):
+        """
+        :return: the MaskIndex of the mask flipped up/down
+        :rtype: MaskIndex
+        """
+        inside = self._flip_pixels(self._inside, False, True)
+        outside = self._flip_pixels(self._outside, False, True)
+        bbox = None
+        if self._bbox is not None:
+            u_min, v_min, u_max, v_max = self._bbox
+            bbox = (
+                u_min,
+                self.image_height - 1 - v_max,
+                u_max,
+                self.image_height - 1 - v_min,
+            )
+        return MaskIndex(
+            inside, self.image_height, self.image_width, bbox, outside=outside
+        )
+
+    def flip_horizontal(self):
+        """
+        :return: the MaskIndex of the mask flipped left/right
+        :rtype: MaskIndex
+        """
+        inside = self._flip_pixels(self._inside, True, False)
+        outside = self._flip_pixels(self._outside, True, False)
+        bbox = None
+        if self._bbox is not None:
+            u_min, v_min, u_max, v_max = self._bbox
+            bbox = (
+                self.image_width - 1 - u_max,
+                v_min,
+                self.image_width - 1 - u_min,
+                v_max,
+            )
+        return MaskIndex(
+            inside, self.image_height, self.image_width, bbox, outside=outside
+        )
+
+    def rotate_180(self):
+        """
+        Same as flip_vertical() followed by flip_horizontal(), but n -> H*W - 1 - n
+        keeps the indices sorted once reversed, so there is no sort
+        :return:
+        :rtype: MaskIndex
+        """
+        inside = (self.num_pixels - 1 - self._inside[::-1]).astype(np.int32)
+        outside = None
+        if self._outside is not None:
+            outside = (self.num_pixels - 1 - self._outside[::-1]).astype(np.int32)
+        bbox = None
+        if self._bbox is not None:
+            u_min, v_min, u_max, v_max = self._bbox
+            bbox = (
+                self.image_width - 1 - u_max,
+                self.image_height - 1 - v_max,
+                self.image_width - 1 - u_min,
+                self.image_height - 1 - v_min,
+            )
+        return MaskIndex(
+            inside, self.image_height, self.image_width, bbox, outside=outside
+        )
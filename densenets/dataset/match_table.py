@@ -0,0 +1,403 @@
+import logging
+import os
+import random
+
+import densenets.correspondence_tools.correspondence_finder as correspondence_finder
+import numpy as np
+import torch
+from densenets.dataset.scene_structure import SceneStructure
+
+MATCH_TABLE_VERSION = 1
+
+
+class CorrespondenceSource:
+    REPROJECTION = "reprojection"  # batch_find_pixel_correspondences at train time
+    MATCH_TABLE = "match_table"  # tables written by precompute_match_tables.py
+
+
+def compute_pair_matches(depth_a, pose_a, depth_b, pose_b, mask_a=None, K=None):
+    """
+    Finds the match in image b of every pixel of image a (or of every masked
+    pixel of image a) that survives the pruning of
+    correspondence_finder.batch_find_pixel_correspondences.
+    :param depth_a, depth_b: [H, W] uint16 depth images
+    :type depth_a, depth_b: numpy.ndarray
+    :param pose_a, pose_b: 4 x 4 camera_to_world
+    :type pose_a, pose_b: numpy.ndarray
+    :param mask_a: optional [H, W] mask, only its nonzero pixels are matched
+    :type mask_a: numpy.ndarray
+    :param K: optional 3 x 3 camera intrinsics matrix
+    :type K: numpy.ndarray
+    :return: flattened pixel indices of the matches in image a and image b,
+             and the number of pixels of image a that were tried
+    :rtype: np.array (int32), np.array (int32), int
+    """
+    image_height, image_width = depth_a.shape
+    if mask_a is not None:
+        candidates = np.flatnonzero(mask_a)
+    else:
+        candidates = np.arange(image_height * image_width)
+
+    empty = np.zeros(0, dtype=np.int32)
+    if len(candidates) == 0:
+        return empty, empty, 0
+
+    candidates = torch.from_numpy(candidates.astype(np.int64))
+    uv_a_vec = (candidates % image_width, candidates // image_width)
+    uv_a, uv_b = correspondence_finder.compute_correspondences_for_pixels(
+        np.asarray(depth_a),
+        pose_a,
+        np.asarray(depth_b),
+        pose_b,
+        uv_a_vec,
+        K=K,
+    )
+    if uv_a is None or len(uv_a[0]) == 0:
+        return empty, empty, len(candidates)
+
+    # same rounding as the flattening done on uv_b at train time
+    flat_a = uv_a[1].long() * image_width + uv_a[0].long()
+    flat_b = uv_b[1].long() * image_width + uv_b[0].long()
+    return (
+        flat_a.cpu().numpy().astype(np.int32),
+        flat_b.cpu().numpy().astype(np.int32),
+        len(candidates),
+    )
+
+
+def compute_batch_matches(depths, poses, pairs, masks=None, K=None):
+    """
+    Same as compute_pair_matches() for many pairs at once, see
+    correspondence_finder.batch_find_pixel_correspondences_for_pairs
+    :param depths: [B, H, W] uint16 depth images
+    :type depths: numpy.ndarray
+    :param poses: [B, 4, 4] camera_to_world
+    :type poses: numpy.ndarray
+    :param pairs: (a, b) indices into depths and poses of each pair
+    :type pairs: list
+    :param masks: optional [B, H, W] masks, only the nonzero pixels of image a
+                  are matched
+    :type masks: numpy.ndarray
+    :param K: optional 3 x 3 camera intrinsics matrix
+    :type K: numpy.ndarray
+    :return: one compute_pair_matches() result per pair
+    :rtype: list
+    """
+    image_width = depths.shape[2]
+    (
+        uv_a,
+        uv_b,
+        offsets,
+    ) = correspondence_finder.batch_find_pixel_correspondences_for_pairs(
+        depths, poses, pairs, masks=masks, K=K
+    )
+
+    # same rounding as the flattening done on uv_b at train time
+    flat_a = (uv_a[1].long() * image_width + uv_a[0].long()).cpu().numpy()
+    flat_b = (uv_b[1].long() * image_width + uv_b[0].long()).cpu().numpy()
+    flat_a = flat_a.astype(np.int32)
+    flat_b = flat_b.astype(np.int32)
+
+    if masks is not None:
+        num_candidates = [np.count_nonzero(masks[a]) for a, _ in pairs]
+    else:
+        num_candidates = [depths.shape[1] * image_width] * len(pairs)
+
+    offsets = offsets.numpy()
+    return [
+        (
+            flat_a[offsets[i] : offsets[i + 1]],
+            flat_b[offsets[i] : offsets[i + 1]],
+            int(num_candidates[i]),
+        )
+        for i in range(len(pairs))
+    ]
+
+
+class MatchTable(object):
+    """
+    Precomputed dense a->b correspondences for a set of frame pairs of a scene:
+
+    - pairs: [P, 2] int32, image indices (img_a_idx, img_b_idx) of each pair
+    - offsets: [P + 1] int64, the matches of pair i are entries
+      offsets[i]:offsets[i+1] of matches_a and matches_b
+    - matches_a, matches_b: int32 flattened pixel indices, n = u + image_width * v
+    - num_candidates: [P] int32, number of pixels of image a that were tried
+      for each pair (the masked pixels, or all of them)
+
+    Sampling from the table reproduces the statistics of sampling
+    num_matching_attempts pixels of image a with replacement and keeping those
+    that have a valid match, without reprojecting anything.
+    """
+
+    def __init__(
+        self, pairs, offsets, matches_a, matches_b, num_candidates, image_width, image_height
+    ):
+        self._pairs = pairs
+        self._offsets = offsets
+        self._matches_a = matches_a
+        self._matches_b = matches_b
+        self._num_candidates = num_candidates
+        self.image_width = int(image_width)
+        self.image_height = int(image_height)
+
+    @staticmethod
+    def from_pair_matches(pairs, pair_matches, image_width, image_height):
+        """
+        :param pairs: list of (img_a_idx, img_b_idx)
+        :type pairs: list
+        :param pair_matches: list of the compute_pair_matches() results, one per pair
+        :type pair_matches: list
+        :return:
+        :rtype: MatchTable
+        """
+        degrees = [len(flat_a) for flat_a, _, _ in pair_matches]
+        offsets = np.zeros(len(pairs) + 1, dtype=np.int64)
+        np.cumsum(degrees, out=offsets[1:])
+
+        empty = np.zeros(0, dtype=np.int32)
+        matches_a = np.concatenate([empty] + [m[0] for m in pair_matches])
+        matches_b = np.concatenate([empty] + [m[1] for m in pair_matches])
+        num_candidates = np.array([m[2] for m in pair_matches], dtype=np.int32)
+        pairs = np.array(pairs, dtype=np.int32).reshape(-1, 2)
+        return MatchTable(
+            pairs, offsets, matches_a, matches_b, num_candidates, image_width, image_height
+        )
+
+    @staticmethod
+    def load(filename):
+        """
+        :param filename: match table npz file, see SceneStructure.match_table_file
+        :type filename: str
+        :return:
+        :rtype: MatchTable
+        """
+        with np.load(filename) as data:
+            version = int(data['version'])
+            if version != MATCH_TABLE_VERSION:
+                raise ValueError(
+                    "match table %s has version %d, expected %d. Rerun "
+                    "precompute_match_tables.py"
+                    % (filename, version, MATCH_TABLE_VERSION)
+                )
+            return MatchTable(
+                data['pairs'],
+                data['offsets'],
+                data['matches_a'],
+                data['matches_b'],
+                data['num_candidates'],
+                data['image_width'],
+                data['image_height'],
+            )
+
+    def save(self, filename, compress=False):
+        """
+        Writes the table as an npz file, through a temporary file so readers
+        never see a partial table
+        :param filename:
+        :type filename: str
+        :param compress: use np.savez_compressed
+        :type compress: bool
+        :return:
+        :rtype:
+        """
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+
+        save = np.savez_compressed if compress else np.savez
+        tmp_filename = filename + '.tmp.npz'
+        save(
+            tmp_filename,
+            version=np.int32(MATCH_TABLE_VERSION),
+            pairs=self._pairs,
+            offsets=self._offsets,
+            matches_a=self._matches_a,
+            matches_b=self._matches_b,
+            num_candidates=self._num_candidates,
+            image_width=np.int32(self.image_width),
+            image_height=np.int32(self.image_height),
+        )
+        os.replace(tmp_filename, filename)
+
+    @property
+    def pairs(self):
+        return self._pairs
+
+    @property
+    def num_matches(self):
+        return len(self._matches_a)
+
+    def __len__(self):
+        return len(self._pairs)
+
+    def get_pair(self, row):
+        """
+        :return: img_a_idx, img_b_idx
+        :rtype: int, int
+        """
+        return int(self._pairs[row, 0]), int(self._pairs[row, 1])
+
+    def get_matches(self, row):
+        """
+        :return: flattened indices of the matches of the pair in image a and b
+        :rtype: np.array, np.array
+        """
+        start = self._offsets[row]
+        end = self._offsets[row + 1]
+        return self._matches_a[start:end], self._matches_b[start:end]
+
+    def sample_pair(self):
+        """
+        :return: a random row of the table
+        :rtype: int
+        """
+        if len(self._pairs) == 0:
+            raise ValueError("match table is empty")
+        return random.randrange(len(self._pairs))
+
+    def sample_matches(self, row, num_attempts):
+        """
+        Draws num_attempts pixels of image a with replacement among the
+        candidates of the pair and keeps the ones that have a match, like
+        batch_find_pixel_correspondences does.
+        :param row:
+        :type row: int
+        :param num_attempts:
+        :type num_attempts: int
+        :return: (uv_a, uv_b), uv_a is a tuple of torch.LongTensor, uv_b a tuple
+                 of torch.FloatTensor. (None, None) if no match was drawn
+        :rtype:
+        """
+        matches_a, matches_b = self.get_matches(row)
+        num_matches = len(matches_a)
+        num_candidates = int(self._num_candidates[row])
+        if num_matches == 0:
+            return (None, None)
+
+        # candidates [0, num_matches) are the ones with a match
+        draws = torch.randint(num_candidates, (num_attempts,))
+        draws = draws[draws < num_matches]
+        if len(draws) == 0:
+            return (None, None)
+
+        flat_a = torch.from_numpy(matches_a[draws.numpy()].astype(np.int64))
+        flat_b = torch.from_numpy(matches_b[draws.numpy()].astype(np.int64))
+        uv_a = (flat_a % self.image_width, flat_a // self.image_width)
+        uv_b = (
+            (flat_b % self.image_width).float(),
+            (flat_b // self.image_width).float(),
+        )
+        return (uv_a, uv_b)
+
+
+def sample_pairs(pose_store, pair_index, num_pairs, seed=None):
+    """
+    Draws num_pairs distinct (img_a_idx, img_b_idx) pairs uniformly from the
+    valid pairs of a PairIndex
+    :param pose_store:
+    :type pose_store: PoseStore
+    :param pair_index:
+    :type pair_index: PairIndex
+    :param num_pairs: capped at the number of valid pairs
+    :type num_pairs: int
+    :param seed:
+    :type seed: int
+    :return:
+    :rtype: list of (int, int)
+    """
+    num_valid_pairs = len(pair_index.indices)
+    num_pairs = min(num_pairs, num_valid_pairs)
+    rng = np.random.RandomState(seed)
+    entries = np.sort(rng.choice(num_valid_pairs, num_pairs, replace=False))
+    rows_a = np.searchsorted(pair_index.indptr, entries, side='right') - 1
+    rows_b = pair_index.indices[entries]
+    image_idxs = pose_store.image_idxs
+    return [
+        (int(image_idxs[row_a]), int(image_idxs[row_b]))
+        for row_a, row_b in zip(rows_a, rows_b)
+    ]
+
+
+def build_scene_match_table(
+    dataset, scene_name, num_pairs, use_mask=True, seed=None, pairs_per_batch=8
+):
+    """
+    Computes the match table of num_pairs pairs of a scene, drawn from the
+    pairs that get_img_idx_with_different_pose could return. The matches are
+    computed pairs_per_batch pairs at a time, see compute_batch_matches()
+    :param dataset:
+    :type dataset: SpartanDataset
+    :param scene_name:
+    :type scene_name: str
+    :param num_pairs:
+    :type num_pairs: int
+    :param use_mask: only match the masked pixels of image a, this should agree
+                     with sample_matches_only_off_mask in training.yaml
+    :type use_mask: bool
+    :param seed: seed for the choice of pairs
+    :type seed: int
+    :param pairs_per_batch: memory use grows with it, a pair of 640x480
+                            images takes ~30 MB
+    :type pairs_per_batch: int
+    :return:
+    :rtype: MatchTable
+    """
+    pairs = sample_pairs(
+        dataset.get_pose_store(scene_name),
+        dataset.get_pair_index(scene_name),
+        num_pairs,
+        seed=seed,
+    )
+
+    pair_matches = []
+    image_height = image_width = 0
+    for start in range(0, len(pairs), pairs_per_batch):
+        batch_pairs = pairs[start : start + pairs_per_batch]
+        img_idxs = sorted(set(img_idx for pair in batch_pairs for img_idx in pair))
+        rows = dict((img_idx, row) for row, img_idx in enumerate(img_idxs))
+
+        depths = []
+        masks = []
+        poses = []
+        for img_idx in img_idxs:
+            _, depth, mask, pose = dataset.get_rgbd_mask_pose_arrays(
+                scene_name, img_idx
+            )
+            depths.append(depth)
+            masks.append(mask)
+            poses.append(pose)
+        image_height, image_width = depths[0].shape
+
+        batch_rows = [(rows[img_a], rows[img_b]) for img_a, img_b in batch_pairs]
+        pair_matches.extend(
+            compute_batch_matches(
+                np.stack(depths),
+                np.stack(poses),
+                batch_rows,
+                masks=np.stack(masks) if use_mask else None,
+                K=dataset.get_camera_matrix(scene_name),
+            )
+        )
+
+    logging.info(
+        "%s: %d pairs, %d matches"
+        % (scene_name, len(pairs), sum(len(m[0]) for m in pair_matches))
+    )
+    return MatchTable.from_pair_matches(pairs, pair_matches, image_width, image_height)
+
+
+def load_scene_match_table(processed_dir):
+    """
+    :param processed_dir: the processed folder of the scene
+    :type processed_dir: str
+    :return:
+    :rtype: MatchTable
+    """
+    filename = SceneStructure(processed_dir).match_table_file
+    if not os.path.isfile(filename):
+        raise ValueError(
+            "no match table at %s, run "
+            "dense_correspondence_manipulation/scripts/precompute_match_tables.py"
+            % (filename)
+        )
+    return MatchTable.load(filename)
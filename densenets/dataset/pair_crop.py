@@ -0,0 +1,233 @@
+import random
+
+import torch
+from densenets.dataset.dense_correspondence_dataset_masked import (
+    PIXEL_INDEX_DTYPE,
+    DenseCorrespondenceDataset,
+)
+
+# positions of the (a, b) index lists in the tuple returned by
+# SpartanDataset.__getitem__: matches, masked non-matches, background
+# non-matches and blind non-matches
+INDEX_PAIR_FIELDS = ((3, 4), (5, 6), (7, 8), (9, 10))
+MATCHES_FIELDS = INDEX_PAIR_FIELDS[0]
+BLIND_NON_MATCHES_FIELDS = INDEX_PAIR_FIELDS[3]
+
+
+class PairCrop(object):
+    """
+    Crops both images of a sample to a random window around the object and
+    maps its matches, non-matches and blind non-matches into the crops, so
+    that training runs on crop_width x crop_height images.
+
+    The window in image a contains the bounding box of the matches in image a,
+    or of the blind non-matches if the sample has no matches, and is placed
+    randomly within the image. The window in image b contains the matches of
+    the pixels that fell into the window in image a. If a bounding box is
+    larger than the window, the window is a random part of it. Windows cover
+    crop_scale times the crop size of the image and are resized to the crop
+    size, so crop_scale > 1 also lowers the resolution.
+
+    Index pairs with either pixel outside of its window are dropped. A sample
+    that loses all of its matches, masked or background non-matches, or all of
+    the blind non-matches its windows were placed around, becomes an empty
+    sample, see DenseCorrespondenceDataset.return_empty_data.
+    """
+
+    def __init__(self, crop_width, crop_height, crop_scale=1.0):
+        """
+        :param crop_width, crop_height: size of the crops in pixels
+        :type crop_width, crop_height: int
+        :param crop_scale: size of the windows relative to the crops
+        :type crop_scale: float
+        """
+        if (crop_width <= 0) or (crop_height <= 0) or (crop_scale <= 0):
+            raise ValueError(
+                "invalid crop size %s with scale %s"
+                % ((crop_width, crop_height), crop_scale)
+            )
+        self.crop_width = int(crop_width)
+        self.crop_height = int(crop_height)
+        self.crop_scale = float(crop_scale)
+        self.window_width = int(round(self.crop_width * self.crop_scale))
+        self.window_height = int(round(self.crop_height * self.crop_scale))
+
+    @staticmethod
+    def from_training_config(training_config):
+        """
+        :return: the PairCrop of crop_size and crop_scale in training.yaml, None
+                 if crop_size isn't set
+        :rtype: PairCrop or None
+        """
+        crop_size = training_config['training'].get('crop_size')
+        if not crop_size:
+            return None
+        crop_scale = training_config['training'].get('crop_scale', 1.0)
+        return PairCrop(crop_size[0], crop_size[1], crop_scale=crop_scale)
+
+    @property
+    def image_shape(self):
+        """
+        :return: [H, W] of the crops, like DenseCorrespondenceNetwork.image_shape
+        :rtype: list
+        """
+        return [self.crop_height, self.crop_width]
+
+    @staticmethod
+    def _sample_window_start(low, high, window_size, image_size):
+        """
+        Random start of a window of window_size containing [low, high], or
+        inside of [low, high] if it is larger than the window
+        """
+        if high - low + 1 <= window_size:
+            first, last = high - window_size + 1, low
+        else:
+            first, last = low, high - window_size + 1
+        return random.randint(max(first, 0), min(last, image_size - window_size))
+
+    def sample_window(self, flat, image_height, image_width):
+        """
+        :param flat: flattened pixel indices the window should contain, an
+            empty tensor places the window anywhere in the image
+        :type flat: torch.IntTensor
+        :return: top, left of the window
+        :rtype: int, int
+        """
+        if (self.window_height > image_height) or (self.window_width > image_width):
+            raise ValueError(
+                "crop windows of %s don't fit into images of %s"
+                % (
+                    (self.window_height, self.window_width),
+                    (image_height, image_width),
+                )
+            )
+
+        if len(flat) == 0:
+            top = random.randint(0, image_height - self.window_height)
+            left = random.randint(0, image_width - self.window_width)
+            return top, left
+
+        u = flat % image_width
+        v = flat // image_width
+        top = self._sample_window_start(
+            int(v.min()), int(v.max()), self.window_height, image_height
+        )
+        left = self._sample_window_start(
+            int(u.min()), int(u.max()), self.window_width, image_width
+        )
+        return top, left
+
+    def crop_image(self, image, top, left):
+        """
+        :param image: normalized image
+        :type image: torch.FloatTensor [3, H, W]
+        :return: the window at top, left resized to the crop size, a new tensor
+        :rtype: torch.FloatTensor [3, crop_height, crop_width]
+        """
+        crop = image[
+            :, top : top + self.window_height, left : left + self.window_width
+        ]
+        if (self.window_height, self.window_width) == (
+            self.crop_height,
+            self.crop_width,
+        ):
+            # a copy, so that a DataLoader worker doesn't send the whole image
+            return crop.contiguous()
+
+        return torch.nn.functional.interpolate(
+            crop.unsqueeze(0),
+            size=(self.crop_height, self.crop_width),
+            mode='bilinear',
+            align_corners=False,
+            antialias=self.crop_scale > 1,
+        ).squeeze(0)
+
+    def crop_indices(self, flat, image_width, top, left):
+        """
+        Maps flattened pixel indices of an image into the crop of the window
+        at top, left. A pixel of the window goes to the crop pixel that its
+        center falls into.
+        :param flat: flattened pixel indices of the image
+        :type flat: torch.IntTensor
+        :return: flattened pixel indices of the crop, and whether each pixel
+                 is inside of the window
+        :rtype: torch.IntTensor, torch.BoolTensor
+        """
+        u = flat % image_width - left
+        v = flat // image_width - top
+        inside = (
+            (u >= 0) & (u < self.window_width) & (v >= 0) & (v < self.window_height)
+        )
+        if self.window_width != self.crop_width:
+            u = (2 * u + 1) * self.crop_width // (2 * self.window_width)
+        if self.window_height != self.crop_height:
+            v = (2 * v + 1) * self.crop_height // (2 * self.window_height)
+        return v * self.crop_width + u, inside
+
+    def __call__(self, sample):
+        """
+        :param sample: see SpartanDataset.get_within_scene_data()
+        :type sample: tuple
+        :return: the sample with cropped images and index lists, the windows
+                 are in the metadata as crop_window_a and crop_window_b, each
+                 [top, left, height, width]
+        :rtype: tuple
+        """
+        sample = list(sample)
+        image_height, image_width = sample[1].shape[1:]
+
+        # the windows follow the matches, or the blind non-matches if there are
+        # none, e.g. across scenes
+        anchor_fields = None
+        anchor_a = anchor_b = torch.zeros(0, dtype=PIXEL_INDEX_DTYPE)
+        for field_a, field_b in (MATCHES_FIELDS, BLIND_NON_MATCHES_FIELDS):
+            if not DenseCorrespondenceDataset.is_empty(sample[field_a]):
+                anchor_fields = (field_a, field_b)
+                anchor_a, anchor_b = sample[field_a], sample[field_b]
+                break
+
+        top_a, left_a = self.sample_window(anchor_a, image_height, image_width)
+        _, inside_a = self.crop_indices(anchor_a, image_width, top_a, left_a)
+        top_b, left_b = self.sample_window(
+            anchor_b[inside_a], image_height, image_width
+        )
+
+        sample[1] = self.crop_image(sample[1], top_a, left_a)
+        sample[2] = self.crop_image(sample[2], top_b, left_b)
+
+        # index lists that lost all of their pairs
+        emptied = []
+        for field_a, field_b in INDEX_PAIR_FIELDS:
+            if DenseCorrespondenceDataset.is_empty(sample[field_a]):
+                continue
+            flat_a, inside_a = self.crop_indices(
+                sample[field_a], image_width, top_a, left_a
+            )
+            flat_b, inside_b = self.crop_indices(
+                sample[field_b], image_width, top_b, left_b
+            )
+            inside = inside_a & inside_b
+            if inside.any():
+                sample[field_a] = flat_a[inside]
+                sample[field_b] = flat_b[inside]
+            else:
+                emptied.append((field_a, field_b))
+                sample[field_a] = DenseCorrespondenceDataset.empty_tensor()
+                sample[field_b] = DenseCorrespondenceDataset.empty_tensor()
+
+        # the loss functions only take empty blind non-matches, and a sample
+        # without the pairs its windows were placed around has nothing to train
+        if any(
+            (fields != BLIND_NON_MATCHES_FIELDS) or (fields == anchor_fields)
+            for fields in emptied
+        ):
+            sample[0] = -1
+            for field_a, field_b in INDEX_PAIR_FIELDS:
+                sample[field_a] = DenseCorrespondenceDataset.empty_tensor()
+                sample[field_b] = DenseCorrespondenceDataset.empty_tensor()
+
+        window_size = [self.window_height, self.window_width]
+        sample[11] = dict(sample[11])
+        sample[11]['crop_window_a'] = [top_a, left_a] + window_size
+        sample[11]['crop_window_b'] = [top_b, left_b] + window_size
+        return tuple(sample)
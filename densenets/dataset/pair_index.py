@@ -0,0 +1,126 @@
+import random
+
+import numpy as np
+
+
+class PairIndex(object):
+    """
+    For every frame of a scene, the list of frames whose pose is different
+    enough from it, stored as a compressed sparse row (CSR) adjacency list:
+
+    - indptr: np.array of size N + 1, dtype=np.int64
+    - indices: np.array of size indptr[-1], row numbers of the valid partners
+
+    The partners of row i are indices[indptr[i]:indptr[i+1]]. Rows refer to the
+    rows of the PoseStore the index was built from.
+
+    Two frames are a valid pair if their translation differs by more than
+    threshold, or their rotation differs by more than angle_threshold, using
+    the same metrics as utils.compute_distance_between_poses and
+    utils.compute_angle_between_poses.
+    """
+
+    def __init__(self, indptr, indices):
+        self._indptr = indptr
+        self._indices = indices
+        self._indptr.flags.writeable = False
+        self._indices.flags.writeable = False
+
+    @staticmethod
+    def pairwise_distances(poses_a, poses_b):
+        """
+        Vectorized version of utils.compute_distance_between_poses and
+        utils.compute_angle_between_poses for all pairs of poses.
+        :param poses_a: np.array with shape [A, 4, 4]
+        :param poses_b: np.array with shape [B, 4, 4]
+        :return: translation distance and angle, each with shape [A, B]
+        :rtype: np.array, np.array
+        """
+        pos_a = poses_a[:, 0:3, 3]
+        pos_b = poses_b[:, 0:3, 3]
+        diff = pos_a[:, np.newaxis, :] - pos_b[np.newaxis, :, :]
+        dist = np.sqrt(np.sum(diff * diff, axis=2))
+
+        # trace(R_a^T R_b) = 1 + 2 cos(phi), phi being the relative rotation
+        # angle. compute_angle_between_poses returns 2 * phi, keep it that way
+        # so that the same angle_threshold means the same thing.
+        trace = np.einsum('aij,bij->ab', poses_a[:, 0:3, 0:3], poses_b[:, 0:3, 0:3])
+        cos_phi = np.clip((trace - 1.0) / 2.0, -1.0, 1.0)
+        angle = 2 * np.arccos(cos_phi)
+
+        return dist, angle
+
+    @staticmethod
+    def from_poses(poses, threshold, angle_threshold, chunk_size=1024):
+        """
+        Builds the index from an array of camera poses, chunk_size rows at a
+        time so that memory stays bounded for large scenes.
+        :param poses: np.array with shape [N, 4, 4]
+        :type poses:
+        :param threshold: translation threshold, in meters
+        :type threshold: float
+        :param angle_threshold: threshold on compute_angle_between_poses
+        :type angle_threshold: float
+        :return:
+        :rtype: PairIndex
+        """
+        num_poses = len(poses)
+        index_dtype = np.uint16 if num_poses <= np.iinfo(np.uint16).max else np.int32
+
+        degrees = np.zeros(num_poses, dtype=np.int64)
+        indices_list = []
+        for start in range(0, num_poses, chunk_size):
+            end = min(start + chunk_size, num_poses)
+            dist, angle = PairIndex.pairwise_distances(poses[start:end], poses)
+            valid = (dist > threshold) | (angle > angle_threshold)
+            degrees[start:end] = np.count_nonzero(valid, axis=1)
+            indices_list.append(np.nonzero(valid)[1].astype(index_dtype))
+
+        indptr = np.zeros(num_poses + 1, dtype=np.int64)
+        np.cumsum(degrees, out=indptr[1:])
+        if len(indices_list) > 0:
+            indices = np.concatenate(indices_list)
+        else:
+            indices = np.zeros(0, dtype=index_dtype)
+
+        return PairIndex(indptr, indices)
+
+    @property
+    def indptr(self):
+        return self._indptr
+
+    @property
+    def indices(self):
+        return self._indices
+
+    @property
+    def degrees(self):
+        """
+        :return: number of valid partners of each row
+        :rtype: np.array of size N
+        """
+        return np.diff(self._indptr)
+
+    def __len__(self):
+        return len(self._indptr) - 1
+
+    def get_partners(self, row):
+        """
+        :return: rows that form a valid pair with row
+        :rtype: np.array
+        """
+        return self._indices[self._indptr[row] : self._indptr[row + 1]]
+
+    def sample_partner(self, row):
+        """
+        Returns a random valid partner of row, or None if it has none
+        :param row:
+        :type row: int
+        :return:
+        :rtype: int or None
+        """
+        start = self._indptr[row]
+        end = self._indptr[row + 1]
+        if end == start:
+            return None
+        return int(self._indices[random.randrange(start, end)])
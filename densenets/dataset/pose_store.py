@@ -0,0 +1,148 @@
+import logging
+import os
+import random
+
+import densenets.dense_correspondence_manipulation.utils.utils as utils
+import numpy as np
+from densenets.dataset.scene_structure import SceneStructure
+
+
+class PoseStore(object):
+    """
+    Compiled form of a scene's pose_data.yaml.
+
+    - image_idxs: sorted np.array of size N, dtype=np.int64
+    - poses: np.array with shape [N, 4, 4], dtype=np.float64, camera_to_world
+    - idx_to_row: np.array of size max(image_idxs) + 1, dtype=np.int32. Holds
+      the row of poses for each image index, -1 if there is no such image
+
+    The arrays are read-only. They are created once in the main process, by
+    SpartanDataset.load_all_pose_data(), so forked DataLoader workers share
+    the same pages instead of each parsing the yaml.
+    """
+
+    def __init__(self, image_idxs, poses, idx_to_row):
+        self._image_idxs = image_idxs
+        self._poses = poses
+        self._idx_to_row = idx_to_row
+        for array in [self._image_idxs, self._poses, self._idx_to_row]:
+            array.flags.writeable = False
+
+    @staticmethod
+    def from_pose_data(pose_data):
+        """
+        Compiles a PoseStore from the dict stored in pose_data.yaml
+        :param pose_data: dict with (key, value) = (img_idx, {'camera_to_world': ...})
+        :type pose_data: dict
+        :return:
+        :rtype: PoseStore
+        """
+        image_idxs = np.array(sorted(int(idx) for idx in pose_data.keys()), dtype=np.int64)
+        if len(image_idxs) == 0:
+            raise ValueError("pose_data is empty")
+
+        poses = np.zeros([len(image_idxs), 4, 4], dtype=np.float64)
+        for row, img_idx in enumerate(image_idxs):
+            poses[row] = utils.homogenous_transform_from_dict(
+                pose_data[int(img_idx)]['camera_to_world']
+            )
+
+        idx_to_row = np.full(image_idxs[-1] + 1, -1, dtype=np.int32)
+        idx_to_row[image_idxs] = np.arange(len(image_idxs), dtype=np.int32)
+        return PoseStore(image_idxs, poses, idx_to_row)
+
+    @staticmethod
+    def load(processed_dir):
+        """
+        Loads the PoseStore for a scene from its binary cache, recompiling
+        pose_data.yaml if the cache is missing or older than the yaml. If the
+        cache can't be written (e.g. read-only dataset) the compiled store is
+        only kept in memory.
+        :param processed_dir: the processed folder of the scene
+        :type processed_dir: str
+        :return:
+        :rtype: PoseStore
+        """
+        ss = SceneStructure(processed_dir)
+        yaml_mtime = os.path.getmtime(ss.camera_pose_file)
+
+        cache_file = ss.pose_data_cache_file
+        if os.path.isfile(cache_file):
+            with np.load(cache_file) as cache:
+                if float(cache['yaml_mtime']) == yaml_mtime:
+                    return PoseStore(
+                        cache['image_idxs'], cache['poses'], cache['idx_to_row']
+                    )
+            logging.info("pose cache %s is stale, recompiling" % (cache_file))
+
+        pose_store = PoseStore.from_pose_data(
+            utils.getDictFromYamlFilename(ss.camera_pose_file)
+        )
+
+        tmp_cache_file = cache_file + '.tmp.npz'
+        try:
+            np.savez(
+                tmp_cache_file,
+                image_idxs=pose_store.image_idxs,
+                poses=pose_store.poses,
+                idx_to_row=pose_store.idx_to_row,
+                yaml_mtime=np.float64(yaml_mtime),
+            )
+            os.replace(tmp_cache_file, cache_file)
+        except (IOError, OSError) as e:
+            logging.warning("couldn't write pose cache %s: %s" % (cache_file, e))
+
+        return pose_store
+
+    @property
+    def image_idxs(self):
+        return self._image_idxs
+
+    @property
+    def poses(self):
+        return self._poses
+
+    @property
+    def idx_to_row(self):
+        return self._idx_to_row
+
+    def __len__(self):
+        return len(self._image_idxs)
+
+    def get_row(self, img_idx):
+        """
+        Returns the row of poses corresponding to img_idx
+        :param img_idx:
+        :type img_idx: int
+        :return:
+        :rtype: int
+        """
+        img_idx = int(img_idx)
+        row = -1
+        if 0 <= img_idx < len(self._idx_to_row):
+            row = self._idx_to_row[img_idx]
+        if row < 0:
+            raise ValueError("no pose for image index %d" % (img_idx))
+        return int(row)
+
+    def has_image(self, img_idx):
+        img_idx = int(img_idx)
+        return 0 <= img_idx < len(self._idx_to_row) and self._idx_to_row[img_idx] >= 0
+
+    def get_pose(self, img_idx):
+        """
+        :param img_idx:
+        :type img_idx: int
+        :return: camera_to_world, 4 x 4 numpy array (a copy, safe to modify)
+        :rtype: numpy.ndarray
+        """
+        return self._poses[self.get_row(img_idx)].copy()
+
+    def get_random_image_index(self):
+        """
+        Returns a random image index, uses the python random module like the
+        rest of the dataset sampling
+        :return:
+        :rtype: int
+        """
+        return int(self._image_idxs[random.randrange(len(self._image_idxs))])
@@ -0,0 +1,245 @@
+import glob
+import hashlib
+import logging
+import multiprocessing
+import os
+
+import densenets.dense_correspondence_manipulation.utils.utils as utils
+import numpy as np
+import yaml
+from densenets.dataset.scene_structure import SceneStructure
+from PIL import Image
+
+SCENE_MANIFEST_VERSION = 2
+
+
+def _file_list_hash(directory, suffix):
+    """
+    :return: sha1 of the sorted names of the files in directory ending in
+             suffix, None if the directory doesn't exist
+    :rtype: str or None
+    """
+    if not os.path.isdir(directory):
+        return None
+    filenames = sorted(x for x in os.listdir(directory) if x.endswith(suffix))
+    return hashlib.sha1('\n'.join(filenames).encode('utf-8')).hexdigest()
+
+
+def scene_fingerprint(processed_dir):
+    """
+    Cheap summary of the state of a scene on disk, used to decide whether a
+    manifest is stale: the lists of rgb, depth and mask images and the mtime of
+    pose_data.yaml. Directory mtimes aren't used, since the caches written next
+    to the images, e.g. the pose cache of densenets/dataset/pose_store.py,
+    change them.
+    :param processed_dir:
+    :type processed_dir: str
+    :return:
+    :rtype: dict
+    """
+    ss = SceneStructure(processed_dir)
+    fingerprint = dict()
+    fingerprint['rgb_images'] = _file_list_hash(ss.images_dir, '_rgb.png')
+    fingerprint['depth_images'] = _file_list_hash(
+        ss.rendered_images_dir, '_depth.png'
+    )
+    fingerprint['masks'] = _file_list_hash(ss.image_masks_dir, '_mask.png')
+    if os.path.exists(ss.camera_pose_file):
+        fingerprint['camera_pose_file'] = os.path.getmtime(ss.camera_pose_file)
+    else:
+        fingerprint['camera_pose_file'] = None
+    return fingerprint
+
+
+def compute_scene_manifest(processed_dir):
+    """
+    Scans a scene once and summarizes it. The manifest contains
+
+    - image_idxs: sorted list of image indices that have an rgb image
+    - image_width, image_height
+    - camera_matrix: 3 x 3 nested list, None if there is no camera_info.yaml
+    - mask_pixel_counts: number of nonzero mask pixels for each of image_idxs,
+                         -1 if the mask is missing
+    - fingerprint: see scene_fingerprint()
+
+    :param processed_dir: the processed folder of the scene
+    :type processed_dir: str
+    :return:
+    :rtype: dict
+    """
+    ss = SceneStructure(processed_dir)
+    fingerprint = scene_fingerprint(processed_dir)
+
+    rgb_images = glob.glob(os.path.join(ss.images_dir, '*_rgb.png'))
+    image_idxs = sorted(
+        int(os.path.basename(filename).split('_')[0]) for filename in rgb_images
+    )
+
+    manifest = dict()
+    manifest['version'] = SCENE_MANIFEST_VERSION
+    manifest['fingerprint'] = fingerprint
+    manifest['image_idxs'] = image_idxs
+    manifest['image_width'] = None
+    manifest['image_height'] = None
+    manifest['camera_matrix'] = None
+    manifest['mask_pixel_counts'] = []
+
+    if len(image_idxs) > 0:
+        # only reads the png header
+        width, height = Image.open(rgb_images[0]).size
+        manifest['image_width'] = width
+        manifest['image_height'] = height
+
+    if os.path.isfile(ss.camera_info_file):
+        camera_intrinsics = utils.CameraIntrinsics.from_yaml_file(ss.camera_info_file)
+        manifest['camera_matrix'] = camera_intrinsics.K.tolist()
+
+    for img_idx in image_idxs:
+        mask_file = os.path.join(
+            ss.image_masks_dir, utils.getPaddedString(img_idx) + '_mask.png'
+        )
+        if os.path.isfile(mask_file):
+            count = np.count_nonzero(np.asarray(Image.open(mask_file)))
+        else:
+            count = -1
+        manifest['mask_pixel_counts'].append(int(count))
+
+    return manifest
+
+
+def load_scene_manifest(processed_dir, fingerprint=None):
+    """
+    Returns the scene manifest stored in the scene, or None if it is missing
+    or stale
+    :param processed_dir:
+    :type processed_dir: str
+    :param fingerprint: current fingerprint of the scene, computed if None
+    :type fingerprint: dict
+    :return:
+    :rtype: dict or None
+    """
+    ss = SceneStructure(processed_dir)
+    if not os.path.isfile(ss.scene_manifest_file):
+        return None
+
+    manifest = utils.getDictFromYamlFilename(ss.scene_manifest_file)
+    if fingerprint is None:
+        fingerprint = scene_fingerprint(processed_dir)
+    if is_manifest_stale(manifest, fingerprint):
+        return None
+    return manifest
+
+
+def is_manifest_stale(manifest, fingerprint):
+    return (
+        manifest is None
+        or manifest.get('version') != SCENE_MANIFEST_VERSION
+        or manifest.get('fingerprint') != fingerprint
+    )
+
+
+def update_scene_manifest(processed_dir):
+    """
+    Returns the manifest of the scene, recomputing and saving it if the one on
+    disk is missing or stale. Meant to be called from a worker pool.
+    :param processed_dir:
+    :type processed_dir: str
+    :return:
+    :rtype: dict
+    """
+    manifest = load_scene_manifest(processed_dir)
+    if manifest is not None:
+        return manifest
+
+    logging.info("computing scene manifest for %s" % (processed_dir))
+    manifest = compute_scene_manifest(processed_dir)
+    try:
+        utils.saveToYaml(manifest, SceneStructure(processed_dir).scene_manifest_file)
+    except (IOError, OSError) as e:
+        logging.warning("couldn't save scene manifest for %s: %s" % (processed_dir, e))
+    return manifest
+
+
+def dataset_config_hash(config):
+    """
+    Hash of a (expanded) composite dataset config, used as the key of the
+    dataset manifest
+    :param config:
+    :type config: dict
+    :return:
+    :rtype: str
+    """
+    config_str = yaml.dump(config, default_flow_style=False)
+    return hashlib.sha1(config_str.encode('utf-8')).hexdigest()
+
+
+def dataset_manifest_filename(logs_root_path, config):
+    return os.path.join(
+        logs_root_path, 'dataset_manifests', dataset_config_hash(config) + '.yaml'
+    )
+
+
+def load_dataset_manifest(logs_root_path, config, scene_dirs, num_workers=None):
+    """
+    Returns the manifests of all the scenes of a composite dataset config.
+
+    The top-level manifest lives in <logs_root_path>/dataset_manifests and is
+    keyed by the hash of the config. Only the scenes whose fingerprint changed
+    are rescanned, in parallel, after which the top-level manifest is rewritten.
+    :param logs_root_path:
+    :type logs_root_path: str
+    :param config: the expanded dataset config, see SpartanDataset.config
+    :type config: dict
+    :param scene_dirs: (key, value) = (scene_name, processed folder of the scene)
+    :type scene_dirs: dict
+    :param num_workers: size of the pool used to rescan stale scenes
+    :type num_workers: int
+    :return: (key, value) = (scene_name, scene manifest)
+    :rtype: dict
+    """
+    manifest_file = dataset_manifest_filename(logs_root_path, config)
+
+    scenes = dict()
+    if os.path.isfile(manifest_file):
+        scenes = utils.getDictFromYamlFilename(manifest_file)['scenes']
+
+    stale_scene_names = []
+    for scene_name, processed_dir in scene_dirs.items():
+        fingerprint = scene_fingerprint(processed_dir)
+        if is_manifest_stale(scenes.get(scene_name), fingerprint):
+            stale_scene_names.append(scene_name)
+
+    if len(stale_scene_names) == 0:
+        return dict((scene_name, scenes[scene_name]) for scene_name in scene_dirs)
+
+    logging.info("updating manifests of %d scenes" % (len(stale_scene_names)))
+    stale_scene_dirs = [scene_dirs[scene_name] for scene_name in stale_scene_names]
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    num_workers = min(num_workers, len(stale_scene_dirs))
+
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            stale_manifests = pool.map(update_scene_manifest, stale_scene_dirs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        stale_manifests = [update_scene_manifest(d) for d in stale_scene_dirs]
+
+    for scene_name, manifest in zip(stale_scene_names, stale_manifests):
+        scenes[scene_name] = manifest
+
+    scenes = dict((scene_name, scenes[scene_name]) for scene_name in scene_dirs)
+    dataset_manifest = dict()
+    dataset_manifest['config_hash'] = dataset_config_hash(config)
+    dataset_manifest['scenes'] = scenes
+    try:
+        if not os.path.isdir(os.path.dirname(manifest_file)):
+            os.makedirs(os.path.dirname(manifest_file))
+        utils.saveToYaml(dataset_manifest, manifest_file)
+    except (IOError, OSError) as e:
+        logging.warning("couldn't save dataset manifest %s: %s" % (manifest_file, e))
+
+    return scenes
@@ -44,6 +44,18 @@ class SceneStructure(object):
         """
         return os.path.join(self._processed_folder_dir, 'images', 'pose_data.yaml')
 
+    @property
+    def pose_data_cache_file(self):
+        """
+        Full filepath for the binary cache of the camera poses, see
+        densenets/dataset/pose_store.py
+        :return:
+        :rtype:
+        """
+        return os.path.join(
+            self._processed_folder_dir, 'images', 'pose_data_cache.npz'
+        )
+
     @property
     def rendered_images_dir(self):
         return os.path.join(self._processed_folder_dir, 'rendered_images')
@@ -52,10 +64,107 @@ class SceneStructure(object):
     def images_dir(self):
         return os.path.join(self._processed_folder_dir, 'images')
 
+    @property
+    def image_masks_dir(self):
+        return os.path.join(self._processed_folder_dir, 'image_masks')
+
     @property
     def metadata_file(self):
         return os.path.join(self.images_dir, 'metadata.yaml')
 
+    @property
+    def scene_manifest_file(self):
+        """
+        Full filepath for the scene manifest, see densenets/dataset/scene_manifest.py
+        :return:
+        :rtype:
+        """
+        return os.path.join(self._processed_folder_dir, 'scene_manifest.yaml')
+
+    @property
+    def frame_store_dir(self):
+        """
+        Directory holding the packed frame store for this scene, see
+        densenets/dataset/frame_store.py
+        :return:
+        :rtype:
+        """
+        return os.path.join(self._processed_folder_dir, 'frame_store')
+
+    @property
+    def frame_store_shard_file(self):
+        """
+        Full filepath for the memory-mapped shard containing the rgb, depth
+        and mask images of every frame in the scene
+        :return:
+        :rtype:
+        """
+        return os.path.join(self.frame_store_dir, 'frames.bin')
+
+    @property
+    def frame_store_index_file(self):
+        """
+        Full filepath for the yaml index describing the layout of the shard
+        :return:
+        :rtype:
+        """
+        return os.path.join(self.frame_store_dir, 'index.yaml')
+
+    @property
+    def frame_store_mask_index_file(self):
+        """
+        Full filepath for the mask indices of every frame in the shard, see
+        densenets/dataset/mask_index.py
+        :return:
+        :rtype:
+        """
+        return os.path.join(self.frame_store_dir, 'mask_index.bin')
+
+    @property
+    def correspondences_dir(self):
+        """
+        Directory holding precomputed correspondences for this scene
+        :return:
+        :rtype:
+        """
+        return os.path.join(self._processed_folder_dir, 'correspondences')
+
+    @property
+    def match_table_file(self):
+        """
+        Full filepath for the precomputed match table of the scene, see
+        densenets/dataset/match_table.py
+        :return:
+        :rtype:
+        """
+        return os.path.join(self.correspondences_dir, 'match_table.npz')
+
+    @property
+    def flow_fields_dir(self):
+        """
+        Directory holding the precomputed flow fields of frame pairs of this
+        scene, see densenets/dataset/flow_field.py
+        :return:
+        :rtype:
+        """
+        return os.path.join(self._processed_folder_dir, 'flow_fields')
+
+    def flow_field_filename(self, img_a_idx, img_b_idx):
+        """
+        Full filepath for the flow field from image a to image b
+        :param img_a_idx:
+        :type img_a_idx: int
+        :param img_b_idx:
+        :type img_b_idx: int
+        :return:
+        :rtype: str
+        """
+        filename = "%s_%s_flow.npz" % (
+            utils.getPaddedString(img_a_idx),
+            utils.getPaddedString(img_b_idx),
+        )
+        return os.path.join(self.flow_fields_dir, filename)
+
     def mesh_descriptors_dir(self, network_name):
         """
         Directory where we store descriptors corresponding to a particular network
@@ -2,21 +2,37 @@ import copy
 import logging
 import os
 import random
+import time
+from collections import OrderedDict
 
 import densenets.correspondence_tools.correspondence_augmentation as correspondence_augmentation
 import densenets.correspondence_tools.correspondence_finder as correspondence_finder
+import densenets.dataset.scene_manifest as scene_manifest
 import densenets.dense_correspondence_manipulation.utils.constants as constants
 import densenets.dense_correspondence_manipulation.utils.utils as utils
 import numpy as np
 import torch
+from PIL import Image
 
 # note that this is the torchvision provided by the warmspringwinds
 # pytorch-segmentation-detection repo. It is a fork of pytorch/vision
 from densenets import transforms
 from densenets.dataset.dense_correspondence_dataset_masked import (
+    PIXEL_INDEX_DTYPE,
     DenseCorrespondenceDataset,
     ImageType,
+    StorageBackend,
 )
+from densenets.dataset.background_bank import BackgroundBank
+from densenets.dataset.frame_bank import FrameBank
+from densenets.dataset.frame_cache import SharedFrameCache
+from densenets.dataset.flow_field import load_scene_flow_field
+from densenets.dataset.frame_store import FrameStore
+from densenets.dataset.mask_index import MaskIndex
+from densenets.dataset.pair_crop import PairCrop
+from densenets.dataset.match_table import CorrespondenceSource, load_scene_match_table
+from densenets.dataset.pair_index import PairIndex
+from densenets.dataset.pose_store import PoseStore
 from densenets.dataset.scene_structure import SceneStructure
 from densenets.dense_correspondence_manipulation.utils.utils import CameraIntrinsics
 
@@ -33,6 +49,9 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
     PADDED_STRING_WIDTH = 6
 
+    # number of frames whose MaskIndex is kept by get_mask_index()
+    MASK_INDEX_CACHE_SIZE = 256
+
     def __init__(
         self,
         debug=False,
@@ -92,6 +111,19 @@ class SpartanDataset(DenseCorrespondenceDataset):
             raise ValueError("You need to give me either a config or config_expanded")
 
         self._pose_data = dict()
+        self._pose_stores = dict()
+        self._pair_indices = dict()
+        self._frame_stores = dict()
+        self._scene_manifests = None
+        self._frame_cache = None
+        self._frame_bank = None
+        self._background_bank = None
+        self._pair_crop = None
+        self._match_tables = dict()
+        self._mask_index_cache = OrderedDict()
+        self._working_sets = dict()
+        self._correspondence_source = CorrespondenceSource.REPROJECTION
+        self.synthetic_multi_object_num_objects = 2
         self._initialize_rgb_image_to_tensor()
 
         if mode == "test":
@@ -116,7 +148,26 @@ class SpartanDataset(DenseCorrespondenceDataset):
         img pair types, then returns that type of data.
         """
 
-        data_load_type = self._get_data_load_type()
+        return self.get_data_of_type(self._get_data_load_type())
+
+    def get_data_of_type(self, data_load_type):
+        """
+        Returns a sample of the given SpartanDatasetDataType
+        :param data_load_type:
+        :type data_load_type: SpartanDatasetDataType
+        :return: see get_within_scene_data(), cropped if crop_size is set in
+                 the training config, see PairCrop
+        :rtype: tuple
+        """
+        sample = self._get_data_of_type(data_load_type)
+        if self._pair_crop is not None:
+            sample = self._pair_crop(sample)
+        return sample
+
+    def _get_data_of_type(self, data_load_type):
+        """
+        get_data_of_type() without the crops
+        """
 
         # Case 0: Same scene, same object
         if data_load_type == SpartanDatasetDataType.SINGLE_OBJECT_WITHIN_SCENE:
@@ -206,7 +257,7 @@ class SpartanDataset(DenseCorrespondenceDataset):
             config_file = os.path.join(prefix, 'multi_object', config_file)
             multi_object_scene_config = utils.getDictFromYamlFilename(config_file)
 
-            for key, val in self._multi_object_scene_dict.iteritems():
+            for key, val in self._multi_object_scene_dict.items():
                 for item in multi_object_scene_config[key]:
                     val.append(item)
 
@@ -285,6 +336,50 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
         return scene_list
 
+    def get_scene_manifests(self):
+        """
+        Returns the manifests of all train and test scenes in this dataset, see
+        densenets/dataset/scene_manifest.py. Stale manifests are regenerated.
+        :return: (key, value) = (scene_name, scene manifest)
+        :rtype: dict
+        """
+        if self._scene_manifests is None:
+            scene_dirs = dict()
+            for mode in ["train", "test"]:
+                for scene_name in self.scene_generator(mode=mode):
+                    scene_dirs[scene_name] = self.get_full_path_for_scene(scene_name)
+
+            self._scene_manifests = scene_manifest.load_dataset_manifest(
+                self.logs_root_path, self._config, scene_dirs
+            )
+
+        return self._scene_manifests
+
+    def get_scene_manifest(self, scene_name):
+        """
+        :param scene_name:
+        :type scene_name: str
+        :return: manifest with keys image_idxs, image_width, image_height,
+                 camera_matrix, mask_pixel_counts
+        :rtype: dict
+        """
+        return self.get_scene_manifests()[scene_name]
+
+    def init_length(self):
+        """
+        Computes the total number of images and scenes in this dataset from the
+        scene manifests, rather than globbing every scene directory.
+        Sets the result to the class variables self.num_images_total and self._num_scenes
+        :return:
+        :rtype:
+        """
+        self.num_images_total = 0
+        self._num_scenes = 0
+        for scene_name in self.scene_generator():
+            manifest = self.get_scene_manifest(scene_name)
+            self.num_images_total += len(manifest['image_idxs'])
+            self._num_scenes += 1
+
     def get_list_of_objects(self):
         """
         Returns a list of object ids
@@ -311,7 +406,9 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
     def _initialize_rgb_image_to_tensor(self):
         """
-        Sets up the RGB PIL.Image --> torch.FloatTensor transform
+        Sets up the RGB PIL.Image --> torch.FloatTensor transform, and the
+        equivalent one for numpy arrays that writes the normalized tensor
+        straight from the (possibly flipped) array
         :return: None
         :rtype:
         """
@@ -321,6 +418,9 @@ class SpartanDataset(DenseCorrespondenceDataset):
         self._rgb_image_to_tensor = transforms.Compose(
             [transforms.ToTensor(), norm_transform]
         )
+        self._rgb_array_to_tensor = transforms.ToNormalizedTensor(
+            self.get_image_mean(), self.get_image_std_dev()
+        )
 
     def get_full_path_for_scene(self, scene_name):
         """
@@ -335,13 +435,33 @@ class SpartanDataset(DenseCorrespondenceDataset):
     def load_all_pose_data(self):
         """
         Efficiently pre-loads all pose data for the scenes. This is because when used as
-        part of torch DataLoader in threaded way it behaves strangely
+        part of torch DataLoader in threaded way it behaves strangely.
+
+        Only the compiled PoseStore and the default PairIndex are built, so that
+        the forked workers share them rather than each parsing pose_data.yaml
         :return:
         :rtype:
         """
 
         for scene_name in self.scene_generator():
-            self.get_pose_data(scene_name)
+            self.get_pose_store(scene_name)
+            self.get_pair_index(scene_name)
+
+    def get_pose_store(self, scene_name):
+        """
+        Returns the compiled PoseStore for this scene, loading it from the binary
+        cache (or compiling pose_data.yaml) on first use.
+        :type scene_name: str
+        :return:
+        :rtype: PoseStore
+        """
+        if scene_name not in self._pose_stores:
+            logging.info("Loading pose store for scene %s" % (scene_name))
+            self._pose_stores[scene_name] = PoseStore.load(
+                self.get_full_path_for_scene(scene_name)
+            )
+
+        return self._pose_stores[scene_name]
 
     def get_pose_data(self, scene_name):
         """
@@ -368,10 +488,467 @@ class SpartanDataset(DenseCorrespondenceDataset):
         :param img_idx: int
         :return: 4 x 4 numpy array
         """
-        idx = int(idx)
-        scene_pose_data = self.get_pose_data(scene_name)
-        pose_data = scene_pose_data[idx]['camera_to_world']
-        return utils.homogenous_transform_from_dict(pose_data)
+        return self.get_pose_store(scene_name).get_pose(idx)
+
+    def get_pair_index(self, scene_name, threshold=0.2, angle_threshold=20):
+        """
+        Returns the PairIndex of image pairs in this scene whose poses differ by
+        more than threshold (translation) or angle_threshold (rotation). Built
+        on first use and kept for the lifetime of the dataset.
+        :param scene_name:
+        :type scene_name: str
+        :return:
+        :rtype: PairIndex
+        """
+        key = (scene_name, threshold, angle_threshold)
+        if key not in self._pair_indices:
+            self._pair_indices[key] = PairIndex.from_poses(
+                self.get_pose_store(scene_name).poses, threshold, angle_threshold
+            )
+
+        return self._pair_indices[key]
+
+    def get_match_table(self, scene_name):
+        """
+        Returns the precomputed MatchTable for this scene, loading it on first
+        use. Raises a ValueError if the scene doesn't have one, see
+        dense_correspondence_manipulation/scripts/precompute_match_tables.py
+        :param scene_name:
+        :type scene_name: str
+        :return:
+        :rtype: MatchTable
+        """
+        if scene_name not in self._match_tables:
+            self._match_tables[scene_name] = load_scene_match_table(
+                self.get_full_path_for_scene(scene_name)
+            )
+        return self._match_tables[scene_name]
+
+    def get_flow_field(self, scene_name, img_a_idx, img_b_idx):
+        """
+        Returns the precomputed FlowField from image a to image b. Raises a
+        ValueError if it hasn't been computed, see
+        dense_correspondence_manipulation/scripts/compute_flow_fields.py
+        :param scene_name:
+        :type scene_name: str
+        :return:
+        :rtype: FlowField
+        """
+        return load_scene_flow_field(
+            self.get_full_path_for_scene(scene_name), img_a_idx, img_b_idx
+        )
+
+    def get_frame_store(self, scene_name):
+        """
+        Returns the packed FrameStore for this scene, opening it on first use.
+        Raises a ValueError if the scene hasn't been packed, see
+        dense_correspondence_manipulation/scripts/pack_frame_store.py
+        :param scene_name:
+        :type scene_name: str
+        :return:
+        :rtype: FrameStore
+        """
+        if scene_name not in self._frame_stores:
+            processed_dir = self.get_full_path_for_scene(scene_name)
+            if not FrameStore.exists(processed_dir):
+                raise ValueError(
+                    "scene %s has no packed frame store, run pack_frame_store.py"
+                    % (scene_name)
+                )
+            self._frame_stores[scene_name] = FrameStore(processed_dir)
+
+        return self._frame_stores[scene_name]
+
+    def get_rgbd_mask_pose(self, scene_name, img_idx):
+        """
+        Returns rgb image, depth image, mask and pose. If the frames come from the
+        preloaded frame bank, the packed storage backend or the shared frame
+        cache, the images are wrapped around those arrays rather than decoded
+        from png.
+        :param scene_name:
+        :type scene_name: str
+        :param img_idx:
+        :type img_idx: int
+        :return: rgb, depth, mask, pose
+        :rtype: PIL.Image.Image, PIL.Image.Image, PIL.Image.Image, a 4x4 numpy array
+        """
+        if (
+            (self._storage_backend == StorageBackend.PNG)
+            and (self._frame_cache is None)
+            and (self._frame_bank is None)
+            and (len(self._working_sets) == 0)
+        ):
+            return DenseCorrespondenceDataset.get_rgbd_mask_pose(
+                self, scene_name, img_idx
+            )
+
+        rgb, depth, mask, pose = self.get_rgbd_mask_pose_arrays(scene_name, img_idx)
+        return Image.fromarray(rgb), Image.fromarray(depth), Image.fromarray(mask), pose
+
+    def get_rgbd_mask_pose_arrays(self, scene_name, img_idx):
+        """
+        Same as get_rgbd_mask_pose but returns numpy arrays. Frames are looked
+        up in the working set of the scene (see set_working_set), the preloaded
+        frame bank, then the shared frame cache, then read from the storage
+        backend. Frames from the bank or the packed backend are read-only views.
+        :param scene_name:
+        :type scene_name: str
+        :param img_idx:
+        :type img_idx: int
+        :return: rgb, depth, mask, pose
+        :rtype: [H,W,3] uint8, [H,W] uint16, [H,W] uint8, a 4x4 numpy array
+        """
+        pose = self.get_pose_from_scene_name_and_idx(scene_name, img_idx)
+
+        working_set = self._working_sets.get(scene_name)
+        if working_set is not None:
+            if working_set.has_frame(img_idx):
+                rgb, depth, mask = working_set.get_frame(img_idx)
+                return rgb, depth, mask, pose
+            working_set.num_misses += 1
+
+        if (self._frame_bank is not None) and self._frame_bank.has_frame(
+            scene_name, img_idx
+        ):
+            rgb, depth, mask = self._frame_bank.get_frame(scene_name, img_idx)
+            return rgb, depth, mask, pose
+
+        if self._frame_cache is not None:
+            frame = self._frame_cache.get(scene_name, img_idx)
+            if frame is not None:
+                rgb, depth, mask = frame
+                return rgb, depth, mask, pose
+
+        rgb, depth, mask = self._load_rgbd_mask_arrays(scene_name, img_idx)
+        if self._frame_cache is not None:
+            self._frame_cache.put(scene_name, img_idx, rgb, depth, mask)
+
+        return rgb, depth, mask, pose
+
+    def set_working_set(self, working_set):
+        """
+        Restricts the within scene sampling of working_set.scene_name to the
+        frames of the working set, which are served from memory, see
+        densenets/dataset/streaming.py
+        :param working_set:
+        :type working_set: WorkingSet
+        :return:
+        :rtype:
+        """
+        self._working_sets[working_set.scene_name] = working_set
+
+    def clear_working_set(self, scene_name):
+        self._working_sets.pop(scene_name, None)
+
+    def get_working_set(self, scene_name):
+        """
+        :return: the working set of the scene, None if it doesn't have one
+        :rtype: WorkingSet or None
+        """
+        return self._working_sets.get(scene_name)
+
+    def get_mask_index(self, scene_name, img_idx, mask=None):
+        """
+        Returns the MaskIndex of the mask of a frame. It comes from the
+        preloaded frame bank if it has it, otherwise it is read from the packed
+        frame store or computed, and kept in a per process LRU cache of
+        SpartanDataset.MASK_INDEX_CACHE_SIZE frames, which also keeps the
+        MaskIndex.outside it computes.
+        :param scene_name:
+        :type scene_name: str
+        :param img_idx:
+        :type img_idx: int
+        :param mask: the mask of the frame if it is already loaded
+        :type mask: PIL.Image.Image or numpy.ndarray
+        :return:
+        :rtype: MaskIndex
+        """
+        if (self._frame_bank is not None) and self._frame_bank.has_frame(
+            scene_name, img_idx
+        ):
+            mask_index = self._frame_bank.get_mask_index(scene_name, img_idx)
+            if mask_index is not None:
+                return mask_index
+
+        key = (scene_name, int(img_idx))
+        if key in self._mask_index_cache:
+            self._mask_index_cache.move_to_end(key)
+            return self._mask_index_cache[key]
+
+        mask_index = None
+        if self._storage_backend == StorageBackend.PACKED:
+            frame_store = self.get_frame_store(scene_name)
+            if frame_store.has_mask_index:
+                mask_index = frame_store.get_mask_index(img_idx)
+
+        if mask_index is None:
+            if mask is None:
+                _, _, mask, _ = self.get_rgbd_mask_pose_arrays(scene_name, img_idx)
+            mask_index = MaskIndex.from_mask(np.asarray(mask))
+        self._mask_index_cache[key] = mask_index
+        if len(self._mask_index_cache) > SpartanDataset.MASK_INDEX_CACHE_SIZE:
+            self._mask_index_cache.popitem(last=False)
+        return mask_index
+
+    def _load_rgbd_mask_arrays(self, scene_name, img_idx):
+        """
+        Reads a frame from the storage backend
+        :return: rgb, depth, mask
+        :rtype: [H,W,3] uint8, [H,W] uint16, [H,W] uint8
+        """
+        if self._storage_backend == StorageBackend.PACKED:
+            return self.get_frame_store(scene_name).get_frame(img_idx)
+
+        rgb, depth, mask, _ = DenseCorrespondenceDataset.get_rgbd_mask_pose(
+            self, scene_name, img_idx
+        )
+        rgb = np.asarray(rgb, dtype=np.uint8)
+        depth = np.asarray(depth, dtype=np.uint16)
+        mask = np.asarray(mask, dtype=np.uint8)
+        return rgb, depth, mask
+
+    def enable_frame_cache(self, size_bytes):
+        """
+        Sets up a SharedFrameCache of size_bytes, shared by all DataLoader
+        workers. Must be called before the DataLoader starts its workers.
+        :param size_bytes:
+        :type size_bytes: int
+        :return:
+        :rtype:
+        """
+        self.disable_frame_cache()
+
+        scene_names = self.get_scene_list(mode="train") + self.get_scene_list(
+            mode="test"
+        )
+        max_height = 0
+        max_width = 0
+        for scene_name in scene_names:
+            manifest = self.get_scene_manifest(scene_name)
+            if manifest['image_height'] is not None:
+                max_height = max(max_height, manifest['image_height'])
+                max_width = max(max_width, manifest['image_width'])
+
+        self._frame_cache = SharedFrameCache(
+            size_bytes, max_height, max_width, scene_names
+        )
+
+    def disable_frame_cache(self):
+        if self._frame_cache is not None:
+            self._frame_cache.close()
+        self._frame_cache = None
+
+    def get_frame_cache_stats(self):
+        """
+        Returns the hit, miss and eviction counters of the frame cache, summed
+        over all workers, or None if it is disabled
+        :return:
+        :rtype: dict or None
+        """
+        if self._frame_cache is None:
+            return None
+        return self._frame_cache.get_stats()
+
+    def enable_preload(self, num_workers=None):
+        """
+        Decodes every frame of the scenes in the current mode once into a
+        shared FrameBank, so that no files are read during training. Must be
+        called before the DataLoader starts its workers.
+        :param num_workers: size of the decoding pool, defaults to the number of cpus
+        :type num_workers: int
+        :return:
+        :rtype:
+        """
+        self.disable_preload()
+        start_time = time.time()
+
+        frames = []
+        image_shape = None
+        for scene_name in self.scene_generator():
+            manifest = self.get_scene_manifest(scene_name)
+            scene_image_shape = (manifest['image_height'], manifest['image_width'])
+            if image_shape is None:
+                image_shape = scene_image_shape
+            elif scene_image_shape != image_shape:
+                raise ValueError(
+                    "preload requires all scenes to have the same image size, "
+                    "%s has %s, expected %s"
+                    % (scene_name, scene_image_shape, image_shape)
+                )
+
+            for img_idx in self.get_pose_store(scene_name).image_idxs:
+                frames.append((scene_name, int(img_idx)))
+
+        frame_bank = FrameBank(frames, image_shape[0], image_shape[1])
+        if self._storage_backend == StorageBackend.PACKED:
+            for row, (scene_name, img_idx) in enumerate(frames):
+                frame_bank.set_frame(
+                    row, *self.get_frame_store(scene_name).get_frame(img_idx)
+                )
+        else:
+            filenames = []
+            for scene_name, img_idx in frames:
+                filenames.append(
+                    [
+                        self.get_image_filename(scene_name, img_idx, image_type)
+                        for image_type in [ImageType.RGB, ImageType.DEPTH, ImageType.MASK]
+                    ]
+                )
+            frame_bank.decode_png_files(filenames, num_workers=num_workers)
+
+        frame_bank.build_mask_indices()
+        frame_bank.load_time = time.time() - start_time
+        self._frame_bank = frame_bank
+
+        stats = self.get_preload_stats()
+        logging.info(
+            "preloaded %d frames (%.1f MB) in %.1f seconds, resident memory %.1f MB"
+            % (
+                stats['num_frames'],
+                stats['bank_bytes'] / 1e6,
+                stats['load_time'],
+                stats['resident_memory_bytes'] / 1e6,
+            )
+        )
+
+    def disable_preload(self):
+        if self._frame_bank is not None:
+            self._frame_bank.close()
+        self._frame_bank = None
+
+    def get_preload_stats(self):
+        """
+        Returns the number of preloaded frames, the size of the frame bank, the
+        time it took to load and the resident memory of this process, or None
+        if preload is disabled
+        :return:
+        :rtype: dict or None
+        """
+        if self._frame_bank is None:
+            return None
+        return self._frame_bank.get_stats()
+
+    def enable_background_bank(self, num_backgrounds, directory=None):
+        """
+        Fills a shared BackgroundBank that domain randomization samples its
+        backgrounds from, instead of synthesizing a new one per image. Must be
+        called before the DataLoader starts its workers.
+        :param num_backgrounds: number of backgrounds to synthesize, or to
+            load from directory (0 loads all of its images)
+        :type num_backgrounds: int
+        :param directory: load the backgrounds from the images in it
+        :type directory: str
+        :return:
+        :rtype:
+        """
+        self.disable_background_bank()
+
+        # the backgrounds have to cover the largest image of the dataset
+        image_height = 0
+        image_width = 0
+        for scene_name in self.scene_generator():
+            manifest = self.get_scene_manifest(scene_name)
+            image_height = max(image_height, manifest['image_height'])
+            image_width = max(image_width, manifest['image_width'])
+
+        if directory:
+            self._background_bank = BackgroundBank.from_directory(
+                directory, image_height, image_width, num_backgrounds
+            )
+        else:
+            self._background_bank = BackgroundBank.synthesize(
+                num_backgrounds, image_height, image_width
+            )
+
+        stats = self.get_background_bank_stats()
+        logging.info(
+            "filled background bank with %d backgrounds (%.1f MB) in %.1f seconds"
+            % (stats['num_backgrounds'], stats['bank_bytes'] / 1e6, stats['load_time'])
+        )
+
+    def disable_background_bank(self):
+        if self._background_bank is not None:
+            self._background_bank.close()
+        self._background_bank = None
+
+    def get_background_bank_stats(self):
+        """
+        Returns the number of backgrounds, the size of the background bank, the
+        time it took to fill and the resident memory of this process, or None
+        if there is no background bank
+        :return:
+        :rtype: dict or None
+        """
+        if self._background_bank is None:
+            return None
+        return self._background_bank.get_stats()
+
+    def set_parameters_from_training_config(self, training_config):
+        """
+        See DenseCorrespondenceDataset.set_parameters_from_training_config.
+        Additionally preloads all frames if preload is set, sets up the
+        shared frame cache if frame_cache_size_bytes > 0, fills the background
+        bank of domain randomization, selects where the within scene matches
+        come from (correspondence_source) and sets up the random crops of
+        crop_size
+        :param training_config: a dict() holding params
+        """
+        DenseCorrespondenceDataset.set_parameters_from_training_config(
+            self, training_config
+        )
+
+        self._correspondence_source = training_config['training'].get(
+            'correspondence_source', CorrespondenceSource.REPROJECTION
+        )
+        if self._correspondence_source not in (
+            CorrespondenceSource.REPROJECTION,
+            CorrespondenceSource.MATCH_TABLE,
+        ):
+            raise ValueError(
+                "unsupported correspondence_source %s" % (self._correspondence_source)
+            )
+
+        self.synthetic_multi_object_num_objects = int(
+            training_config['training'].get('synthetic_multi_object_num_objects', 2)
+        )
+        if self.synthetic_multi_object_num_objects < 2:
+            raise ValueError("synthetic_multi_object_num_objects has to be at least 2")
+
+        if training_config['training'].get('preload', False):
+            self.enable_preload()
+        else:
+            self.disable_preload()
+
+        frame_cache_size_bytes = int(
+            training_config['training'].get('frame_cache_size_bytes', 0)
+        )
+        if frame_cache_size_bytes > 0:
+            self.enable_frame_cache(frame_cache_size_bytes)
+        else:
+            self.disable_frame_cache()
+
+        background_bank_size = int(
+            training_config['training'].get('background_bank_size', 0)
+        )
+        background_bank_dir = training_config['training'].get('background_bank_dir')
+        if self._domain_randomize and (
+            (background_bank_size > 0) or background_bank_dir
+        ):
+            self.enable_background_bank(
+                background_bank_size, directory=background_bank_dir
+            )
+        else:
+            self.disable_background_bank()
+
+        self._pair_crop = PairCrop.from_training_config(training_config)
+
+    @property
+    def pair_crop(self):
+        """
+        :return: the random crops of the samples, None if they aren't cropped
+        :rtype: PairCrop or None
+        """
+        return self._pair_crop
 
     def get_image_filename(self, scene_name, img_index, image_type):
         """
@@ -428,19 +1005,71 @@ class SpartanDataset(DenseCorrespondenceDataset):
         )
         return CameraIntrinsics.from_yaml_file(camera_info_file)
 
+    def get_camera_matrix(self, scene_name):
+        """
+        Returns the camera matrix of the scene from its manifest, for
+        reprojecting its depth images
+        :param scene_name:
+        :type scene_name: str
+        :return: 3 x 3 camera intrinsics matrix, None if the scene has no
+                 camera_info.yaml, in which case the default K is used
+        :rtype: numpy.ndarray
+        """
+        camera_matrix = self.get_scene_manifest(scene_name)['camera_matrix']
+        if camera_matrix is None:
+            return None
+        return np.array(camera_matrix)
+
     def get_random_image_index(self, scene_name):
         """
-        Returns a random image index from a given scene
+        Returns a random image index from a given scene, from its working set
+        if it has one
         :param scene_name:
         :type scene_name:
         :return:
         :rtype:
         """
-        pose_data = self.get_pose_data(scene_name)
-        image_idxs = list(pose_data.keys())  # list of integers
-        random.choice(image_idxs)
-        random_idx = random.choice(image_idxs)
-        return random_idx
+        working_set = self._working_sets.get(scene_name)
+        if working_set is not None:
+            return working_set.get_random_image_index()
+        return self.get_pose_store(scene_name).get_random_image_index()
+
+    def get_img_idx_with_different_pose(
+        self,
+        scene_name,
+        pose_a,
+        threshold=0.2,
+        angle_threshold=20,
+        num_attempts=10,
+        img_a_idx=None,
+    ):
+        """
+        See DenseCorrespondenceDataset.get_img_idx_with_different_pose. If the
+        scene has a working set the partner is drawn from the working set,
+        falling back to the whole scene if none of its frames is a valid
+        partner of img_a_idx.
+        """
+        working_set = self._working_sets.get(scene_name)
+        if (working_set is not None) and (img_a_idx is not None):
+            pair_index = self.get_pair_index(
+                scene_name, threshold=threshold, angle_threshold=angle_threshold
+            )
+            pose_store = self.get_pose_store(scene_name)
+            row_b = working_set.sample_partner(
+                pair_index, pose_store.get_row(img_a_idx)
+            )
+            if row_b is not None:
+                return int(pose_store.image_idxs[row_b])
+
+        return DenseCorrespondenceDataset.get_img_idx_with_different_pose(
+            self,
+            scene_name,
+            pose_a,
+            threshold=threshold,
+            angle_threshold=angle_threshold,
+            num_attempts=num_attempts,
+            img_a_idx=img_a_idx,
+        )
 
     def get_random_object_id(self):
         """
@@ -457,7 +1086,7 @@ class SpartanDataset(DenseCorrespondenceDataset):
         :return:
         :rtype:
         """
-        object_id_list = self._single_object_scene_dict.keys()
+        object_id_list = list(self._single_object_scene_dict.keys())
         random_object_id = random.choice(object_id_list)
         object_id_int = sorted(self._single_object_scene_dict.keys()).index(
             random_object_id
@@ -506,19 +1135,27 @@ class SpartanDataset(DenseCorrespondenceDataset):
         :return: two object ids
         :rtype: two strings separated by commas
         """
+        object_1_id, object_2_id = self.get_different_object_ids(2)
+        return object_1_id, object_2_id
 
-        object_id_list = self._single_object_scene_dict.keys()
-        if len(object_id_list) == 1:
-            raise ValueError("There is only one object, can't sample a different one")
+    def get_different_object_ids(self, num_objects):
+        """
+        Returns num_objects different random object ids
+        :param num_objects:
+        :type num_objects: int
+        :return: object ids
+        :rtype: list of strings
+        """
+        object_id_list = list(self._single_object_scene_dict.keys())
+        if len(object_id_list) < num_objects:
+            raise ValueError(
+                "There are only %d objects, can't sample %d different ones"
+                % (len(object_id_list), num_objects)
+            )
 
         idx_array = np.arange(0, len(object_id_list))
-        rand_idxs = np.random.choice(idx_array, 2, replace=False)
-
-        object_1_id = object_id_list[rand_idxs[0]]
-        object_2_id = object_id_list[rand_idxs[1]]
-
-        assert object_1_id != object_2_id
-        return object_1_id, object_2_id
+        rand_idxs = np.random.choice(idx_array, num_objects, replace=False)
+        return [object_id_list[idx] for idx in rand_idxs]
 
     def get_random_multi_object_scene_name(self):
         """
@@ -566,15 +1203,18 @@ class SpartanDataset(DenseCorrespondenceDataset):
             object_id = self.get_random_object_id()
             return self.get_random_single_object_scene_name(object_id)
 
-    def get_single_object_within_scene_data(self):
+    def get_single_object_within_scene_data(self, object_id=None, scene_name=None):
         """
-        Simple wrapper around get_within_scene_data(), for the single object case
+        Simple wrapper around get_within_scene_data(), for the single object case.
+        The object and scene are random unless given.
         """
         if self.get_number_of_unique_single_objects() == 0:
             raise ValueError("There are no single object scenes in this dataset")
 
-        object_id = self.get_random_object_id()
-        scene_name = self.get_random_single_object_scene_name(object_id)
+        if object_id is None:
+            object_id = self.get_random_object_id()
+        if scene_name is None:
+            scene_name = self.get_random_single_object_scene_name(object_id)
 
         metadata = dict()
         metadata["object_id"] = object_id
@@ -586,15 +1226,17 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
         return self.get_within_scene_data(scene_name, metadata)
 
-    def get_multi_object_within_scene_data(self):
+    def get_multi_object_within_scene_data(self, scene_name=None):
         """
-        Simple wrapper around get_within_scene_data(), for the multi object case
+        Simple wrapper around get_within_scene_data(), for the multi object case.
+        The scene is random unless given.
         """
 
         if not self.has_multi_object_scenes():
             raise ValueError("There are no multi object scenes in this dataset")
 
-        scene_name = self.get_random_multi_object_scene_name()
+        if scene_name is None:
+            scene_name = self.get_random_multi_object_scene_name()
 
         metadata = dict()
         metadata["scene_name"] = scene_name
@@ -650,27 +1292,48 @@ class SpartanDataset(DenseCorrespondenceDataset):
         functions you cannot return an empty tensor like torch.FloatTensor([]). So we
         return SpartanDataset.empty_tensor()
 
+        With for_synthetic_multi_object it instead returns the rgb, depth and mask
+        arrays of both images and uv_a, uv_b, before any augmentation, or None if
+        no second image was found.
+
         """
 
         SD = SpartanDataset
 
-        image_a_idx = self.get_random_image_index(scene_name)
+        use_match_table = (
+            self._correspondence_source == CorrespondenceSource.MATCH_TABLE
+        )
+        if use_match_table:
+            match_table = self.get_match_table(scene_name)
+            working_set = self._working_sets.get(scene_name)
+            match_table_row = None
+            if working_set is not None:
+                match_table_row = working_set.sample_match_table_row()
+            if match_table_row is None:
+                match_table_row = match_table.sample_pair()
+            image_a_idx, image_b_idx = match_table.get_pair(match_table_row)
+        else:
+            image_a_idx = self.get_random_image_index(scene_name)
+
         (
             image_a_rgb,
             image_a_depth,
             image_a_mask,
             image_a_pose,
-        ) = self.get_rgbd_mask_pose(scene_name, image_a_idx)
+        ) = self.get_rgbd_mask_pose_arrays(scene_name, image_a_idx)
 
         metadata['image_a_idx'] = image_a_idx
 
         # image b
-        image_b_idx = self.get_img_idx_with_different_pose(
-            scene_name, image_a_pose, num_attempts=50
-        )
+        if not use_match_table:
+            image_b_idx = self.get_img_idx_with_different_pose(
+                scene_name, image_a_pose, num_attempts=50, img_a_idx=image_a_idx
+            )
         metadata['image_b_idx'] = image_b_idx
         if image_b_idx is None:
             logging.info("no frame with sufficiently different pose found, returning")
+            if for_synthetic_multi_object:
+                return None
             # TODO: return something cleaner than no-data
             image_a_rgb_tensor = self.rgb_image_to_tensor(image_a_rgb)
             return self.return_empty_data(image_a_rgb_tensor, image_a_rgb_tensor)
@@ -680,25 +1343,32 @@ class SpartanDataset(DenseCorrespondenceDataset):
             image_b_depth,
             image_b_mask,
             image_b_pose,
-        ) = self.get_rgbd_mask_pose(scene_name, image_b_idx)
+        ) = self.get_rgbd_mask_pose_arrays(scene_name, image_b_idx)
 
-        image_a_depth_numpy = np.asarray(image_a_depth)
-        image_b_depth_numpy = np.asarray(image_b_depth)
+        image_a_mask_index = self.get_mask_index(scene_name, image_a_idx, image_a_mask)
+        image_b_mask_index = self.get_mask_index(scene_name, image_b_idx, image_b_mask)
 
         if self.sample_matches_only_off_mask:
-            correspondence_mask = np.asarray(image_a_mask)
+            correspondence_mask_index = image_a_mask_index
         else:
-            correspondence_mask = None
+            correspondence_mask_index = None
 
         # find correspondences
-        uv_a, uv_b = correspondence_finder.batch_find_pixel_correspondences(
-            image_a_depth_numpy,
-            image_a_pose,
-            image_b_depth_numpy,
-            image_b_pose,
-            img_a_mask=correspondence_mask,
-            num_attempts=self.num_matching_attempts,
-        )
+        if use_match_table:
+            uv_a, uv_b = match_table.sample_matches(
+                match_table_row, self.num_matching_attempts
+            )
+        else:
+            uv_a, uv_b = self._correspondence_finder.batch_find_pixel_correspondences(
+                image_a_depth,
+                image_a_pose,
+                image_b_depth,
+                image_b_pose,
+                img_a_mask_index=correspondence_mask_index,
+                num_attempts=self.num_matching_attempts,
+                K=self.get_camera_matrix(scene_name),
+                occlusion_mode=self.occlusion_mode,
+            )
 
         if for_synthetic_multi_object:
             return (
@@ -721,75 +1391,71 @@ class SpartanDataset(DenseCorrespondenceDataset):
         if self._domain_randomize:
             image_a_rgb = (
                 correspondence_augmentation.random_domain_randomize_background(
-                    image_a_rgb, image_a_mask
+                    image_a_rgb, image_a_mask, self._background_bank
                 )
             )
             image_b_rgb = (
                 correspondence_augmentation.random_domain_randomize_background(
-                    image_b_rgb, image_b_mask
+                    image_b_rgb, image_b_mask, self._background_bank
                 )
             )
 
+        # the masks are only needed through their MaskIndex from here on, which
+        # is remapped rather than recomputed from the mutated mask
         if not self.debug:
-            [
-                image_a_rgb,
-                image_a_mask,
-            ], uv_a = correspondence_augmentation.random_image_and_indices_mutation(
-                [image_a_rgb, image_a_mask], uv_a
+            (
+                [image_a_rgb],
+                uv_a,
+                image_a_mask_index,
+            ) = correspondence_augmentation.random_image_indices_and_mask_index_mutation(
+                [image_a_rgb], uv_a, image_a_mask_index
             )
-            [
-                image_b_rgb,
-                image_b_mask,
-            ], uv_b = correspondence_augmentation.random_image_and_indices_mutation(
-                [image_b_rgb, image_b_mask], uv_b
+            (
+                [image_b_rgb],
+                uv_b,
+                image_b_mask_index,
+            ) = correspondence_augmentation.random_image_indices_and_mask_index_mutation(
+                [image_b_rgb], uv_b, image_b_mask_index
             )
         else:  # also mutate depth just for plotting
-            [
-                image_a_rgb,
-                image_a_depth,
-                image_a_mask,
-            ], uv_a = correspondence_augmentation.random_image_and_indices_mutation(
-                [image_a_rgb, image_a_depth, image_a_mask], uv_a
+            (
+                [image_a_rgb, image_a_depth],
+                uv_a,
+                image_a_mask_index,
+            ) = correspondence_augmentation.random_image_indices_and_mask_index_mutation(
+                [image_a_rgb, image_a_depth], uv_a, image_a_mask_index
             )
-            [
-                image_b_rgb,
-                image_b_depth,
-                image_b_mask,
-            ], uv_b = correspondence_augmentation.random_image_and_indices_mutation(
-                [image_b_rgb, image_b_depth, image_b_mask], uv_b
+            (
+                [image_b_rgb, image_b_depth],
+                uv_b,
+                image_b_mask_index,
+            ) = correspondence_augmentation.random_image_indices_and_mask_index_mutation(
+                [image_b_rgb, image_b_depth], uv_b, image_b_mask_index
             )
 
         image_a_depth_numpy = np.asarray(image_a_depth)
         image_b_depth_numpy = np.asarray(image_b_depth)
 
         # find non_correspondences
-        image_b_mask_torch = torch.from_numpy(np.asarray(image_b_mask)).type(
-            torch.FloatTensor
-        )
         image_b_shape = image_b_depth_numpy.shape
         image_width = image_b_shape[1]
         image_height = image_b_shape[0]
 
-        uv_b_masked_non_matches = correspondence_finder.create_non_correspondences(
-            uv_b,
-            image_b_shape,
-            num_non_matches_per_match=self.num_masked_non_matches_per_match,
-            img_b_mask=image_b_mask_torch,
-        )
-
-        if self._use_image_b_mask_inv:
-            image_b_mask_inv = 1 - image_b_mask_torch
-        else:
-            image_b_mask_inv = None
-
-        uv_b_background_non_matches = correspondence_finder.create_non_correspondences(
+        finder = self._correspondence_finder
+        (
+            uv_b_masked_non_matches,
+            uv_b_background_non_matches,
+        ) = finder.create_masked_and_background_non_correspondences(
             uv_b,
             image_b_shape,
-            num_non_matches_per_match=self.num_background_non_matches_per_match,
-            img_b_mask=image_b_mask_inv,
+            image_b_mask_index,
+            self.num_masked_non_matches_per_match,
+            self.num_background_non_matches_per_match,
+            background_outside_of_mask=self._use_image_b_mask_inv,
+            min_distance=self.non_match_min_distance,
         )
 
-        # convert PIL.Image to torch.FloatTensor
+        # convert the arrays to torch.FloatTensor
         image_a_rgb_PIL = image_a_rgb
         image_b_rgb_PIL = image_b_rgb
         image_a_rgb = self.rgb_image_to_tensor(image_a_rgb)
@@ -825,40 +1491,39 @@ class SpartanDataset(DenseCorrespondenceDataset):
             uv_b_background_non_matches_long, image_width
         ).squeeze(1)
 
-        # make blind non matches
-        matches_a_mask = SD.mask_image_from_uv_flat_tensor(
-            matches_a, image_width, image_height
-        )
-        image_a_mask_torch = torch.from_numpy(np.asarray(image_a_mask)).long()
-        mask_a_flat = image_a_mask_torch.view(-1, 1).squeeze(1)
-        blind_non_matches_a = (mask_a_flat - matches_a_mask).nonzero()
+        # make blind non matches, the pixels that are either in mask a or a
+        # match, but not both
+        matches_a_numpy = matches_a.cpu().numpy()
+        is_match_a = np.zeros(image_a_mask_index.num_pixels, dtype=bool)
+        is_match_a[matches_a_numpy] = True
+        mask_a_inside = image_a_mask_index.inside
+        blind_non_matches_a = mask_a_inside[~is_match_a[mask_a_inside]]
+        matches_a_off_mask = matches_a_numpy[
+            ~image_a_mask_index.contains(matches_a_numpy)
+        ]
+        if len(matches_a_off_mask) > 0:
+            blind_non_matches_a = np.union1d(blind_non_matches_a, matches_a_off_mask)
+        blind_non_matches_a = torch.from_numpy(blind_non_matches_a.astype(np.int32))
 
         no_blind_matches_found = False
         if len(blind_non_matches_a) == 0:
             no_blind_matches_found = True
         else:
 
-            blind_non_matches_a = blind_non_matches_a.squeeze(1)
             num_blind_samples = blind_non_matches_a.size()[0]
 
             if num_blind_samples > 0:
                 # blind_uv_b is a tuple of torch.LongTensor
                 # make sure we check that blind_uv_b is not None and that it is non-empty
 
-                blind_uv_b = (
-                    correspondence_finder.random_sample_from_masked_image_torch(
-                        image_b_mask_torch, num_blind_samples
-                    )
-                )
+                blind_uv_b = image_b_mask_index.sample_uv(num_blind_samples)
 
                 if blind_uv_b[0] is None:
                     no_blind_matches_found = True
                 elif len(blind_uv_b[0]) == 0:
                     no_blind_matches_found = True
                 else:
-                    blind_non_matches_b = utils.uv_to_flattened_pixel_locations(
-                        blind_uv_b, image_width
-                    )
+                    blind_non_matches_b = SD.flatten_uv_tensor(blind_uv_b, image_width)
 
                     if len(blind_non_matches_b) == 0:
                         no_blind_matches_found = True
@@ -962,6 +1627,12 @@ class SpartanDataset(DenseCorrespondenceDataset):
                 # Mask-plotting city
                 import matplotlib.pyplot as plt
 
+                image_a_mask = image_a_mask_index.to_mask()
+                mask_a_flat = torch.from_numpy(image_a_mask).long().view(-1)
+                matches_a_mask = SD.mask_image_from_uv_flat_tensor(
+                    matches_a, image_width, image_height
+                )
+
                 plt.imshow(np.asarray(image_a_mask))
                 plt.title("Mask of img a object pixels")
                 plt.show()
@@ -1008,13 +1679,13 @@ class SpartanDataset(DenseCorrespondenceDataset):
         :rtype:
         """
         uv_a_long = (
-            torch.t(uv_a[0].repeat(multiplier, 1)).contiguous().view(-1, 1),
-            torch.t(uv_a[1].repeat(multiplier, 1)).contiguous().view(-1, 1),
+            uv_a[0].to(PIXEL_INDEX_DTYPE).repeat_interleave(multiplier).view(-1, 1),
+            uv_a[1].to(PIXEL_INDEX_DTYPE).repeat_interleave(multiplier).view(-1, 1),
         )
 
         uv_b_non_matches_long = (
-            uv_b_non_matches[0].view(-1, 1),
-            uv_b_non_matches[1].view(-1, 1),
+            uv_b_non_matches[0].to(PIXEL_INDEX_DTYPE).view(-1, 1),
+            uv_b_non_matches[1].to(PIXEL_INDEX_DTYPE).view(-1, 1),
         )
 
         return uv_a_long, uv_b_non_matches_long
@@ -1051,139 +1722,113 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
     def get_synthetic_multi_object_within_scene_data(self):
         """
-        Synthetic case
+        Synthetic case: within scene frame pairs of
+        synthetic_multi_object_num_objects different objects, layered in a
+        random order into one pair of images. Matches that end up occluded
+        are dropped, and an object without matches still occludes the others.
         """
 
-        object_id_a, object_id_b = self.get_two_different_object_ids()
-        scene_name_a = self.get_random_single_object_scene_name(object_id_a)
-        scene_name_b = self.get_random_single_object_scene_name(object_id_b)
+        object_ids = self.get_different_object_ids(
+            self.synthetic_multi_object_num_objects
+        )
+        scene_names = [
+            self.get_random_single_object_scene_name(object_id)
+            for object_id in object_ids
+        ]
 
         metadata = dict()
-        metadata["object_id_a"] = object_id_a
-        metadata["scene_name_a"] = scene_name_a
-        metadata["object_id_b"] = object_id_b
-        metadata["scene_name_b"] = scene_name_b
+        metadata["object_id_a"] = object_ids[0]
+        metadata["scene_name_a"] = scene_names[0]
+        metadata["object_id_b"] = object_ids[1]
+        metadata["scene_name_b"] = scene_names[1]
         metadata["type"] = SpartanDatasetDataType.SYNTHETIC_MULTI_OBJECT
 
-        (
-            image_a1_rgb,
-            image_a2_rgb,
-            image_a1_depth,
-            image_a2_depth,
-            image_a1_mask,
-            image_a2_mask,
-            uv_a1,
-            uv_a2,
-        ) = self.get_within_scene_data(
-            scene_name_a, metadata, for_synthetic_multi_object=True
-        )
-
-        if uv_a1 is None:
-            logging.info("no matches found, returning")
-            image_a1_rgb_tensor = self.rgb_image_to_tensor(image_a1_rgb)
-            return self.return_empty_data(image_a1_rgb_tensor, image_a1_rgb_tensor)
-
-        (
-            image_b1_rgb,
-            image_b2_rgb,
-            image_b1_depth,
-            image_b2_depth,
-            image_b1_mask,
-            image_b2_mask,
-            uv_b1,
-            uv_b2,
-        ) = self.get_within_scene_data(
-            scene_name_b, metadata, for_synthetic_multi_object=True
-        )
+        # frames 1 and 2 of each object, and its matches from 1 to 2
+        images_1, images_2 = [], []
+        depths_1, depths_2 = [], []
+        masks_1, masks_2 = [], []
+        matches = []
+        for scene_name in scene_names:
+            data = self.get_within_scene_data(
+                scene_name, metadata, for_synthetic_multi_object=True
+            )
+            if data is None:
+                continue
+            rgb_1, rgb_2, depth_1, depth_2, mask_1, mask_2, uv_1, uv_2 = data
+            images_1.append(rgb_1)
+            images_2.append(rgb_2)
+            depths_1.append(depth_1)
+            depths_2.append(depth_2)
+            masks_1.append(mask_1)
+            masks_2.append(mask_2)
+            if uv_1 is None:
+                matches.append(None)
+            else:
+                matches.append(
+                    (
+                        (uv_1[0].long(), uv_1[1].long()),
+                        (uv_2[0].long(), uv_2[1].long()),
+                    )
+                )
 
-        if uv_b1 is None:
+        if all(x is None for x in matches):
             logging.info("no matches found, returning")
-            image_b1_rgb_tensor = self.rgb_image_to_tensor(image_b1_rgb)
-            return self.return_empty_data(image_b1_rgb_tensor, image_b1_rgb_tensor)
-
-        uv_a1 = (uv_a1[0].long(), uv_a1[1].long())
-        uv_a2 = (uv_a2[0].long(), uv_a2[1].long())
-        uv_b1 = (uv_b1[0].long(), uv_b1[1].long())
-        uv_b2 = (uv_b2[0].long(), uv_b2[1].long())
+            if len(images_1) == 0:
+                image_rgb_tensor = self.rgb_image_to_tensor(
+                    self.get_random_rgbd_mask_pose()[0]
+                )
+            else:
+                image_rgb_tensor = self.rgb_image_to_tensor(images_1[0])
+            return self.return_empty_data(image_rgb_tensor, image_rgb_tensor)
 
-        matches_pair_a = (uv_a1, uv_a2)
-        matches_pair_b = (uv_b1, uv_b2)
         (
             merged_rgb_1,
+            owner_1,
             merged_mask_1,
-            uv_a1,
-            uv_a2,
-            uv_b1,
-            uv_b2,
-        ) = correspondence_augmentation.merge_images_with_occlusions(
-            image_a1_rgb,
-            image_b1_rgb,
-            image_a1_mask,
-            image_b1_mask,
-            matches_pair_a,
-            matches_pair_b,
+        ) = correspondence_augmentation.composite_images_with_occlusions(
+            images_1, masks_1
         )
-
-        if (uv_a1 is None) or (uv_a2 is None) or (uv_b1 is None) or (uv_b2 is None):
-            logging.info("something got fully occluded, returning")
-            image_b1_rgb_tensor = self.rgb_image_to_tensor(image_b1_rgb)
-            return self.return_empty_data(image_b1_rgb_tensor, image_b1_rgb_tensor)
-
-        matches_pair_a = (uv_a2, uv_a1)
-        matches_pair_b = (uv_b2, uv_b1)
         (
             merged_rgb_2,
+            owner_2,
             merged_mask_2,
-            uv_a2,
-            uv_a1,
-            uv_b2,
-            uv_b1,
-        ) = correspondence_augmentation.merge_images_with_occlusions(
-            image_a2_rgb,
-            image_b2_rgb,
-            image_a2_mask,
-            image_b2_mask,
-            matches_pair_a,
-            matches_pair_b,
+        ) = correspondence_augmentation.composite_images_with_occlusions(
+            images_2, masks_2
         )
 
-        if (uv_a1 is None) or (uv_a2 is None) or (uv_b1 is None) or (uv_b2 is None):
-            logging.info("something got fully occluded, returning")
-            image_b1_rgb_tensor = self.rgb_image_to_tensor(image_b1_rgb)
-            return self.return_empty_data(image_b1_rgb_tensor, image_b1_rgb_tensor)
+        kept_matches, num_kept = correspondence_augmentation.prune_occluded_matches(
+            [owner_1, owner_2], matches
+        )
+        if kept_matches is None:
+            logging.info("everything got fully occluded, returning")
+            image_rgb_tensor = self.rgb_image_to_tensor(merged_rgb_1)
+            return self.return_empty_data(image_rgb_tensor, image_rgb_tensor)
 
-        matches_1 = correspondence_augmentation.merge_matches(uv_a1, uv_b1)
-        matches_2 = correspondence_augmentation.merge_matches(uv_a2, uv_b2)
+        matches_1, matches_2 = kept_matches
         matches_2 = (matches_2[0].float(), matches_2[1].float())
 
         # find non_correspondences
-        merged_mask_2_torch = torch.from_numpy(merged_mask_2).type(torch.FloatTensor)
-        image_b_shape = merged_mask_2_torch.shape
+        merged_mask_2_index = MaskIndex.from_mask(merged_mask_2)
+        image_b_shape = merged_mask_2.shape
         image_width = image_b_shape[1]
         image_height = image_b_shape[0]
 
-        matches_2_masked_non_matches = correspondence_finder.create_non_correspondences(
+        finder = self._correspondence_finder
+        (
+            matches_2_masked_non_matches,
+            matches_2_background_non_matches,
+        ) = finder.create_masked_and_background_non_correspondences(
             matches_2,
             image_b_shape,
-            num_non_matches_per_match=self.num_masked_non_matches_per_match,
-            img_b_mask=merged_mask_2_torch,
-        )
-        if self._use_image_b_mask_inv:
-            merged_mask_2_torch_inv = 1 - merged_mask_2_torch
-        else:
-            merged_mask_2_torch_inv = None
-
-        matches_2_background_non_matches = (
-            correspondence_finder.create_non_correspondences(
-                matches_2,
-                image_b_shape,
-                num_non_matches_per_match=self.num_background_non_matches_per_match,
-                img_b_mask=merged_mask_2_torch_inv,
-            )
+            merged_mask_2_index,
+            self.num_masked_non_matches_per_match,
+            self.num_background_non_matches_per_match,
+            background_outside_of_mask=self._use_image_b_mask_inv,
+            min_distance=self.non_match_min_distance,
         )
 
         SD = SpartanDataset
-        # convert PIL.Image to torch.FloatTensor
+        # convert the arrays to torch.FloatTensor
         merged_rgb_1_PIL = merged_rgb_1
         merged_rgb_2_PIL = merged_rgb_2
         merged_rgb_1 = self.rgb_image_to_tensor(merged_rgb_1)
@@ -1228,26 +1873,7 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
             num_matches_to_plot = 10
 
-            print("PRE-MERGING")
-            plot_uv_a1, plot_uv_a2 = SpartanDataset.subsample_tuple_pair(
-                uv_a1, uv_a2, num_samples=num_matches_to_plot
-            )
-
-            # correspondence_plotter.plot_correspondences_direct(image_a1_rgb, np.asarray(image_a1_depth),
-            #                                                        image_a2_rgb, np.asarray(image_a2_depth),
-            #                                                        plot_uv_a1, plot_uv_a2,
-            #                                                        circ_color='g', show=True)
-
-            plot_uv_b1, plot_uv_b2 = SpartanDataset.subsample_tuple_pair(
-                uv_b1, uv_b2, num_samples=num_matches_to_plot
-            )
-
-            # correspondence_plotter.plot_correspondences_direct(image_b1_rgb, np.asarray(image_b1_depth),
-            #                                                        image_b2_rgb, np.asarray(image_b2_depth),
-            #                                                        plot_uv_b1, plot_uv_b2,
-            #                                                        circ_color='g', show=True)
-
-            print("MERGED")
+            print("MERGED, matches kept per object: %s" % (num_kept))
             plot_uv_1, plot_uv_2 = SpartanDataset.subsample_tuple_pair(
                 matches_1, matches_2, num_samples=num_matches_to_plot
             )
@@ -1271,9 +1897,9 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
             fig, axes = correspondence_plotter.plot_correspondences_direct(
                 merged_rgb_1_PIL,
-                np.asarray(image_b1_depth),
+                depths_1[-1],
                 merged_rgb_2_PIL,
-                np.asarray(image_b2_depth),
+                depths_2[-1],
                 plot_uv_1,
                 plot_uv_2,
                 circ_color='g',
@@ -1282,9 +1908,9 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
             correspondence_plotter.plot_correspondences_direct(
                 merged_rgb_1_PIL,
-                np.asarray(image_b1_depth),
+                depths_1[-1],
                 merged_rgb_2_PIL,
-                np.asarray(image_b2_depth),
+                depths_2[-1],
                 plot_uv_a_masked_long,
                 plot_uv_b_masked_non_matches_long,
                 use_previous_plot=(fig, axes),
@@ -1294,9 +1920,9 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
             fig, axes = correspondence_plotter.plot_correspondences_direct(
                 merged_rgb_1_PIL,
-                np.asarray(image_b1_depth),
+                depths_1[-1],
                 merged_rgb_2_PIL,
-                np.asarray(image_b2_depth),
+                depths_2[-1],
                 plot_uv_1,
                 plot_uv_2,
                 circ_color='g',
@@ -1305,9 +1931,9 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
             correspondence_plotter.plot_correspondences_direct(
                 merged_rgb_1_PIL,
-                np.asarray(image_b1_depth),
+                depths_1[-1],
                 merged_rgb_2_PIL,
-                np.asarray(image_b2_depth),
+                depths_2[-1],
                 plot_uv_a_background_long,
                 plot_uv_b_background_non_matches_long,
                 use_previous_plot=(fig, axes),
@@ -1356,7 +1982,7 @@ class SpartanDataset(DenseCorrespondenceDataset):
             image_a_depth,
             image_a_mask,
             image_a_pose,
-        ) = self.get_rgbd_mask_pose(scene_name_a, image_a_idx)
+        ) = self.get_rgbd_mask_pose_arrays(scene_name_a, image_a_idx)
 
         metadata['image_a_idx'] = image_a_idx
 
@@ -1367,18 +1993,18 @@ class SpartanDataset(DenseCorrespondenceDataset):
             image_b_depth,
             image_b_mask,
             image_b_pose,
-        ) = self.get_rgbd_mask_pose(scene_name_b, image_b_idx)
+        ) = self.get_rgbd_mask_pose_arrays(scene_name_b, image_b_idx)
         metadata['image_b_idx'] = image_b_idx
 
         # sample random indices from mask in image a
         num_samples = self.cross_scene_num_samples
-        blind_uv_a = correspondence_finder.random_sample_from_masked_image_torch(
-            np.asarray(image_a_mask), num_samples
-        )
+        blind_uv_a = self.get_mask_index(
+            scene_name_a, image_a_idx, image_a_mask
+        ).sample_uv(num_samples)
         # sample random indices from mask in image b
-        blind_uv_b = correspondence_finder.random_sample_from_masked_image_torch(
-            np.asarray(image_b_mask), num_samples
-        )
+        blind_uv_b = self.get_mask_index(
+            scene_name_b, image_b_idx, image_b_mask
+        ).sample_uv(num_samples)
 
         if (blind_uv_a[0] is None) or (blind_uv_b[0] is None):
             image_a_rgb_tensor = self.rgb_image_to_tensor(image_a_rgb)
@@ -1388,12 +2014,12 @@ class SpartanDataset(DenseCorrespondenceDataset):
         if self._domain_randomize:
             image_a_rgb = (
                 correspondence_augmentation.random_domain_randomize_background(
-                    image_a_rgb, image_a_mask
+                    image_a_rgb, image_a_mask, self._background_bank
                 )
             )
             image_b_rgb = (
                 correspondence_augmentation.random_domain_randomize_background(
-                    image_b_rgb, image_b_mask
+                    image_b_rgb, image_b_mask, self._background_bank
                 )
             )
 
@@ -1436,7 +2062,7 @@ class SpartanDataset(DenseCorrespondenceDataset):
         blind_uv_a_flat = SD.flatten_uv_tensor(blind_uv_a, image_width)
         blind_uv_b_flat = SD.flatten_uv_tensor(blind_uv_b, image_width)
 
-        # convert PIL.Image to torch.FloatTensor
+        # convert the arrays to torch.FloatTensor
         image_a_rgb_PIL = image_a_rgb
         image_b_rgb_PIL = image_b_rgb
         image_a_rgb = self.rgb_image_to_tensor(image_a_rgb)
@@ -1509,14 +2135,16 @@ class SpartanDataset(DenseCorrespondenceDataset):
 
     def rgb_image_to_tensor(self, img):
         """
-        Transforms a PIL.Image to a torch.FloatTensor.
+        Transforms a PIL.Image or a [H,W,3] uint8 numpy array to a
+        torch.FloatTensor.
         Performs normalization of mean and std dev
         :param img: input image
-        :type img: PIL.Image
+        :type img: PIL.Image or numpy.ndarray
         :return:
         :rtype:
         """
-
+        if isinstance(img, np.ndarray):
+            return self._rgb_array_to_tensor(img)
         return self._rgb_image_to_tensor(img)
 
     def get_first_image_index(self, scene_name):
@@ -1540,8 +2168,7 @@ class SpartanDataset(DenseCorrespondenceDataset):
             else:
                 first_image_index = min(metadata['normal_image_indices'])
         else:
-            pose_data = self.get_pose_data(scene_name)
-            first_image_index = min(pose_data.keys())
+            first_image_index = int(self.get_pose_store(scene_name).image_idxs[0])
 
         return first_image_index
 
@@ -1592,10 +2219,13 @@ class SpartanDataset(DenseCorrespondenceDataset):
         Flattens a uv_tensor to single dimensional tensor
         :param uv_tensor:
         :type uv_tensor:
-        :return:
-        :rtype:
+        :return: flattened pixel indices v * image_width + u
+        :rtype: torch.IntTensor, see PIXEL_INDEX_DTYPE
         """
-        return uv_tensor[1].long() * image_width + uv_tensor[0].long()
+        return (
+            uv_tensor[1].to(PIXEL_INDEX_DTYPE) * image_width
+            + uv_tensor[0].to(PIXEL_INDEX_DTYPE)
+        )
 
     @staticmethod
     def mask_image_from_uv_flat_tensor(uv_flat_tensor, image_width, image_height):
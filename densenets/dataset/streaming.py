@@ -0,0 +1,355 @@
+import logging
+import multiprocessing
+import random
+import time
+
+import numpy as np
+import torch
+from densenets.dataset.match_table import CorrespondenceSource
+from densenets.dataset.spartan_dataset_masked import SpartanDatasetDataType
+
+# layout of the counters array
+_NUM_CHUNKS = 0
+_FRAMES_DECODED = 1
+_PAIRS_EMITTED = 2
+_PASSTHROUGH_SAMPLES = 3
+_WORKING_SET_MISSES = 4
+_DECODE_TIME_US = 5
+_NUM_COUNTERS = 6
+
+
+class WorkingSet(object):
+    """
+    Decoded frames of a single scene that within scene samples are drawn from,
+    see SpartanDataset.set_working_set()
+
+    - frames: dict img_idx -> (rgb, depth, mask) numpy arrays
+    - rows: the rows of the frames in the PoseStore of the scene
+    - match_table_rows: rows of the scene's MatchTable whose two frames are
+      both in the working set, None if matches aren't read from a match table
+    """
+
+    def __init__(self, scene_name, frames, rows, match_table_rows=None):
+        self.scene_name = scene_name
+        self._frames = frames
+        self._image_idxs = sorted(frames.keys())
+        self._rows = np.sort(np.asarray(rows, dtype=np.int64))
+        self._match_table_rows = match_table_rows
+
+        # frames of the scene requested while this working set was active but
+        # that aren't in it, incremented by SpartanDataset
+        self.num_misses = 0
+
+    def __len__(self):
+        return len(self._image_idxs)
+
+    def has_frame(self, img_idx):
+        return int(img_idx) in self._frames
+
+    def get_frame(self, img_idx):
+        """
+        :return: rgb, depth, mask
+        :rtype: [H,W,3] uint8, [H,W] uint16, [H,W] uint8
+        """
+        return self._frames[int(img_idx)]
+
+    def get_random_image_index(self):
+        return self._image_idxs[random.randrange(len(self._image_idxs))]
+
+    def sample_partner(self, pair_index, row):
+        """
+        Returns a random valid partner of row among the frames of the working
+        set, or None if it has none
+        :param pair_index:
+        :type pair_index: PairIndex
+        :param row: PoseStore row
+        :type row: int
+        :return: PoseStore row
+        :rtype: int or None
+        """
+        partners = pair_index.get_partners(row)
+        partners = partners[np.isin(partners, self._rows, assume_unique=True)]
+        if len(partners) == 0:
+            return None
+        return int(partners[random.randrange(len(partners))])
+
+    def sample_match_table_row(self):
+        """
+        :return: a random MatchTable row of the working set, None if it has none
+        :rtype: int or None
+        """
+        if not self._match_table_rows:
+            return None
+        return random.choice(self._match_table_rows)
+
+
+class SceneAffinityStream(torch.utils.data.IterableDataset):
+    """
+    Streams the samples of a SpartanDataset so that decoded frames are reused
+    across many pairs.
+
+    Each DataLoader worker claims scenes from its own share of the dataset.
+    For every claimed scene it decodes a working set of frames_per_chunk frames
+    once and then draws pairs_per_decode * frames_per_chunk within scene
+    samples from those frames only, before moving on to the next scene.
+
+    The data type of every sample is drawn from the same mixture as
+    SpartanDataset.__getitem__. SINGLE_OBJECT_WITHIN_SCENE and MULTI_OBJECT
+    samples come from the current single and multi object chunk respectively,
+    the other types span several scenes and are sampled as usual.
+
+    Decode amortization statistics are aggregated over the workers in shared
+    memory, see get_stats(). Like SharedFrameCache, the stream has to be
+    created in the main process and the workers forked.
+    """
+
+    WITHIN_SCENE_TYPES = (
+        SpartanDatasetDataType.SINGLE_OBJECT_WITHIN_SCENE,
+        SpartanDatasetDataType.MULTI_OBJECT,
+    )
+
+    def __init__(self, dataset, frames_per_chunk=32, pairs_per_decode=4.0):
+        """
+        :param dataset:
+        :type dataset: SpartanDataset
+        :param frames_per_chunk: number of frames decoded per claimed scene
+        :type frames_per_chunk: int
+        :param pairs_per_decode: number of samples drawn from a chunk per
+            decoded frame
+        :type pairs_per_decode: float
+        """
+        if frames_per_chunk < 2:
+            raise ValueError("frames_per_chunk must be at least 2")
+        if pairs_per_decode <= 0:
+            raise ValueError("pairs_per_decode must be positive")
+
+        self._dataset = dataset
+        self._frames_per_chunk = int(frames_per_chunk)
+        self._pairs_per_decode = float(pairs_per_decode)
+        self._counters = multiprocessing.Array('q', _NUM_COUNTERS)
+
+    @property
+    def dataset(self):
+        return self._dataset
+
+    def __len__(self):
+        return len(self._dataset)
+
+    def _num_samples(self, worker_id, num_workers):
+        """
+        Every worker yields its share of len(self) samples per epoch
+        """
+        num_samples, remainder = divmod(len(self), num_workers)
+        if worker_id < remainder:
+            num_samples += 1
+        return num_samples
+
+    @staticmethod
+    def _shard(scenes, worker_id, num_workers):
+        """
+        Splits scenes between the workers, they are all shared if there are
+        fewer scenes than workers
+        """
+        if len(scenes) < num_workers:
+            return list(scenes)
+        return list(scenes[worker_id::num_workers])
+
+    def _get_scene_shards(self, worker_id, num_workers):
+        """
+        :return: single object scenes as a dict object_id -> list of scene
+            names, list of multi object scene names
+        :rtype: dict, list
+        """
+        dataset = self._dataset
+        single_object_scenes = []
+        for object_id in sorted(dataset._single_object_scene_dict.keys()):
+            for scene_name in dataset.get_scene_list_for_object(object_id):
+                single_object_scenes.append((object_id, scene_name))
+
+        single_object_shard = dict()
+        for object_id, scene_name in self._shard(
+            single_object_scenes, worker_id, num_workers
+        ):
+            single_object_shard.setdefault(object_id, []).append(scene_name)
+
+        multi_object_shard = self._shard(
+            sorted(dataset._multi_object_scene_dict[dataset.mode]),
+            worker_id,
+            num_workers,
+        )
+        return single_object_shard, multi_object_shard
+
+    def _claim_chunk(self, data_load_type, single_object_shard, multi_object_shard):
+        """
+        Picks a scene for the next chunk and decodes its working set
+        :return: chunk
+        :rtype: dict
+        """
+        if data_load_type == SpartanDatasetDataType.SINGLE_OBJECT_WITHIN_SCENE:
+            if len(single_object_shard) == 0:
+                raise ValueError("There are no single object scenes in this dataset")
+            object_id = random.choice(sorted(single_object_shard.keys()))
+            scene_name = random.choice(single_object_shard[object_id])
+        else:
+            if len(multi_object_shard) == 0:
+                raise ValueError("There are no multi object scenes in this dataset")
+            object_id = None
+            scene_name = random.choice(multi_object_shard)
+
+        working_set = self.decode_working_set(scene_name)
+        chunk = dict()
+        chunk['object_id'] = object_id
+        chunk['working_set'] = working_set
+        chunk['num_pairs_left'] = max(
+            int(round(len(working_set) * self._pairs_per_decode)), 1
+        )
+        return chunk
+
+    def decode_working_set(self, scene_name):
+        """
+        Decodes frames_per_chunk random frames of the scene. When matches are
+        read from a match table the frames are those of random table pairs.
+        :param scene_name:
+        :type scene_name: str
+        :return:
+        :rtype: WorkingSet
+        """
+        dataset = self._dataset
+        dataset.clear_working_set(scene_name)
+        start_time = time.time()
+
+        pose_store = dataset.get_pose_store(scene_name)
+        num_frames = min(self._frames_per_chunk, len(pose_store.image_idxs))
+
+        match_table = None
+        if dataset._correspondence_source == CorrespondenceSource.MATCH_TABLE:
+            match_table = dataset.get_match_table(scene_name)
+
+        if match_table is None:
+            rows = random.sample(range(len(pose_store.image_idxs)), num_frames)
+            image_idxs = [int(pose_store.image_idxs[row]) for row in rows]
+        else:
+            image_idxs = []
+            for table_row in np.random.permutation(len(match_table)):
+                for img_idx in match_table.get_pair(table_row):
+                    if img_idx not in image_idxs:
+                        image_idxs.append(img_idx)
+                if len(image_idxs) >= num_frames:
+                    break
+            rows = [pose_store.get_row(img_idx) for img_idx in image_idxs]
+
+        frames = dict()
+        for img_idx in image_idxs:
+            rgb, depth, mask, _ = dataset.get_rgbd_mask_pose_arrays(
+                scene_name, img_idx
+            )
+            frames[img_idx] = (rgb, depth, mask)
+
+        match_table_rows = None
+        if match_table is not None:
+            in_set = np.isin(match_table.pairs, image_idxs).all(axis=1)
+            match_table_rows = np.flatnonzero(in_set).tolist()
+
+        working_set = WorkingSet(scene_name, frames, rows, match_table_rows)
+        dataset.set_working_set(working_set)
+
+        decode_time_us = int((time.time() - start_time) * 1e6)
+        with self._counters.get_lock():
+            self._counters[_NUM_CHUNKS] += 1
+            self._counters[_FRAMES_DECODED] += len(frames)
+            self._counters[_DECODE_TIME_US] += decode_time_us
+        return working_set
+
+    def _retire_chunk(self, chunk):
+        working_set = chunk['working_set']
+        self._dataset.clear_working_set(working_set.scene_name)
+        with self._counters.get_lock():
+            self._counters[_WORKING_SET_MISSES] += working_set.num_misses
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+
+        single_object_shard, multi_object_shard = self._get_scene_shards(
+            worker_id, num_workers
+        )
+        chunks = dict()
+        try:
+            for _ in range(self._num_samples(worker_id, num_workers)):
+                data_load_type = self._dataset._get_data_load_type()
+                if data_load_type not in SceneAffinityStream.WITHIN_SCENE_TYPES:
+                    with self._counters.get_lock():
+                        self._counters[_PASSTHROUGH_SAMPLES] += 1
+                    yield self._dataset.get_data_of_type(data_load_type)
+                    continue
+
+                chunk = chunks.get(data_load_type)
+                if chunk is None:
+                    chunk = self._claim_chunk(
+                        data_load_type, single_object_shard, multi_object_shard
+                    )
+                    chunks[data_load_type] = chunk
+
+                scene_name = chunk['working_set'].scene_name
+                if data_load_type == SpartanDatasetDataType.MULTI_OBJECT:
+                    data = self._dataset.get_multi_object_within_scene_data(
+                        scene_name=scene_name
+                    )
+                else:
+                    data = self._dataset.get_single_object_within_scene_data(
+                        object_id=chunk['object_id'], scene_name=scene_name
+                    )
+                if self._dataset.pair_crop is not None:
+                    data = self._dataset.pair_crop(data)
+
+                chunk['num_pairs_left'] -= 1
+                if chunk['num_pairs_left'] <= 0:
+                    self._retire_chunk(chunk)
+                    del chunks[data_load_type]
+
+                with self._counters.get_lock():
+                    self._counters[_PAIRS_EMITTED] += 1
+                yield data
+        finally:
+            for chunk in chunks.values():
+                self._retire_chunk(chunk)
+
+    def get_stats(self):
+        """
+        Returns the decode amortization counters, aggregated over every worker
+        :return:
+        :rtype: dict
+        """
+        with self._counters.get_lock():
+            counters = list(self._counters)
+
+        stats = dict()
+        stats['num_chunks'] = counters[_NUM_CHUNKS]
+        stats['frames_decoded'] = counters[_FRAMES_DECODED]
+        stats['pairs_emitted'] = counters[_PAIRS_EMITTED]
+        stats['passthrough_samples'] = counters[_PASSTHROUGH_SAMPLES]
+        stats['working_set_misses'] = counters[_WORKING_SET_MISSES]
+        stats['decode_time'] = counters[_DECODE_TIME_US] / 1e6
+        stats['pairs_per_decode'] = counters[_PAIRS_EMITTED] / float(
+            max(counters[_FRAMES_DECODED], 1)
+        )
+        return stats
+
+    def log_stats(self):
+        stats = self.get_stats()
+        logging.info(
+            "streaming: %.2f pairs per decoded frame (%d pairs, %d frames in %d "
+            "chunks, %.1f s decoding), %d working set misses, %d passthrough samples"
+            % (
+                stats['pairs_per_decode'],
+                stats['pairs_emitted'],
+                stats['frames_decoded'],
+                stats['num_chunks'],
+                stats['decode_time'],
+                stats['working_set_misses'],
+                stats['passthrough_samples'],
+            )
+        )
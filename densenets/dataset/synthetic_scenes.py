@@ -0,0 +1,653 @@
+"""
+Renders small synthetic datasets in the layout of the PDC logs, so that
+SpartanDataset, training and evaluation can be run and benchmarked on a CPU
+without downloading any data, see
+dense_correspondence_manipulation/scripts/make_synthetic_dataset.py.
+
+A scene is a set of primitive objects (boxes, spheres and cylinders) resting
+on a textured table, seen by a camera orbiting around them. The images are ray
+cast in numpy, so the rgb, depth, mask and camera_to_world pose of every frame
+are exactly consistent:
+
+    <logs_root_path>/<scene_name>/processed/
+        images/%06d_rgb.png, pose_data.yaml, camera_info.yaml
+        rendered_images/%06d_depth.png  (uint16, millimeters)
+        image_masks/%06d_mask.png       (1 on the objects, 0 elsewhere)
+
+Pixel (u, v) sees along the ray K^-1 * (u, v, 1), as in correspondence_finder.
+The texture of an object is a function of the position on its surface in its
+own frame, so an object looks the same in every scene it appears in, and the
+cross scene correspondences of its single object scenes are known exactly.
+They are written as evaluation labeled data, see
+DenseCorrespondenceEvaluation.parse_cross_scene_data().
+"""
+
+import logging
+import os
+import zlib
+
+import densenets.dense_correspondence_manipulation.utils.transformations as transformations
+import densenets.dense_correspondence_manipulation.utils.utils as utils
+import numpy as np
+from densenets.correspondence_tools.projection_context import get_default_K_matrix
+from densenets.dataset.scene_structure import SceneStructure
+from densenets.dense_correspondence_manipulation.utils import constants
+from PIL import Image
+
+SHAPES = ["box", "sphere", "cylinder"]
+
+# the table is the square |x|, |y| <= TABLE_HALF_SIZE of the plane z = 0, in
+# meters. Rays that miss everything have no depth return.
+TABLE_HALF_SIZE = 0.6
+
+BACKGROUND_COLOR = np.array([0.1, 0.1, 0.12])
+
+LIGHT_DIRECTION = np.array([0.3, -0.2, 1.0]) / np.linalg.norm([0.3, -0.2, 1.0])
+
+# a point is visible in an image if its depth is within this of the rendered
+# depth, in meters
+VISIBILITY_TOLERANCE = 0.002
+
+
+def get_camera_matrix(image_width=640, image_height=480):
+    """
+    :return: get_default_K_matrix(), scaled from 640 x 480 to the image size
+    :rtype: numpy.ndarray 3 x 3
+    """
+    K = get_default_K_matrix()
+    K[0] *= image_width / 640.0
+    K[1] *= image_height / 480.0
+    return K
+
+
+def look_at(eye, target):
+    """
+    :param eye: camera position, in world frame
+    :param target: point the optical axis goes through
+    :return: camera_to_world pose of a right-down-forward camera at eye looking
+             at target, with the world z axis pointing up in the image
+    :rtype: numpy.ndarray 4 x 4
+    """
+    forward = np.asarray(target, dtype=np.float64) - eye
+    forward /= np.linalg.norm(forward)
+    right = np.cross(forward, [0, 0, 1.0])
+    right /= np.linalg.norm(right)
+    down = np.cross(forward, right)
+
+    pose = np.eye(4)
+    pose[0:3, 0] = right
+    pose[0:3, 1] = down
+    pose[0:3, 2] = forward
+    pose[0:3, 3] = eye
+    return pose
+
+
+def pose_to_dict(pose):
+    """
+    :return: pose in the format of pose_data.yaml
+    :rtype: dict
+    """
+    quaternion = transformations.quaternion_from_matrix(pose)
+    return utils.dictFromPosQuat(
+        [float(x) for x in pose[0:3, 3]], [float(x) for x in quaternion]
+    )
+
+
+class SyntheticObject(object):
+    """
+    A primitive shape centered at the origin of its object frame, with a
+    smooth non-repeating color texture. size holds the half extents along x, y
+    and z; a sphere uses size[0] as its radius and a cylinder, whose axis is
+    z, uses size[0] as its radius and size[2] as its half height.
+    """
+
+    def __init__(self, object_id, shape, size, base_color, frequencies, phases):
+        if shape not in SHAPES:
+            raise ValueError("unknown shape %s, options are %s" % (shape, SHAPES))
+        self.object_id = object_id
+        self.shape = shape
+        self.size = np.asarray(size, dtype=np.float64)
+        self.base_color = np.asarray(base_color, dtype=np.float64)
+        self.frequencies = np.asarray(frequencies, dtype=np.float64)
+        self.phases = np.asarray(phases, dtype=np.float64)
+
+    @staticmethod
+    def from_object_id(object_id, shape):
+        """
+        Draws the size and texture of the object from a seed derived from
+        object_id, so the same object_id always gives the same object
+        :rtype: SyntheticObject
+        """
+        rng = np.random.RandomState(zlib.crc32(object_id.encode("utf-8")))
+        if shape == "box":
+            size = rng.uniform(0.03, 0.07, 3)
+        elif shape == "sphere":
+            size = np.full(3, rng.uniform(0.04, 0.06))
+        else:
+            radius = rng.uniform(0.03, 0.05)
+            size = np.array([radius, radius, rng.uniform(0.04, 0.08)])
+
+        # one wave per color channel, with a period of a few centimeters
+        directions = rng.normal(size=(3, 3))
+        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+        frequencies = directions * rng.uniform(40, 120, (3, 1))
+        return SyntheticObject(
+            object_id,
+            shape,
+            size,
+            rng.uniform(0.4, 1.0, 3),
+            frequencies,
+            rng.uniform(0, 2 * np.pi, 3),
+        )
+
+    def intersect(self, origins, directions):
+        """
+        :param origins, directions: rays in object frame, [3, N] or [3, 1]
+        :type origins, directions: numpy.ndarray
+        :return: ray parameter t of the first hit, inf where the ray misses,
+                 and the [3, N] outward normals at the hits, in object frame
+        :rtype: numpy.ndarray, numpy.ndarray
+        """
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            if self.shape == "box":
+                return self._intersect_box(origins, directions)
+            elif self.shape == "sphere":
+                return self._intersect_sphere(origins, directions)
+            return self._intersect_cylinder(origins, directions)
+
+    def _intersect_box(self, origins, directions):
+        half_size = self.size[:, None]
+        t1 = (-half_size - origins) / directions
+        t2 = (half_size - origins) / directions
+        t_near = np.minimum(t1, t2)
+        t_enter = t_near.max(axis=0)
+        t_exit = np.maximum(t1, t2).min(axis=0)
+        hit = (t_exit >= t_enter) & (t_enter > 0)
+        t = np.where(hit, t_enter, np.inf)
+
+        axis = t_near.argmax(axis=0)
+        columns = np.arange(directions.shape[1])
+        normals = np.zeros_like(directions)
+        normals[axis, columns] = -np.sign(directions[axis, columns])
+        return t, normals
+
+    def _intersect_sphere(self, origins, directions):
+        radius = self.size[0]
+        a = (directions * directions).sum(axis=0)
+        b = (origins * directions).sum(axis=0)
+        c = (origins * origins).sum(axis=0) - radius * radius
+        t = (-b - np.sqrt(b * b - a * c)) / a
+        t = np.where(t > 0, t, np.inf)
+        normals = (origins + np.where(np.isfinite(t), t, 0) * directions) / radius
+        return t, normals
+
+    def _intersect_cylinder(self, origins, directions):
+        radius = self.size[0]
+        half_height = self.size[2]
+
+        a = directions[0] ** 2 + directions[1] ** 2
+        b = origins[0] * directions[0] + origins[1] * directions[1]
+        c = origins[0] ** 2 + origins[1] ** 2 - radius * radius
+        t_side = (-b - np.sqrt(b * b - a * c)) / a
+        z_side = origins[2] + t_side * directions[2]
+        on_side = (t_side > 0) & (np.abs(z_side) <= half_height)
+        t_side = np.where(on_side, t_side, np.inf)
+
+        # the cap facing the ray
+        cap_z = -np.sign(directions[2]) * half_height
+        t_cap = (cap_z - origins[2]) / directions[2]
+        x_cap = origins[0] + t_cap * directions[0]
+        y_cap = origins[1] + t_cap * directions[1]
+        on_cap = (t_cap > 0) & (x_cap**2 + y_cap**2 <= radius * radius)
+        t_cap = np.where(on_cap, t_cap, np.inf)
+
+        t = np.minimum(t_side, t_cap)
+        points = origins + np.where(np.isfinite(t), t, 0) * directions
+        normals = np.zeros_like(directions)
+        normals[0:2] = points[0:2] / radius
+        use_cap = t_cap < t_side
+        normals[:, use_cap] = 0
+        normals[2, use_cap] = np.sign(cap_z[use_cap])
+        return t, normals
+
+    def color(self, points):
+        """
+        :param points: surface points in object frame, [3, N]
+        :return: [3, N] albedo in [0, 1]
+        :rtype: numpy.ndarray
+        """
+        waves = np.sin(self.frequencies.dot(points) + self.phases[:, None])
+        return self.base_color[:, None] * (0.35 + 0.325 * (waves + 1))
+
+
+def table_color(points):
+    """
+    :param points: points on the table, in world frame, [3, N]
+    :return: [3, N] albedo of a gray 5 cm checkerboard
+    :rtype: numpy.ndarray
+    """
+    cells = np.floor(points[0:2] / 0.05).astype(np.int64).sum(axis=0)
+    gray = np.where(cells % 2 == 0, 0.55, 0.45)
+    return np.tile(gray, (3, 1)) * np.array([[1.0], [0.95], [0.9]])
+
+
+class SyntheticScene(object):
+    """
+    Objects placed on the table, each with an object_to_world pose
+    """
+
+    def __init__(self, objects, object_to_world_poses):
+        """
+        :param objects:
+        :type objects: list of SyntheticObject
+        :param object_to_world_poses: 4 x 4 pose of each object
+        :type object_to_world_poses: list of numpy.ndarray
+        """
+        self.objects = list(objects)
+        self.object_to_world_poses = [np.asarray(x) for x in object_to_world_poses]
+
+    @staticmethod
+    def place_objects(objects, rng):
+        """
+        Rests the objects on the table, rotated about the vertical axis and
+        spread around a circle so they do not intersect
+        :rtype: SyntheticScene
+        """
+        poses = []
+        angle = rng.uniform(0, 2 * np.pi)
+        radius = 0.0 if len(objects) == 1 else 0.12
+        for obj in objects:
+            pose = np.eye(4)
+            pose[0:3, 0:3] = transformations.rotation_matrix(
+                rng.uniform(0, 2 * np.pi), [0, 0, 1]
+            )[0:3, 0:3]
+            offset = rng.uniform(-0.02, 0.02, 2)
+            pose[0:2, 3] = radius * np.array([np.cos(angle), np.sin(angle)]) + offset
+            pose[2, 3] = obj.size[2]
+            poses.append(pose)
+            angle += 2 * np.pi / len(objects)
+        return SyntheticScene(objects, poses)
+
+    def center(self):
+        """
+        :return: the mean of the object positions, in world frame
+        :rtype: numpy.ndarray
+        """
+        return np.mean([pose[0:3, 3] for pose in self.object_to_world_poses], axis=0)
+
+    def radius(self):
+        """
+        :return: radius about center() of a sphere holding all the objects
+        :rtype: float
+        """
+        center = self.center()
+        return max(
+            np.linalg.norm(pose[0:3, 3] - center) + np.linalg.norm(obj.size)
+            for obj, pose in zip(self.objects, self.object_to_world_poses)
+        )
+
+    def ray_cast(self, camera_to_world, K, image_height, image_width):
+        """
+        :return: a dict of [H, W] images
+
+            - depth: along the optical axis, in meters, 0 where nothing is hit
+            - object_index: index into self.objects of the object seen, -1 for
+              the table and the background
+            - points: [H, W, 3] surface point seen, in the frame of that
+              object, in world frame for the table
+            - normals: [H, W, 3] outward surface normals, in world frame
+
+        :rtype: dict
+        """
+        v, u = np.mgrid[0:image_height, 0:image_width].astype(np.float64)
+        rays = np.linalg.inv(K).dot(np.stack((u.ravel(), v.ravel(), np.ones(u.size))))
+
+        # the rays have unit z in camera frame, so t is the depth
+        directions = camera_to_world[0:3, 0:3].dot(rays)
+        origin = camera_to_world[0:3, 3:4]
+        num_rays = rays.shape[1]
+
+        depth = np.full(num_rays, np.inf)
+        object_index = np.full(num_rays, -1, dtype=np.int64)
+        points = np.zeros((3, num_rays))
+        normals = np.zeros((3, num_rays))
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t_table = -origin[2] / directions[2]
+        table_points = origin + np.where(t_table > 0, t_table, 0) * directions
+        on_table = (t_table > 0) & np.all(
+            np.abs(table_points[0:2]) <= TABLE_HALF_SIZE, axis=0
+        )
+        depth[on_table] = t_table[on_table]
+        points[:, on_table] = table_points[:, on_table]
+        normals[2, on_table] = 1.0
+
+        for index, (obj, pose) in enumerate(
+            zip(self.objects, self.object_to_world_poses)
+        ):
+            rotation = pose[0:3, 0:3]
+            object_origin = rotation.T.dot(origin - pose[0:3, 3:4])
+            object_directions = rotation.T.dot(directions)
+            t, object_normals = obj.intersect(object_origin, object_directions)
+            closer = t < depth
+            depth[closer] = t[closer]
+            object_index[closer] = index
+            points[:, closer] = (
+                object_origin + t[closer] * object_directions[:, closer]
+            )
+            normals[:, closer] = rotation.dot(object_normals[:, closer])
+
+        depth[~np.isfinite(depth)] = 0
+        return {
+            "depth": depth.reshape(image_height, image_width),
+            "object_index": object_index.reshape(image_height, image_width),
+            "points": points.T.reshape(image_height, image_width, 3),
+            "normals": normals.T.reshape(image_height, image_width, 3),
+        }
+
+    def render(self, camera_to_world, K, image_height, image_width):
+        """
+        :return: rgb, depth in millimeters and mask of the objects, and the
+                 ray_cast() result they were computed from
+        :rtype: numpy.ndarray [H, W, 3] uint8, [H, W] uint16, [H, W] uint8,
+                dict
+        """
+        hits = self.ray_cast(camera_to_world, K, image_height, image_width)
+        object_index = hits["object_index"].ravel()
+        points = hits["points"].reshape(-1, 3).T
+        normals = hits["normals"].reshape(-1, 3).T
+
+        albedo = np.tile(BACKGROUND_COLOR[:, None], (1, object_index.size))
+        on_table = (object_index == -1) & (hits["depth"].ravel() > 0)
+        albedo[:, on_table] = table_color(points[:, on_table])
+        for index, obj in enumerate(self.objects):
+            on_object = object_index == index
+            albedo[:, on_object] = obj.color(points[:, on_object])
+
+        shading = 0.4 + 0.6 * np.maximum(LIGHT_DIRECTION.dot(normals), 0)
+        rgb = albedo * np.where(hits["depth"].ravel() > 0, shading, 1.0)
+        rgb = np.round(255 * np.clip(rgb, 0, 1)).astype(np.uint8)
+        rgb = rgb.T.reshape(image_height, image_width, 3)
+
+        depth = np.round(hits["depth"] * constants.DEPTH_IM_SCALE)
+        depth = np.clip(depth, 0, np.iinfo(np.uint16).max).astype(np.uint16)
+        mask = (hits["object_index"] >= 0).astype(np.uint8)
+        return rgb, depth, mask, hits
+
+
+def orbit_trajectory(scene, num_frames, rng):
+    """
+    Camera poses on a partial orbit around the objects of scene, with the
+    elevation and the distance varying along it
+    :type scene: SyntheticScene
+    :return: camera_to_world poses
+    :rtype: list of numpy.ndarray 4 x 4
+    """
+    target = scene.center()
+    phase = np.linspace(0, 1, num_frames)
+    azimuth = rng.uniform(0, 2 * np.pi) + rng.uniform(1.2, 1.8) * np.pi * phase
+    elevation = np.deg2rad(45 + 15 * np.sin(2 * np.pi * phase + rng.uniform(0, 6)))
+    distance = 2.5 * scene.radius() + rng.uniform(0.1, 0.2)
+    distance = distance + 0.05 * np.cos(2 * np.pi * phase)
+
+    poses = []
+    for i in range(num_frames):
+        direction = np.array(
+            [
+                np.cos(elevation[i]) * np.cos(azimuth[i]),
+                np.cos(elevation[i]) * np.sin(azimuth[i]),
+                np.sin(elevation[i]),
+            ]
+        )
+        poses.append(look_at(target + distance[i] * direction, target))
+    return poses
+
+
+def write_scene(processed_dir, scene, poses, K, image_height, image_width):
+    """
+    Renders the frames of scene seen from poses and writes them in the layout
+    of a processed PDC log, see SceneStructure
+    """
+    ss = SceneStructure(processed_dir)
+    for directory in [ss.images_dir, ss.rendered_images_dir, ss.image_masks_dir]:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    pose_data = dict()
+    for img_idx, pose in enumerate(poses):
+        rgb, depth, mask, _ = scene.render(pose, K, image_height, image_width)
+        padded = utils.getPaddedString(img_idx)
+        Image.fromarray(rgb).save(os.path.join(ss.images_dir, padded + "_rgb.png"))
+        Image.fromarray(depth).save(
+            os.path.join(ss.rendered_images_dir, padded + "_depth.png")
+        )
+        Image.fromarray(mask).save(
+            os.path.join(ss.image_masks_dir, padded + "_mask.png")
+        )
+        pose_data[img_idx] = {"camera_to_world": pose_to_dict(pose)}
+
+    camera_info = {
+        "image_width": image_width,
+        "image_height": image_height,
+        "camera_matrix": {"rows": 3, "cols": 3, "data": K.ravel().tolist()},
+    }
+    utils.saveToYaml(pose_data, ss.camera_pose_file)
+    utils.saveToYaml(camera_info, ss.camera_info_file)
+
+
+def label_cross_scene_pair(
+    scene_a,
+    pose_a,
+    scene_b,
+    pose_b,
+    K,
+    image_height,
+    image_width,
+    object_id,
+    num_pixels,
+    rng,
+):
+    """
+    Picks pixels of image a on the object object_id and finds where the same
+    points of the object are in image b, keeping those that are visible there
+    :param pose_a, pose_b: camera_to_world of image a and image b
+    :return: the pixels of image a and their matches in image b, as lists of
+             dicts with keys u and v, empty if none is visible
+    :rtype: list, list
+    """
+    index_a = [obj.object_id for obj in scene_a.objects].index(object_id)
+    index_b = [obj.object_id for obj in scene_b.objects].index(object_id)
+    hits_a = scene_a.ray_cast(pose_a, K, image_height, image_width)
+    depth_b = scene_b.ray_cast(pose_b, K, image_height, image_width)["depth"]
+
+    v_a, u_a = np.nonzero(hits_a["object_index"] == index_a)
+    order = rng.permutation(len(u_a))
+    u_a = u_a[order]
+    v_a = v_a[order]
+
+    object_points = hits_a["points"][v_a, u_a].T
+    object_to_world = scene_b.object_to_world_poses[index_b]
+    world_to_camera_b = np.linalg.inv(pose_b).dot(object_to_world)
+    points_b = world_to_camera_b[0:3, 0:3].dot(object_points)
+    points_b += world_to_camera_b[0:3, 3:4]
+    uv_b = K.dot(points_b)
+    u_b = uv_b[0] / uv_b[2]
+    v_b = uv_b[1] / uv_b[2]
+
+    pixels_a = []
+    pixels_b = []
+    for i in range(len(u_a)):
+        column = int(round(u_b[i]))
+        row = int(round(v_b[i]))
+        if not (0 <= column < image_width and 0 <= row < image_height):
+            continue
+        if abs(depth_b[row, column] - points_b[2, i]) > VISIBILITY_TOLERANCE:
+            continue
+        pixels_a.append({"u": int(u_a[i]), "v": int(v_a[i])})
+        pixels_b.append({"u": column, "v": row})
+        if len(pixels_a) == num_pixels:
+            break
+    return pixels_a, pixels_b
+
+
+def write_synthetic_dataset(
+    output_dir,
+    num_objects=3,
+    num_scenes_per_object=3,
+    num_multi_object_scenes=2,
+    num_frames=20,
+    image_width=640,
+    image_height=480,
+    num_labeled_pairs=4,
+    num_labeled_pixels=10,
+    seed=0,
+):
+    """
+    Writes a dataset of num_objects objects, each with its own single object
+    scenes, and of multi object scenes holding all of them. The last single
+    object scene of each object and the last multi object scene are test
+    scenes, if there is more than one. Writes into output_dir:
+
+        logs_proto/<scene_name>/processed/...
+        single_object/<object_id>.yaml
+        multi_object/synthetic_multi_object.yaml
+        evaluation_labeled_data/<object_id>.yaml
+        composite/synthetic.yaml
+
+    The config files hold absolute paths, so the composite config can be given
+    to SpartanDataset wherever the dataset is.
+    :return: filename of the composite dataset config
+    :rtype: str
+    """
+    output_dir = os.path.abspath(output_dir)
+    logs_root_path = os.path.join(output_dir, "logs_proto")
+    rng = np.random.RandomState(seed)
+    K = get_camera_matrix(image_width, image_height)
+
+    objects = []
+    for i in range(num_objects):
+        shape = SHAPES[i % len(SHAPES)]
+        objects.append(SyntheticObject.from_object_id("%s_%d" % (shape, i), shape))
+
+    def write(scene_name, scene):
+        poses = orbit_trajectory(scene, num_frames, rng)
+        processed_dir = os.path.join(logs_root_path, scene_name, "processed")
+        logging.info("writing %s" % (scene_name))
+        write_scene(processed_dir, scene, poses, K, image_height, image_width)
+        return poses
+
+    def split(scene_names):
+        if len(scene_names) > 1:
+            return scene_names[:-1], scene_names[-1:]
+        return scene_names, []
+
+    single_object_config_files = []
+    for obj in objects:
+        scenes = dict()
+        for k in range(num_scenes_per_object):
+            scene_name = "%s_scene_%02d" % (obj.object_id, k)
+            scene = SyntheticScene.place_objects([obj], rng)
+            scenes[scene_name] = (scene, write(scene_name, scene))
+
+        scene_names = sorted(scenes)
+        labeled_data = []
+        for _ in range(num_labeled_pairs if len(scene_names) > 1 else 0):
+            scene_name_a, scene_name_b = rng.choice(scene_names, 2, replace=False)
+            scene_a, poses_a = scenes[scene_name_a]
+            scene_b, poses_b = scenes[scene_name_b]
+            img_a_idx, img_b_idx = rng.randint(0, num_frames, 2)
+            pixels_a, pixels_b = label_cross_scene_pair(
+                scene_a,
+                poses_a[img_a_idx],
+                scene_b,
+                poses_b[img_b_idx],
+                K,
+                image_height,
+                image_width,
+                obj.object_id,
+                num_labeled_pixels,
+                rng,
+            )
+            if len(pixels_a) == 0:
+                continue
+            labeled_data.append(
+                {
+                    "image_a": {
+                        "scene_name": str(scene_name_a),
+                        "image_idx": int(img_a_idx),
+                        "pixels": pixels_a,
+                    },
+                    "image_b": {
+                        "scene_name": str(scene_name_b),
+                        "image_idx": int(img_b_idx),
+                        "pixels": pixels_b,
+                    },
+                }
+            )
+
+        evaluation_labeled_data_path = []
+        if len(labeled_data) > 0:
+            labeled_data_file = os.path.join(
+                output_dir, "evaluation_labeled_data", obj.object_id + ".yaml"
+            )
+            _make_parent_dir(labeled_data_file)
+            utils.saveToYaml(labeled_data, labeled_data_file)
+            evaluation_labeled_data_path.append(labeled_data_file)
+
+        train, test = split(scene_names)
+        config_file = os.path.join(output_dir, "single_object", obj.object_id + ".yaml")
+        _make_parent_dir(config_file)
+        utils.saveToYaml(
+            {
+                "logs_root_path": logs_root_path,
+                "object_id": obj.object_id,
+                "train": train,
+                "test": test,
+                "evaluation_labeled_data_path": evaluation_labeled_data_path,
+            },
+            config_file,
+        )
+        single_object_config_files.append(config_file)
+
+    multi_object_config_files = []
+    if num_multi_object_scenes > 0:
+        scene_names = []
+        for k in range(num_multi_object_scenes):
+            scene_name = "multi_object_scene_%02d" % (k)
+            write(scene_name, SyntheticScene.place_objects(objects, rng))
+            scene_names.append(scene_name)
+
+        train, test = split(scene_names)
+        config_file = os.path.join(
+            output_dir, "multi_object", "synthetic_multi_object.yaml"
+        )
+        _make_parent_dir(config_file)
+        utils.saveToYaml(
+            {
+                "logs_root_path": logs_root_path,
+                "object_id_list": [obj.object_id for obj in objects],
+                "train": train,
+                "test": test,
+                "evaluation_labeled_data_path": [],
+            },
+            config_file,
+        )
+        multi_object_config_files.append(config_file)
+
+    composite_config_file = os.path.join(output_dir, "composite", "synthetic.yaml")
+    _make_parent_dir(composite_config_file)
+    utils.saveToYaml(
+        {
+            "logs_root_path": logs_root_path,
+            "single_object_scenes_config_files": single_object_config_files,
+            "multi_object_scenes_config_files": multi_object_config_files,
+        },
+        composite_config_file,
+    )
+    return composite_config_file
+
+
+def _make_parent_dir(filename):
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Computes the dense flow fields (where every pixel of image a lands in image b,
+and whether it is valid, out of view or occluded) of a set of frame pairs for
+every scene of a dataset, see densenets/dataset/flow_field.py. They are written
+to processed/flow_fields/ of each scene.
+
+Usage:
+
+    compute_flow_fields.py --dataset_config <composite dataset yaml> \
+        --num_pairs_per_scene 100 [--seed 0]
+
+    compute_flow_fields.py --dataset_config <composite dataset yaml> \
+        --match_table_pairs
+
+The pairs are either drawn from the pairs that get_img_idx_with_different_pose
+could return, or taken from the precomputed match table of each scene.
+"""
+
+import argparse
+import logging
+import os
+import time
+
+import densenets.dataset.match_table as match_table
+import densenets.dense_correspondence_manipulation.utils.utils as utils
+from densenets.dataset.flow_field import FlowField
+from densenets.dataset.scene_structure import SceneStructure
+from densenets.dataset.spartan_dataset_masked import SpartanDataset
+
+
+def get_scene_pairs(dataset, scene_name, num_pairs, match_table_pairs=False, seed=None):
+    """
+    :return: (img_a_idx, img_b_idx) pairs of the scene
+    :rtype: list of (int, int)
+    """
+    if match_table_pairs:
+        table = dataset.get_match_table(scene_name)
+        return [table.get_pair(row) for row in range(len(table))]
+
+    return match_table.sample_pairs(
+        dataset.get_pose_store(scene_name),
+        dataset.get_pair_index(scene_name),
+        num_pairs,
+        seed=seed,
+    )
+
+
+def compute_dataset(
+    dataset, num_pairs_per_scene, match_table_pairs=False, overwrite=False, seed=None
+):
+    """
+    Writes the flow fields of every train and test scene of a SpartanDataset
+    :param dataset:
+    :type dataset: SpartanDataset
+    :param num_pairs_per_scene: ignored if match_table_pairs is set
+    :type num_pairs_per_scene: int
+    :param match_table_pairs: use the pairs of the scenes' match tables
+    :type match_table_pairs: bool
+    :param overwrite: recompute flow fields that already exist
+    :type overwrite: bool
+    :param seed: seed for the choice of pairs
+    :type seed: int
+    :return:
+    :rtype:
+    """
+    dataset.load_all_pose_data()
+    scene_names = dataset.get_scene_list(mode="train") + dataset.get_scene_list(
+        mode="test"
+    )
+    scene_names = sorted(set(scene_names))
+    for counter, scene_name in enumerate(scene_names):
+        scene_structure = SceneStructure(dataset.get_full_path_for_scene(scene_name))
+        pairs = get_scene_pairs(
+            dataset,
+            scene_name,
+            num_pairs_per_scene,
+            match_table_pairs=match_table_pairs,
+            seed=seed,
+        )
+        print(
+            "computing scene %d of %d: %s, %d pairs"
+            % (counter + 1, len(scene_names), scene_name, len(pairs))
+        )
+
+        K = dataset.get_camera_matrix(scene_name)
+        num_written = 0
+        for img_a_idx, img_b_idx in pairs:
+            filename = scene_structure.flow_field_filename(img_a_idx, img_b_idx)
+            if os.path.isfile(filename) and not overwrite:
+                continue
+
+            _, depth_a, _, pose_a = dataset.get_rgbd_mask_pose_arrays(
+                scene_name, img_a_idx
+            )
+            _, depth_b, _, pose_b = dataset.get_rgbd_mask_pose_arrays(
+                scene_name, img_b_idx
+            )
+            FlowField.from_frames(depth_a, pose_a, depth_b, pose_b, K=K).save(filename)
+            num_written += 1
+
+        logging.info(
+            "%s: wrote %d flow fields, %d already existed"
+            % (scene_name, num_written, len(pairs) - num_written)
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--dataset_config",
+        type=str,
+        required=True,
+        help="composite dataset config yaml",
+    )
+    parser.add_argument("--num_pairs_per_scene", type=int, default=100)
+    parser.add_argument(
+        "--match_table_pairs",
+        action="store_true",
+        help="compute the pairs of each scene's match table",
+    )
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    start_time = time.time()
+
+    config = utils.getDictFromYamlFilename(args.dataset_config)
+    dataset = SpartanDataset(config=config)
+    compute_dataset(
+        dataset,
+        args.num_pairs_per_scene,
+        match_table_pairs=args.match_table_pairs,
+        overwrite=args.overwrite,
+        seed=args.seed,
+    )
+
+    print("finished computing in %.1f seconds" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Writes a small synthetic dataset of primitive objects on a table in the
+layout of the PDC logs, with its dataset configs and cross scene labeled
+data, see densenets/dataset/synthetic_scenes.py. The defaults take well under
+a minute to generate, and the dataset runs through SpartanDataset, training
+(with device: cpu in training.yaml) and evaluation without any download, e.g.
+for benchmarks on a CPU.
+
+Usage:
+
+    make_synthetic_dataset.py --output_dir /tmp/synthetic [--num_objects 3] \
+        [--num_scenes_per_object 3] [--num_multi_object_scenes 2] \
+        [--num_frames 20] [--image_width 640] [--image_height 480] [--seed 0]
+
+then point dataset_config at the composite config it prints, e.g.
+
+    config = utils.getDictFromYamlFilename("/tmp/synthetic/composite/synthetic.yaml")
+    dataset = SpartanDataset(config=config)
+"""
+
+import argparse
+import logging
+import time
+
+import densenets.dataset.synthetic_scenes as synthetic_scenes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--num_objects", type=int, default=3)
+    parser.add_argument("--num_scenes_per_object", type=int, default=3)
+    parser.add_argument("--num_multi_object_scenes", type=int, default=2)
+    parser.add_argument("--num_frames", type=int, default=20)
+    parser.add_argument("--image_width", type=int, default=640)
+    parser.add_argument("--image_height", type=int, default=480)
+    parser.add_argument(
+        "--num_labeled_pairs",
+        type=int,
+        default=4,
+        help="cross scene image pairs labeled per object",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    start_time = time.time()
+    config_file = synthetic_scenes.write_synthetic_dataset(
+        args.output_dir,
+        num_objects=args.num_objects,
+        num_scenes_per_object=args.num_scenes_per_object,
+        num_multi_object_scenes=args.num_multi_object_scenes,
+        num_frames=args.num_frames,
+        image_width=args.image_width,
+        image_height=args.image_height,
+        num_labeled_pairs=args.num_labeled_pairs,
+        seed=args.seed,
+    )
+    print("took %.1f seconds" % (time.time() - start_time))
+    print("composite dataset config: %s" % (config_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Packs the rgb, depth and mask pngs of one or more scenes into memory-mapped
+frame store shards, see densenets/dataset/frame_store.py.
+
+Usage:
+
+    pack_frame_store.py --data_dir <logs_proto/scene_name/processed>
+    pack_frame_store.py --dataset_config <composite dataset yaml>
+
+Set storage_backend: packed in training.yaml to train from the shards.
+"""
+
+import argparse
+import logging
+import os
+import time
+
+import densenets.dataset.frame_store as frame_store
+import densenets.dense_correspondence_manipulation.utils.utils as utils
+from densenets.dataset.spartan_dataset_masked import SpartanDataset
+
+
+def pack_dataset(dataset, mask_encoding, overwrite=False):
+    """
+    Packs every train and test scene of a SpartanDataset
+    :param dataset:
+    :type dataset: SpartanDataset
+    :param mask_encoding:
+    :type mask_encoding: str
+    :param overwrite: repack scenes that already have a frame store
+    :type overwrite: bool
+    :return:
+    :rtype:
+    """
+    scene_names = dataset.get_scene_list(mode="train") + dataset.get_scene_list(
+        mode="test"
+    )
+    scene_names = sorted(set(scene_names))
+    for counter, scene_name in enumerate(scene_names):
+        processed_dir = dataset.get_full_path_for_scene(scene_name)
+        if frame_store.FrameStore.exists(processed_dir) and not overwrite:
+            print("skipping %s, already packed" % (scene_name))
+            continue
+
+        print("packing scene %d of %d: %s" % (counter + 1, len(scene_names), scene_name))
+        frame_store.pack_scene(processed_dir, mask_encoding=mask_encoding)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str, help="processed folder of a scene")
+    parser.add_argument(
+        "--dataset_config", type=str, help="composite dataset config yaml"
+    )
+    parser.add_argument(
+        "--mask_encoding",
+        type=str,
+        default=frame_store.MaskEncoding.UINT8,
+        choices=[frame_store.MaskEncoding.UINT8, frame_store.MaskEncoding.PACKBITS],
+    )
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    start_time = time.time()
+
+    if args.data_dir is not None:
+        frame_store.pack_scene(
+            os.path.abspath(args.data_dir), mask_encoding=args.mask_encoding
+        )
+    elif args.dataset_config is not None:
+        config = utils.getDictFromYamlFilename(args.dataset_config)
+        dataset = SpartanDataset(config=config)
+        pack_dataset(dataset, args.mask_encoding, overwrite=args.overwrite)
+    else:
+        parser.error("one of --data_dir or --dataset_config is required")
+
+    print("finished packing in %.1f seconds" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
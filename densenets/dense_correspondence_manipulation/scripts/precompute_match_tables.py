@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Precomputes the dense pixel correspondences of a set of frame pairs for every
+scene of a dataset and stores them as match tables, see
+densenets/dataset/match_table.py.
+
+Usage:
+
+    precompute_match_tables.py --dataset_config <composite dataset yaml> \
+        --num_pairs_per_scene 500 [--compress] [--no_mask]
+
+Set correspondence_source: match_table in training.yaml to sample matches from
+the tables instead of reprojecting at train time.
+"""
+
+import argparse
+import logging
+import os
+import time
+
+import densenets.dataset.match_table as match_table
+import densenets.dense_correspondence_manipulation.utils.utils as utils
+from densenets.dataset.scene_structure import SceneStructure
+from densenets.dataset.spartan_dataset_masked import SpartanDataset
+
+
+def precompute_dataset(
+    dataset,
+    num_pairs_per_scene,
+    use_mask=True,
+    compress=False,
+    overwrite=False,
+    seed=None,
+    pairs_per_batch=8,
+):
+    """
+    Writes the match table of every train and test scene of a SpartanDataset
+    :param dataset:
+    :type dataset: SpartanDataset
+    :param num_pairs_per_scene:
+    :type num_pairs_per_scene: int
+    :param use_mask: only match the masked pixels of image a
+    :type use_mask: bool
+    :param compress: store the tables with np.savez_compressed
+    :type compress: bool
+    :param overwrite: recompute scenes that already have a match table
+    :type overwrite: bool
+    :param seed: seed for the choice of pairs
+    :type seed: int
+    :param pairs_per_batch: number of pairs whose correspondences are computed
+                            together
+    :type pairs_per_batch: int
+    :return:
+    :rtype:
+    """
+    dataset.load_all_pose_data()
+    scene_names = dataset.get_scene_list(mode="train") + dataset.get_scene_list(
+        mode="test"
+    )
+    scene_names = sorted(set(scene_names))
+    for counter, scene_name in enumerate(scene_names):
+        filename = SceneStructure(
+            dataset.get_full_path_for_scene(scene_name)
+        ).match_table_file
+        if os.path.isfile(filename) and not overwrite:
+            print("skipping %s, already has a match table" % (scene_name))
+            continue
+
+        print(
+            "computing scene %d of %d: %s" % (counter + 1, len(scene_names), scene_name)
+        )
+        table = match_table.build_scene_match_table(
+            dataset,
+            scene_name,
+            num_pairs_per_scene,
+            use_mask=use_mask,
+            seed=seed,
+            pairs_per_batch=pairs_per_batch,
+        )
+        table.save(filename, compress=compress)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--dataset_config",
+        type=str,
+        required=True,
+        help="composite dataset config yaml",
+    )
+    parser.add_argument("--num_pairs_per_scene", type=int, default=500)
+    parser.add_argument(
+        "--compress", action="store_true", help="write compressed npz files"
+    )
+    parser.add_argument(
+        "--no_mask",
+        action="store_true",
+        help="match every pixel of image a rather than only the masked ones",
+    )
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument(
+        "--pairs_per_batch",
+        type=int,
+        default=8,
+        help="pairs whose correspondences are computed in one pass",
+    )
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    start_time = time.time()
+
+    config = utils.getDictFromYamlFilename(args.dataset_config)
+    dataset = SpartanDataset(config=config)
+    precompute_dataset(
+        dataset,
+        args.num_pairs_per_scene,
+        use_mask=not args.no_mask,
+        compress=args.compress,
+        overwrite=args.overwrite,
+        seed=args.seed,
+        pairs_per_batch=args.pairs_per_batch,
+    )
+
+    print("finished precomputing in %.1f seconds" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,7 @@ import densenets.correspondence_tools.correspondence_plotter as correspondence_p
 import densenets.dense_correspondence_manipulation.utils.utils as utils
 import densenets.dense_correspondence_manipulation.utils.visualization as vis_utils
 import densenets.evaluation.plotting as dc_plotting
+import densenets.loss_functions.loss_composer as loss_composer
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
@@ -188,7 +189,11 @@ class DenseCorrespondenceEvaluation(object):
     ):
         """
         Given a dataset and scene name find a random pair of images with
-        poses that are different above a threshold
+        poses that are different above a threshold.
+
+        If the dataset provides a pair index (see SpartanDataset.get_pair_index)
+        the pair is drawn from it, and None is only returned if the scene has
+        no such pair. Otherwise falls back to max_num_attempts random draws.
         :param dataset:
         :type dataset:
         :param scene_name:
@@ -200,6 +205,20 @@ class DenseCorrespondenceEvaluation(object):
         :return:
         :rtype:
         """
+        # only the translation is thresholded here
+        pair_index = dataset.get_pair_index(
+            scene_name, threshold=threshold, angle_threshold=np.inf
+        )
+        if pair_index is not None:
+            image_idxs = dataset.get_pose_store(scene_name).image_idxs
+            rows_with_partners = np.flatnonzero(pair_index.degrees)
+            if len(rows_with_partners) == 0:
+                return None
+
+            row_a = rows_with_partners[random.randrange(len(rows_with_partners))]
+            row_b = pair_index.sample_partner(row_a)
+            return (int(image_idxs[row_a]), int(image_idxs[row_b]))
+
         img_a_idx = dataset.get_random_image_index(scene_name)
         pose_a = dataset.get_pose_from_scene_name_and_idx(scene_name, img_a_idx)
         pos_a = pose_a[0:3, 3]
@@ -832,7 +851,7 @@ class DenseCorrespondenceEvaluation(object):
             # Loop over J different views for image a
             for j in range(J):
                 different_view_a_idx = dataset.get_img_idx_with_different_pose(
-                    scene_name_a, pose_a, num_attempts=50
+                    scene_name_a, pose_a, num_attempts=50, img_a_idx=img_a_idx
                 )
                 if different_view_a_idx is None:
                     logging.info(
@@ -899,7 +918,7 @@ class DenseCorrespondenceEvaluation(object):
             # Loop over K different views for image b
             for k in range(K):
                 different_view_b_idx = dataset.get_img_idx_with_different_pose(
-                    scene_name_b, pose_b, num_attempts=50
+                    scene_name_b, pose_b, num_attempts=50, img_a_idx=img_b_idx
                 )
                 if different_view_b_idx is None:
                     logging.info(
@@ -1111,7 +1130,13 @@ class DenseCorrespondenceEvaluation(object):
 
         # find correspondences
         (uv_a_vec, uv_b_vec) = correspondence_finder.batch_find_pixel_correspondences(
-            depth_a, pose_a, depth_b, pose_b, device='CPU', img_a_mask=mask_a
+            depth_a,
+            pose_a,
+            depth_b,
+            pose_b,
+            device='CPU',
+            img_a_mask=mask_a,
+            K=camera_intrinsics_matrix,
         )
 
         if uv_a_vec is None:
@@ -1489,15 +1514,8 @@ class DenseCorrespondenceEvaluation(object):
         :return:
         :rtype: np.array with shape (3,)
         """
-        pos_in_camera_frame = correspondence_finder.pinhole_projection_image_to_world(
-            uv, depth, camera_intrinsics_matrix
-        )
-
-        pos_in_world_frame = np.dot(camera_to_world, np.append(pos_in_camera_frame, 1))[
-            :3
-        ]
-
-        return pos_in_world_frame
+        context = correspondence_finder.get_projection_context(camera_intrinsics_matrix)
+        return context.image_to_world(uv, depth, camera_to_world)
 
     @staticmethod
     def single_same_scene_image_pair_qualitative_analysis(
@@ -2314,7 +2332,7 @@ class DenseCorrespondenceEvaluation(object):
             img_a_idx = dataset.get_random_image_index(scene_name)
             pose_a = dataset.get_pose_from_scene_name_and_idx(scene_name, img_a_idx)
             img_b_idx = dataset.get_img_idx_with_different_pose(
-                scene_name, pose_a, num_attempts=100
+                scene_name, pose_a, num_attempts=100, img_a_idx=img_a_idx
             )
             if img_b_idx is None:
                 continue
@@ -2343,7 +2361,7 @@ class DenseCorrespondenceEvaluation(object):
             img_a_idx = dataset.get_random_image_index(scene_name)
             pose_a = dataset.get_pose_from_scene_name_and_idx(scene_name, img_a_idx)
             img_b_idx = dataset.get_img_idx_with_different_pose(
-                scene_name, pose_a, num_attempts=100
+                scene_name, pose_a, num_attempts=100, img_a_idx=img_a_idx
             )
             if img_b_idx is None:
                 continue
@@ -2467,11 +2485,16 @@ class DenseCorrespondenceEvaluation(object):
 
         :param dcn:
         :type dcn:
-        :param data_loader:
+        :param data_loader: a DataLoader of a SpartanDataset with
+                            collate_fn=collate_matches, see
+                            densenets.dataset.collate. If the dataset crops
+                            its samples the loss is computed on the crops
         :type data_loader:
         :param num_iterations:
         :type num_iterations:
-        :return:
+        :return: loss, match_loss and non_match_loss, the sum of the masked,
+                 background and blind non-match losses, averaged over the
+                 batches
         :rtype:
         """
         dcn.eval()
@@ -2481,65 +2504,65 @@ class DenseCorrespondenceEvaluation(object):
         match_loss_vec = []
         non_match_loss_vec = []
         counter = 0
+        image_shape = dcn.image_shape
+        if data_loader.dataset.pair_crop is not None:
+            image_shape = data_loader.dataset.pair_crop.image_shape
         pixelwise_contrastive_loss = PixelwiseContrastiveLoss(
-            dcn.image_shape, config=loss_config
+            image_shape, config=loss_config
         )
 
-        batch_size = 1
-
         for i, data in enumerate(data_loader, 0):
 
-            # get the inputs
-            (
-                data_type,
-                img_a,
-                img_b,
-                matches_a,
-                matches_b,
-                non_matches_a,
-                non_matches_b,
-                metadata,
-            ) = data
-            data_type = data_type[0]
-
-            if len(matches_a[0]) == 0:
+            # get the inputs, the index lists are (values, offsets) pairs
+            match_type, img_a, img_b = data[0:3]
+
+            if (match_type == -1).all():
                 print("didn't have any matches, continuing")
                 continue
 
-            img_a = Variable(img_a.cuda(), requires_grad=False)
-            img_b = Variable(img_b.cuda(), requires_grad=False)
-
-            if data_type == "matches":
-                matches_a = Variable(matches_a.cuda().squeeze(0), requires_grad=False)
-                matches_b = Variable(matches_b.cuda().squeeze(0), requires_grad=False)
-                non_matches_a = Variable(
-                    non_matches_a.cuda().squeeze(0), requires_grad=False
-                )
-                non_matches_b = Variable(
-                    non_matches_b.cuda().squeeze(0), requires_grad=False
-                )
+            device = dcn.device
+            img_a = Variable(img_a.to(device), requires_grad=False)
+            img_b = Variable(img_b.to(device), requires_grad=False)
+            packed_indices = [
+                (Variable(values.to(device), requires_grad=False), offsets)
+                for values, offsets in data[3:11]
+            ]
 
             # run both images through the network
             image_a_pred = dcn.forward(img_a)
-            image_a_pred = dcn.process_network_output(image_a_pred, batch_size)
+            image_a_pred = dcn.process_network_output(
+                image_a_pred, len(match_type), image_shape=image_shape
+            )
 
             image_b_pred = dcn.forward(img_b)
-            image_b_pred = dcn.process_network_output(image_b_pred, batch_size)
-
-            # get loss
-            if data_type == "matches":
-                loss, match_loss, non_match_loss = pixelwise_contrastive_loss.get_loss(
-                    image_a_pred,
-                    image_b_pred,
-                    matches_a,
-                    matches_b,
-                    non_matches_a,
-                    non_matches_b,
-                )
+            image_b_pred = dcn.process_network_output(
+                image_b_pred, len(match_type), image_shape=image_shape
+            )
+
+            # get loss, averaged over the non-empty samples of the batch
+            (
+                loss,
+                match_loss,
+                masked_non_match_loss,
+                background_non_match_loss,
+                blind_non_match_loss,
+                _,
+            ) = loss_composer.get_batch_loss(
+                pixelwise_contrastive_loss,
+                match_type,
+                image_a_pred,
+                image_b_pred,
+                packed_indices,
+            )
+            non_match_loss = (
+                masked_non_match_loss
+                + background_non_match_loss
+                + blind_non_match_loss
+            )
 
-                loss_vec.append(loss.data[0])
-                non_match_loss_vec.append(non_match_loss.data[0])
-                match_loss_vec.append(match_loss.data[0])
+            loss_vec.append(loss.item())
+            non_match_loss_vec.append(non_match_loss.item())
+            match_loss_vec.append(match_loss.item())
 
             if i > num_iterations:
                 break
@@ -2672,7 +2695,7 @@ class DenseCorrespondenceEvaluation(object):
             img_tensor = dataset.rgb_image_to_tensor(rgb)
             res = dcn.forward_single_image_tensor(img_tensor)  # [H, W, D]
 
-            mask_tensor = to_tensor(mask).cuda()
+            mask_tensor = to_tensor(mask).to(res.device)
             entire_image_stats, mask_image_stats = compute_descriptor_statistics(
                 res, mask_tensor
             )
@@ -2949,19 +2972,13 @@ class DenseCorrespondenceEvaluation(object):
             rgb = dataset.get_rgb_image_from_scene_name_and_idx(scene_name, img_idx)
             mask = dataset.get_mask_image_from_scene_name_and_idx(scene_name, img_idx)
 
-            mask_torch = torch.from_numpy(np.asarray(mask)).long()
-            mask_inv = 1 - mask_torch
-
-            object_uv_samples = (
-                correspondence_finder.random_sample_from_masked_image_torch(
-                    mask_torch, num_samples_per_image
-                )
-            )
-            background_uv_samples = (
-                correspondence_finder.random_sample_from_masked_image_torch(
-                    mask_inv, num_samples_per_image / num_objects
-                )
+            mask_index = dataset.get_mask_index(scene_name, img_idx, mask)
+            object_uv_samples = mask_index.sample_uv(num_samples_per_image)
+            background_uv_samples = mask_index.sample_uv(
+                num_samples_per_image // num_objects, inverse=True
             )
+            if (object_uv_samples[0] is None) or (background_uv_samples[0] is None):
+                continue
 
             object_u_samples = object_uv_samples[0].numpy()
             object_v_samples = object_uv_samples[1].numpy()
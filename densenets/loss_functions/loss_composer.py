@@ -1,4 +1,5 @@
 import torch
+from densenets.dataset.collate import unpack_indices
 from densenets.dataset.spartan_dataset_masked import (
     SpartanDataset,
     SpartanDatasetDataType,
@@ -110,6 +111,49 @@ def get_loss(
         raise ValueError("Should only have above scenes?")
 
 
+def get_batch_loss(
+    pixelwise_contrastive_loss, match_type, image_a_pred, image_b_pred, packed_indices
+):
+    """
+    Applies get_loss() to every non-empty sample of a batch made by
+    densenets.dataset.collate.collate_matches and averages the results, so that
+    samples of different match types can share a batch.
+
+    :param match_type: torch.LongTensor with shape [N], -1 for empty samples
+    :param image_a_pred, image_b_pred: network outputs with shape [N, H*W, D]
+    :param packed_indices: the 8 (values, offsets) index lists, in the order of
+                           the get_loss() args
+    :type packed_indices: list of tuples
+    :return args: loss, match_loss, masked_non_match_loss, \
+                background_non_match_loss, blind_non_match_loss, each averaged
+                over the non-empty samples, and the number of such samples
+    """
+    losses = []
+    for i in range(len(match_type)):
+        if match_type[i] == -1:
+            continue
+
+        sample_indices = [
+            unpack_indices(values, offsets, i) for values, offsets in packed_indices
+        ]
+        losses.append(
+            get_loss(
+                pixelwise_contrastive_loss,
+                match_type[i : i + 1],
+                image_a_pred[i : i + 1],
+                image_b_pred[i : i + 1],
+                *sample_indices
+            )
+        )
+
+    num_samples = len(losses)
+    if num_samples == 0:
+        raise ValueError("batch has no non-empty samples")
+
+    averaged = [sum(terms) / num_samples for terms in zip(*losses)]
+    return tuple(averaged) + (num_samples,)
+
+
 def get_within_scene_loss(
     pixelwise_contrastive_loss,
     image_a_pred,
@@ -167,7 +211,7 @@ def get_within_scene_loss(
             M_descriptor=pcl._config["M_background"],
         )
 
-    blind_non_match_loss = zero_loss()
+    blind_non_match_loss = zero_loss(image_a_pred.device)
     num_blind_hard_negatives = 1
     if not (SpartanDataset.is_empty(blind_non_matches_a.data)):
         (
@@ -274,7 +318,8 @@ def get_within_scene_loss_triplet(
 
     total_loss = masked_triplet_loss + background_triplet_loss
 
-    return total_loss, zero_loss(), zero_loss(), zero_loss(), zero_loss()
+    zero = zero_loss(image_a_pred.device)
+    return total_loss, zero, zero, zero, zero
 
 
 def get_different_object_loss(
@@ -291,7 +336,7 @@ def get_different_object_loss(
     scale_by_hard_negatives = pixelwise_contrastive_loss.config[
         "scale_by_hard_negatives_DIFFERENT_OBJECT"
     ]
-    blind_non_match_loss = zero_loss()
+    blind_non_match_loss = zero_loss(image_a_pred.device)
     if not (SpartanDataset.is_empty(blind_non_matches_a.data)):
         M_descriptor = pixelwise_contrastive_loss.config["M_background"]
 
@@ -313,7 +358,8 @@ def get_different_object_loss(
 
         blind_non_match_loss = 1.0 / scale_factor * blind_non_match_loss
     loss = blind_non_match_loss
-    return loss, zero_loss(), zero_loss(), zero_loss(), blind_non_match_loss
+    zero = zero_loss(image_a_pred.device)
+    return loss, zero, zero, zero, blind_non_match_loss
 
 
 def get_same_object_across_scene_loss(
@@ -326,7 +372,7 @@ def get_same_object_across_scene_loss(
     """
     Simple wrapper for pixelwise_contrastive_loss functions.  Args and return args documented above in get_loss()
     """
-    blind_non_match_loss = zero_loss()
+    blind_non_match_loss = zero_loss(image_a_pred.device)
     if not (SpartanDataset.is_empty(blind_non_matches_a.data)):
         (
             blind_non_match_loss,
@@ -347,11 +393,12 @@ def get_same_object_across_scene_loss(
 
     loss = 1.0 / scale_factor * blind_non_match_loss
     blind_non_match_loss_scaled = 1.0 / scale_factor * blind_non_match_loss
-    return loss, zero_loss(), zero_loss(), zero_loss(), blind_non_match_loss
+    zero = zero_loss(image_a_pred.device)
+    return loss, zero, zero, zero, blind_non_match_loss
 
 
-def zero_loss():
-    return Variable(torch.FloatTensor([0]).cuda())
+def zero_loss(device="cuda"):
+    return Variable(torch.zeros(1, device=device))
 
 
 def is_zero_loss(loss):
@@ -3,6 +3,13 @@ import torch
 
 class PixelwiseContrastiveLoss(object):
     def __init__(self, image_shape, config=None):
+        """
+        :param image_shape: [H, W] of the images the descriptors are of, the
+            crop size if training on random crops, see PairCrop
+        :type image_shape: list of ints
+        :param config: the loss_function section of training.yaml
+        :type config: dict
+        """
         self.type = "pixelwise_contrastive"
         self.image_width = image_shape[1]
         self.image_height = image_shape[0]
@@ -220,10 +227,10 @@ class PixelwiseContrastiveLoss(object):
         :rtype:
         """
         non_matches_a_descriptors = torch.index_select(
-            image_a_pred, 1, non_matches_a.long()
+            image_a_pred, 1, non_matches_a
         ).squeeze()
         non_matches_b_descriptors = torch.index_select(
-            image_b_pred, 1, non_matches_b.long()
+            image_b_pred, 1, non_matches_b
         ).squeeze()
 
         # crazily enough, if there is only one element to index_select into
@@ -431,7 +438,7 @@ class PixelwiseContrastiveLoss(object):
         """
         u_v_pixel_locations = flat_pixel_locations.repeat(1, 2)
         u_v_pixel_locations[:, 0] = u_v_pixel_locations[:, 0] % self.image_width
-        u_v_pixel_locations[:, 1] = u_v_pixel_locations[:, 1] / self.image_width
+        u_v_pixel_locations[:, 1] = u_v_pixel_locations[:, 1] // self.image_width
         return u_v_pixel_locations
 
     def get_l2_pixel_loss_original(self):
@@ -81,6 +81,14 @@ class DenseCorrespondenceNetwork(nn.Module):
     def image_shape(self):
         return [self._image_height, self._image_width]
 
+    @property
+    def device(self):
+        """
+        :return: the device the parameters of the network are on
+        :rtype: torch.device
+        """
+        return next(self.parameters()).device
+
     @property
     def image_mean(self):
         return self._image_mean
@@ -235,8 +243,7 @@ class DenseCorrespondenceNetwork(nn.Module):
         warnings.warn("use forward method instead", DeprecationWarning)
 
         img = img.unsqueeze(0)
-        img = torch.tensor(img, device=torch.device("cuda"))
-        # img = torch.tensor(img)
+        img = img.to(self.device)
         res = self.fcn(img)
         res = res.squeeze(0)
         res = res.permute(1, 2, 0)
@@ -287,9 +294,8 @@ class DenseCorrespondenceNetwork(nn.Module):
         # transform to shape [1,3,H,W]
         img_tensor = img_tensor.unsqueeze(0)
 
-        # make sure it's on the GPU
-        img_tensor = torch.tensor(img_tensor, device=torch.device("cuda"))
-        # img_tensor = torch.tensor(img_tensor)
+        # make sure it's on the device of the network
+        img_tensor = img_tensor.to(self.device)
 
         res = self.forward(img_tensor)  # shape [1,D,H,W]
         # print "res.shape 1", res.shape
@@ -302,7 +308,7 @@ class DenseCorrespondenceNetwork(nn.Module):
 
         return res
 
-    def process_network_output(self, image_pred, N):
+    def process_network_output(self, image_pred, N, image_shape=None):
         """
         Processes the network output into a new shape
 
@@ -310,12 +316,16 @@ class DenseCorrespondenceNetwork(nn.Module):
         :type image_pred: torch.Tensor
         :param N: batch size
         :type N: int
+        :param image_shape: [H, W] of the images the network ran on, e.g. the
+            crop size of training, see PairCrop. Defaults to self.image_shape
+        :type image_shape: list of ints
         :return: same as input, new shape is [N, W*H, descriptor_dim]
         :rtype:
         """
 
-        W = self._image_width
-        H = self._image_height
+        if image_shape is None:
+            image_shape = self.image_shape
+        H, W = image_shape
         image_pred = image_pred.view(N, self.descriptor_dimension, W * H)
         image_pred = image_pred.permute(0, 2, 1)
         return image_pred
@@ -354,8 +364,7 @@ class DenseCorrespondenceNetwork(nn.Module):
         sys.path.append(os.path.join(dc_source_dir, 'external/unet-pytorch'))
         from unet_model import UNet
 
-        model = UNet(num_classes=config["descriptor_dimension"]).cuda()
-        # model = UNet(num_classes=config["descriptor_dimension"])
+        model = UNet(num_classes=config["descriptor_dimension"])
         return model
 
     @staticmethod
@@ -389,7 +398,9 @@ class DenseCorrespondenceNetwork(nn.Module):
         return fcn
 
     @staticmethod
-    def from_config(config, load_stored_params=True, model_param_file=None):
+    def from_config(
+        config, load_stored_params=True, model_param_file=None, device=None
+    ):
         """
         Load a network from a configuration
 
@@ -407,6 +418,10 @@ class DenseCorrespondenceNetwork(nn.Module):
             image_width: 640
             image_height: 480
 
+        :param device: device to put the network on, defaults to cuda if it is
+            available and to cpu otherwise
+        :type device: torch.device or str
+
         :return: DenseCorrespondenceNetwork
         :rtype:
         """
@@ -436,14 +451,18 @@ class DenseCorrespondenceNetwork(nn.Module):
             assert model_param_file is not None
             config['model_param_file'] = model_param_file  # should be an absolute path
             try:
-                dcn.load_state_dict(torch.load(model_param_file))
+                dcn.load_state_dict(torch.load(model_param_file, map_location="cpu"))
             except:
                 logging.info(
                     "loading params with the new style failed, falling back to dcn.fcn.load_state_dict"
                 )
-                dcn.fcn.load_state_dict(torch.load(model_param_file))
+                dcn.fcn.load_state_dict(
+                    torch.load(model_param_file, map_location="cpu")
+                )
 
-        dcn.cuda()
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        dcn.to(device)
         dcn.train()
         dcn.config = config
         return dcn
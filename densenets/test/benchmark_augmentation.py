@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+"""
+Compares the augmentation pipeline of SpartanDataset.get_within_scene_data on
+PIL images, as it was, against the one on numpy arrays, stage by stage:
+
+- load: the frame as handed out by the dataset. The frame bank and the packed
+  store hold arrays, which the PIL pipeline wraps in PIL images
+- domain_randomize: correspondence_augmentation.domain_randomize_background,
+  for PIL the version from before the numpy pipeline
+- flip: a vertical and a horizontal flip
+- to_tensor: to a normalized torch.FloatTensor
+
+The input is a frame rendered with synthetic_scenes, made contiguous and
+read-only like the frames of the bank. For every stage this prints the median
+time, the number of output buffers that are copies rather than views of the
+stage inputs, the bytes of those copies and the peak of the memory traced by
+tracemalloc, in units of the rgb frame. tracemalloc sees the numpy
+allocations only: PIL outputs always count as copies of their size, torch
+outputs are counted through their numpy view, but neither shows up in the
+traced peak.
+
+Per pipeline it then prints the sum of the stages and the median time of
+whole runs from the frame to the tensor, which is what a DataLoader worker
+spends on the augmentation of an image. The pipelines take turns for these
+runs and draw the same random backgrounds in each round, which differ from
+round to round as in training.
+
+Both pipelines draw the same random numbers and the script checks that they
+end in identical tensors.
+
+Usage:
+
+    benchmark_augmentation.py [--image_width 640] [--image_height 480] \
+        [--repeats 50] [--seed 0]
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+
+import densenets.correspondence_tools.correspondence_augmentation as correspondence_augmentation
+import densenets.dataset.synthetic_scenes as synthetic_scenes
+import densenets.transforms as transforms
+import numpy as np
+import torch
+from densenets.dense_correspondence_manipulation.utils import constants
+from PIL import Image, ImageOps
+
+
+def make_frame(image_width, image_height, seed):
+    """
+    :return: read-only rgb and mask of a rendered scene of two objects
+    :rtype: numpy.ndarray [H, W, 3] uint8, numpy.ndarray [H, W] uint8
+    """
+    rng = np.random.RandomState(seed)
+    objects = [
+        synthetic_scenes.SyntheticObject.from_object_id("box", "box"),
+        synthetic_scenes.SyntheticObject.from_object_id("cylinder", "cylinder"),
+    ]
+    scene = synthetic_scenes.SyntheticScene.place_objects(objects, rng)
+    pose = synthetic_scenes.orbit_trajectory(scene, 1, rng)[0]
+    K = synthetic_scenes.get_camera_matrix(image_width, image_height)
+    rgb, _, mask, _ = scene.render(pose, K, image_height, image_width)
+    # render() returns a channel-major view, the frames of the bank, the packed
+    # store and decoded png files are contiguous
+    rgb = np.ascontiguousarray(rgb)
+    rgb.setflags(write=False)
+    mask.setflags(write=False)
+    return rgb, mask
+
+
+def legacy_domain_randomize_background(image_rgb, image_mask):
+    """
+    domain_randomize_background on PIL images, before the numpy pipeline
+    """
+    image_rgb_numpy = np.asarray(image_rgb)
+    three_channel_mask = np.zeros_like(image_rgb_numpy)
+    three_channel_mask[:, :, 0] = three_channel_mask[:, :, 1] = three_channel_mask[
+        :, :, 2
+    ] = image_mask
+    image_rgb_numpy = image_rgb_numpy * three_channel_mask
+
+    three_channel_mask_complement = (
+        np.ones_like(three_channel_mask) - three_channel_mask
+    )
+    random_rgb_image = correspondence_augmentation.get_random_image(
+        image_rgb_numpy.shape
+    )
+    random_rgb_background = three_channel_mask_complement * random_rgb_image
+
+    domain_randomized_image_rgb = image_rgb_numpy + random_rgb_background
+    return Image.fromarray(domain_randomized_image_rgb)
+
+
+def make_pipelines():
+    """
+    :return: the stages of each pipeline, as (name, function) pairs. Each
+             function maps the list of images of the previous stage to a new
+             list, the first stage gets the rgb and mask arrays
+    :rtype: dict
+    """
+    mean = constants.DEFAULT_IMAGE_MEAN
+    std = constants.DEFAULT_IMAGE_STD_DEV
+    pil_to_tensor = transforms.Compose(
+        [transforms.ToTensor(), transforms.Normalize(mean, std)]
+    )
+    array_to_tensor = transforms.ToNormalizedTensor(mean, std)
+
+    def flip_array(images):
+        rgb, mask = images
+        return [np.flip(np.flip(rgb, 0), 1), mask]
+
+    return {
+        "pil": [
+            ("load", lambda images: [Image.fromarray(x) for x in images]),
+            (
+                "domain_randomize",
+                lambda images: [
+                    legacy_domain_randomize_background(*images),
+                    images[1],
+                ],
+            ),
+            (
+                "flip",
+                lambda images: [ImageOps.mirror(ImageOps.flip(images[0])), images[1]],
+            ),
+            ("to_tensor", lambda images: [pil_to_tensor(images[0])]),
+        ],
+        "array": [
+            ("load", lambda images: list(images)),
+            (
+                "domain_randomize",
+                lambda images: [
+                    correspondence_augmentation.domain_randomize_background(*images),
+                    images[1],
+                ],
+            ),
+            ("flip", flip_array),
+            ("to_tensor", lambda images: [array_to_tensor(images[0])]),
+        ],
+    }
+
+
+def as_array(image):
+    """
+    :return: numpy view of the buffer of image, None for a PIL image
+    """
+    if isinstance(image, Image.Image):
+        return None
+    if torch.is_tensor(image):
+        return image.numpy()
+    return image
+
+
+def count_copies(inputs, outputs):
+    """
+    :return: number of outputs that do not share memory with any of the
+             inputs, and their size in bytes. Inputs passed through as they
+             are do not count
+    :rtype: int, int
+    """
+    input_arrays = [x for x in (as_array(x) for x in inputs) if x is not None]
+    num_copies = 0
+    num_bytes = 0
+    for output in outputs:
+        if any(output is x for x in inputs):
+            continue
+        array = as_array(output)
+        if array is None:
+            num_copies += 1
+            num_bytes += output.width * output.height * len(output.getbands())
+        elif not any(np.shares_memory(array, x) for x in input_arrays):
+            num_copies += 1
+            num_bytes += array.nbytes
+    return num_copies, num_bytes
+
+
+def seed_all(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def time_whole_pipelines(pipelines, frame, repeats, seed):
+    """
+    Runs the pipelines in turn on the frame, with the same seed for each
+    round, so that they draw the same random backgrounds
+    :return: per pipeline the median time of running all of its stages
+    :rtype: dict
+    """
+    timings = dict((pipeline, []) for pipeline in pipelines)
+    for i in range(repeats):
+        for pipeline, stages in pipelines.items():
+            seed_all(seed + i)
+            start_time = time.perf_counter()
+            images = list(frame)
+            for _, stage in stages:
+                images = stage(images)
+            timings[pipeline].append(time.perf_counter() - start_time)
+    return dict((pipeline, float(np.median(x))) for pipeline, x in timings.items())
+
+
+def run_pipeline(stages, frame, repeats, seed):
+    """
+    :return: per stage (name, median time, copies, bytes copied, traced
+             peak in bytes), and the final tensor
+    :rtype: list of tuples, torch.Tensor
+    """
+    results = []
+    images = list(frame)
+    for name, stage in stages:
+        timings = []
+        for _ in range(repeats):
+            seed_all(seed)
+            start_time = time.perf_counter()
+            stage(images)
+            timings.append(time.perf_counter() - start_time)
+
+        seed_all(seed)
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        outputs = stage(images)
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        tracemalloc.stop()
+
+        num_copies, num_bytes = count_copies(images, outputs)
+        results.append((name, float(np.median(timings)), num_copies, num_bytes, peak))
+        images = outputs
+    return results, images[0]
+
+
+def run_benchmark(image_width, image_height, repeats, seed):
+    frame = make_frame(image_width, image_height, seed)
+    frame_bytes = float(frame[0].nbytes)
+
+    print(
+        "%8s %18s %10s %8s %12s %14s"
+        % ("pipeline", "stage", "time (ms)", "copies", "copied (MB)", "traced peak")
+    )
+    pipelines = make_pipelines()
+    whole_pipeline_times = time_whole_pipelines(pipelines, frame, repeats, seed)
+    tensors = []
+    for pipeline, stages in pipelines.items():
+        results, tensor = run_pipeline(stages, frame, repeats, seed)
+        tensors.append(tensor)
+        total_time = 0.0
+        total_copies = 0
+        total_bytes = 0
+        for name, elapsed, num_copies, num_bytes, peak in results:
+            print(
+                "%8s %18s %10.3f %8d %12.2f %13.2fx"
+                % (
+                    pipeline,
+                    name,
+                    elapsed * 1e3,
+                    num_copies,
+                    num_bytes / 1e6,
+                    peak / frame_bytes,
+                )
+            )
+            total_time += elapsed
+            total_copies += num_copies
+            total_bytes += num_bytes
+        print(
+            "%8s %18s %10.3f %8d %12.2f"
+            % (
+                pipeline,
+                "sum of stages",
+                total_time * 1e3,
+                total_copies,
+                total_bytes / 1e6,
+            )
+        )
+        print(
+            "%8s %18s %10.3f"
+            % (
+                pipeline,
+                "whole pipeline",
+                whole_pipeline_times[pipeline] * 1e3,
+            )
+        )
+
+    if not torch.equal(tensors[0], tensors[1]):
+        raise ValueError("the pipelines give different tensors")
+    print("both pipelines give identical tensors")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image_width", type=int, default=640)
+    parser.add_argument("--image_height", type=int, default=480)
+    parser.add_argument("--repeats", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run_benchmark(args.image_width, args.image_height, args.repeats, args.seed)
+
+
+if __name__ == "__main__":
+    main()
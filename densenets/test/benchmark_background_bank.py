@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Compares the backgrounds of domain randomization synthesized per image, with
+correspondence_augmentation.get_random_image, against ones sampled from a
+BackgroundBank of each size, see background_bank_size in training.yaml.
+
+For the synthesis and for each bank size this prints the time to fill the
+bank and its size, the median time of one background and of one call of
+domain_randomize_background on a rendered frame, and the number of images
+after which the bank has paid for its filling time.
+
+Usage:
+
+    benchmark_background_bank.py [--bank_sizes 16 64 256] \
+        [--image_width 640] [--image_height 480] [--repeats 50] [--seed 0]
+"""
+
+import argparse
+import random
+
+import densenets.correspondence_tools.correspondence_augmentation as correspondence_augmentation
+import numpy as np
+from densenets.dataset.background_bank import BackgroundBank
+from densenets.test.benchmark_augmentation import make_frame
+from densenets.test.benchmark_correspondence_finder import time_function
+
+
+def run_benchmark(bank_sizes, image_width, image_height, repeats, seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    rgb, mask = make_frame(image_width, image_height, seed)
+    shape = rgb.shape
+
+    synthesis_time = time_function(
+        correspondence_augmentation.get_random_image, (shape,), repeats
+    )
+    synthesis_randomize_time = time_function(
+        correspondence_augmentation.domain_randomize_background, (rgb, mask), repeats
+    )
+
+    print(
+        "%12s %10s %10s %16s %20s %10s"
+        % (
+            "backgrounds",
+            "fill (s)",
+            "bank (MB)",
+            "background (ms)",
+            "domain random. (ms)",
+            "break-even",
+        )
+    )
+    print(
+        "%12s %10s %10s %16.3f %20.3f %10s"
+        % (
+            "synthesized",
+            "-",
+            "-",
+            synthesis_time * 1e3,
+            synthesis_randomize_time * 1e3,
+            "-",
+        )
+    )
+    for bank_size in bank_sizes:
+        bank = BackgroundBank.synthesize(bank_size, image_height, image_width)
+        try:
+            sample_time = time_function(bank.sample, (shape,), repeats)
+            randomize_time = time_function(
+                correspondence_augmentation.domain_randomize_background,
+                (rgb, mask, bank),
+                repeats,
+            )
+            saving = synthesis_time - sample_time
+            break_even = "%d" % np.ceil(bank.load_time / saving) if saving > 0 else "-"
+            print(
+                "%12d %10.2f %10.1f %16.3f %20.3f %10s"
+                % (
+                    bank_size,
+                    bank.load_time,
+                    bank.nbytes / 1e6,
+                    sample_time * 1e3,
+                    randomize_time * 1e3,
+                    break_even,
+                )
+            )
+        finally:
+            bank.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bank_sizes", type=int, nargs="+", default=[16, 64, 256])
+    parser.add_argument("--image_width", type=int, default=640)
+    parser.add_argument("--image_height", type=int, default=480)
+    parser.add_argument("--repeats", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run_benchmark(
+        args.bank_sizes, args.image_width, args.image_height, args.repeats, args.seed
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""
+Times the compositing of SYNTHETIC_MULTI_OBJECT samples against the number
+of objects, see synthetic_multi_object_num_objects in training.yaml.
+
+For each number of objects K this layers K rendered frames with
+correspondence_augmentation.composite_images_with_occlusions and prunes
+num_matches matches of each with prune_occluded_matches, for both images of a
+sample. It prints the median time of a sample, the time per object and the
+fraction of matches kept. For K = 2 it also times the previous pair of
+merge_images_with_occlusions calls.
+
+Usage:
+
+    benchmark_compositing.py [--num_objects 2 3 4 8] [--num_matches 2000] \
+        [--image_width 640] [--image_height 480] [--repeats 20] [--seed 0]
+"""
+
+import argparse
+import random
+
+import densenets.correspondence_tools.correspondence_augmentation as correspondence_augmentation
+import numpy as np
+import torch
+from densenets.test.benchmark_augmentation import make_frame
+from densenets.test.benchmark_correspondence_finder import time_function
+
+
+def sample_on_mask(mask, num_matches, rng):
+    """
+    :return: num_matches random pixels of the mask
+    :rtype: tuple of torch.LongTensor
+    """
+    v, u = np.nonzero(mask)
+    rows = rng.randint(len(u), size=num_matches)
+    return (torch.from_numpy(u[rows]), torch.from_numpy(v[rows]))
+
+
+def make_objects(num_objects, num_matches, image_width, image_height, rng):
+    """
+    :return: frames 1 and 2 of each object, their masks and matches
+    :rtype: list, list, list, list, list
+    """
+    images_1, images_2, masks_1, masks_2, matches = [], [], [], [], []
+    for i in range(num_objects):
+        rgb_1, mask_1 = make_frame(image_width, image_height, 2 * i)
+        rgb_2, mask_2 = make_frame(image_width, image_height, 2 * i + 1)
+        images_1.append(rgb_1)
+        images_2.append(rgb_2)
+        masks_1.append(mask_1)
+        masks_2.append(mask_2)
+        matches.append(
+            (
+                sample_on_mask(mask_1, num_matches, rng),
+                sample_on_mask(mask_2, num_matches, rng),
+            )
+        )
+    return images_1, images_2, masks_1, masks_2, matches
+
+
+def composite_sample(images_1, images_2, masks_1, masks_2, matches):
+    _, owner_1, _ = correspondence_augmentation.composite_images_with_occlusions(
+        images_1, masks_1
+    )
+    _, owner_2, _ = correspondence_augmentation.composite_images_with_occlusions(
+        images_2, masks_2
+    )
+    return correspondence_augmentation.prune_occluded_matches(
+        [owner_1, owner_2], matches
+    )
+
+
+def merge_sample(images_1, images_2, masks_1, masks_2, matches):
+    """
+    The two objects of a sample as merged before composite_images_with_occlusions
+    """
+    (uv_a1, uv_a2), (uv_b1, uv_b2) = matches
+    (
+        _,
+        _,
+        uv_a1,
+        uv_a2,
+        uv_b1,
+        uv_b2,
+    ) = correspondence_augmentation.merge_images_with_occlusions(
+        images_1[0],
+        images_1[1],
+        masks_1[0],
+        masks_1[1],
+        (uv_a1, uv_a2),
+        (uv_b1, uv_b2),
+    )
+    if (uv_a1 is None) or (uv_b1 is None):
+        return None
+    return correspondence_augmentation.merge_images_with_occlusions(
+        images_2[0],
+        images_2[1],
+        masks_2[0],
+        masks_2[1],
+        (uv_a2, uv_a1),
+        (uv_b2, uv_b1),
+    )
+
+
+def run_benchmark(
+    num_objects_list, num_matches, image_width, image_height, repeats, seed
+):
+    rng = np.random.RandomState(seed)
+    random.seed(seed)
+
+    print(
+        "%8s %22s %12s %16s %8s"
+        % ("objects", "method", "sample (ms)", "per object (ms)", "kept")
+    )
+    for num_objects in num_objects_list:
+        objects = make_objects(
+            num_objects, num_matches, image_width, image_height, rng
+        )
+        elapsed = time_function(composite_sample, objects, repeats)
+        _, num_kept = composite_sample(*objects)
+        print(
+            "%8d %22s %12.3f %16.3f %7.1f%%"
+            % (
+                num_objects,
+                "composite",
+                elapsed * 1e3,
+                elapsed * 1e3 / num_objects,
+                100.0 * sum(num_kept) / (num_objects * num_matches),
+            )
+        )
+        if num_objects == 2:
+            elapsed = time_function(merge_sample, objects, repeats)
+            print(
+                "%8d %22s %12.3f %16.3f %8s"
+                % (
+                    num_objects,
+                    "merge_with_occlusions",
+                    elapsed * 1e3,
+                    elapsed * 1e3 / 2,
+                    "-",
+                )
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_objects", type=int, nargs="+", default=[2, 3, 4, 8])
+    parser.add_argument("--num_matches", type=int, default=2000)
+    parser.add_argument("--image_width", type=int, default=640)
+    parser.add_argument("--image_height", type=int, default=480)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run_benchmark(
+        args.num_objects,
+        args.num_matches,
+        args.image_width,
+        args.image_height,
+        args.repeats,
+        args.seed,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+Compares the torch (correspondence_finder) and NumPy
+(correspondence_finder_numpy) correspondence backends, see
+correspondence_backend in training.yaml.
+
+First checks that the backends are equivalent:
+
+- every pixel of image a is matched to the same pixel of image b, up to float32
+  rounding of the position in image b
+- sampled matches and non-matches follow the same distributions. The two
+  backends draw from different random generators, so only the means of the
+  number of matches and of the sampled pixels are compared, against their
+  standard errors.
+
+Then times the correspondence work of one within scene sample: the matches
+found from num_attempts pixels of the mask of image a, then the masked and
+background non-matches of image b.
+
+Usage:
+
+    benchmark_correspondence_backends.py [--num_attempts 20 150 1000 10000] \
+        [--repeats 100] [--num_threads 1]
+"""
+
+import argparse
+
+import densenets.correspondence_tools.correspondence_finder as correspondence_finder
+import densenets.correspondence_tools.correspondence_finder_numpy as correspondence_finder_numpy
+import numpy as np
+import torch
+from densenets.dataset.mask_index import MaskIndex
+from densenets.test.benchmark_correspondence_finder import (
+    make_synthetic_pair,
+    time_function,
+)
+
+BACKENDS = [
+    ("torch", correspondence_finder),
+    ("numpy", correspondence_finder_numpy),
+]
+
+# how many standard errors apart the means of the two backends may be
+MAX_STANDARD_ERRORS = 5.0
+
+
+def make_synthetic_masks(image_height=480, image_width=640):
+    """
+    :return: MaskIndex of an object mask for image a and for image b
+    :rtype: MaskIndex, MaskIndex
+    """
+    mask = np.zeros((image_height, image_width), dtype=np.uint8)
+    mask[150:330, 220:480] = 1
+    return MaskIndex.from_mask(mask), MaskIndex.from_mask(mask)
+
+
+def sample(finder, frames, mask_index_a, mask_index_b, num_attempts, num_non_matches):
+    """
+    The correspondence_finder calls of one within scene sample of SpartanDataset
+    :return: uv_a, uv_b, masked non-matches, background non-matches
+    :rtype: tuple
+    """
+    img_a_depth, img_a_pose, img_b_depth, img_b_pose = frames
+    uv_a, uv_b = finder.batch_find_pixel_correspondences(
+        img_a_depth,
+        img_a_pose,
+        img_b_depth,
+        img_b_pose,
+        img_a_mask_index=mask_index_a,
+        num_attempts=num_attempts,
+    )
+    (
+        masked_non_matches,
+        background_non_matches,
+    ) = finder.create_masked_and_background_non_correspondences(
+        uv_b, img_b_depth.shape, mask_index_b, num_non_matches, num_non_matches
+    )
+    return uv_a, uv_b, masked_non_matches, background_non_matches
+
+
+def check_all_pixels(frames):
+    """
+    Both backends have to match every pixel of image a to the same pixel of
+    image b
+    """
+    img_a_depth = frames[0]
+    image_height, image_width = img_a_depth.shape
+    flat = torch.arange(image_height * image_width)
+    uv_a_vec = (flat % image_width, flat // image_width)
+
+    results = [
+        finder.compute_correspondences_for_pixels(*(frames + (uv_a_vec,)))
+        for _, finder in BACKENDS
+    ]
+    (u_a, v_a), (u_b, v_b) = results[0]
+    (u_a_numpy, v_a_numpy), (u_b_numpy, v_b_numpy) = results[1]
+    if not (torch.equal(u_a, u_a_numpy) and torch.equal(v_a, v_a_numpy)):
+        raise ValueError("the backends match different pixels of image a")
+    for x, y in [(u_b, u_b_numpy), (v_b, v_b_numpy)]:
+        if (x.dtype != y.dtype) or not torch.allclose(x, y, rtol=0, atol=1e-3):
+            raise ValueError("the backends match pixels to different positions")
+    print("all pixels: %d identical matches" % (len(u_a)))
+
+
+def check_distributions(frames, mask_index_a, mask_index_b, num_attempts, num_trials):
+    """
+    Compares the means of the number of matches per sample and of the
+    coordinates of the sampled pixels between the backends
+    """
+    statistics = dict()
+    for name, finder in BACKENDS:
+        values = dict()
+        for _ in range(num_trials):
+            uv_a, uv_b, masked, background = sample(
+                finder, frames, mask_index_a, mask_index_b, num_attempts, 10
+            )
+            flat_masked = (masked[1] * frames[0].shape[1] + masked[0]).long()
+            flat_background = (background[1] * frames[0].shape[1] + background[0]).long()
+            if not mask_index_b.contains(flat_masked.reshape(-1).numpy()).all():
+                raise ValueError("%s: masked non-match outside of the mask" % name)
+            if mask_index_b.contains(flat_background.reshape(-1).numpy()).any():
+                raise ValueError("%s: background non-match inside the mask" % name)
+            for key, x in [
+                ("num matches", torch.tensor([float(len(uv_a[0]))])),
+                ("u_a", uv_a[0].float()),
+                ("v_b", uv_b[1]),
+                ("masked u", masked[0]),
+                ("background v", background[1]),
+            ]:
+                values.setdefault(key, []).append(x.reshape(-1).numpy())
+        statistics[name] = {key: np.concatenate(x) for key, x in values.items()}
+
+    print("%14s %12s %12s %12s" % ("statistic", "torch", "numpy", "std errors"))
+    for key in statistics["torch"]:
+        x = statistics["torch"][key]
+        y = statistics["numpy"][key]
+        standard_error = np.sqrt(x.var() / len(x) + y.var() / len(y))
+        num_standard_errors = abs(x.mean() - y.mean()) / max(standard_error, 1e-12)
+        print(
+            "%14s %12.3f %12.3f %12.2f"
+            % (key, x.mean(), y.mean(), num_standard_errors)
+        )
+        if num_standard_errors > MAX_STANDARD_ERRORS:
+            raise ValueError("the backends differ in the mean of %s" % key)
+
+
+def run_benchmark(num_attempts_list, repeats, num_non_matches, seed=0):
+    frames = make_synthetic_pair()
+    mask_index_a, mask_index_b = make_synthetic_masks()
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+
+    check_all_pixels(frames)
+    check_distributions(frames, mask_index_a, mask_index_b, 1000, num_trials=200)
+
+    print(
+        "\n%12s %12s %12s %10s"
+        % ("attempts", "torch (ms)", "numpy (ms)", "speedup")
+    )
+    for num_attempts in num_attempts_list:
+        timings = []
+        for _, finder in BACKENDS:
+            args = (
+                finder,
+                frames,
+                mask_index_a,
+                mask_index_b,
+                num_attempts,
+                num_non_matches,
+            )
+            timings.append(time_function(sample, args, repeats))
+        print(
+            "%12d %12.3f %12.3f %9.2fx"
+            % (num_attempts, timings[0] * 1e3, timings[1] * 1e3, timings[0] / timings[1])
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--num_attempts", type=int, nargs="+", default=[20, 150, 1000, 10000]
+    )
+    parser.add_argument("--repeats", type=int, default=100)
+    parser.add_argument(
+        "--num_non_matches",
+        type=int,
+        default=75,
+        help="masked and background non-matches per match",
+    )
+    parser.add_argument("--num_threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    run_benchmark(args.num_attempts, args.repeats, args.num_non_matches)
+
+
+if __name__ == "__main__":
+    main()
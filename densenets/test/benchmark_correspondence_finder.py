@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of correspondence_finder.compute_correspondences_for_pixels,
+which computes a single validity mask over all attempted pixels, against the
+previous implementation that pruned after each test.
+
+Both are run on the same synthetic pair of depth images: a plane with a box
+in front of it, seen from two camera poses so that some pixels of image a
+fall outside of image b and some are occluded in it. The outputs are checked
+to be the same matches, see check_identical().
+
+Usage:
+
+    benchmark_correspondence_finder.py [--num_attempts 20 1000 50000] [--repeats 200]
+"""
+
+import argparse
+import time
+
+import densenets.dense_correspondence_manipulation.utils.constants as constants
+import numpy as np
+import torch
+from densenets.correspondence_tools import correspondence_finder
+from densenets.correspondence_tools.correspondence_finder import (
+    apply_transform_torch,
+    get_default_K_matrix,
+    invert_transform,
+    where,
+)
+from numpy.linalg import inv
+
+dtype_float = torch.FloatTensor
+dtype_long = torch.LongTensor
+
+
+def compute_correspondences_for_pixels_staged(
+    img_a_depth, img_a_pose, img_b_depth, img_b_pose, uv_a_vec, K=None
+):
+    """
+    The implementation of correspondence_finder.compute_correspondences_for_pixels
+    that prunes in three passes, each followed by a compaction of all the
+    vectors that are carried along. Kept as the reference for the benchmark.
+    """
+    image_width = img_a_depth.shape[1]
+    image_height = img_b_depth.shape[0]
+    uv_a_vec_flattened = (uv_a_vec[1] * image_width + uv_a_vec[0]).type(dtype_long)
+
+    if K is None:
+        K = get_default_K_matrix()
+
+    K_inv = inv(K)
+
+    img_a_depth_torch = torch.from_numpy(img_a_depth).type(dtype_float)
+    img_a_depth_torch = torch.squeeze(img_a_depth_torch, 0)
+    img_a_depth_torch = img_a_depth_torch.view(-1, 1)
+
+    depth_vec = (
+        torch.index_select(img_a_depth_torch, 0, uv_a_vec_flattened)
+        * 1.0
+        / constants.DEPTH_IM_SCALE
+    )
+    depth_vec = depth_vec.squeeze(1)
+
+    # Prune based on
+    # Case 1: depth is zero (for this data, this means no-return)
+    nonzero_indices = torch.nonzero(depth_vec)
+    if nonzero_indices.dim() == 0:
+        return (None, None)
+    nonzero_indices = nonzero_indices.squeeze(1)
+    depth_vec = torch.index_select(depth_vec, 0, nonzero_indices)
+
+    # prune u_vec and v_vec, then multiply by already pruned depth_vec
+    u_a_pruned = torch.index_select(uv_a_vec[0], 0, nonzero_indices)
+    u_vec = u_a_pruned.type(dtype_float) * depth_vec
+
+    v_a_pruned = torch.index_select(uv_a_vec[1], 0, nonzero_indices)
+    v_vec = v_a_pruned.type(dtype_float) * depth_vec
+
+    z_vec = depth_vec
+
+    full_vec = torch.stack((u_vec, v_vec, z_vec))
+
+    K_inv_torch = torch.from_numpy(K_inv).type(dtype_float)
+    point_camera_frame_rdf_vec = K_inv_torch.mm(full_vec)
+
+    point_world_frame_rdf_vec = apply_transform_torch(
+        point_camera_frame_rdf_vec, torch.from_numpy(img_a_pose).type(dtype_float)
+    )
+    point_camera_2_frame_rdf_vec = apply_transform_torch(
+        point_world_frame_rdf_vec,
+        torch.from_numpy(invert_transform(img_b_pose)).type(dtype_float),
+    )
+
+    K_torch = torch.from_numpy(K).type(dtype_float)
+    vec2_vec = K_torch.mm(point_camera_2_frame_rdf_vec)
+
+    u2_vec = vec2_vec[0] / vec2_vec[2]
+    v2_vec = vec2_vec[1] / vec2_vec[2]
+
+    z2_vec = vec2_vec[2]
+
+    # Prune based on
+    # Case 2: the pixels projected into image b are outside FOV
+    # u2_vec bounds should be: 0, image_width
+    # v2_vec bounds should be: 0, image_height
+
+    # do u2-based pruning
+    u2_vec_lower_bound = 0.0
+    epsilon = 1e-3
+    u2_vec_upper_bound = (
+        image_width * 1.0 - epsilon
+    )  # careful, needs to be epsilon less!!
+    lower_bound_vec = torch.ones_like(u2_vec) * u2_vec_lower_bound
+    upper_bound_vec = torch.ones_like(u2_vec) * u2_vec_upper_bound
+    zeros_vec = torch.zeros_like(u2_vec)
+
+    u2_vec = where(u2_vec < lower_bound_vec, zeros_vec, u2_vec)
+    u2_vec = where(u2_vec > upper_bound_vec, zeros_vec, u2_vec)
+    in_bound_indices = torch.nonzero(u2_vec)
+    if in_bound_indices.dim() == 0:
+        return (None, None)
+    in_bound_indices = in_bound_indices.squeeze(1)
+
+    # apply pruning
+    u2_vec = torch.index_select(u2_vec, 0, in_bound_indices)
+    v2_vec = torch.index_select(v2_vec, 0, in_bound_indices)
+    z2_vec = torch.index_select(z2_vec, 0, in_bound_indices)
+    u_a_pruned = torch.index_select(
+        u_a_pruned, 0, in_bound_indices
+    )  # also prune from first list
+    v_a_pruned = torch.index_select(
+        v_a_pruned, 0, in_bound_indices
+    )  # also prune from first list
+
+    # do v2-based pruning
+    v2_vec_lower_bound = 0.0
+    v2_vec_upper_bound = image_height * 1.0 - epsilon
+    lower_bound_vec = torch.ones_like(v2_vec) * v2_vec_lower_bound
+    upper_bound_vec = torch.ones_like(v2_vec) * v2_vec_upper_bound
+    zeros_vec = torch.zeros_like(v2_vec)
+
+    v2_vec = where(v2_vec < lower_bound_vec, zeros_vec, v2_vec)
+    v2_vec = where(v2_vec > upper_bound_vec, zeros_vec, v2_vec)
+    in_bound_indices = torch.nonzero(v2_vec)
+    if in_bound_indices.dim() == 0:
+        return (None, None)
+    in_bound_indices = in_bound_indices.squeeze(1)
+
+    # apply pruning
+    u2_vec = torch.index_select(u2_vec, 0, in_bound_indices)
+    v2_vec = torch.index_select(v2_vec, 0, in_bound_indices)
+    z2_vec = torch.index_select(z2_vec, 0, in_bound_indices)
+    u_a_pruned = torch.index_select(
+        u_a_pruned, 0, in_bound_indices
+    )  # also prune from first list
+    v_a_pruned = torch.index_select(
+        v_a_pruned, 0, in_bound_indices
+    )  # also prune from first list
+
+    # Prune based on
+    # Case 3: the pixels in image b are occluded, OR there is no depth return
+    # in image b so we aren't sure
+
+    img_b_depth_torch = torch.from_numpy(img_b_depth).type(dtype_float)
+    img_b_depth_torch = torch.squeeze(img_b_depth_torch, 0)
+    img_b_depth_torch = img_b_depth_torch.view(-1, 1)
+
+    uv_b_vec_flattened = v2_vec.type(dtype_long) * image_width + u2_vec.type(
+        dtype_long
+    )  # simply round to int -- good enough
+    # occlusion check for smooth surfaces
+    depth2_vec = (
+        torch.index_select(img_b_depth_torch, 0, uv_b_vec_flattened) * 1.0 / 1000
+    )
+    depth2_vec = depth2_vec.squeeze(1)
+
+    # occlusion margin, in meters
+    occlusion_margin = 0.003
+    z2_vec = z2_vec - occlusion_margin
+    zeros_vec = torch.zeros_like(depth2_vec)
+
+    depth2_vec = where(
+        depth2_vec < zeros_vec, zeros_vec, depth2_vec
+    )  # to be careful, prune any negative depths
+    depth2_vec = where(depth2_vec < z2_vec, zeros_vec, depth2_vec)  # prune occlusions
+    non_occluded_indices = torch.nonzero(depth2_vec)
+    if non_occluded_indices.dim() == 0:
+        return (None, None)
+    non_occluded_indices = non_occluded_indices.squeeze(1)
+    depth2_vec = torch.index_select(depth2_vec, 0, non_occluded_indices)
+
+    # apply pruning
+    u2_vec = torch.index_select(u2_vec, 0, non_occluded_indices)
+    v2_vec = torch.index_select(v2_vec, 0, non_occluded_indices)
+    u_a_pruned = torch.index_select(
+        u_a_pruned, 0, non_occluded_indices
+    )  # also prune from first list
+    v_a_pruned = torch.index_select(
+        v_a_pruned, 0, non_occluded_indices
+    )  # also prune from first list
+
+    uv_b_vec = (u2_vec, v2_vec)
+    uv_a_vec = (u_a_pruned, v_a_pruned)
+    return (uv_a_vec, uv_b_vec)
+
+
+def make_synthetic_pair(image_height=480, image_width=640):
+    """
+    :return: depth a, pose a, depth b, pose b
+    :rtype: [H,W] uint16, 4x4 numpy array, [H,W] uint16, 4x4 numpy array
+    """
+    depth = np.full((image_height, image_width), 1000, dtype=np.uint16)
+    depth[200:260, 300:400] = 800
+    depth[0:20, :] = 0  # no depth return
+
+    pose_a = np.eye(4)
+    pose_b = np.eye(4)
+    angle = np.deg2rad(10)
+    pose_b[0:3, 0:3] = np.array(
+        [
+            [np.cos(angle), 0, np.sin(angle)],
+            [0, 1, 0],
+            [-np.sin(angle), 0, np.cos(angle)],
+        ]
+    )
+    pose_b[0:3, 3] = [0.15, 0.05, 0.0]
+    return depth, pose_a, depth.copy(), pose_b
+
+
+def time_function(function, args, repeats):
+    """
+    :return: median time of a call, in seconds
+    :rtype: float
+    """
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start_time)
+    return float(np.median(timings))
+
+
+def check_identical(result_staged, result_fused):
+    """
+    The matches have to be the same pixels. Their positions in image b can
+    differ by float32 rounding, the staged version back-projects with a K_inv
+    matrix multiply and the fused one with precomputed rays.
+    """
+    (u_a, v_a), (u_b, v_b) = result_staged
+    (u_a_fused, v_a_fused), (u_b_fused, v_b_fused) = result_fused
+    for x, y in [(u_a, u_a_fused), (v_a, v_a_fused)]:
+        if (x.dtype != y.dtype) or not torch.equal(x, y):
+            raise ValueError("fused and staged correspondences differ")
+    for x, y in [(u_b, u_b_fused), (v_b, v_b_fused)]:
+        if (x.dtype != y.dtype) or not torch.allclose(x, y, rtol=0, atol=1e-3):
+            raise ValueError("fused and staged correspondences differ")
+
+
+def run_benchmark(num_attempts_list, repeats, seed=0):
+    img_a_depth, img_a_pose, img_b_depth, img_b_pose = make_synthetic_pair()
+    image_height, image_width = img_a_depth.shape
+    torch.manual_seed(seed)
+
+    print(
+        "%12s %12s %12s %10s %10s"
+        % ("attempts", "staged (ms)", "fused (ms)", "speedup", "matches")
+    )
+    for num_attempts in num_attempts_list:
+        uv_a_vec = correspondence_finder.pytorch_rand_select_pixel(
+            image_width, image_height, num_samples=num_attempts
+        )
+        args = (img_a_depth, img_a_pose, img_b_depth, img_b_pose, uv_a_vec)
+
+        result_staged = compute_correspondences_for_pixels_staged(*args)
+        result_fused = correspondence_finder.compute_correspondences_for_pixels(*args)
+        check_identical(result_staged, result_fused)
+
+        staged = time_function(compute_correspondences_for_pixels_staged, args, repeats)
+        fused = time_function(
+            correspondence_finder.compute_correspondences_for_pixels, args, repeats
+        )
+        print(
+            "%12d %12.3f %12.3f %9.2fx %10d"
+            % (
+                num_attempts,
+                staged * 1e3,
+                fused * 1e3,
+                staged / fused,
+                len(result_fused[0][0]),
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--num_attempts", type=int, nargs="+", default=[20, 1000, 50000]
+    )
+    parser.add_argument("--repeats", type=int, default=200)
+    parser.add_argument("--num_threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    run_benchmark(args.num_attempts, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
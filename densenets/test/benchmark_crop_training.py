@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""
+Measures the training throughput on random crops around the object against
+the crop size, see crop_size and crop_scale in training.yaml.
+
+For the full images and for each crop size this draws batches from a
+SpartanDataset and runs training steps of the network of training.yaml on
+them: forward of both images, get_batch_loss, backward and an optimizer step.
+It prints, in images per second (two per sample), the throughput of sampling
+and collating batches and of the training steps, and the mean number of
+matches per non-empty sample. The network doesn't load trained parameters.
+
+Usage:
+
+    benchmark_crop_training.py --dataset_config <composite dataset yaml> \
+        [--training_config <training yaml>] \
+        [--crop_sizes full 480x360 320x240 160x120] [--crop_scale 1.0] \
+        [--batch_size 4] [--num_batches 10] [--device cpu] [--seed 0]
+"""
+
+import argparse
+import os
+import random
+import time
+
+import densenets.dense_correspondence_manipulation.utils.utils as utils
+import densenets.loss_functions.loss_composer as loss_composer
+import numpy as np
+import torch
+from densenets.dataset.collate import collate_matches
+from densenets.dataset.spartan_dataset_masked import SpartanDataset
+from densenets.loss_functions.pixelwise_contrastive_loss import (
+    PixelwiseContrastiveLoss,
+)
+from densenets.network.dense_correspondence_network import (
+    DenseCorrespondenceNetwork,
+)
+
+
+def parse_crop_size(crop_size):
+    """
+    :param crop_size: "full" or "<width>x<height>"
+    :type crop_size: str
+    :return: [width, height], None for the full images
+    :rtype: list or None
+    """
+    if crop_size == "full":
+        return None
+    return [int(x) for x in crop_size.split("x")]
+
+
+def draw_batches(dataset, batch_size, num_batches):
+    """
+    :return: the collated batches and the time it took to draw them
+    :rtype: list, float
+    """
+    start_time = time.perf_counter()
+    batches = [
+        collate_matches([dataset[0] for _ in range(batch_size)])
+        for _ in range(num_batches)
+    ]
+    return batches, time.perf_counter() - start_time
+
+
+def train_on_batches(dcn, optimizer, pixelwise_contrastive_loss, batches, device):
+    """
+    :return: the time of the training steps on all batches
+    :rtype: float
+    """
+    image_shape = [
+        pixelwise_contrastive_loss.image_height,
+        pixelwise_contrastive_loss.image_width,
+    ]
+    elapsed = 0.0
+    for batch in batches:
+        match_type, img_a, img_b = batch[0:3]
+        if (match_type == -1).all():
+            continue
+        start_time = time.perf_counter()
+        img_a = img_a.to(device)
+        img_b = img_b.to(device)
+        packed_indices = [
+            (values.to(device), offsets) for values, offsets in batch[3:11]
+        ]
+
+        optimizer.zero_grad()
+        image_a_pred = dcn.process_network_output(
+            dcn.forward(img_a), len(match_type), image_shape=image_shape
+        )
+        image_b_pred = dcn.process_network_output(
+            dcn.forward(img_b), len(match_type), image_shape=image_shape
+        )
+        loss = loss_composer.get_batch_loss(
+            pixelwise_contrastive_loss,
+            match_type,
+            image_a_pred,
+            image_b_pred,
+            packed_indices,
+        )[0]
+        loss.backward()
+        optimizer.step()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed += time.perf_counter() - start_time
+    return elapsed
+
+
+def mean_num_matches(batches):
+    """
+    :return: mean number of matches of the non-empty samples
+    :rtype: float
+    """
+    num_matches = []
+    for batch in batches:
+        match_type = batch[0]
+        _, offsets = batch[3]
+        lengths = offsets[1:] - offsets[:-1]
+        num_matches.extend(lengths[match_type != -1].tolist())
+    return float(np.mean(num_matches)) if len(num_matches) > 0 else 0.0
+
+
+def run_benchmark(
+    dataset_config,
+    training_config,
+    crop_sizes,
+    crop_scale,
+    batch_size,
+    num_batches,
+    device,
+    seed,
+):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    device = torch.device(device)
+
+    training_config = utils.getDictFromYamlFilename(training_config)
+    training_config['training']['crop_scale'] = crop_scale
+    dataset = SpartanDataset(config=utils.getDictFromYamlFilename(dataset_config))
+    dataset.load_all_pose_data()
+
+    dcn = DenseCorrespondenceNetwork.from_config(
+        training_config['dense_correspondence_network'],
+        load_stored_params=False,
+        device=device,
+    )
+    dcn.to(device)
+    dcn.train()
+    optimizer = torch.optim.Adam(
+        dcn.parameters(), lr=float(training_config['training']['learning_rate'])
+    )
+
+    print(
+        "%10s %14s %18s %18s %10s"
+        % ("crop", "image size", "sampling (img/s)", "training (img/s)", "matches")
+    )
+    for crop_size in crop_sizes:
+        training_config['training']['crop_size'] = parse_crop_size(crop_size)
+        dataset.set_parameters_from_training_config(training_config)
+        image_shape = dcn.image_shape
+        if dataset.pair_crop is not None:
+            image_shape = dataset.pair_crop.image_shape
+        pixelwise_contrastive_loss = PixelwiseContrastiveLoss(
+            image_shape=image_shape, config=training_config['loss_function']
+        )
+
+        # a first batch to warm up the network
+        batches, _ = draw_batches(dataset, batch_size, 1)
+        train_on_batches(dcn, optimizer, pixelwise_contrastive_loss, batches, device)
+
+        batches, sampling_time = draw_batches(dataset, batch_size, num_batches)
+        training_time = train_on_batches(
+            dcn, optimizer, pixelwise_contrastive_loss, batches, device
+        )
+        num_images = 2 * batch_size * num_batches
+        print(
+            "%10s %14s %18.1f %18.1f %10.1f"
+            % (
+                crop_size,
+                "%dx%d" % (image_shape[1], image_shape[0]),
+                num_images / sampling_time,
+                num_images / training_time if training_time > 0 else 0.0,
+                mean_num_matches(batches),
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset_config", type=str, required=True)
+    parser.add_argument(
+        "--training_config",
+        type=str,
+        default=os.path.join(
+            utils.getDenseCorrespondenceSourceDir(),
+            "config",
+            "dense_correspondence",
+            "training",
+            "training.yaml",
+        ),
+    )
+    parser.add_argument(
+        "--crop_sizes",
+        type=str,
+        nargs="+",
+        default=["full", "480x360", "320x240", "160x120"],
+        help='"full" or <width>x<height>',
+    )
+    parser.add_argument("--crop_scale", type=float, default=1.0)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--num_batches", type=int, default=10)
+    parser.add_argument(
+        "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run_benchmark(
+        args.dataset_config,
+        args.training_config,
+        args.crop_sizes,
+        args.crop_scale,
+        args.batch_size,
+        args.num_batches,
+        args.device,
+        args.seed,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+Measures what the DataLoader workers hand to the training process per batch,
+with the pixel indices of the samples as int64, as they were, and as int32,
+see PIXEL_INDEX_DTYPE in dense_correspondence_dataset_masked.py.
+
+Draws batches of each SpartanDatasetDataType from a dataset and prints per
+batch, see collate.get_payload_nbytes, the bytes of the images and of the
+index lists, the fraction of the payload that the indices are and the median
+time to move the batch into shared memory, which is what a worker does before
+it sends the batch through its queue.
+
+Usage:
+
+    benchmark_index_payload.py --dataset_config <composite dataset yaml> \
+        [--training_config <training yaml>] [--batch_size 4] [--num_batches 5] \
+        [--seed 0]
+"""
+
+import argparse
+import os
+import random
+import time
+
+import densenets.dense_correspondence_manipulation.utils.utils as utils
+import numpy as np
+import torch
+from densenets.dataset.collate import (
+    INDEX_FIELDS,
+    collate_matches,
+    get_payload_nbytes,
+)
+from densenets.dataset.spartan_dataset_masked import (
+    SpartanDataset,
+    SpartanDatasetDataType,
+)
+
+DATA_TYPES = [
+    ("SINGLE_OBJECT_WITHIN_SCENE", SpartanDatasetDataType.SINGLE_OBJECT_WITHIN_SCENE),
+    ("SINGLE_OBJECT_ACROSS_SCENE", SpartanDatasetDataType.SINGLE_OBJECT_ACROSS_SCENE),
+    ("DIFFERENT_OBJECT", SpartanDatasetDataType.DIFFERENT_OBJECT),
+    ("MULTI_OBJECT", SpartanDatasetDataType.MULTI_OBJECT),
+    ("SYNTHETIC_MULTI_OBJECT", SpartanDatasetDataType.SYNTHETIC_MULTI_OBJECT),
+]
+
+
+def as_int64(batch):
+    """
+    :return: the batch with int64 index values, as collated before int32
+    :rtype: tuple
+    """
+    batch = list(batch)
+    for field in INDEX_FIELDS:
+        values, offsets = batch[field]
+        batch[field] = (values.long(), offsets)
+    return tuple(batch)
+
+
+def time_share_memory(batch, repeats=5):
+    """
+    :return: median time to move copies of the tensors of the batch into
+             shared memory
+    :rtype: float
+    """
+    tensors = [batch[1], batch[2]] + [batch[field][0] for field in INDEX_FIELDS]
+    timings = []
+    for _ in range(repeats):
+        copies = [x.clone() for x in tensors]
+        start_time = time.perf_counter()
+        for x in copies:
+            x.share_memory_()
+        timings.append(time.perf_counter() - start_time)
+    return float(np.median(timings))
+
+
+def run_benchmark(dataset_config, training_config, batch_size, num_batches, seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    dataset = SpartanDataset(config=utils.getDictFromYamlFilename(dataset_config))
+    dataset.load_all_pose_data()
+    dataset.set_parameters_from_training_config(
+        utils.getDictFromYamlFilename(training_config)
+    )
+
+    print(
+        "%28s %6s %12s %13s %11s %11s"
+        % (
+            "data type",
+            "dtype",
+            "images (MB)",
+            "indices (MB)",
+            "of payload",
+            "share (ms)",
+        )
+    )
+    for name, data_type in DATA_TYPES:
+        batches = [
+            collate_matches(
+                [dataset.get_data_of_type(data_type) for _ in range(batch_size)]
+            )
+            for _ in range(num_batches)
+        ]
+        for encoding, convert in (("int64", as_int64), ("int32", lambda x: x)):
+            converted = [convert(batch) for batch in batches]
+            payloads = [get_payload_nbytes(batch) for batch in converted]
+            image_bytes = np.mean([x['images'] for x in payloads])
+            index_bytes = np.mean([x['indices'] for x in payloads])
+            total_bytes = np.mean([x['total'] for x in payloads])
+            share_time = np.mean([time_share_memory(batch) for batch in converted])
+            print(
+                "%28s %6s %12.2f %13.2f %10.1f%% %11.3f"
+                % (
+                    name,
+                    encoding,
+                    image_bytes / 1e6,
+                    index_bytes / 1e6,
+                    100.0 * index_bytes / total_bytes,
+                    share_time * 1e3,
+                )
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset_config", type=str, required=True)
+    parser.add_argument(
+        "--training_config",
+        type=str,
+        default=os.path.join(
+            utils.getDenseCorrespondenceSourceDir(),
+            "config",
+            "dense_correspondence",
+            "training",
+            "training.yaml",
+        ),
+    )
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--num_batches", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run_benchmark(
+        args.dataset_config,
+        args.training_config,
+        args.batch_size,
+        args.num_batches,
+        args.seed,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""
+Compares the occlusion tests of correspondence finding, see OcclusionMode in
+correspondence_finder and occlusion_mode in training.yaml.
+
+The depth images are ray cast from a scene with known geometry: a plane
+slanted by a given angle away from camera a, with a square in front of it,
+seen from two camera poses. Every pixel of image a is projected into image b
+and the ground truth depth of image b is ray cast at exactly the projected
+position, so every attempt in view of image b is known to be visible or
+occluded. For each mode and slant this prints:
+
+- yield: the fraction of attempts that become matches, i.e. the number of
+  matches per num_matching_attempts
+- rejected: the fraction of the visible pixels that the test drops as occluded
+- accepted: the fraction of the occluded pixels that the test keeps as matches
+- the time of one sample of num_attempts pixels, for both backends
+
+Usage:
+
+    benchmark_occlusion_modes.py [--slants -75 -60 -45 0 45 60 75] \
+        [--num_attempts 10000] [--repeats 50]
+"""
+
+import argparse
+
+import densenets.correspondence_tools.correspondence_finder as correspondence_finder
+import densenets.correspondence_tools.correspondence_finder_numpy as correspondence_finder_numpy
+import numpy as np
+import torch
+from densenets.correspondence_tools.correspondence_finder import (
+    FlowStatus,
+    OcclusionMode,
+)
+from densenets.correspondence_tools.projection_context import get_default_K_matrix
+from densenets.test.benchmark_correspondence_finder import time_function
+
+MODES = [OcclusionMode.NEAREST, OcclusionMode.BILINEAR]
+
+BACKENDS = [
+    ("torch", correspondence_finder),
+    ("numpy", correspondence_finder_numpy),
+]
+
+# ground truth: visible if the projected point is within VISIBLE_TOLERANCE of
+# the surface of image b, occluded if more than OCCLUDED_TOLERANCE behind it,
+# in meters. The depth images are quantized to millimeters.
+VISIBLE_TOLERANCE = 0.002
+OCCLUDED_TOLERANCE = 0.005
+
+
+def rotation_y(angle):
+    """
+    :param angle: in radians
+    :return: 3 x 3 rotation about the y axis
+    :rtype: numpy.ndarray
+    """
+    return np.array(
+        [
+            [np.cos(angle), 0, np.sin(angle)],
+            [0, 1, 0],
+            [-np.sin(angle), 0, np.cos(angle)],
+        ]
+    )
+
+
+class SlantedPlaneScene(object):
+    """
+    A plane through (0, 0, 1) whose normal is the optical axis of camera a
+    rotated by slant about the y axis, and a 0.2 m square at depth 0.7 in
+    front of it, facing camera a. All in the world frame, which is the
+    right-down-forward frame of camera a.
+    """
+
+    def __init__(self, slant_degrees):
+        self.plane_point = np.array([0.0, 0.0, 1.0])
+        self.plane_normal = rotation_y(np.deg2rad(slant_degrees)).dot([0, 0, -1.0])
+        self.square_depth = 0.7
+        self.square_center = np.array([0.02, 0.03])
+        self.square_half_size = 0.1
+
+    def ray_cast(self, pose, u_vec, v_vec, K):
+        """
+        :param pose: camera_to_world pose of the camera
+        :param u_vec, v_vec: pixel coordinates, of any shape
+        :return: depth in camera frame of the first surface hit along the ray
+                 through each (u, v), inf where none is hit
+        :rtype: numpy.ndarray
+        """
+        rays = np.linalg.inv(K).dot(
+            np.stack((u_vec.ravel(), v_vec.ravel(), np.ones(u_vec.size)))
+        )
+        directions = pose[0:3, 0:3].dot(rays)
+        origin = pose[0:3, 3:4]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            plane_depth = self.plane_normal.dot(
+                self.plane_point[:, None] - origin
+            ) / self.plane_normal.dot(directions)
+            square_depth = (self.square_depth - origin[2]) / directions[2]
+        square_points = origin[0:2] + square_depth * directions[0:2]
+        square_offsets = np.abs(square_points - self.square_center[:, None])
+        on_square = np.all(square_offsets <= self.square_half_size, axis=0)
+
+        depth = np.full(u_vec.size, np.inf)
+        for surface_depth, hit in [
+            (plane_depth, plane_depth > 0),
+            (square_depth, on_square & (square_depth > 0)),
+        ]:
+            depth = np.where(hit, np.minimum(depth, surface_depth), depth)
+        return depth.reshape(u_vec.shape)
+
+    def render(self, pose, K, image_height=480, image_width=640):
+        """
+        :return: depth image in millimeters, 0 where nothing is hit
+        :rtype: numpy.ndarray [H, W] uint16
+        """
+        v, u = np.mgrid[0:image_height, 0:image_width].astype(np.float64)
+        depth = self.ray_cast(pose, u, v, K)
+        depth = np.where(np.isfinite(depth), np.round(depth * 1000), 0)
+        return np.clip(depth, 0, np.iinfo(np.uint16).max).astype(np.uint16)
+
+
+def make_frames(scene, K):
+    """
+    :return: depth a, pose a, depth b, pose b
+    :rtype: tuple
+    """
+    pose_a = np.eye(4)
+    pose_b = np.eye(4)
+    pose_b[0:3, 0:3] = rotation_y(np.deg2rad(-12))
+    pose_b[0:3, 3] = [0.2, 0.03, 0.02]
+    return (scene.render(pose_a, K), pose_a, scene.render(pose_b, K), pose_b)
+
+
+def evaluate_mode(scene, frames, K, occlusion_mode):
+    """
+    Computes the flow field of image a with the torch backend and compares its
+    matches against the ground truth visibility
+    :return: yield, fraction of visible pixels rejected, fraction of occluded
+             pixels accepted
+    :rtype: float, float, float
+    """
+    img_a_depth, img_a_pose, img_b_depth, img_b_pose = frames
+    image_height, image_width = img_a_depth.shape
+    uv_b, status = correspondence_finder.compute_flow_field(
+        *frames, K=K, occlusion_mode=occlusion_mode
+    )
+    status = status.numpy()
+    candidates = (status == FlowStatus.VALID) | (status == FlowStatus.OCCLUDED)
+    u2 = uv_b[0].numpy()[candidates].astype(np.float64)
+    v2 = uv_b[1].numpy()[candidates].astype(np.float64)
+    accepted = status[candidates] == FlowStatus.VALID
+
+    # depth along the optical axis of camera b of the back-projected points
+    v_a, u_a = np.nonzero(candidates)
+    depth_a = img_a_depth[candidates] / 1000.0
+    rays_a = np.linalg.inv(K).dot(np.stack((u_a, v_a, np.ones(len(u_a)))))
+    points = img_a_pose[0:3, 0:3].dot(rays_a * depth_a) + img_a_pose[0:3, 3:4]
+    world_to_b = np.linalg.inv(img_b_pose)
+    z2 = world_to_b[2, 0:3].dot(points) + world_to_b[2, 3]
+
+    true_depth = scene.ray_cast(img_b_pose, u2, v2, K)
+    visible = np.abs(true_depth - z2) <= VISIBLE_TOLERANCE
+    occluded = true_depth < z2 - OCCLUDED_TOLERANCE
+
+    match_yield = accepted.sum() / float(image_height * image_width)
+    rejected = (~accepted & visible).sum() / float(max(visible.sum(), 1))
+    false_accepted = (accepted & occluded).sum() / float(max(occluded.sum(), 1))
+    return match_yield, rejected, false_accepted
+
+
+def run_benchmark(slants, num_attempts, repeats, seed=0):
+    K = get_default_K_matrix()
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+
+    print(
+        "%6s %10s %8s %9s %9s %11s %11s"
+        % ("slant", "mode", "yield", "rejected", "accepted", "torch (ms)", "numpy (ms)")
+    )
+    for slant in slants:
+        scene = SlantedPlaneScene(slant)
+        frames = make_frames(scene, K)
+        for occlusion_mode in MODES:
+            match_yield, rejected, accepted = evaluate_mode(
+                scene, frames, K, occlusion_mode
+            )
+            timings = []
+            for _, finder in BACKENDS:
+
+                def sample():
+                    return finder.batch_find_pixel_correspondences(
+                        *frames,
+                        num_attempts=num_attempts,
+                        K=K,
+                        occlusion_mode=occlusion_mode,
+                    )
+
+                timings.append(time_function(sample, (), repeats))
+            print(
+                "%6d %10s %8.3f %8.2f%% %8.2f%% %11.3f %11.3f"
+                % (
+                    slant,
+                    occlusion_mode,
+                    match_yield,
+                    rejected * 100,
+                    accepted * 100,
+                    timings[0] * 1e3,
+                    timings[1] * 1e3,
+                )
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--slants", type=int, nargs="+", default=[-75, -60, -45, 0, 45, 60, 75]
+    )
+    parser.add_argument("--num_attempts", type=int, default=10000)
+    parser.add_argument("--repeats", type=int, default=50)
+    args = parser.parse_args()
+    run_benchmark(args.slants, args.num_attempts, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""
+Differential test of the correspondence finding backends against the one pixel
+at a time float64 reference in numpy_correspondence_finder.py, on synthetic
+pairs of depth images, so that changes to the finders can be checked without
+a dataset.
+
+The pairs are ray cast from slanted plane scenes, see
+benchmark_occlusion_modes.py, with random slants and camera poses. The same
+num_attempts pixels of image a of each pair are given to every backend:
+
+- torch: correspondence_finder.compute_correspondences_for_pixels, float32
+- torch_float64: the same in float64
+- numpy: correspondence_finder_numpy.compute_correspondences_for_pixels
+- pairs: correspondence_finder.batch_find_pixel_correspondences_for_pairs,
+  all pairs in a single call
+
+For every backend this prints the number of matches, the pixels of image a on
+which it disagrees with the reference about being a match, the largest
+difference of the matched positions in image b and the throughput in pairs
+per second. Float32 rounding can flip the tests for pixels right at their
+thresholds, so up to MAX_DISAGREEMENT of the attempts may disagree. Exits with
+an error if a backend is out of tolerance.
+
+Usage:
+
+    compare_correspondence_finders.py [--num_pairs 20] [--num_attempts 2000] \
+        [--seed 0]
+"""
+
+import argparse
+import time
+
+import densenets.correspondence_tools.correspondence_finder as correspondence_finder
+import densenets.correspondence_tools.correspondence_finder_numpy as correspondence_finder_numpy
+import densenets.test.numpy_correspondence_finder as numpy_correspondence_finder
+import numpy as np
+import torch
+from densenets.correspondence_tools.projection_context import get_default_K_matrix
+from densenets.test.benchmark_correspondence_finder import make_synthetic_pair
+from densenets.test.benchmark_occlusion_modes import SlantedPlaneScene, rotation_y
+
+# fraction of the attempted pixels on which a backend may disagree with the
+# reference about being a match
+MAX_DISAGREEMENT = 1e-3
+
+# largest difference to the reference of a position in image b, in pixels
+POSITION_TOLERANCE = 1e-2
+
+
+def make_random_pair(rng, K):
+    """
+    :param rng: random generator for the slant and the camera poses
+    :type rng: numpy.random.RandomState
+    :return: depth a, pose a, depth b, pose b
+    :rtype: tuple
+    """
+    scene = SlantedPlaneScene(rng.uniform(-75, 75))
+    poses = []
+    for max_angle, max_translation in [(5, 0.05), (20, 0.2)]:
+        pose = np.eye(4)
+        pose[0:3, 0:3] = rotation_y(np.deg2rad(rng.uniform(-max_angle, max_angle)))
+        pose[0:3, 3] = rng.uniform(-max_translation, max_translation, 3)
+        poses.append(pose)
+    pose_a, pose_b = poses
+    return (scene.render(pose_a, K), pose_a, scene.render(pose_b, K), pose_b)
+
+
+def make_pairs(num_pairs, num_attempts, seed, K):
+    """
+    :return: (frames, uv_a_vec) of each pair, uv_a_vec being num_attempts
+             distinct pixels of image a in flattened order, as torch.LongTensors
+    :rtype: list of tuples
+    """
+    rng = np.random.RandomState(seed)
+    pairs = []
+    for i in range(num_pairs):
+        if i == 0:
+            frames = make_synthetic_pair()
+        else:
+            frames = make_random_pair(rng, K)
+        image_height, image_width = frames[0].shape
+        flat = np.sort(
+            rng.choice(image_height * image_width, num_attempts, replace=False)
+        )
+        flat = torch.from_numpy(flat)
+        pairs.append((frames, (flat % image_width, flat // image_width)))
+    return pairs
+
+
+def run_reference(pairs, K):
+    results = []
+    for frames, uv_a_vec in pairs:
+        uv_a_list = list(zip(uv_a_vec[0].tolist(), uv_a_vec[1].tolist()))
+        results.append(
+            numpy_correspondence_finder.find_pixel_correspondences_for_frames(
+                *(frames + (uv_a_list, K))
+            )
+        )
+    return results
+
+
+def run_finder(finder, **kwargs):
+    def run(pairs, K):
+        return [
+            finder.compute_correspondences_for_pixels(
+                *(frames + (uv_a_vec,)), K=K, **kwargs
+            )
+            for frames, uv_a_vec in pairs
+        ]
+
+    return run
+
+
+def run_pairs(pairs, K):
+    """
+    All pairs in one batch_find_pixel_correspondences_for_pairs call, the
+    pixels of image a are given as its masks
+    """
+    depths = np.stack([x for frames, _ in pairs for x in (frames[0], frames[2])])
+    poses = np.stack([x for frames, _ in pairs for x in (frames[1], frames[3])])
+    masks = np.zeros(depths.shape, dtype=bool)
+    for i, (_, uv_a_vec) in enumerate(pairs):
+        masks[2 * i, uv_a_vec[1].numpy(), uv_a_vec[0].numpy()] = True
+
+    frame_pairs = [(2 * i, 2 * i + 1) for i in range(len(pairs))]
+    (
+        uv_a,
+        uv_b,
+        offsets,
+    ) = correspondence_finder.batch_find_pixel_correspondences_for_pairs(
+        depths, poses, frame_pairs, masks=masks, K=K
+    )
+    results = []
+    for start, stop in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+        results.append(
+            (
+                (uv_a[0][start:stop], uv_a[1][start:stop]),
+                (uv_b[0][start:stop], uv_b[1][start:stop]),
+            )
+        )
+    return results
+
+
+BACKENDS = [
+    ("torch", run_finder(correspondence_finder)),
+    ("torch_float64", run_finder(correspondence_finder, dtype=torch.float64)),
+    ("numpy", run_finder(correspondence_finder_numpy)),
+    ("pairs", run_pairs),
+]
+
+
+def to_numpy(result, image_width):
+    """
+    :return: flattened matched pixels of image a and their [N, 2] positions
+             in image b
+    :rtype: numpy.ndarray, numpy.ndarray
+    """
+    (u_a, v_a), (u_b, v_b) = result
+    flat_a = np.asarray(v_a, dtype=np.int64) * image_width + np.asarray(
+        u_a, dtype=np.int64
+    )
+    uv_b = np.stack((np.asarray(u_b, np.float64), np.asarray(v_b, np.float64)), 1)
+    return flat_a, uv_b
+
+
+def compare(pairs, results, reference_results):
+    """
+    :return: number of matches, of pixels on which the backend and the
+             reference disagree and the largest position difference
+    :rtype: int, int, float
+    """
+    num_matches = 0
+    num_disagreements = 0
+    max_difference = 0.0
+    for (frames, _), result, reference in zip(pairs, results, reference_results):
+        image_width = frames[0].shape[1]
+        flat_a, uv_b = to_numpy(result, image_width)
+        reference_flat_a, reference_uv_b = to_numpy(reference, image_width)
+        num_matches += len(flat_a)
+        num_disagreements += len(np.setxor1d(flat_a, reference_flat_a))
+
+        _, rows, reference_rows = np.intersect1d(
+            flat_a, reference_flat_a, assume_unique=True, return_indices=True
+        )
+        if len(rows) > 0:
+            difference = np.abs(uv_b[rows] - reference_uv_b[reference_rows]).max()
+            max_difference = max(max_difference, float(difference))
+    return num_matches, num_disagreements, max_difference
+
+
+def run_comparison(num_pairs, num_attempts, seed):
+    K = get_default_K_matrix()
+    pairs = make_pairs(num_pairs, num_attempts, seed, K)
+    num_attempts_total = num_pairs * num_attempts
+
+    start_time = time.perf_counter()
+    reference_results = run_reference(pairs, K)
+    reference_time = time.perf_counter() - start_time
+
+    print(
+        "%14s %10s %10s %12s %12s"
+        % ("backend", "matches", "disagree", "max |duv|", "pairs/s")
+    )
+    num_reference_matches = sum(len(uv_a[0]) for uv_a, _ in reference_results)
+    print(
+        "%14s %10d %10s %12s %12.1f"
+        % ("reference", num_reference_matches, "-", "-", num_pairs / reference_time)
+    )
+
+    failures = []
+    for name, run in BACKENDS:
+        run(pairs[0:1], K)  # warm up
+        start_time = time.perf_counter()
+        results = run(pairs, K)
+        elapsed = time.perf_counter() - start_time
+
+        num_matches, num_disagreements, max_difference = compare(
+            pairs, results, reference_results
+        )
+        print(
+            "%14s %10d %10d %12.2e %12.1f"
+            % (
+                name,
+                num_matches,
+                num_disagreements,
+                max_difference,
+                num_pairs / elapsed,
+            )
+        )
+        if num_disagreements > MAX_DISAGREEMENT * num_attempts_total:
+            failures.append("%s disagrees on %d pixels" % (name, num_disagreements))
+        if max_difference > POSITION_TOLERANCE:
+            failures.append("%s positions differ by %g" % (name, max_difference))
+
+    if failures:
+        raise ValueError("; ".join(failures))
+    print("all backends agree with the reference")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_pairs", type=int, default=20)
+    parser.add_argument("--num_attempts", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run_comparison(args.num_pairs, args.num_attempts, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,129 +1,223 @@
-# io
-import imageio
+"""
+Reference implementation of the correspondence finding of
+correspondence_finder, one pixel at a time in float64 numpy. It is slow and
+kept simple on purpose, as the ground truth that the batched backends are
+checked against, see compare_correspondence_finders.py.
+"""
 
-# math
-import numpy as numpy
 import math
 import random
+
+import densenets.dense_correspondence_manipulation.utils.constants as constants
+import numpy as np
 from numpy.linalg import inv
+from PIL import Image
+
+# occlusion margin, in meters
+OCCLUSION_MARGIN = 0.003
+
+_EPS = np.finfo(float).eps * 4.0
+
+
+def get_labelfusion_K_matrix():
+    K = np.zeros((3, 3))
+    K[0, 0] = 528.0  # focal x
+    K[1, 1] = 528.0  # focal y
+    K[0, 2] = 320.0  # principal point x
+    K[1, 2] = 240.0  # principal point y
+    K[2, 2] = 1.0
+    return K
+
+
+def rand_select_pixel(width, height):
+    u = random.randint(0, width - 1)
+    v = random.randint(0, height - 1)
+    return (u, v)
+
+
+def quaternion_matrix(quaternion):
+    """
+    :param quaternion: (w, x, y, z)
+    :return: 4 x 4 homogeneous rotation
+    :rtype: numpy.ndarray
+    """
+    q = np.array(quaternion, dtype=np.float64, copy=True)
+    n = np.dot(q, q)
+    if n < _EPS:
+        return np.identity(4)
+    q *= math.sqrt(2.0 / n)
+    q = np.outer(q, q)
+    return np.array(
+        [
+            [1.0 - q[2, 2] - q[3, 3], q[1, 2] - q[3, 0], q[1, 3] + q[2, 0], 0.0],
+            [q[1, 2] + q[3, 0], 1.0 - q[1, 1] - q[3, 3], q[2, 3] - q[1, 0], 0.0],
+            [q[1, 3] - q[2, 0], q[2, 3] + q[1, 0], 1.0 - q[1, 1] - q[2, 2], 0.0],
+            [0.0, 0.0, 0.0, 1.0],
+        ]
+    )
+
+
+def labelfusion_pose_to_homogeneous_transform(lf_pose):
+    """
+    :param lf_pose: x, y, z, qx, qy, qz, qw
+    :return: 4 x 4 homogeneous transform
+    :rtype: numpy.ndarray
+    """
+    homogeneous_transform = quaternion_matrix(
+        [lf_pose[6], lf_pose[3], lf_pose[4], lf_pose[5]]
+    )
+    homogeneous_transform[0:3, 3] = lf_pose[0:3]
+    return homogeneous_transform
+
+
+def invert_transform(transform4):
+    R = transform4[0:3, 0:3]
+    t = transform4[0:3, 3]
+    inverse = np.identity(4)
+    inverse[0:3, 0:3] = R.T
+    inverse[0:3, 3] = -R.T.dot(t)
+    return inverse
+
+
+def apply_transform(vec3, transform4):
+    return transform4[0:3, 0:3].dot(vec3) + transform4[0:3, 3]
+
+
+def reproject_pixel(img_a_depth, img_a_pose, img_b_pose, uv_a, K):
+    """
+    :param img_a_depth: depth image a, in millimeters
+    :type img_a_depth: numpy.ndarray [H, W]
+    :param img_a_pose, img_b_pose: camera_to_world poses, 4 x 4
+    :type img_a_pose, img_b_pose: numpy.ndarray
+    :param uv_a: pixel of image a
+    :type uv_a: (int, int)
+    :param K: 3 x 3 camera intrinsics matrix
+    :type K: numpy.ndarray
+    :return: (u2, v2, z2), the position of the pixel in image b and its depth
+             in camera b, None if it has no depth return in image a
+    :rtype: tuple of floats
+    """
+    u, v = uv_a
+    depth = img_a_depth[v, u] * 1.0 / constants.DEPTH_IM_SCALE
+    if depth == 0:
+        return None
+
+    point_camera_frame_rdf = inv(K).dot(np.array([u * depth, v * depth, depth]))
+    point_world_frame_rdf = apply_transform(point_camera_frame_rdf, img_a_pose)
+    point_camera_2_frame_rdf = apply_transform(
+        point_world_frame_rdf, invert_transform(img_b_pose)
+    )
+
+    vec2 = K.dot(point_camera_2_frame_rdf)
+    return (vec2[0] / vec2[2], vec2[1] / vec2[2], vec2[2])
+
+
+def find_pixel_correspondence_for_frames(
+    img_a_depth, img_a_pose, img_b_depth, img_b_pose, uv_a, K
+):
+    """
+    Finds the match of a single pixel, with the three tests of
+    correspondence_finder.batch_find_pixel_correspondences: the pixel has a
+    depth return in image a, it lands inside of image b and it is not occluded
+    in image b (OcclusionMode.NEAREST)
+    :return: (u2, v2) in image b, None if the pixel has no match
+    :rtype: tuple of floats
+    """
+    projection = reproject_pixel(img_a_depth, img_a_pose, img_b_pose, uv_a, K)
+    if projection is None:
+        return None
+    u2, v2, z2 = projection
+
+    image_height, image_width = img_b_depth.shape
+    epsilon = 1e-3
+    if not (0 < u2 <= image_width - epsilon and 0 < v2 <= image_height - epsilon):
+        return None
+
+    depth2 = img_b_depth[int(v2), int(u2)] * 1.0 / constants.DEPTH_IM_SCALE
+    if depth2 == 0 or depth2 < z2 - OCCLUSION_MARGIN:
+        return None
+    return (u2, v2)
+
+
+def find_pixel_correspondences_for_frames(
+    img_a_depth, img_a_pose, img_b_depth, img_b_pose, uv_a_list, K
+):
+    """
+    find_pixel_correspondence_for_frames() for each of uv_a_list
+    :return: uv_a, uv_b of the pixels that have a match, as float64 arrays
+    :rtype: (numpy.ndarray, numpy.ndarray), (numpy.ndarray, numpy.ndarray)
+    """
+    matched = []
+    uv_b = []
+    for uv_a in uv_a_list:
+        match = find_pixel_correspondence_for_frames(
+            img_a_depth, img_a_pose, img_b_depth, img_b_pose, uv_a, K
+        )
+        if match is not None:
+            matched.append(uv_a)
+            uv_b.append(match)
+    matched = np.array(matched, dtype=np.int64).reshape(-1, 2)
+    uv_b = np.array(uv_b, dtype=np.float64).reshape(-1, 2)
+    return (matched[:, 0], matched[:, 1]), (uv_b[:, 0], uv_b[:, 1])
 
-def rand_select_pixel(width,height):
-    x = random.randint(0,width)
-    y = random.randint(0,height)
-    return (x,y)
 
 def find_pixel_correspondence(log_dir, img_a, img_b, uv_a=None):
-    img1_filename = log_dir+"/images/"+img_a+"_rgb.png"
-    img2_filename = log_dir+"/images/"+img_b+"_rgb.png"
-    img1_depth_filename = log_dir+"/images/"+img_a+"_depth.png"
-    img2_depth_filename = log_dir+"/images/"+img_b+"_depth.png"
-    img1_time_filename = log_dir+"/images/"+img_a+"_utime.txt"
-    img2_time_filename = log_dir+"/images/"+img_b+"_utime.txt"
+    """
+    Reprojects a pixel of image a into image b of a LabelFusion log, without
+    any of the pruning tests
+    :param log_dir: LabelFusion log directory
+    :param img_a, img_b: image names, e.g. "0000000001"
+    :param uv_a: pixel of image a, random if None
+    :return: (uv_a, uv_b)
+    :rtype: tuple
+    """
+    img1_depth_filename = log_dir + "/images/" + img_a + "_depth.png"
+    img1_time_filename = log_dir + "/images/" + img_a + "_utime.txt"
+    img2_time_filename = log_dir + "/images/" + img_b + "_utime.txt"
 
     def get_time(time_filename):
-        with open (time_filename) as f:
+        with open(time_filename) as f:
             content = f.readlines()
-        return int(content[0])/1e6
+        return int(content[0]) / 1e6
 
     img1_time = get_time(img1_time_filename)
     img2_time = get_time(img2_time_filename)
 
-    posegraph_filename = log_dir+"/posegraph.posegraph"
+    posegraph_filename = log_dir + "/posegraph.posegraph"
     with open(posegraph_filename) as f:
         content = f.readlines()
-    pose_list = [x.strip().split() for x in content] 
+    pose_list = [x.strip().split() for x in content]
 
     def get_pose(time, pose_list):
-        if (time <= float(pose_list[0][0])):
+        if time <= float(pose_list[0][0]):
             pose = pose_list[0]
             pose = [float(x) for x in pose[1:]]
             return pose
         for pose in pose_list:
-            if (time <= float(pose[0])):
+            if time <= float(pose[0]):
                 pose = [float(x) for x in pose[1:]]
                 return pose
-        print "did not find matching pose"
+        print("did not find matching pose")
 
     img1_pose = get_pose(img1_time, pose_list)
     img2_pose = get_pose(img2_time, pose_list)
 
-    _EPS = numpy.finfo(float).eps * 4.0
-    def quaternion_matrix(quaternion):
-        q = numpy.array(quaternion, dtype=numpy.float64, copy=True)
-        n = numpy.dot(q, q)
-        if n < _EPS:
-            return numpy.identity(4)
-        q *= math.sqrt(2.0 / n)
-        q = numpy.outer(q, q)
-        return numpy.array([
-            [1.0-q[2, 2]-q[3, 3],     q[1, 2]-q[3, 0],     q[1, 3]+q[2, 0], 0.0],
-            [    q[1, 2]+q[3, 0], 1.0-q[1, 1]-q[3, 3],     q[2, 3]-q[1, 0], 0.0],
-            [    q[1, 3]-q[2, 0],     q[2, 3]+q[1, 0], 1.0-q[1, 1]-q[2, 2], 0.0],
-            [                0.0,                 0.0,                 0.0, 1.0]])
-
-    def labelfusion_pose_to_homogeneous_transform(lf_pose):
-        homogeneous_transform = quaternion_matrix([lf_pose[6], lf_pose[3], lf_pose[4], lf_pose[5]])
-        homogeneous_transform[0,3] = lf_pose[0]
-        homogeneous_transform[1,3] = lf_pose[1]
-        homogeneous_transform[2,3] = lf_pose[2]
-        return homogeneous_transform
-
     img1_pose_4 = labelfusion_pose_to_homogeneous_transform(img1_pose)
     img2_pose_4 = labelfusion_pose_to_homogeneous_transform(img2_pose)
 
-    img1_depth = imageio.imread(img1_depth_filename)
+    img1_depth = np.asarray(Image.open(img1_depth_filename))
 
     if uv_a is None:
-        uv_a = rand_select_pixel(width=640,height=480)
-    print uv_a
-
-    body_to_rdf = numpy.zeros((3,3))
-    body_to_rdf[0,1] = -1.0
-    body_to_rdf[1,2] = -1.0
-    body_to_rdf[2,0] = 1.0
-    rdf_to_body = inv(body_to_rdf)
-
-    K = numpy.zeros((3,3))
-    K[0,0] = 528.0 # focal x
-    K[1,1] = 528.0 # focal y
-    K[0,2] = 320.0 # principal point x
-    K[1,2] = 240.0 # principal point y
-    K[2,2] = 1.0
-    K_inv = inv(K)
-
-    depth = img1_depth[uv_a[::-1]]*1.0/1000
-    print "depth, ", depth
-    u = uv_a[0]
-    v = uv_a[1]
-
-    x = u*depth
-    y = v*depth
-    z = depth
-    vec = numpy.array([x,y,z])
-
-    point_camera_frame_rdf = K_inv.dot(vec)
-
-    def invert_transform(transform4):
-        transform4_copy = numpy.copy(transform4)
-        R = transform4_copy[0:3,0:3]
-        R = numpy.transpose(R)
-        transform4_copy[0:3,0:3] = R
-        t = transform4_copy[0:3,3]
-        inv_t = -1.0 * numpy.transpose(R).dot(t)
-        transform4_copy[0:3,3] = inv_t
-        return transform4_copy
-
-    def apply_transform(vec3, transform4):
-        vec4 = numpy.array([vec3[0], vec3[1], vec3[2], 1.0])
-        vec4 = transform4.dot(vec4)
-        return numpy.array([vec4[0], vec4[1], vec4[2]])
-
-    point_world_frame_rdf = apply_transform(point_camera_frame_rdf, img1_pose_4)
-    point_camera_2_frame_rdf = apply_transform(point_world_frame_rdf, invert_transform(img2_pose_4))
-
-    vec2 = K.dot(point_camera_2_frame_rdf)
-    u2 = vec2[0]/vec2[2]
-    v2 = vec2[1]/vec2[2]
-    uv_b = (u2, v2)
-    print uv_b
-    return (uv_a, uv_b)
\ No newline at end of file
+        uv_a = rand_select_pixel(width=640, height=480)
+    print(uv_a)
+
+    projection = reproject_pixel(
+        img1_depth, img1_pose_4, img2_pose_4, uv_a, get_labelfusion_K_matrix()
+    )
+    if projection is None:
+        print("no depth return at", uv_a)
+        return (uv_a, None)
+
+    uv_b = projection[0:2]
+    print(uv_b)
+    return (uv_a, uv_b)
@@ -11,10 +11,12 @@ import densenets.loss_functions.loss_composer as loss_composer
 import tensorboard_logger
 import torch
 import torch.optim as optim
+from densenets.dataset.collate import collate_matches, get_payload_nbytes
 from densenets.dataset.spartan_dataset_masked import (
     SpartanDataset,
     SpartanDatasetDataType,
 )
+from densenets.dataset.streaming import SceneAffinityStream
 from densenets.evaluation.evaluation import DenseCorrespondenceEvaluation
 from densenets.loss_functions.pixelwise_contrastive_loss import PixelwiseContrastiveLoss
 from densenets.network.dense_correspondence_network import DenseCorrespondenceNetwork
@@ -29,6 +31,7 @@ class DenseCorrespondenceTraining(object):
         self._config = config
         self._dataset = dataset
         self._dataset_test = dataset_test
+        self._stream = None
 
         self._dcn = None
         self._optimizer = None
@@ -47,6 +50,14 @@ class DenseCorrespondenceTraining(object):
     def dataset(self):
         return self._dataset
 
+    @property
+    def device(self):
+        """
+        :return: the device to train on, set by device in training.yaml
+        :rtype: torch.device
+        """
+        return torch.device(self._config['training'].get('device', 'cuda'))
+
     @dataset.setter
     def dataset(self, value):
         self._dataset = value
@@ -68,13 +79,35 @@ class DenseCorrespondenceTraining(object):
         self._dataset.load_all_pose_data()
         self._dataset.set_parameters_from_training_config(self._config)
 
-        self._data_loader = torch.utils.data.DataLoader(
-            self._dataset,
-            batch_size=batch_size,
-            shuffle=True,
-            num_workers=num_workers,
-            drop_last=True,
-        )
+        # in streaming mode the workers decode a working set of frames per
+        # scene and draw many pairs from it, see densenets/dataset/streaming.py
+        self._stream = None
+        if self._config['training'].get('streaming', False):
+            self._stream = SceneAffinityStream(
+                self._dataset,
+                frames_per_chunk=self._config['training'].get(
+                    'streaming_frames_per_chunk', 32
+                ),
+                pairs_per_decode=self._config['training'].get(
+                    'streaming_pairs_per_decode', 4
+                ),
+            )
+            self._data_loader = torch.utils.data.DataLoader(
+                self._stream,
+                batch_size=batch_size,
+                num_workers=num_workers,
+                drop_last=True,
+                collate_fn=collate_matches,
+            )
+        else:
+            self._data_loader = torch.utils.data.DataLoader(
+                self._dataset,
+                batch_size=batch_size,
+                shuffle=True,
+                num_workers=num_workers,
+                drop_last=True,
+                collate_fn=collate_matches,
+            )
 
         # create a test dataset
         if self._config["training"]["compute_test_loss"]:
@@ -92,6 +125,7 @@ class DenseCorrespondenceTraining(object):
                 shuffle=True,
                 num_workers=2,
                 drop_last=True,
+                collate_fn=collate_matches,
             )
 
     def load_dataset_from_config(self, config):
@@ -114,7 +148,9 @@ class DenseCorrespondenceTraining(object):
         """
 
         return DenseCorrespondenceNetwork.from_config(
-            self._config['dense_correspondence_network'], load_stored_params=False
+            self._config['dense_correspondence_network'],
+            load_stored_params=False,
+            device=self.device,
         )
 
     def _construct_optimizer(self, parameters):
@@ -187,12 +223,16 @@ class DenseCorrespondenceTraining(object):
         optim_param_file = os.path.join(model_folder, optim_param_file)
 
         self._dcn = self.build_network()
-        self._dcn.load_state_dict(torch.load(model_param_file))
-        self._dcn.cuda()
+        self._dcn.load_state_dict(
+            torch.load(model_param_file, map_location=self.device)
+        )
+        self._dcn.to(self.device)
         self._dcn.train()
 
         self._optimizer = self._construct_optimizer(self._dcn.parameters())
-        self._optimizer.load_state_dict(torch.load(optim_param_file))
+        self._optimizer.load_state_dict(
+            torch.load(optim_param_file, map_location=self.device)
+        )
 
         return iteration
 
@@ -237,16 +277,22 @@ class DenseCorrespondenceTraining(object):
             if self._optimizer is None:
                 raise ValueError("you must set self._optimizer if use_pretrained=True")
 
-        # make sure network is using cuda and is in train mode
+        # make sure network is on the training device and is in train mode
+        device = self.device
         dcn = self._dcn
-        dcn.cuda()
+        dcn.to(device)
         dcn.train()
 
         optimizer = self._optimizer
         batch_size = self._data_loader.batch_size
 
+        # with random crops the network runs on images of the crop size
+        image_shape = dcn.image_shape
+        if self._dataset.pair_crop is not None:
+            image_shape = self._dataset.pair_crop.image_shape
+
         pixelwise_contrastive_loss = PixelwiseContrastiveLoss(
-            image_shape=dcn.image_shape, config=self._config['loss_function']
+            image_shape=image_shape, config=self._config['loss_function']
         )
         pixelwise_contrastive_loss.debug = True
 
@@ -292,6 +338,7 @@ class DenseCorrespondenceTraining(object):
                 loss_current_iteration += 1
                 start_iter = time.time()
 
+                # the index lists are (values, offsets) pairs, see collate_matches
                 (
                     match_type,
                     img_a,
@@ -312,33 +359,26 @@ class DenseCorrespondenceTraining(object):
                     print("\n empty data, continuing \n")
                     continue
 
-                data_type = metadata["type"][0]
-
-                img_a = Variable(img_a.cuda(), requires_grad=False)
-                img_b = Variable(img_b.cuda(), requires_grad=False)
-
-                matches_a = Variable(matches_a.cuda().squeeze(0), requires_grad=False)
-                matches_b = Variable(matches_b.cuda().squeeze(0), requires_grad=False)
-                masked_non_matches_a = Variable(
-                    masked_non_matches_a.cuda().squeeze(0), requires_grad=False
-                )
-                masked_non_matches_b = Variable(
-                    masked_non_matches_b.cuda().squeeze(0), requires_grad=False
-                )
-
-                background_non_matches_a = Variable(
-                    background_non_matches_a.cuda().squeeze(0), requires_grad=False
-                )
-                background_non_matches_b = Variable(
-                    background_non_matches_b.cuda().squeeze(0), requires_grad=False
-                )
-
-                blind_non_matches_a = Variable(
-                    blind_non_matches_a.cuda().squeeze(0), requires_grad=False
-                )
-                blind_non_matches_b = Variable(
-                    blind_non_matches_b.cuda().squeeze(0), requires_grad=False
-                )
+                # used for logging, the type of the first non-empty sample
+                first_sample = int(torch.nonzero(match_type != -1)[0])
+                data_type = metadata["type"][first_sample]
+
+                img_a = Variable(img_a.to(device), requires_grad=False)
+                img_b = Variable(img_b.to(device), requires_grad=False)
+
+                packed_indices = [
+                    (Variable(values.to(device), requires_grad=False), offsets)
+                    for values, offsets in [
+                        matches_a,
+                        matches_b,
+                        masked_non_matches_a,
+                        masked_non_matches_b,
+                        background_non_matches_a,
+                        background_non_matches_b,
+                        blind_non_matches_a,
+                        blind_non_matches_b,
+                    ]
+                ]
 
                 # img_a = Variable(img_a.cuda(), requires_grad=False)
                 # img_b = Variable(img_b.cuda(), requires_grad=False)
@@ -402,31 +442,29 @@ class DenseCorrespondenceTraining(object):
 
                 # run both images through the network
                 image_a_pred = dcn.forward(img_a)
-                image_a_pred = dcn.process_network_output(image_a_pred, batch_size)
+                image_a_pred = dcn.process_network_output(
+                    image_a_pred, batch_size, image_shape=image_shape
+                )
 
                 image_b_pred = dcn.forward(img_b)
-                image_b_pred = dcn.process_network_output(image_b_pred, batch_size)
+                image_b_pred = dcn.process_network_output(
+                    image_b_pred, batch_size, image_shape=image_shape
+                )
 
-                # get loss
+                # get loss, averaged over the non-empty samples of the batch
                 (
                     loss,
                     match_loss,
                     masked_non_match_loss,
                     background_non_match_loss,
                     blind_non_match_loss,
-                ) = loss_composer.get_loss(
+                    _,
+                ) = loss_composer.get_batch_loss(
                     pixelwise_contrastive_loss,
                     match_type,
                     image_a_pred,
                     image_b_pred,
-                    matches_a,
-                    matches_b,
-                    masked_non_matches_a,
-                    masked_non_matches_b,
-                    background_non_matches_a,
-                    background_non_matches_b,
-                    blind_non_matches_a,
-                    blind_non_matches_b,
+                    packed_indices,
                 )
 
                 loss.backward()
@@ -581,6 +619,32 @@ class DenseCorrespondenceTraining(object):
 
                     logging.info("single iteration took %.3f seconds" % (elapsed))
 
+                    frame_cache_stats = self._dataset.get_frame_cache_stats()
+                    if frame_cache_stats is not None:
+                        logging.info(
+                            "frame cache hit rate %.3f (%d hits, %d misses, %d evictions)"
+                            % (
+                                frame_cache_stats['hit_rate'],
+                                frame_cache_stats['hits'],
+                                frame_cache_stats['misses'],
+                                frame_cache_stats['evictions'],
+                            )
+                        )
+
+                    if self._stream is not None:
+                        self._stream.log_stats()
+
+                    # what the DataLoader workers hand over per batch
+                    payload = get_payload_nbytes(data)
+                    logging.info(
+                        "batch payload %.2f MB (images %.2f MB, indices %.2f MB)"
+                        % (
+                            payload['total'] / 1e6,
+                            payload['images'] / 1e6,
+                            payload['indices'] / 1e6,
+                        )
+                    )
+
                     percent_complete = (
                         loss_current_iteration
                         * 100.0
@@ -169,6 +169,33 @@ def normalize(tensor, mean, std):
     return tensor
 
 
+def to_normalized_tensor(pic, mean, std):
+    """Convert a ``numpy.ndarray`` (H x W x C) uint8 image to a normalized
+    float tensor (C x H x W).
+
+    Same result as ``normalize(to_tensor(pic), mean, std)``, but the image is
+    written once into a single float buffer. pic may be any strided view, such
+    as a flipped image, which ``torch.from_numpy`` would have to copy first.
+
+    Args:
+        pic (numpy.ndarray): uint8 image to be converted to tensor.
+        mean (sequence): Sequence of means for each channel.
+        std (sequence): Sequence of standard deviations for each channel.
+
+    Returns:
+        Tensor: Converted and normalized image.
+    """
+    if not(_is_numpy_image(pic) and pic.ndim == 3):
+        raise TypeError('pic should be an H x W x C ndarray. Got {}'.format(type(pic)))
+
+    img = np.empty((pic.shape[2], pic.shape[0], pic.shape[1]), dtype=np.float32)
+    for c in range(pic.shape[2]):
+        np.copyto(img[c], pic[:, :, c], casting='unsafe')
+    img = torch.from_numpy(img)
+    img.div_(255)
+    return normalize(img, mean, std)
+
+
 def resize(img, size, interpolation=Image.BILINEAR):
     """Resize the input PIL Image to the given size.
 
@@ -15,7 +15,7 @@ import warnings
 
 from . import functional as F
 
-__all__ = ["Compose", "ToTensor", "ToPILImage", "Normalize", "Resize", "Scale", "CenterCrop", "Pad",
+__all__ = ["Compose", "ToTensor", "ToPILImage", "Normalize", "ToNormalizedTensor", "Resize", "Scale", "CenterCrop", "Pad",
            "Lambda", "RandomApply", "RandomChoice", "RandomOrder", "RandomCrop", "RandomHorizontalFlip",
            "RandomVerticalFlip", "RandomResizedCrop", "RandomSizedCrop", "FiveCrop", "TenCrop", "LinearTransformation",
            "ColorJitter", "RandomRotation", "RandomAffine", "Grayscale", "RandomGrayscale"]
@@ -146,6 +146,36 @@ class Normalize(object):
         return self.__class__.__name__ + '(mean={0}, std={1})'.format(self.mean, self.std)
 
 
+class ToNormalizedTensor(object):
+    """Convert a uint8 ``numpy.ndarray`` (H x W x C), which may be a strided
+    view, to a normalized torch.FloatTensor of shape (C x H x W).
+
+    Same as ``Compose([ToTensor(), Normalize(mean, std)])`` for numpy arrays,
+    without the intermediate copies.
+
+    Args:
+        mean (sequence): Sequence of means for each channel.
+        std (sequence): Sequence of standard deviations for each channel.
+    """
+
+    def __init__(self, mean, std):
+        self.mean = mean
+        self.std = std
+
+    def __call__(self, pic):
+        """
+        Args:
+            pic (numpy.ndarray): Image to be converted to tensor.
+
+        Returns:
+            Tensor: Converted and normalized image.
+        """
+        return F.to_normalized_tensor(pic, self.mean, self.std)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(mean={0}, std={1})'.format(self.mean, self.std)
+
+
 class Resize(object):
     """Resize the input PIL Image to the given size.
 